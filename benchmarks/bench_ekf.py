@@ -0,0 +1,54 @@
+"""
+Benchmarks for the hot path of the extended kalman filter
+
+Run from the benchmarks directory with
+python -m pytest bench_ekf.py
+"""
+
+from synthetic_data import create_basis_list, create_measurement_model,\
+    create_ekf, create_measurements
+
+import numpy as np
+import pytest
+
+
+time_step = 1/150
+
+
+@pytest.mark.benchmark(group='MeasurementModel.evaluate_dh_func')
+@pytest.mark.parametrize("jacobean_method", ['analytic', 'numerical'])
+@pytest.mark.parametrize("calculate_output_derivative", [True, False])
+def bench_evaluate_dh_func(benchmark, jacobean_method,
+                           calculate_output_derivative):
+    measurement_model = create_measurement_model(create_basis_list(),
+        calculate_output_derivative, jacobean_method)
+    state = np.array([[0.3, 1.1, 1.3, 0.5]]).T
+
+    H = benchmark(measurement_model.evaluate_dh_func, state)
+
+    assert H.shape == (len(measurement_model.output_names), state.shape[0])
+
+
+@pytest.mark.benchmark(group='Extended_Kalman_Filter.calculate_next_estimates')
+@pytest.mark.parametrize("covariance_update",
+                         ['standard', 'joseph', 'square_root'])
+@pytest.mark.parametrize("heteroschedastic_model", [True, False])
+def bench_ekf_step(benchmark, covariance_update, heteroschedastic_model):
+    measurement_model = create_measurement_model(create_basis_list())
+    ekf = create_ekf(measurement_model, covariance_update=covariance_update,
+                     heteroschedastic_model=heteroschedastic_model)
+
+    #Cycle through a few strides of measurements so that the filter stays
+    # close to the true state while it is benchmarked
+    _, measurements = create_measurements(measurement_model, 1500)
+    measurements = measurements[:,:,np.newaxis]
+    step = iter(range(10**9))
+
+    def calculate_next_estimates():
+        measurement = measurements[next(step) % measurements.shape[0]]
+        return ekf.calculate_next_estimates(time_step, measurement)
+
+    state, covariance = benchmark(calculate_next_estimates)
+
+    assert np.all(np.isfinite(state))
+    assert np.all(np.isfinite(covariance))
@@ -0,0 +1,53 @@
+"""
+Benchmarks for the evaluation of the kronecker models
+
+Run from the benchmarks directory with
+python -m pytest bench_k_model.py
+"""
+
+from context import model_definition
+from model_definition.k_model import KroneckerModel
+
+from synthetic_data import BASIS_TYPES, create_basis_list, create_states,\
+    create_personal_model
+
+import pytest
+
+
+#Batch sizes for one ekf step, one stride and one chunk of the fitter
+batch_sizes = [1, 150, 10000]
+
+
+@pytest.mark.benchmark(group='KroneckerModel.evaluate')
+@pytest.mark.parametrize("batch_size", batch_sizes)
+@pytest.mark.parametrize("basis_type", list(BASIS_TYPES))
+def bench_k_model_evaluate(benchmark, basis_type, batch_size):
+    k_model = KroneckerModel(create_basis_list(basis_type))
+    states = create_states(batch_size)
+
+    output = benchmark(k_model.evaluate, states)
+
+    assert output.shape == (batch_size, k_model.get_output_size())
+
+
+@pytest.mark.benchmark(group='KroneckerModel.evaluate workspace')
+@pytest.mark.parametrize("batch_size", batch_sizes)
+def bench_k_model_evaluate_workspace(benchmark, batch_size):
+    k_model = KroneckerModel(create_basis_list())
+    k_model.set_workspace_mode(True)
+    states = create_states(batch_size)
+
+    output = benchmark(k_model.evaluate, states)
+
+    assert output.shape == (batch_size, k_model.get_output_size())
+
+
+@pytest.mark.benchmark(group='PersonalMeasurementFunction.evaluate')
+@pytest.mark.parametrize("batch_size", batch_sizes)
+def bench_personal_measurement_function_evaluate(benchmark, batch_size):
+    personal_model = create_personal_model(create_basis_list())
+    states = create_states(batch_size)
+
+    output = benchmark(personal_model.evaluate, states)
+
+    assert output.shape == (batch_size, personal_model.num_kmodels)
@@ -0,0 +1,85 @@
+"""
+Benchmarks for fitting the kronecker models and calculating the 
+personalization maps
+
+These use large datasets, so they run a fixed amount of rounds
+
+Run from the benchmarks directory with
+python -m pytest bench_model_fitting.py
+"""
+
+from context import model_definition
+from model_definition.k_model import KroneckerModel
+from model_fitting.k_model_fitting import KModelFitter
+from model_fitting.parallel_fitting import ParallelKModelFitter
+from model_fitting.cross_validation import LeaveOneOutCrossValidator
+
+from synthetic_data import OUTPUT_NAMES, create_basis_list, \
+    create_dataframe, create_subject_data_list
+
+import numpy as np
+import pytest
+
+
+#Smaller than the ekf model so that 10^6 rows fit in a few seconds
+fitting_basis_list = create_basis_list(phase_n=6)
+
+
+@pytest.mark.benchmark(group='KModelFitter.calculate_regressor')
+@pytest.mark.parametrize("num_datapoints", [10**5, 10**6])
+def bench_calculate_regressor(benchmark, num_datapoints):
+    k_model = KroneckerModel(fitting_basis_list)
+    data = create_dataframe(num_datapoints)
+
+    RTR, RTy, yTR, yTy = benchmark.pedantic(KModelFitter().calculate_regressor,
+        args=(k_model, data, OUTPUT_NAMES[0]), rounds=3, iterations=1)
+
+    assert RTR.shape == (k_model.get_output_size(), k_model.get_output_size())
+
+
+@pytest.mark.benchmark(group='KModelFitter.calculate_regressor_multi')
+@pytest.mark.parametrize("num_datapoints", [10**5, 10**6])
+def bench_calculate_regressor_multi(benchmark, num_datapoints):
+    k_model = KroneckerModel(fitting_basis_list)
+    data = create_dataframe(num_datapoints)
+
+    RTR, RTY, YTR, YTY = benchmark.pedantic(
+        KModelFitter().calculate_regressor_multi,
+        args=(k_model, data, OUTPUT_NAMES), rounds=3, iterations=1)
+
+    assert RTY.shape == (k_model.get_output_size(), len(OUTPUT_NAMES))
+
+
+#PersonalizedKModelFactory.generate_personalized_model can't be imported in
+# this tree, so the same stages are benchmarked with the classes that
+# replaced them: one regressor pass per subject, the pca of the fits in 
+# the orthonormal space and the gait fingerprint least squares
+@pytest.mark.benchmark(group='generate personalized model')
+@pytest.mark.parametrize("num_subjects", [5, 10])
+def bench_generate_personalized_model(benchmark, num_subjects):
+    k_model = KroneckerModel(create_basis_list())
+    subject_data_list = create_subject_data_list(num_subjects, 10**4)
+
+    def generate_personalized_model():
+        validator = LeaveOneOutCrossValidator.from_data(k_model,
+            subject_data_list, OUTPUT_NAMES, num_processes=1)
+        return validator.cross_validate(num_pca_vectors=2)
+
+    result = benchmark.pedantic(generate_personalized_model, rounds=3,
+                                iterations=1)
+
+    assert np.all(np.isfinite(result.gait_fingerprint_rmse))
+
+
+@pytest.mark.benchmark(group='ParallelKModelFitter.fit_subjects')
+@pytest.mark.parametrize("num_processes", [1, 4])
+def bench_fit_subjects(benchmark, num_processes):
+    k_model = KroneckerModel(fitting_basis_list)
+    subject_data_list = create_subject_data_list(10, 10**5)
+    fitter = ParallelKModelFitter(num_processes)
+
+    results = benchmark.pedantic(fitter.fit_subjects,
+        args=(k_model, subject_data_list, OUTPUT_NAMES), rounds=3,
+        iterations=1)
+
+    assert len(results) == len(subject_data_list)
@@ -0,0 +1,13 @@
+import os, sys
+
+#Add the kmodel directory so that model_definition can be imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), 
+                                                '../kmodel/')))
+
+#Add the repository root so that the ekf and utils packages can be imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), 
+                                                '../')))
+
+#Import the relevant modules
+import model_definition
+import model_fitting
@@ -0,0 +1,95 @@
+"""
+Micro-benchmark that compares the default kronecker model evaluation against
+the evaluation with pre-allocated workspaces
+
+Run with 
+python benchmarks/k_model_workspace_benchmark.py
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+
+import timeit
+import tracemalloc
+import numpy as np
+
+
+#Same shape of basis that is used in the ekf
+basis_list = [FourierBasis(20,'phase'), PolynomialBasis(2,'phase_dot'),
+              PolynomialBasis(2,'stride_length'), PolynomialBasis(2,'ramp')]
+
+#Batch sizes to test
+batch_sizes = [1, 150, 100000]
+
+#Derivatives that the measurement model uses for the jacobean
+derivative_list = [(0,0,0,0), (1,0,0,0), (0,1,0,0), (0,0,1,0), (0,0,0,1)]
+
+
+def time_call(function, batch_size):
+    """
+    Returns the time per call in nano seconds
+    """
+    #Get at least ~0.2 seconds of measurements
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    best_time = min(timer.repeat(repeat=5, number=number))
+    return best_time/number*1e9
+
+
+def bytes_allocated(function):
+    """
+    Returns the peak amount of bytes allocated in one call after warming up
+
+    This includes the temporary buffers that numpy uses internally for 
+    broadcasting ufuncs, which are released before the call returns
+    """
+    function()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+
+    rng = np.random.default_rng(0)
+
+    default_model = KroneckerModel(basis_list)
+    workspace_model = KroneckerModel(basis_list)
+    workspace_model.set_workspace_mode(True)
+
+    print(f"Output size {default_model.get_output_size()}")
+    print(f"{'test':<25}{'batch':>8}{'default ns':>15}{'workspace ns':>15}"
+          f"{'speedup':>10}{'peak temp bytes':>18}")
+
+    for batch_size in batch_sizes:
+        data = np.column_stack([rng.uniform(0,1,batch_size),
+                                rng.uniform(0.6,1.4,batch_size),
+                                rng.uniform(0.8,1.6,batch_size),
+                                rng.uniform(-10,10,batch_size)])
+
+        tests = {
+            'evaluate':
+                (lambda: default_model.evaluate(data),
+                 lambda: workspace_model.evaluate(data)),
+            'partial_derivatives':
+                (lambda: default_model.evaluate_partial_derivatives(data,
+                    derivative_list),
+                 lambda: workspace_model.evaluate_partial_derivatives(data,
+                    derivative_list)),
+        }
+
+        for test_name, (default_call, workspace_call) in tests.items():
+            default_ns = time_call(default_call, batch_size)
+            workspace_ns = time_call(workspace_call, batch_size)
+            workspace_bytes = bytes_allocated(workspace_call)
+
+            print(f"{test_name:<25}{batch_size:>8}{default_ns:>15.0f}"
+                  f"{workspace_ns:>15.0f}{default_ns/workspace_ns:>10.2f}"
+                  f"{workspace_bytes:>18}")
+
+
+if __name__ == '__main__':
+    main()
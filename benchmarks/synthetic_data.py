@@ -0,0 +1,156 @@
+"""
+Synthetic data generators for the benchmarks so that they do not need any
+dataset files
+
+The data has the same columns and ranges as the flattened dataport dataset
+and the models have random fits with the same shapes that are used in the
+ekf
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis,\
+    LegendreBasis, ChebyshevBasis, HermiteBasis
+from model_definition.fitted_model import SimpleFitModel
+from model_definition.personal_measurement_function import \
+    PersonalMeasurementFunction
+from ekf.measurement_model import MeasurementModel
+from ekf.dynamic_model import GaitDynamicModel
+from ekf.ekf import Extended_Kalman_Filter
+
+import numpy as np
+import pandas as pd
+
+
+#States of the ekf, in the order that the models take them
+STATE_NAMES = ['phase', 'phase_dot', 'stride_length', 'ramp']
+
+#Range of every state in the dataset
+STATE_RANGES = {'phase': (0, 1),
+                'phase_dot': (0.6, 1.4),
+                'stride_length': (0.8, 1.6),
+                'ramp': (-10, 10)}
+
+#Outputs that the ekf uses
+OUTPUT_NAMES = ['jointangles_thigh_x', 'jointangles_shank_x',
+                'jointangles_foot_x']
+
+#Basis types for the non-periodic states
+BASIS_TYPES = {'polynomial': PolynomialBasis, 'legendre': LegendreBasis,
+               'chebyshev': ChebyshevBasis, 'hermite': HermiteBasis}
+
+
+def create_basis_list(basis_type='polynomial', phase_n=20, n=2):
+    """
+    Create a basis list with the same shape that is used in the ekf. Phase
+    always uses a fourier basis
+
+    Keyword Arguments:
+    basis_type -- key of BASIS_TYPES used for the rest of the states
+    phase_n -- order of the fourier basis
+    n -- order of the rest of the basis
+    """
+    basis_class = BASIS_TYPES[basis_type]
+    return [FourierBasis(phase_n, 'phase')] \
+        + [basis_class(n, state_name) for state_name in STATE_NAMES[1:]]
+
+
+def create_states(num_datapoints, seed=0):
+    """
+    Create random states with shape (num_datapoints, num_states)
+    """
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(*STATE_RANGES[state_name],
+                                        num_datapoints)
+                            for state_name in STATE_NAMES])
+
+
+def create_dataframe(num_datapoints, output_names=OUTPUT_NAMES, seed=0):
+    """
+    Create a dataframe with the states and outputs of the dataset. The
+    outputs are smooth functions of the states plus noise so that the fits
+    are well conditioned
+    """
+    rng = np.random.default_rng(seed)
+    states = create_states(num_datapoints, seed)
+    data = pd.DataFrame(states, columns=STATE_NAMES)
+
+    for i, output_name in enumerate(output_names):
+        data[output_name] = np.sin(2*np.pi*(data['phase'] + 0.1*i)) \
+            * data['stride_length'] + 0.01*data['ramp'] \
+            + rng.normal(scale=0.05, size=num_datapoints)
+
+    return data
+
+
+def create_subject_data_list(num_subjects, num_datapoints,
+                             output_names=OUTPUT_NAMES):
+    """
+    Create a list of (subject_name, dataframe) with different data per
+    subject
+    """
+    return [(f"AB{i+1:02}", create_dataframe(num_datapoints, output_names,
+                                             seed=i))
+            for i in range(num_subjects)]
+
+
+def create_personal_model(basis_list, output_names=OUTPUT_NAMES, seed=0):
+    """
+    Create a PersonalMeasurementFunction with random fits
+    """
+    rng = np.random.default_rng(seed)
+    output_size = np.prod([basis.size for basis in basis_list])
+    models = [SimpleFitModel(basis_list, rng.normal(size=(1,output_size)),
+                             output_name)
+              for output_name in output_names]
+    return PersonalMeasurementFunction(models, list(output_names), 'AB01')
+
+
+def create_measurement_model(basis_list, calculate_output_derivative=True,
+                             jacobean_method='analytic'):
+    """
+    Create a MeasurementModel with random fits
+    """
+    return MeasurementModel(create_personal_model(basis_list),
+                            calculate_output_derivative,
+                            jacobean_method=jacobean_method)
+
+
+def create_ekf(measurement_model, **kwargs):
+    """
+    Create an Extended_Kalman_Filter with the same tuning shape as the
+    simulations
+    """
+    num_outputs = len(measurement_model.output_names)
+
+    initial_state = np.array([[0.0, 1.0, 1.2, 0.0]]).T
+    initial_covariance = np.diag([1e-3, 1e-3, 1e-3, 1e-2])
+    process_noise = np.diag([0, 1e-4, 1e-5, 1e-3])
+    observation_noise = np.eye(num_outputs)
+    lower_limit = np.array([[-np.inf, 0.0, 0.0, -10]]).T
+    upper_limit = np.array([[np.inf, 2.0, 2.0, 10]]).T
+
+    return Extended_Kalman_Filter(initial_state, initial_covariance,
+                                  GaitDynamicModel(), process_noise,
+                                  measurement_model, observation_noise,
+                                  lower_state_limit=lower_limit,
+                                  upper_state_limit=upper_limit, **kwargs)
+
+
+def create_measurements(measurement_model, num_steps, time_step=1/150,
+                        seed=0):
+    """
+    Create noisy measurements of a subject walking at a constant speed
+
+    Returns:
+    states -- true states with shape (num_steps, num_states)
+    measurements -- measurements with shape (num_steps, num_measurements)
+    """
+    rng = np.random.default_rng(seed)
+    states = np.tile([0.0, 1.1, 1.3, 0.5], (num_steps, 1))
+    states[:,0] = (np.arange(num_steps) * 1.1 * time_step) % 1
+
+    measurements = np.stack([measurement_model.evaluate_h_func(
+        state.reshape(-1,1))[:,0] for state in states])
+    measurements += rng.normal(scale=0.1, size=measurements.shape)
+
+    return states, measurements
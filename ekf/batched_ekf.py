@@ -0,0 +1,509 @@
+"""
+This file defines an extended kalman filter that advances many independent
+filters at the same time with vectorized numpy operations
+
+This is meant for parameter sweeps where the same sensor stream is filtered
+with different process and observation noise matrices
+"""
+
+#Standard Imports
+import numpy as np
+
+#Import from same folder
+from .measurement_model import MeasurementModel
+from .dynamic_model import GaitDynamicModel
+
+#Get relative imports
+from .context import math_utils
+
+#Use the same names for the covariance update methods
+from .ekf import Extended_Kalman_Filter
+
+
+class BatchedExtendedKalmanFilter:
+
+    #Methods to update the covariance
+    STANDARD_UPDATE = Extended_Kalman_Filter.STANDARD_UPDATE
+    JOSEPH_UPDATE = Extended_Kalman_Filter.JOSEPH_UPDATE
+    SQUARE_ROOT_UPDATE = Extended_Kalman_Filter.SQUARE_ROOT_UPDATE
+
+    #Noise attributes whose cholesky factors are cached
+    NOISE_NAMES = Extended_Kalman_Filter.NOISE_NAMES
+
+    def __init__(self, initial_states: np.ndarray,
+                 initial_covariances: np.ndarray,
+                 dynamic_model: GaitDynamicModel, process_noise: np.ndarray,
+                 measurement_model: MeasurementModel,
+                 observation_noise: np.ndarray,
+                 output_model: MeasurementModel = None,
+                 lower_state_limit: np.ndarray = None,
+                 upper_state_limit: np.ndarray = None,
+                 heteroschedastic_model: bool = False,
+                 covariance_update: str = JOSEPH_UPDATE,
+                 repair_covariance: bool = False):
+        """
+        Create the batched extended kalman filter object
+
+        Every parameter can be shared between all the filters or be defined
+        per filter
+
+        Keyword Arguments
+        initial_states -- initial state of every filter as row vectors
+            shape(num_filters, num_states)
+
+        initial_covariances -- initial covariance of the filters
+            shape(num_states, num_states) or
+            shape(num_filters, num_states, num_states)
+
+        dynamic_model -- Dynamic model that generates the predicted states
+
+        process_noise -- noise that is applied to the dynamic model
+            shape(num_states, num_states) or
+            shape(num_filters, num_states, num_states)
+
+        measurement_model -- Measurement model that generates the expected
+            measurements for a predicted state. The measurements and
+            jacobeans are calculated with MeasurementModel.analytic_evaluation
+
+        observation_noise -- Noise that is applied to the measurement model
+            shape(num_measurements, num_measurements) or
+            shape(num_filters, num_measurements, num_measurements)
+
+        output_model -- Optional, calculates an output based
+            on the current states
+
+        lower_state_limit -- sets a lower bound on the states of the system
+            shape(num_states, 1) or shape(num_filters, num_states)
+
+        upper_state_limit -- sets an upper bound on the states of the system
+            shape(num_states, 1) or shape(num_filters, num_states)
+
+        heteroschedastic_model -- Use the measurement model heteroshedastic
+            model
+
+        covariance_update -- 'standard', 'joseph' or 'square_root'. Same as
+            in Extended_Kalman_Filter
+
+        repair_covariance -- if a covariance fails the positive definite 
+            check, replace it with the nearest PD matrix instead of raising
+            AssertionError. Only the filters that failed are repaired
+        """
+
+        if covariance_update not in (self.STANDARD_UPDATE, self.JOSEPH_UPDATE,
+                                     self.SQUARE_ROOT_UPDATE):
+            raise ValueError(f"Unknown covariance update {covariance_update}")
+
+        if initial_states.ndim != 2:
+            raise ValueError("Initial states must have shape "
+                             f"(num_filters, num_states), got {initial_states.shape}")
+
+        self.num_filters, self.num_states = initial_states.shape
+
+        #Assign internal variables
+        self.dynamic_model = dynamic_model
+        self.measurement_model = measurement_model
+        self.x = initial_states.astype(float)
+        self.P = self._per_filter_matrix(initial_covariances,
+                                         "Initial covariance")
+        self.Q = self._per_filter_matrix(process_noise, "Process noise")
+        self.R = self._per_filter_matrix(observation_noise,
+                                         "Observation noise")
+        self.num_measurements = self.R.shape[1]
+        self.heteroschedastic_model = heteroschedastic_model
+        self.covariance_update = covariance_update
+        self.repair_covariance = repair_covariance
+
+        #Same heteroschedastic scaling as Extended_Kalman_Filter
+        self.R_h = np.copy(self.R)
+        self.R_h[:,:3,:3] *= 20
+        self.R_h[:,3:,3:] *= 100
+
+        #Optional, output model
+        self.output_model = output_model
+
+        #Calculate output based on initial conditions if it is defined
+        if self.output_model is not None:
+            self.output, _ = self.output_model.analytic_evaluation(self.x,
+                calculate_jacobean=False)
+        else:
+            self.output = None
+
+        #Set saturation limits
+        #upper limit of infinity
+        if (upper_state_limit is not None):
+            self.upper_state_limit = self._per_filter_limit(upper_state_limit,
+                                                            "Upper state limit")
+        else:
+            self.upper_state_limit = np.ones(self.x.shape) + np.inf
+        #lower limit of minus infinity
+        if (lower_state_limit is not None):
+            self.lower_state_limit = self._per_filter_limit(lower_state_limit,
+                                                            "Lower state limit")
+        else:
+            self.lower_state_limit = np.ones(self.x.shape) - np.inf
+
+        #Identity used in the covariance update
+        self.I = np.eye(self.num_states)
+
+        #Cholesky factors of the noise matrices, keyed by the attribute name
+        self._sqrt_cache = {}
+
+        #Amount of failed positive definite checks of every filter when
+        # the covariances are repaired
+        self.pd_failures = np.zeros(self.num_filters, dtype=np.int64)
+
+        #The square root update propagates the factor P = P_sqrt @ P_sqrt.T
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            self.P_sqrt = math_utils.covariance_sqrt(self.P)
+
+
+    def _per_filter_matrix(self, matrix: np.ndarray, name: str) -> np.ndarray:
+        """
+        Returns a copy of the matrix with one matrix per filter
+        shape(num_filters, size, size)
+        """
+        if matrix.ndim == 2:
+            matrix = matrix[np.newaxis]
+
+        if (matrix.ndim != 3 or matrix.shape[1] != matrix.shape[2]
+                or matrix.shape[0] not in (1, self.num_filters)):
+            raise ValueError(f"{name} has shape {matrix.shape}, expected "
+                             "(size, size) or (num_filters, size, size)")
+
+        return np.array(np.broadcast_to(matrix, (self.num_filters,)
+                                        + matrix.shape[1:]), dtype=float)
+
+
+    def _per_filter_limit(self, limit: np.ndarray, name: str) -> np.ndarray:
+        """
+        Returns a copy of the state limit with one row per filter
+        shape(num_filters, num_states)
+        """
+        if limit.shape == (self.num_states, 1):
+            limit = limit.T
+
+        if limit.shape not in ((1, self.num_states),
+                               (self.num_filters, self.num_states)):
+            raise ValueError(f"{name} has shape {limit.shape}, expected "
+                             f"({self.num_states}, 1) or "
+                             f"({self.num_filters}, {self.num_states})")
+
+        return np.array(np.broadcast_to(limit, self.x.shape), dtype=float)
+
+
+    def select_filters(self, indices: np.ndarray):
+        """
+        Keep only some of the filters, e.g. to stop running the filters of a
+        sweep that diverged. The filters keep their current estimates
+
+        Keyword Arguments
+        indices -- integer indices or boolean mask of the filters to keep
+        """
+        indices = np.arange(self.num_filters)[indices]
+
+        self.x = self.x[indices]
+        self.P = self.P[indices]
+        self.Q = self.Q[indices]
+        self.R = self.R[indices]
+        self.R_h = self.R_h[indices]
+        self.upper_state_limit = self.upper_state_limit[indices]
+        self.lower_state_limit = self.lower_state_limit[indices]
+        self.pd_failures = self.pd_failures[indices]
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            self.P_sqrt = self.P_sqrt[indices]
+        if self.output is not None:
+            self.output = self.output[indices]
+
+        self.num_filters = indices.shape[0]
+
+        #The noise matrices are new arrays
+        self._sqrt_cache = {}
+
+
+    #Getter for output
+    def get_output(self):
+        return self.output
+
+
+    #Calculate the next estimate of all the kalman filters
+    def calculate_next_estimates(self, time_step, sensor_measurements,
+                                 control_input_u=0):
+        """
+        Advance all the filters one time step
+
+        Keyword Arguments
+        time_step -- time since the last estimate
+        sensor_measurements -- measurements shared by all the filters
+            shape(num_measurements, 1) or measurements per filter
+            shape(num_filters, num_measurements)
+
+        Returns
+        updated_states -- shape(num_filters, num_states)
+        updated_covariances -- shape(num_filters, num_states, num_states)
+        """
+
+        #Perform a heteroschedastic model on the filters that are close
+        # to heel strike
+        R = self.R
+        R_sqrt = None
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            R_sqrt = self._get_sqrt(self.R)
+        if self.heteroschedastic_model:
+            heel_strike = (self.x[:,0] > 0.95) | (self.x[:,0] < 0.05)
+            heel_strike = heel_strike[:,np.newaxis,np.newaxis]
+            R = np.where(heel_strike, self.R_h, R)
+            if R_sqrt is not None:
+                R_sqrt = np.where(heel_strike, self._get_sqrt(self.R_h), 
+                                  R_sqrt)
+
+        #Run the prediction step
+        predicted_states, predicted_covariances = \
+            self.prediction_step(time_step, self.Q)
+
+        #Saturate the predicted states
+        predicted_states = np.clip(predicted_states, self.lower_state_limit,
+                                   self.upper_state_limit)
+
+        #Store predicted states for debugging purpose
+        self.predicted_states = predicted_states
+        self.predicted_covariances = predicted_covariances
+
+        #Run the measurement step
+        updated_states, updated_covariances = \
+            self.update_step(predicted_states, predicted_covariances,
+                             sensor_measurements, R, R_sqrt)
+
+        #Saturate the updated states
+        updated_states = np.clip(updated_states, self.lower_state_limit,
+                                 self.upper_state_limit)
+
+        #Store the updated states and covariances
+        self.x = updated_states
+        self.P = updated_covariances
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            self.P_sqrt = self.updated_covariances_sqrt
+
+        # Calculate the output
+        if (self.output_model is not None):
+            self.output, _ = self.output_model.analytic_evaluation(
+                updated_states, calculate_jacobean=False)
+
+        return updated_states, updated_covariances
+
+
+    def prediction_step(self, time_step, Q, control_input_u=0):
+        """
+        Predict the next states and covariances of all the filters
+        """
+        #Calculate the new step with the prediction function
+        new_states = self.dynamic_model.f_function_batch(self.x, time_step)
+
+        #Calculate the jacobian of f_function
+        F = self.dynamic_model.f_jacobean_batch(self.x, time_step)
+
+        #Get the new covariances
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            #Triangularize [F P_sqrt, Q_sqrt] for every filter
+            pre_array = np.concatenate([F @ self.P_sqrt, self._get_sqrt(Q)],
+                                       axis=2)
+            self.predicted_covariances_sqrt = np.linalg.qr(
+                pre_array.transpose(0,2,1), mode='r').transpose(0,2,1)
+            new_covariances = self.predicted_covariances_sqrt @ \
+                self.predicted_covariances_sqrt.transpose(0,2,1)
+        else:
+            new_covariances = F @ self.P @ F.transpose(0,2,1) + Q
+
+        valid = self._validate_pd(new_covariances-Q, "Updated covariance")
+        if not np.all(valid):
+            failed = ~valid
+            new_covariances[failed] = math_utils.nearest_pd(
+                new_covariances[failed] - Q[failed], "Updated covariance") \
+                + Q[failed]
+            if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+                self.predicted_covariances_sqrt[failed] = \
+                    math_utils.covariance_sqrt(new_covariances[failed])
+
+        return new_states, new_covariances
+
+
+    def update_step(self, predicted_states, predicted_covariances,
+                    sensor_measurements, R, R_sqrt=None):
+        """
+        Correct the predicted states of all the filters with the measurements
+
+        R_sqrt is the cholesky factor of R, only used by the square root 
+        update. It is calculated from R if it is not provided
+        """
+
+        #Calculate the expected measurements (z) and the jacobian for the
+        # measurement function
+        expected_measurements, H = \
+            self.measurement_model.analytic_evaluation(predicted_states)
+        self.calculated_measurements = expected_measurements
+
+        #Measurements shared between all the filters are row vectors
+        if sensor_measurements.shape != expected_measurements.shape:
+            sensor_measurements = sensor_measurements.reshape(1,-1)
+
+        #Calculate the innovation
+        y_tilde = sensor_measurements - expected_measurements
+        self.y_tilde = y_tilde
+
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            if R_sqrt is None:
+                R_sqrt = math_utils.covariance_sqrt(R)
+            K, updated_covariances = self._square_root_update(H, R_sqrt)
+        else:
+            #Calculate the innovation covariance
+            PHT = predicted_covariances @ H.transpose(0,2,1)
+            S = H @ PHT + R
+
+            #Verify if S is PD, the cholesky factorization will fail if S 
+            # is not PD. The filters that failed are repaired so that the
+            # other filters can continue
+            valid = self._validate_pd(S-R, "S-R")
+            if not np.all(valid):
+                failed = ~valid
+                S[failed] = math_utils.nearest_pd(S[failed] - R[failed], 
+                                                  "S-R") + R[failed]
+
+            #Calculate the Kalman Gain K = P H^T S^-1 with the cholesky 
+            # factor of S, K^T = L^-T L^-1 H P
+            L = self._factor_innovation_covariances(S, R)
+            K = np.linalg.solve(L.transpose(0,2,1), 
+                    np.linalg.solve(L, PHT.transpose(0,2,1)))\
+                .transpose(0,2,1)
+
+            #Calculate the updated covariances
+            I_KH = self.I - K @ H
+            if self.covariance_update == self.JOSEPH_UPDATE:
+                updated_covariances = \
+                    I_KH @ predicted_covariances @ I_KH.transpose(0,2,1) \
+                    + K @ R @ K.transpose(0,2,1)
+            else:
+                updated_covariances = I_KH @ predicted_covariances
+
+        #Calculate the updated states
+        self.delta_states = (K @ y_tilde[:,:,np.newaxis])[:,:,0]
+        updated_states = predicted_states + self.delta_states
+
+        #Verify that updated covariances are PD
+        valid = self._validate_pd(updated_covariances, "Updated Covariance")
+        if not np.all(valid):
+            failed = ~valid
+            updated_covariances[failed] = math_utils.nearest_pd(
+                updated_covariances[failed], "Updated Covariance")
+            if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+                self.updated_covariances_sqrt[failed] = \
+                    math_utils.covariance_sqrt(updated_covariances[failed])
+
+        return updated_states, updated_covariances
+
+
+    def _square_root_update(self, H, R_sqrt):
+        """
+        Measurement update of the covariance factors with the array 
+        algorithm, see Extended_Kalman_Filter._square_root_update
+        """
+        num_measurements = R_sqrt.shape[1]
+        P_sqrt = self.predicted_covariances_sqrt
+        size = num_measurements + self.num_states
+
+        pre_array = np.zeros((self.num_filters, size, size))
+        pre_array[:,:num_measurements,:num_measurements] = R_sqrt
+        pre_array[:,:num_measurements,num_measurements:] = H @ P_sqrt
+        pre_array[:,num_measurements:,num_measurements:] = P_sqrt
+
+        post_array = np.linalg.qr(pre_array.transpose(0,2,1), mode='r')\
+            .transpose(0,2,1)
+
+        S_sqrt = post_array[:,:num_measurements,:num_measurements]
+        K_S_sqrt = post_array[:,num_measurements:,:num_measurements]
+        self.updated_covariances_sqrt = post_array[:,num_measurements:,
+                                                   num_measurements:]
+
+        #K = (K S_sqrt) S_sqrt^-1
+        K = np.linalg.solve(S_sqrt.transpose(0,2,1), 
+                            K_S_sqrt.transpose(0,2,1)).transpose(0,2,1)
+
+        updated_covariances = self.updated_covariances_sqrt @ \
+            self.updated_covariances_sqrt.transpose(0,2,1)
+
+        return K, updated_covariances
+
+
+    def _validate_pd(self, matrices, name):
+        """
+        Check that the matrices are PD with the math_utils policy. Raises 
+        AssertionError on failure unless repair_covariance is set
+
+        Returns
+        valid -- boolean per filter, False if the matrix needs to be repaired
+        """
+        if self.repair_covariance == False:
+            math_utils.assert_pd_batch(matrices, name)
+            return np.ones(self.num_filters, dtype=bool)
+
+        valid = math_utils.check_pd(matrices, name)
+        self.pd_failures += ~valid
+        return valid
+
+
+    def _factor_innovation_covariances(self, S, R):
+        """
+        Returns the cholesky factors of the innovation covariances. The 
+        positive definite check can be skipped by the math_utils policy, so
+        the filters whose factorization fails are found here and repaired 
+        like a failed check. Raises AssertionError on failure unless 
+        repair_covariance is set
+        """
+        try:
+            return np.linalg.cholesky(S)
+        except np.linalg.LinAlgError:
+            pass
+
+        #Find the filters that failed, only done when there is a failure
+        failed = np.zeros(self.num_filters, dtype=bool)
+        for i in range(self.num_filters):
+            try:
+                np.linalg.cholesky(S[i])
+            except np.linalg.LinAlgError:
+                failed[i] = True
+
+        if self.repair_covariance == False:
+            raise AssertionError(f"S is not positive definite for the "
+                                 f"filters {np.flatnonzero(failed)}")
+
+        self.pd_failures += failed
+        S[failed] = math_utils.nearest_pd(S[failed] - R[failed], "S-R") \
+            + R[failed]
+
+        return np.linalg.cholesky(S)
+
+
+    def _get_sqrt(self, matrices):
+        """
+        Returns the cholesky factors of the noise matrices. The factors of
+        the noise attributes are cached by the attribute name and only
+        recalculated if the attribute changes. Any other matrices are 
+        factored every call
+        """
+        name = self._get_noise_name(matrices)
+        if name is None:
+            return math_utils.covariance_sqrt(matrices)
+
+        cached = self._sqrt_cache.get(name)
+        if cached is None or not np.array_equal(cached[0], matrices):
+            cached = (matrices.copy(), math_utils.covariance_sqrt(matrices))
+            self._sqrt_cache[name] = cached
+        return cached[1]
+
+
+    def _get_noise_name(self, matrices):
+        """
+        Returns the name of the noise attribute that is the matrices or None
+        """
+        for name in self.NOISE_NAMES:
+            if matrices is getattr(self, name):
+                return name
+        return None
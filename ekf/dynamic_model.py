@@ -3,6 +3,10 @@ import numpy as np
 
 class GaitDynamicModel():
 
+    #f_jacobean only depends on the time step, so filters can reuse it while
+    # the time step does not change
+    jacobean_depends_on_state = False
+
     def __init__(self):
 
         #Small increase in phase dot every time step
@@ -44,4 +48,42 @@ class GaitDynamicModel():
         #Small phase_dot increase per state
         current_state[1,0] = current_state[1,0]*self.phase_dot_scale
         
-        return current_state
\ No newline at end of file
+        return current_state
+
+    #Batched version of f_jacobean for states as row vectors with 
+    # shape(num_filters, num_states). The jacobean is the same for every 
+    # filter so a read-only view with shape(num_filters, num_states, num_states)
+    # is returned
+    def f_jacobean_batch(self, states, time_step):
+
+        num_filters, amount_of_states = states.shape
+
+        jacobean = self.f_jacobean(states[0].reshape(-1,1), time_step)
+
+        return np.broadcast_to(jacobean, 
+                               (num_filters, amount_of_states, 
+                                amount_of_states))
+
+    #Batched version of f_function for states as row vectors with 
+    # shape(num_filters, num_states). Unlike f_function, the input is not 
+    # modified
+    def f_function_batch(self, states, time_step):
+
+        new_states = states.copy()
+
+        phase = new_states[:,0] + new_states[:,1]*time_step
+
+        integer_part = np.floor(np.abs(phase))
+
+        #Reset if you get over one
+        phase = np.where(phase >= 1.0, phase - integer_part, phase)
+
+        #Prevent negative phase
+        phase = np.where(phase < 0.0, phase + integer_part + 1, phase)
+
+        new_states[:,0] = phase
+
+        #Small phase_dot increase per state
+        new_states[:,1] = new_states[:,1]*self.phase_dot_scale
+
+        return new_states
@@ -1,26 +1,37 @@
 #Standard Imports
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
 from sympy import uppergamma 
 
 #Import from same folder
 from .measurement_model import MeasurementModel
 from .dynamic_model import GaitDynamicModel
+from .instrumentation import EKFInstrumentation
 
 #Get relative imports
+#Use math_utils.set_pd_check_policy to configure how often the covariances 
+# are tested to be PD
 from .context import math_utils 
 
-#Set this to false to speed up calculations but not test if ekf is PSD
-math_utils.test_pd = True
-
 class Extended_Kalman_Filter:
 
+    #Methods to update the covariance
+    STANDARD_UPDATE = 'standard'
+    JOSEPH_UPDATE = 'joseph'
+    SQUARE_ROOT_UPDATE = 'square_root'
+
+    #Noise attributes whose cholesky factors are cached
+    NOISE_NAMES = ('Q', 'R', 'R_h')
+
     def __init__(self,initial_state: np.ndarray, initial_covariance: np.ndarray , 
                  dynamic_model: GaitDynamicModel,process_noise: np.ndarray,
                  measurement_model: MeasurementModel,observation_noise: np.ndarray,
                  output_model: MeasurementModel = None, 
                  lower_state_limit: np.ndarray = None, 
                  upper_state_limit: np.ndarray = None,
-                 heteroschedastic_model: bool = False):
+                 heteroschedastic_model: bool = False,
+                 covariance_update: str = JOSEPH_UPDATE,
+                 repair_covariance: bool = False):
         """
         Create the extended Kalman filter object
 
@@ -59,8 +70,19 @@ class Extended_Kalman_Filter:
         use_optimal_fit -- uses the optimal subject fit, which does not use
             gait fingerprints, instead of using gait fingerprint online.
         heteroschedastic_model: Use the measurement model heteroshedastic model
+        covariance_update -- 'standard' uses (I-KH)P, 'joseph' uses the 
+            Joseph form (I-KH)P(I-KH)^T + KRK^T which keeps the covariance 
+            symmetric and PD, 'square_root' propagates a cholesky factor of 
+            the covariance with QR array algorithms
+        repair_covariance -- if a covariance fails the positive definite 
+            check, replace it with the nearest PD matrix instead of raising
+            AssertionError
         """
 
+        if covariance_update not in (self.STANDARD_UPDATE, self.JOSEPH_UPDATE,
+                                     self.SQUARE_ROOT_UPDATE):
+            raise ValueError(f"Unknown covariance update {covariance_update}")
+
         #Assign internal variables
         self.dynamic_model = dynamic_model
         self.measurement_model = measurement_model
@@ -76,6 +98,18 @@ class Extended_Kalman_Filter:
         self.calculated_measurement_ = None
         self.num_states = initial_state.shape[0]
         self.heteroschedastic_model = heteroschedastic_model
+        self.covariance_update = covariance_update
+        self.repair_covariance = repair_covariance
+
+        #Cholesky factors of the noise matrices, keyed by the attribute name
+        self._sqrt_cache = {}
+
+        #Optional timing and counters, see enable_instrumentation
+        self.instrumentation = None
+
+        #The square root update propagates the factor P = P_sqrt @ P_sqrt.T
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            self.P_sqrt = math_utils.covariance_sqrt(initial_covariance)
 
         #Optional, output model
         self.output_model = output_model
@@ -112,6 +146,37 @@ class Extended_Kalman_Filter:
         return self.output
 
 
+    def enable_instrumentation(self, instrumentation: EKFInstrumentation = None) \
+            -> EKFInstrumentation:
+        """
+        Time every stage of the filter and count clipping events and 
+        positive definite check failures. A filter without instrumentation
+        does not run any of the instrumentation code
+
+        Keyword Arguments
+        instrumentation -- object that stores the times and counters. A new
+            one is created if it is not given
+
+        Returns
+        instrumentation -- query it or export it after the run
+        """
+        if instrumentation is None:
+            instrumentation = EKFInstrumentation()
+
+        instrumentation.attach(self)
+
+        return instrumentation
+
+
+    def disable_instrumentation(self):
+        """
+        Remove the instrumentation. The times and counters are kept in the 
+        instrumentation object
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.detach(self)
+
+
     #Calculate the next estimate of the kalman filter
     def calculate_next_estimates(self, time_step, sensor_measurements, control_input_u=0):
 
@@ -143,6 +208,8 @@ class Extended_Kalman_Filter:
         #Store the updated state and covariance
         self.x = updated_state
         self.P = updated_covariance
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            self.P_sqrt = self.updated_covariance_sqrt
 
         # Calculate the output
         if (self.output_model is not None):
@@ -151,6 +218,112 @@ class Extended_Kalman_Filter:
         return updated_state, updated_covariance
 
 
+    def _square_root_update(self, H, R):
+        """
+        Measurement update of the covariance factor with the array algorithm
+
+        The QR decomposition triangularizes the pre-array
+            [[R_sqrt, H P_sqrt],      [[S_sqrt,      0     ],
+             [  0,      P_sqrt]]  ->   [K S_sqrt, P_sqrt_new]]
+        
+        Returns 
+        K -- kalman gain, shape(num_states, num_measurements)
+        updated_covariance -- shape(num_states, num_states)
+        """
+        num_measurements = R.shape[0]
+        P_sqrt = self.predicted_covariance_sqrt
+
+        pre_array = np.zeros((num_measurements + self.num_states,
+                              num_measurements + self.num_states))
+        pre_array[:num_measurements,:num_measurements] = self._get_sqrt(R)
+        pre_array[:num_measurements,num_measurements:] = H @ P_sqrt
+        pre_array[num_measurements:,num_measurements:] = P_sqrt
+
+        post_array = np.linalg.qr(pre_array.T, mode='r').T
+
+        S_sqrt = post_array[:num_measurements,:num_measurements]
+        K_S_sqrt = post_array[num_measurements:,:num_measurements]
+        self.updated_covariance_sqrt = post_array[num_measurements:,
+                                                  num_measurements:]
+
+        #K = (K S_sqrt) S_sqrt^-1
+        K = solve_triangular(S_sqrt, K_S_sqrt.T, trans='T', lower=True).T
+
+        updated_covariance = self.updated_covariance_sqrt @ \
+                             self.updated_covariance_sqrt.T
+
+        return K, updated_covariance
+
+
+    def _calculate_kalman_gain(self, PHT, S):
+        """
+        Calculate the Kalman Gain K = P H^T S^-1 by factorizing S once
+        and solving K^T = S^-1 H P with triangular solves
+        """
+        try:
+            S_factor = cho_factor(S, lower=True)
+        #Raise the same error as a failed positive definite check so that
+        # the callers that handle it keep working
+        except np.linalg.LinAlgError:
+            raise AssertionError("S is not positive definite")
+
+        return cho_solve(S_factor, PHT.T).T
+
+
+    def _update_covariance(self, K, H, predicted_covariance, R):
+        """
+        Calculate the updated covariance with the standard or Joseph form
+        """
+        I_KH = np.eye(self.num_states) - K @ H
+        if self.covariance_update == self.JOSEPH_UPDATE:
+            return I_KH @ predicted_covariance @ I_KH.T + K @ R @ K.T
+        else:
+            return I_KH @ predicted_covariance
+
+
+    def _validate_pd(self, matrix, name):
+        """
+        Check that the matrix is PD with the math_utils policy. Raises 
+        AssertionError on failure unless repair_covariance is set
+
+        Returns
+        valid -- False if the matrix failed and needs to be repaired
+        """
+        if self.repair_covariance == False:
+            math_utils.assert_pd(matrix, name)
+            return True
+
+        return math_utils.check_pd(matrix, name)
+
+
+    def _get_sqrt(self, matrix):
+        """
+        Returns the cholesky factor of a noise matrix. The factors of the 
+        noise attributes are cached by the attribute name and only 
+        recalculated if the attribute changes. Any other matrix is factored
+        every call
+        """
+        name = self._get_noise_name(matrix)
+        if name is None:
+            return math_utils.covariance_sqrt(matrix)
+
+        cached = self._sqrt_cache.get(name)
+        if cached is None or not np.array_equal(cached[0], matrix):
+            cached = (matrix.copy(), math_utils.covariance_sqrt(matrix))
+            self._sqrt_cache[name] = cached
+        return cached[1]
+
+
+    def _get_noise_name(self, matrix):
+        """
+        Returns the name of the noise attribute that is the matrix or None
+        """
+        for name in self.NOISE_NAMES:
+            if matrix is getattr(self, name):
+                return name
+        return None
+
+
     #Call this function to get the next state 
     def preditction_step(self, time_step,Q,control_input_u=0):
         #Calculate the new step with the prediction function
@@ -162,9 +335,24 @@ class Extended_Kalman_Filter:
         #print("Dynamic model jacobean F: {}".format(F))
         
         #Get the new measurements
-        new_covariance = F @ self.P @ F.T + Q
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            #Triangularize [F P_sqrt, Q_sqrt] so that the factor satisfies
+            # factor @ factor.T = F P F^T + Q
+            pre_array = np.concatenate([F @ self.P_sqrt, self._get_sqrt(Q)],
+                                       axis=1)
+            self.predicted_covariance_sqrt = \
+                np.linalg.qr(pre_array.T, mode='r').T
+            new_covariance = self.predicted_covariance_sqrt @ \
+                             self.predicted_covariance_sqrt.T
+        else:
+            new_covariance = F @ self.P @ F.T + Q
         
-        math_utils.assert_pd(new_covariance-Q,"Updated covariance")
+        if not self._validate_pd(new_covariance-Q,"Updated covariance"):
+            new_covariance = math_utils.nearest_pd(new_covariance-Q,
+                                                   "Updated covariance") + Q
+            if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+                self.predicted_covariance_sqrt = \
+                    math_utils.covariance_sqrt(new_covariance)
         
         return (new_state, new_covariance)
 
@@ -172,36 +360,44 @@ class Extended_Kalman_Filter:
     #This function will calculate the new state based on the predicted state
     def update_step(self, predicted_state, predicted_covariance, sensor_measurements, R):
 
-        #Calculate the expected measurements (z)
-        expected_measurements = self.measurement_model.evaluate_h_func(predicted_state)
+        #Calculate the expected measurements (z) and the jacobian for the
+        # measurement function
+        expected_measurements, H = \
+            self.measurement_model.evaluate_h_and_dh_func(predicted_state)
         self.calculated_measurement_ = expected_measurements
 
         #Calculate the innovation
         y_tilde = (sensor_measurements - expected_measurements)
         self.y_tilde = y_tilde
-        
-        #Get the jacobian for the measurement function
-        H = self.measurement_model.evaluate_dh_func(predicted_state)
 
-        #Calculate the innovation covariance
-        S = H @ predicted_covariance @ H.T + R
-        
-        #Verify if S is PD
-        math_utils.assert_pd(S-R, "S-R")
-        
-        #Calculate the Kalman Gain
-        K = predicted_covariance @ H.T @ np.linalg.inv(S)
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            K, updated_covariance = self._square_root_update(H, R)
+        else:
+            #Calculate the innovation covariance
+            PHT = predicted_covariance @ H.T
+            S = H @ PHT + R
+            
+            #Verify if S is PD, the cholesky factorization will fail if S 
+            # is not PD. Repair it the same way as the batched filter
+            if not self._validate_pd(S-R, "S-R"):
+                S = math_utils.nearest_pd(S-R, "S-R") + R
+            
+            K = self._calculate_kalman_gain(PHT, S)
+            updated_covariance = self._update_covariance(K, H, 
+                                                         predicted_covariance,
+                                                         R)
         
         #Calculate the updated state
         self.delta_state = K @ y_tilde
         updated_state = predicted_state + self.delta_state
-
-        #Calculate the updated covariance
-        I = np.eye(self.num_states)
-        updated_covariance = (I - K @ H) @ predicted_covariance
         
         #Verify that updated covariance is done
-        math_utils.assert_pd(updated_covariance, "Updated Covariance")
+        if not self._validate_pd(updated_covariance, "Updated Covariance"):
+            updated_covariance = math_utils.nearest_pd(updated_covariance,
+                                                       "Updated Covariance")
+            if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+                self.updated_covariance_sqrt = \
+                    math_utils.covariance_sqrt(updated_covariance)
         
         return updated_state, updated_covariance
 
@@ -0,0 +1,331 @@
+"""
+This file defines optional timing and counters for the extended kalman filter
+
+The instrumentation is attached by replacing the methods and models of one
+filter object with timed wrappers, and detached by removing them again. The
+filter code has no instrumentation checks, so a filter that is not
+instrumented runs exactly the same code as before
+
+E.g.
+    instrumentation = ekf.enable_instrumentation()
+    for measurement in measurements:
+        ekf.calculate_next_estimates(time_step, measurement)
+    print(instrumentation.get_stage_table())
+    instrumentation.to_json('ekf_timing.json')
+"""
+
+#Standard Imports
+import json
+import time
+import numpy as np
+import pandas as pd
+
+#For docstring
+from typing import Callable, Dict
+
+
+#Stages that are timed
+# dynamic_model -- f_function and f_jacobean
+# measurement_model -- expected measurements. With the analytic jacobean
+#   this also includes the jacobean since both share one evaluation
+# jacobean -- numerical jacobean of the measurement model
+# kalman_gain -- factorization of the innovation covariance and the gain.
+#   With the square root update this includes the covariance factor update
+# covariance_update -- standard or Joseph covariance update
+# pd_check -- positive definite checks of the covariances
+STAGES = ['dynamic_model', 'measurement_model', 'jacobean', 'kalman_gain',
+          'covariance_update', 'pd_check']
+
+#Default bin edges of the step latency histogram in seconds, from 1us to 1s
+DEFAULT_LATENCY_BINS = np.logspace(-6, 0, 61)
+
+#Filter methods that are replaced with timed wrappers, and their stage
+_TIMED_METHODS = {'_calculate_kalman_gain': 'kalman_gain',
+                  '_square_root_update': 'kalman_gain',
+                  '_update_covariance': 'covariance_update'}
+
+
+class _TimedDynamicModel():
+    """
+    Times the dynamic model functions and forwards everything else
+    """
+
+    def __init__(self, dynamic_model, instrumentation):
+        self.dynamic_model = dynamic_model
+        self.f_function = instrumentation.timed('dynamic_model',
+                                                dynamic_model.f_function)
+        self.f_jacobean = instrumentation.timed('dynamic_model',
+                                                dynamic_model.f_jacobean)
+
+    def __getattr__(self, name):
+        return getattr(self.dynamic_model, name)
+
+
+class _TimedMeasurementModel():
+    """
+    Times the measurement model and the numerical jacobean separately and
+    forwards everything else
+    """
+
+    def __init__(self, measurement_model, instrumentation):
+        self.measurement_model = measurement_model
+        self.evaluate_h_func = instrumentation.timed('measurement_model',
+            measurement_model.evaluate_h_func)
+        self._evaluate_h_and_dh_func = instrumentation.timed(
+            'measurement_model', measurement_model.evaluate_h_and_dh_func)
+        self._numerical_jacobean = instrumentation.timed('jacobean',
+            measurement_model.numerical_jacobean)
+
+    def evaluate_h_and_dh_func(self, current_state):
+        #Same calls as MeasurementModel.evaluate_h_and_dh_func
+        if self.measurement_model.jacobean_method \
+                == self.measurement_model.ANALYTIC_JACOBEAN:
+            return self._evaluate_h_and_dh_func(current_state)
+
+        return (self.evaluate_h_func(current_state),
+                self._numerical_jacobean(current_state))
+
+    def __getattr__(self, name):
+        return getattr(self.measurement_model, name)
+
+
+class EKFInstrumentation():
+    """
+    This class stores the per stage wall time and call counts, a histogram
+    of the step latency and counters of clipping events and positive
+    definite check failures of an Extended_Kalman_Filter
+    """
+
+    def __init__(self, latency_bins : np.ndarray = DEFAULT_LATENCY_BINS):
+        """
+        Keyword Arguments:
+        latency_bins -- bin edges of the step latency histogram in seconds.
+            Latencies outside of the edges are counted in the first and
+            last bins
+        """
+        self.latency_bins = np.asarray(latency_bins, dtype=float)
+        self.reset()
+
+
+    def reset(self):
+        """
+        Set all the times and counters to zero
+        """
+        self.stage_time = {stage: 0.0 for stage in STAGES}
+        self.stage_calls = {stage: 0 for stage in STAGES}
+
+        self.num_steps = 0
+        self.step_time = 0.0
+        self.max_step_time = 0.0
+        self.latency_histogram = np.zeros(len(self.latency_bins) - 1,
+                                          dtype=np.int64)
+
+        #Clipping counters per state, created on the first step
+        self.num_clipped_steps = {'predicted': 0, 'updated': 0}
+        self.clipped_states = {'predicted': None, 'updated': None}
+
+        #Positive definite check failures per check name
+        self.pd_failures = {}
+
+
+    def timed(self, stage : str, function : Callable) -> Callable:
+        """
+        Wrap a function so that its wall time is added to a stage
+        """
+        perf_counter = time.perf_counter
+        stage_time = self.stage_time
+        stage_calls = self.stage_calls
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage_time[stage] += perf_counter() - start
+                stage_calls[stage] += 1
+
+        return timed_function
+
+
+    def attach(self, ekf):
+        """
+        Replace the methods and models of the filter with timed wrappers.
+        The wrappers are instance attributes, so other filters and the
+        shared models are not affected
+        """
+        if getattr(ekf, 'instrumentation', None) is not None:
+            raise ValueError("The filter is already instrumented")
+
+        ekf.instrumentation = self
+
+        for method_name, stage in _TIMED_METHODS.items():
+            setattr(ekf, method_name,
+                    self.timed(stage, getattr(ekf, method_name)))
+
+        ekf._validate_pd = self._counted_pd_check(ekf._validate_pd)
+        ekf.calculate_next_estimates = \
+            self._timed_step(ekf, ekf.calculate_next_estimates)
+
+        ekf.dynamic_model = _TimedDynamicModel(ekf.dynamic_model, self)
+        ekf.measurement_model = _TimedMeasurementModel(ekf.measurement_model,
+                                                       self)
+
+
+    def detach(self, ekf):
+        """
+        Remove the timed wrappers so that the filter runs the original code
+        """
+        if getattr(ekf, 'instrumentation', None) is not self:
+            raise ValueError("The filter is not instrumented by this object")
+
+        for method_name in list(_TIMED_METHODS) + ['_validate_pd',
+                'calculate_next_estimates']:
+            del ekf.__dict__[method_name]
+
+        ekf.dynamic_model = ekf.dynamic_model.dynamic_model
+        ekf.measurement_model = ekf.measurement_model.measurement_model
+        ekf.instrumentation = None
+
+
+    def _counted_pd_check(self, validate_pd : Callable) -> Callable:
+        """
+        Time the positive definite checks and count the failures. The
+        failure raises AssertionError unless the filter repairs covariances
+        """
+        timed_validate_pd = self.timed('pd_check', validate_pd)
+        pd_failures = self.pd_failures
+
+        def counted_validate_pd(matrix, name):
+            try:
+                valid = timed_validate_pd(matrix, name)
+            except AssertionError:
+                pd_failures[name] = pd_failures.get(name, 0) + 1
+                raise
+            if not valid:
+                pd_failures[name] = pd_failures.get(name, 0) + 1
+            return valid
+
+        return counted_validate_pd
+
+
+    def _timed_step(self, ekf, calculate_next_estimates : Callable) \
+            -> Callable:
+        """
+        Time the whole step and count the states that were clipped
+        """
+        perf_counter = time.perf_counter
+
+        def timed_calculate_next_estimates(*args, **kwargs):
+            start = perf_counter()
+            result = calculate_next_estimates(*args, **kwargs)
+            self.record_step(perf_counter() - start)
+
+            #The stored states are already clipped, so a state that is at
+            # its limit was clipped
+            self.record_clipping('predicted', ekf.predicted_state,
+                                 ekf.lower_state_limit, ekf.upper_state_limit)
+            self.record_clipping('updated', ekf.x,
+                                 ekf.lower_state_limit, ekf.upper_state_limit)
+
+            return result
+
+        return timed_calculate_next_estimates
+
+
+    def record_step(self, latency : float):
+        """
+        Add the latency of one step in seconds
+        """
+        self.num_steps += 1
+        self.step_time += latency
+        self.max_step_time = max(self.max_step_time, latency)
+
+        bin_index = np.searchsorted(self.latency_bins, latency, side='right')-1
+        self.latency_histogram[min(max(bin_index, 0),
+                                   len(self.latency_histogram) - 1)] += 1
+
+
+    def record_clipping(self, name : str, state : np.ndarray,
+                        lower_limit : np.ndarray, upper_limit : np.ndarray):
+        """
+        Count the states that are at their limits
+        """
+        clipped = ((state <= lower_limit) | (state >= upper_limit)).ravel()
+
+        if self.clipped_states[name] is None:
+            self.clipped_states[name] = np.zeros(clipped.shape[0],
+                                                 dtype=np.int64)
+
+        self.clipped_states[name] += clipped
+        self.num_clipped_steps[name] += int(clipped.any())
+
+
+    def get_latency_percentile(self, percentile : float) -> float:
+        """
+        Returns the upper edge of the histogram bin that contains the
+        percentile of the step latency, in seconds
+        """
+        if self.num_steps == 0:
+            return np.nan
+
+        cumulative = np.cumsum(self.latency_histogram)
+        bin_index = np.searchsorted(cumulative,
+                                    percentile/100*self.num_steps)
+        return min(self.latency_bins[bin_index + 1], self.max_step_time)
+
+
+    def get_stage_table(self) -> pd.DataFrame:
+        """
+        Returns a dataframe with the calls, total time in seconds, mean time
+        in microseconds and fraction of the step time of every stage
+        """
+        calls = np.array([self.stage_calls[stage] for stage in STAGES]
+                         + [self.num_steps])
+        total_time = np.array([self.stage_time[stage] for stage in STAGES]
+                              + [self.step_time])
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame({
+                'stage': STAGES + ['step'],
+                'calls': calls,
+                'total_time': total_time,
+                'mean_time_us': total_time/calls*1e6,
+                'step_fraction': total_time/self.step_time})
+
+
+    def to_dict(self) -> Dict:
+        """
+        Returns all the times and counters with json serializable values
+        """
+        clipped_states = {name: None if counts is None else counts.tolist()
+                          for name, counts in self.clipped_states.items()}
+
+        return {'stages': {stage: {'calls': self.stage_calls[stage],
+                                   'total_time': self.stage_time[stage]}
+                           for stage in STAGES},
+                'steps': {'calls': self.num_steps,
+                          'total_time': self.step_time,
+                          'max_time': self.max_step_time,
+                          'p99_time': self.get_latency_percentile(99)},
+                'latency_histogram': {
+                    'bin_edges': self.latency_bins.tolist(),
+                    'counts': self.latency_histogram.tolist()},
+                'clipping': {'steps': dict(self.num_clipped_steps),
+                             'states': clipped_states},
+                'pd_failures': dict(self.pd_failures)}
+
+
+    def to_json(self, file_name : str):
+        """
+        Save to_dict as a json file
+        """
+        with open(file_name, 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+
+    def to_csv(self, file_name : str):
+        """
+        Save the stage table as a csv file. The histogram and counters are
+        only in the json export
+        """
+        self.get_stage_table().to_csv(file_name, index=False)
@@ -5,16 +5,39 @@ from kmodel.model_definition.personal_measurement_function import PersonalMeasur
 class MeasurementModel():
     """
     This class wraps the PersonalMeasurementFunction and adds the
-    numerical differentiation required for the extended kalman filter
-    """
+    differentiation required for the extended kalman filter
 
+    The jacobean can be calculated analytically, using the derivatives of 
+    the function bases and the product rule of the kronecker product, or 
+    numerically with finite differences
+    """
 
+    #Methods to calculate the jacobean
+    ANALYTIC_JACOBEAN = 'analytic'
+    NUMERICAL_JACOBEAN = 'numerical'
 
     def __init__(self,personal_model : PersonalMeasurementFunction,
-                      calculate_output_derivative: bool):
-        
+                      calculate_output_derivative: bool,
+                      jacobean_method: str = ANALYTIC_JACOBEAN):
+        """
+        Keyword Arguments
+        personal_model -- function that evaluates the models for every output
+        calculate_output_derivative -- adds the time derivative of every 
+            output to the measurements. Assumes that phase is the first state 
+            and phase_dot is the second state
+        jacobean_method -- 'analytic' to use the exact derivatives of the 
+            function bases or 'numerical' to use finite differences
+        """
+
+        if jacobean_method not in (self.ANALYTIC_JACOBEAN, 
+                                   self.NUMERICAL_JACOBEAN):
+            raise ValueError(f"Unknown jacobean method {jacobean_method}")
+
         #The initialization method only requires the PersonalMeasurementFunction
         self.personal_model = personal_model
+
+        #Store how the jacobean is calculated
+        self.jacobean_method = jacobean_method
         
         #Add property for calculating output derivative
         self.calculcate_output_derivative = calculate_output_derivative
@@ -53,6 +76,12 @@ class MeasurementModel():
         """
 
 
+        #The analytic method calculates the time derivative exactly
+        if self.jacobean_method == self.ANALYTIC_JACOBEAN:
+            output, _ = self.analytic_evaluation(current_state.T,
+                                                 calculate_jacobean=False)
+            return output.T
+
         #Measurment models receive their input as row vectors and the 
         # ekf inputs column vectors
         # therefore, transpose both input and output
@@ -74,7 +103,7 @@ class MeasurementModel():
         """
         Calculate the derivative at this current point in time
 
-        Currently only support numerical differentiation
+        Uses the method selected with jacobean_method
 
         Keyword Arguments
         current_state: current state of the extended kalman filter
@@ -87,11 +116,181 @@ class MeasurementModel():
         measurement_value: Value of the derivative of the measurement function
                            shape(num_outputs, 1)
         """
-        #Use numerical method to calculate the jacobean 
-        result = self.numerical_jacobean(current_state)
+        if self.jacobean_method == self.ANALYTIC_JACOBEAN:
+            result = self.analytic_jacobean(current_state)
+        else:
+            #Use numerical method to calculate the jacobean 
+            result = self.numerical_jacobean(current_state)
 
         return result
 
+
+    def evaluate_h_and_dh_func(self, current_state:np.ndarray):
+        """
+        Evaluate the measurement function and its jacobean
+
+        With the analytic method both are calculated in one pass that 
+        shares the kronecker evaluation
+
+        Keyword Arguments
+        current_state: current state of the extended kalman filter
+                       shape(num_states, 1)
+        Returns
+        measurement_value: Value of the measurement function
+                           shape(num_outputs, 1)
+        jacobean: Value of the derivative of the measurement function
+                  shape(num_outputs, num_states)
+        """
+        if self.jacobean_method == self.ANALYTIC_JACOBEAN:
+            output, jacobean = self.analytic_evaluation(current_state.T)
+            return output.T, jacobean[0]
+
+        return (self.evaluate_h_func(current_state), 
+                self.numerical_jacobean(current_state))
+
+
+    def analytic_jacobean(self, current_state:np.ndarray):
+        """
+        Analytic differentiation algorithm
+
+        Keyword Arguments
+        current_state: current state of the extended kalman filter
+                       shape(num_states, 1)
+        Returns
+        measurement_value: Value of the derivative of the measurement function
+                           shape(num_outputs, num_states)
+        """
+        _, jacobean = self.analytic_evaluation(current_state.T)
+
+        return jacobean[0]
+
+
+    def analytic_evaluation(self, states:np.ndarray, 
+                            calculate_jacobean:bool = True):
+        """
+        Evaluate the measurement function, the time derivative outputs 
+        and the jacobean for a batch of states
+
+        The kronecker row and its partial derivatives are evaluated once
+        and multiplied by the model fits of every output. For the time 
+        derivative outputs, h_dot = dh/dphase * phase_dot, therefore
+
+        d h_dot/dx_j = d^2h/(dphase dx_j) * phase_dot 
+                       (+ dh/dphase if x_j is phase_dot)
+
+        States after the kronecker basis variables (e.g. gait fingerprints) 
+        are differentiated numerically
+
+        Keyword Arguments
+        states: batch of states as row vectors 
+                shape(num_datapoints, num_states)
+        calculate_jacobean: if false, only the outputs are calculated
+
+        Returns
+        output: measurement function, shape(num_datapoints, num_outputs)
+        jacobean: derivative of the measurement function or None 
+                  shape(num_datapoints, num_outputs, num_states)
+        """
+        num_datapoints, num_states = states.shape
+
+        #All the outputs share the same kronecker model
+        k_model = self.personal_model.kmodels[0]
+        num_basis = k_model.get_num_basis()
+
+        #Create the derivative orders for the partial derivatives
+        def partial(*orders):
+            derivative_orders = [0]*num_basis
+            for i in orders:
+                derivative_orders[i] += 1
+            return tuple(derivative_orders)
+
+        #The kronecker row
+        derivative_list = [partial()]
+
+        #The partial derivatives start with the phase derivative, which is
+        # also needed for the time derivative outputs
+        if calculate_jacobean:
+            derivative_list += [partial(j) for j in range(num_basis)]
+        elif self.calculcate_output_derivative == True:
+            derivative_list += [partial(0)]
+
+        #The phase derivative of every partial derivative
+        if self.calculcate_output_derivative == True and calculate_jacobean:
+            derivative_list += [partial(0,j) for j in range(num_basis)]
+
+        #Evaluate all the kronecker rows and multiply with the fits at once.
+        # The rows are consumed right away so the model workspace can be used
+        kronecker_rows = k_model.evaluate_partial_derivatives(states, 
+                                                              derivative_list,
+                                                              use_workspace=True)
+        num_rows = kronecker_rows.shape[0]
+        model_outputs = self.personal_model.evaluate(states,
+            kronecker_output=kronecker_rows.reshape(num_rows*num_datapoints,-1))\
+            .reshape(num_rows, num_datapoints, -1)
+
+        #Unpack the evaluations
+        output = model_outputs[0]
+        num_kmodels = output.shape[1]
+
+        if self.calculcate_output_derivative == True:
+            #Assumes phase_dot is the second state
+            phase_dot = states[:,[1]]
+            phase_derivative = model_outputs[1]
+            output = np.concatenate([output, phase_derivative*phase_dot], 
+                                    axis=1)
+
+        if calculate_jacobean == False:
+            return output, None
+
+        jacobean = np.zeros((num_datapoints, output.shape[1], num_states))
+
+        #Transpose the partial derivatives to (num_datapoints, num_kmodels, 
+        # num_basis)
+        jacobean[:,:num_kmodels,:num_basis] = \
+            model_outputs[1:num_basis+1].transpose(1,2,0)
+
+        if self.calculcate_output_derivative == True:
+            jacobean[:,num_kmodels:,:num_basis] = \
+                model_outputs[num_basis+1:].transpose(1,2,0) \
+                * phase_dot[:,:,np.newaxis]
+            jacobean[:,num_kmodels:,1] += phase_derivative
+
+        #Differentiate the states that are not part of the kronecker model
+        for col in range(num_basis, num_states):
+            state_plus_delta = states.copy()
+            state_plus_delta[:,col] += self.delta
+            output_delta, _ = self.analytic_evaluation(state_plus_delta, 
+                                                       calculate_jacobean=False)
+            jacobean[:,:,col] = (output_delta - output)/self.delta
+
+        return output, jacobean
+
+
+    def check_jacobean(self, current_state:np.ndarray):
+        """
+        Compare the analytic jacobean against finite differences
+
+        Keyword Arguments
+        current_state: current state of the extended kalman filter
+                       shape(num_states, 1)
+        Returns
+        max_error: maximum absolute difference between both jacobeans
+        """
+        #Finite differences have to use the same measurement function
+        analytic = self.analytic_jacobean(current_state)
+        f_state, _ = self.analytic_evaluation(current_state.T, 
+                                              calculate_jacobean=False)
+
+        numerical = np.zeros(analytic.shape)
+        for col in range(current_state.shape[0]):
+            state_plus_delta = current_state.T.copy()
+            state_plus_delta[0,col] += self.delta
+            f_delta, _ = self.analytic_evaluation(state_plus_delta, 
+                                                  calculate_jacobean=False)
+            numerical[:,col] = ((f_delta - f_state)/self.delta)[0]
+
+        return np.max(np.abs(analytic - numerical))
+
     def numerical_jacobean(self, current_state:np.ndarray):
 
         """
@@ -0,0 +1,368 @@
+"""
+This file implements gradient based tuning of the process and observation
+noise of the extended kalman filter
+
+The objective is the mean negative log likelihood of the innovations, or
+the mean weighted squared state error against ground truth, over a training
+stream. Its gradient with respect to the log of the noise diagonals is
+calculated with forward sensitivities, i.e. the derivatives of the state and
+covariance are propagated with the filter. The derivative of the measurement
+jacobean along the state sensitivities is calculated with central finite
+differences of the batched jacobean, so every step evaluates the measurement
+model once for all the parameters
+
+The objective follows the filter exactly, including the heteroschedastic
+observation noise near heel strike and the state saturation. Saturated
+states have zero sensitivity. Covariance repairs are not differentiated
+
+E.g.
+    result = tune_noise(ekf, sensor_data, time_steps)
+    ekf = Extended_Kalman_Filter(..., np.diag(result.q_diagonal), ...,
+                                 np.diag(result.r_diagonal), ...)
+"""
+
+#Standard Imports
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize, OptimizeResult
+from dataclasses import dataclass
+
+#Import from same folder
+from .ekf import Extended_Kalman_Filter
+
+#For docstring
+from typing import Tuple
+
+
+#Objectives that can be minimized
+NEGATIVE_LOG_LIKELIHOOD = 'nll'
+STATE_ERROR = 'state_error'
+
+
+@dataclass(repr=False)
+class NoiseTuningResult:
+    """
+    Noise diagonals that minimize the objective
+    """
+    q_diagonal: np.ndarray
+    r_diagonal: np.ndarray
+    #Objective before and after the optimization
+    initial_value: float
+    value: float
+    #Result of scipy.optimize.minimize
+    optimize_result: OptimizeResult
+
+
+
+class NoiseSensitivityObjective():
+    """
+    This class evaluates the objective of a training stream and its gradient
+    with respect to the log of the positive noise diagonals. Diagonal
+    entries that are zero, e.g. the phase process noise, are not tuned
+    """
+
+    def __init__(self, ekf : Extended_Kalman_Filter,
+                 sensor_data : np.ndarray, time_steps : np.ndarray,
+                 state_data : np.ndarray = None,
+                 objective : str = NEGATIVE_LOG_LIKELIHOOD,
+                 state_weights : np.ndarray = None,
+                 score_start_index : int = 0,
+                 jacobean_step : float = 1e-5):
+        """
+        Keyword Arguments:
+        ekf -- filter that defines the initial state and covariance, models,
+            state limits, heteroschedastic model and the initial diagonal
+            noise matrices. It is not modified
+        sensor_data -- measurements, shape(num_steps, num_measurements)
+        time_steps -- time step of every measurement, shape(num_steps,), or
+            one time step for all of them
+        state_data -- ground truth states, shape(num_steps, num_states).
+            Only needed for the state error objective
+        objective -- 'nll' for the innovation negative log likelihood or
+            'state_error' for the weighted squared state error. Phase uses
+            the phase distance
+        state_weights -- weight of the squared error of every ground truth
+            state. Defaults to one
+        score_start_index -- steps before this are not part of the
+            objective, e.g. to let the filter converge
+        jacobean_step -- step of the finite differences of the measurement
+            jacobean along the state sensitivities
+        """
+        if objective not in (NEGATIVE_LOG_LIKELIHOOD, STATE_ERROR):
+            raise ValueError(f"Unknown objective {objective}")
+        if objective == STATE_ERROR and state_data is None:
+            raise ValueError("The state error objective needs state_data")
+
+        Q = np.asarray(ekf.Q, dtype=float)
+        R = np.asarray(ekf.R, dtype=float)
+        if np.any(Q != np.diag(np.diag(Q))) or np.any(R != np.diag(np.diag(R))):
+            raise ValueError("Only diagonal noise matrices can be tuned")
+
+        self.dynamic_model = ekf.dynamic_model
+        self.measurement_model = ekf.measurement_model
+        self.initial_state = np.array(ekf.x, dtype=float).reshape(-1)
+        self.initial_covariance = np.array(ekf.P, dtype=float)
+        self.lower_state_limit = np.asarray(ekf.lower_state_limit).reshape(-1)
+        self.upper_state_limit = np.asarray(ekf.upper_state_limit).reshape(-1)
+        self.heteroschedastic_model = ekf.heteroschedastic_model
+
+        self.q_diagonal = np.diag(Q).copy()
+        self.r_diagonal = np.diag(R).copy()
+
+        #Same scaling of the observation noise near heel strike as the filter
+        self.heteroschedastic_scale = np.divide(np.diag(ekf.R_h),
+            self.r_diagonal, out=np.ones_like(self.r_diagonal),
+            where=self.r_diagonal > 0)
+
+        #Only the positive entries are tuned
+        self.q_indices = np.flatnonzero(self.q_diagonal > 0)
+        self.r_indices = np.flatnonzero(self.r_diagonal > 0)
+        self.num_parameters = self.q_indices.shape[0] \
+            + self.r_indices.shape[0]
+
+        self.sensor_data = np.asarray(sensor_data, dtype=float)
+        self.time_steps = np.broadcast_to(np.asarray(time_steps, dtype=float),
+                                          (self.sensor_data.shape[0],))
+        self.state_data = state_data
+        self.objective = objective
+        self.score_start_index = score_start_index
+        self.jacobean_step = jacobean_step
+
+        if state_data is not None and state_weights is None:
+            state_weights = np.ones(state_data.shape[1])
+        self.state_weights = state_weights
+
+        #Updated states of the last evaluation
+        self.states = None
+
+
+    def get_initial_parameters(self) -> np.ndarray:
+        """
+        Returns the log of the tuned diagonal entries of the filter
+        """
+        return np.log(np.concatenate([self.q_diagonal[self.q_indices],
+                                      self.r_diagonal[self.r_indices]]))
+
+
+    def get_noise_diagonals(self, parameters : np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the process and observation noise diagonals of the
+        parameters
+        """
+        num_q = self.q_indices.shape[0]
+        q_diagonal = self.q_diagonal.copy()
+        r_diagonal = self.r_diagonal.copy()
+        q_diagonal[self.q_indices] = np.exp(parameters[:num_q])
+        r_diagonal[self.r_indices] = np.exp(parameters[num_q:])
+        return q_diagonal, r_diagonal
+
+
+    def _get_jacobean_derivative(self, predicted_state : np.ndarray,
+                                 state_sensitivity : np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluate the measurement model at the predicted state and at the
+        predicted state moved along every state sensitivity in one batch
+
+        Returns:
+        expected_measurements -- shape(num_measurements,)
+        H -- measurement jacobean, shape(num_measurements, num_states)
+        dH -- derivative of H with respect to every parameter
+            shape(num_parameters, num_measurements, num_states)
+        """
+        num_parameters = state_sensitivity.shape[1]
+
+        #Use unit directions so that the step is the same for all of them
+        norms = np.linalg.norm(state_sensitivity, axis=0)
+        directions = np.divide(state_sensitivity, norms,
+                               out=np.zeros_like(state_sensitivity),
+                               where=norms > 0).T
+        step = self.jacobean_step
+        states = np.concatenate([predicted_state[np.newaxis],
+                                 predicted_state + step*directions,
+                                 predicted_state - step*directions])
+
+        outputs, jacobeans = self.measurement_model.analytic_evaluation(states)
+
+        dH = (jacobeans[1:num_parameters+1] - jacobeans[num_parameters+1:]) \
+            * (norms/(2*step))[:,np.newaxis,np.newaxis]
+
+        return outputs[0], jacobeans[0], dH
+
+
+    def evaluate(self, parameters : np.ndarray) -> Tuple[float, np.ndarray]:
+        """
+        Run the filter over the training stream
+
+        Keyword Arguments:
+        parameters -- log of the tuned diagonal entries, process noise first
+
+        Returns:
+        value -- mean objective per scored step
+        gradient -- derivative of the value, shape(num_parameters,)
+        """
+        parameters = np.asarray(parameters, dtype=float)
+        q_diagonal, r_diagonal = self.get_noise_diagonals(parameters)
+        num_q = self.q_indices.shape[0]
+        num_parameters = self.num_parameters
+
+        num_steps, num_measurements = self.sensor_data.shape
+        num_states = self.initial_state.shape[0]
+
+        Q = np.diag(q_diagonal)
+        R = np.diag(r_diagonal)
+        R_h = np.diag(r_diagonal*self.heteroschedastic_scale)
+
+        #Derivatives of the noise matrices, d exp(p)/dp = exp(p)
+        dQ = np.zeros((num_parameters, num_states, num_states))
+        dQ[np.arange(num_q), self.q_indices, self.q_indices] = \
+            q_diagonal[self.q_indices]
+        dR = np.zeros((num_parameters, num_measurements, num_measurements))
+        dR[np.arange(num_q, num_parameters), self.r_indices,
+           self.r_indices] = r_diagonal[self.r_indices]
+        dR_h = dR * self.heteroschedastic_scale
+
+        #State, covariance and their sensitivities
+        x = self.initial_state.copy()
+        P = self.initial_covariance.copy()
+        dx = np.zeros((num_states, num_parameters))
+        dP = np.zeros((num_parameters, num_states, num_states))
+
+        value = 0.0
+        gradient = np.zeros(num_parameters)
+        log_2_pi = np.log(2*np.pi)
+        states = np.empty((num_steps, num_states))
+
+        for i in range(num_steps):
+            time_step = self.time_steps[i]
+
+            #Perform a heteroschedastic model near heel strike
+            if self.heteroschedastic_model and (x[0] > 0.95 or x[0] < 0.05):
+                R_step, dR_step = R_h, dR_h
+            else:
+                R_step, dR_step = R, dR
+
+            ## Prediction step
+            F = self.dynamic_model.f_jacobean(x.reshape(-1,1), time_step)
+            x = self.dynamic_model.f_function(x.reshape(-1,1),
+                                              time_step).reshape(-1)
+            P = F @ P @ F.T + Q
+            dx = F @ dx
+            dP = F @ dP @ F.T + dQ
+
+            #Saturated states do not change with the parameters
+            clipped = (x < self.lower_state_limit) \
+                | (x > self.upper_state_limit)
+            x = np.clip(x, self.lower_state_limit, self.upper_state_limit)
+            dx[clipped] = 0
+
+            ## Measurement step
+            expected_measurements, H, dH = \
+                self._get_jacobean_derivative(x, dx)
+
+            y = self.sensor_data[i] - expected_measurements
+            dy = -H @ dx
+
+            PHT = P @ H.T
+            S = H @ PHT + R_step
+            dHPHT = dH @ PHT
+            dS = dHPHT + H @ dP @ H.T + dHPHT.transpose(0,2,1) + dR_step
+
+            S_factor = cho_factor(S, lower=True)
+            S_inv = cho_solve(S_factor, np.eye(num_measurements))
+            S_inv_y = S_inv @ y
+            K = PHT @ S_inv
+
+            scored = i >= self.score_start_index
+
+            if scored and self.objective == NEGATIVE_LOG_LIKELIHOOD:
+                log_det_S = 2*np.sum(np.log(np.diag(S_factor[0])))
+                value += 0.5*(log_det_S + y @ S_inv_y
+                              + num_measurements*log_2_pi)
+                gradient += 0.5*(np.einsum('ij,kji->k', S_inv, dS)
+                                 + 2*(S_inv_y @ dy)
+                                 - np.einsum('i,kij,j->k', S_inv_y, dS,
+                                             S_inv_y))
+
+            #Derivative of the gain K = P H^T S^-1
+            dPHT = dP @ H.T + P @ dH.transpose(0,2,1)
+            dK = (dPHT - K @ dS) @ S_inv
+
+            #Update the state and its sensitivity
+            x = x + K @ y
+            dx = dx + np.einsum('knm,m->nk', dK, y) + K @ dy
+
+            #Differentiate the Joseph form instead of P - K S K^T. The errors
+            # of dP are multiplied by (I - KH) on both sides, otherwise they
+            # grow when the covariance is ill conditioned
+            I_KH = np.eye(num_states) - K @ H
+            dI_KH = -(dK @ H + K @ dH)
+            dJoseph = dI_KH @ P @ I_KH.T + dK @ R_step @ K.T
+            dP = dJoseph + dJoseph.transpose(0,2,1) \
+                + I_KH @ dP @ I_KH.T + K @ dR_step @ K.T
+            P = I_KH @ P @ I_KH.T + K @ R_step @ K.T
+
+            clipped = (x < self.lower_state_limit) \
+                | (x > self.upper_state_limit)
+            x = np.clip(x, self.lower_state_limit, self.upper_state_limit)
+            dx[clipped] = 0
+
+            states[i] = x
+
+            if scored and self.objective == STATE_ERROR:
+                num_ground_truth = self.state_data.shape[1]
+                error = x[:num_ground_truth] - self.state_data[i]
+                #Signed phase distance
+                error[0] -= np.round(error[0])
+                weighted_error = self.state_weights*error
+                value += weighted_error @ error
+                gradient += 2*weighted_error @ dx[:num_ground_truth]
+
+        self.states = states
+
+        num_scored = max(num_steps - self.score_start_index, 1)
+        return value/num_scored, gradient/num_scored
+
+
+
+def tune_noise(ekf : Extended_Kalman_Filter, sensor_data : np.ndarray,
+               time_steps : np.ndarray, state_data : np.ndarray = None,
+               objective : str = NEGATIVE_LOG_LIKELIHOOD,
+               max_iterations : int = 50, log_bounds : Tuple = (None, None),
+               **kwargs) -> NoiseTuningResult:
+    """
+    Minimize the objective with L-BFGS starting at the noise of the filter
+
+    Keyword Arguments:
+    ekf -- filter with the initial noise, see NoiseSensitivityObjective
+    sensor_data -- measurements, shape(num_steps, num_measurements)
+    time_steps -- time step of every measurement
+    state_data -- ground truth states, only for the state error objective
+    objective -- 'nll' or 'state_error'
+    max_iterations -- maximum amount of L-BFGS iterations
+    log_bounds -- (lower, upper) bound of the log of every noise entry,
+        None for no bound
+    kwargs -- passed to NoiseSensitivityObjective
+
+    Returns:
+    NoiseTuningResult
+    """
+    noise_objective = NoiseSensitivityObjective(ekf, sensor_data, time_steps,
+                                                state_data, objective,
+                                                **kwargs)
+    initial_parameters = noise_objective.get_initial_parameters()
+    initial_value, _ = noise_objective.evaluate(initial_parameters)
+
+    optimize_result = minimize(noise_objective.evaluate, initial_parameters,
+        jac=True, method='L-BFGS-B',
+        bounds=[log_bounds]*noise_objective.num_parameters,
+        options={'maxiter': max_iterations})
+
+    q_diagonal, r_diagonal = \
+        noise_objective.get_noise_diagonals(optimize_result.x)
+
+    return NoiseTuningResult(q_diagonal=q_diagonal, r_diagonal=r_diagonal,
+                             initial_value=initial_value,
+                             value=float(optimize_result.fun),
+                             optimize_result=optimize_result)
@@ -0,0 +1,338 @@
+"""
+This file defines an extended kalman filter for real time use, where every
+step has to finish inside the control period of the prosthesis
+
+All the matrices of the filter are allocated once and every step writes into
+them. The latency of every step is measured against a deadline and, when the
+step is about to run out of time, the measurement update reuses the jacobean
+of a previous step instead of calculating a new one
+
+E.g. to check if the filter can run at 200Hz
+    ekf = RealTimeExtendedKalmanFilter(..., deadline=1/200)
+    report = replay_latency(ekf, measurements, 1/150, warmup_steps=150)
+    print(report.p99, report.worst_case, report.deadline_misses)
+"""
+
+#Standard Imports
+import time
+import numpy as np
+from scipy.linalg.lapack import dpotrf, dpotrs
+from dataclasses import dataclass
+
+#Import from same folder
+from .measurement_model import MeasurementModel
+from .dynamic_model import GaitDynamicModel
+from .ekf import Extended_Kalman_Filter
+
+#Get relative imports
+from .context import math_utils
+
+
+@dataclass
+class LatencyReport:
+    """
+    Step latency of a RealTimeExtendedKalmanFilter, all times in seconds
+    """
+    #Time budget of every step
+    deadline: float
+    #Steps since the stats were reset
+    num_steps: int
+    #Slowest step since the stats were reset
+    worst_case: float
+    #99th percentile and mean of the steps in the latency history
+    p99: float
+    mean: float
+    #Steps that took longer than the deadline
+    deadline_misses: int
+    #Steps that reused a previous jacobean
+    degraded_steps: int
+
+    def meets_deadline(self) -> bool:
+        return self.deadline_misses == 0
+
+
+class RealTimeExtendedKalmanFilter(Extended_Kalman_Filter):
+
+    def __init__(self, initial_state: np.ndarray,
+                 initial_covariance: np.ndarray,
+                 dynamic_model: GaitDynamicModel, process_noise: np.ndarray,
+                 measurement_model: MeasurementModel,
+                 observation_noise: np.ndarray,
+                 deadline: float = 1/150,
+                 degrade_threshold: float = 0.8,
+                 max_jacobean_age: int = 5,
+                 latency_history: int = 2**16,
+                 **kwargs):
+        """
+        Create the real time extended kalman filter object. Same arguments
+        as Extended_Kalman_Filter plus the real time settings. The square
+        root covariance update is not supported
+
+        Keyword Arguments
+        deadline -- time budget of every step in seconds, e.g. 1/200 for a
+            200Hz control loop
+        degrade_threshold -- the previous jacobean is reused if the time
+            spent in the step plus the expected time of the measurement
+            model is more than this fraction of the deadline
+        max_jacobean_age -- maximum amount of steps in a row that reuse the
+            jacobean. Zero disables the degraded path
+        latency_history -- amount of steps used for the percentile and mean
+            latency. The worst case and deadline misses use every step
+        kwargs -- passed to Extended_Kalman_Filter
+        """
+        super().__init__(initial_state, initial_covariance, dynamic_model,
+                         process_noise, measurement_model, observation_noise,
+                         **kwargs)
+
+        if self.covariance_update == self.SQUARE_ROOT_UPDATE:
+            raise ValueError("The real time filter supports the standard "
+                             "and joseph covariance updates")
+
+        self.deadline = deadline
+        self.degrade_threshold = degrade_threshold
+        self.max_jacobean_age = max_jacobean_age
+
+        num_states = self.num_states
+        num_measurements = observation_noise.shape[0]
+
+        #The state and covariance are updated in place, copy the inputs so
+        # that the caller's arrays are not modified
+        self.x = np.array(initial_state, dtype=float)
+        self.P = np.array(initial_covariance, dtype=float)
+
+        #Prediction buffers. If the dynamic model declares that its jacobean
+        # only depends on the time step, e.g. the gait dynamic model, it is
+        # recalculated when the time step changes. Otherwise every step
+        self.F = None
+        self._F_time_step = None
+        self._cache_F = not getattr(dynamic_model,
+                                    'jacobean_depends_on_state', True)
+        self._FP = np.empty((num_states, num_states))
+        self.predicted_state = np.empty((num_states, 1))
+        self.predicted_covariance = np.empty((num_states, num_states))
+
+        #Update buffers. S and K^T are fortran ordered so that lapack
+        # factorizes and solves them in place
+        self.H = np.zeros((num_measurements, num_states))
+        self.y_tilde = np.empty((num_measurements, 1))
+        self.PHT = np.empty((num_states, num_measurements))
+        self.S = np.empty((num_measurements, num_measurements), order='F')
+        self._KT = np.empty((num_measurements, num_states), order='F')
+        self.delta_state = np.empty((num_states, 1))
+        self._identity = np.eye(num_states)
+        self._KH = np.empty((num_states, num_states))
+        self._I_KH = np.empty((num_states, num_states))
+        self._I_KH_P = np.empty((num_states, num_states))
+        self._KR = np.empty((num_states, num_measurements))
+        self._KRKT = np.empty((num_states, num_states))
+
+        #The jacobean can't be reused until it is calculated once
+        self.jacobean_age = max_jacobean_age
+
+        #Running estimate of the time of the measurement model with jacobean
+        self.measurement_time = None
+
+        #Latency statistics
+        self.latencies = np.zeros(latency_history)
+        self.reset_latency_stats()
+
+
+    def reset_latency_stats(self):
+        """
+        Set the latency statistics to zero, e.g. after a warm up
+        """
+        self.num_steps = 0
+        self.worst_case_latency = 0.0
+        self.deadline_misses = 0
+        self.degraded_steps = 0
+        self.deadline_missed = False
+        self.degraded = False
+
+
+    def get_latency_report(self) -> LatencyReport:
+        """
+        Returns the latency statistics since the last reset
+        """
+        history = self.latencies[:min(self.num_steps, self.latencies.shape[0])]
+
+        if history.shape[0] == 0:
+            p99 = mean = np.nan
+        else:
+            p99 = float(np.percentile(history, 99))
+            mean = float(history.mean())
+
+        return LatencyReport(deadline=self.deadline,
+                             num_steps=self.num_steps,
+                             worst_case=self.worst_case_latency,
+                             p99=p99, mean=mean,
+                             deadline_misses=self.deadline_misses,
+                             degraded_steps=self.degraded_steps)
+
+
+    #Calculate the next estimate of the kalman filter
+    def calculate_next_estimates(self, time_step, sensor_measurements,
+                                 control_input_u=0):
+        """
+        Same as Extended_Kalman_Filter.calculate_next_estimates, but the
+        returned state and covariance are the filter's buffers. They are
+        overwritten in the next step, copy them to keep them
+        """
+        start = time.perf_counter()
+
+        #Perform a heteroschedastic model on ramp
+        Q = self.Q
+        R = self.R
+        if (self.x[0,0] > 0.95 or self.x[0,0] < 0.05) \
+                and self.heteroschedastic_model:
+            R = self.R_h
+
+        ## Prediction step
+        #f_function updates the state in place
+        new_state = self.dynamic_model.f_function(self.x, time_step)
+
+        if not self._cache_F or time_step != self._F_time_step:
+            self.F = self.dynamic_model.f_jacobean(new_state, time_step)
+            self._F_time_step = time_step
+
+        #P = F P F^T + Q
+        np.matmul(self.F, self.P, out=self._FP)
+        np.matmul(self._FP, self.F.T, out=self.predicted_covariance)
+        if not self._validate_pd(self.predicted_covariance,
+                                 "Updated covariance"):
+            np.copyto(self.predicted_covariance,
+                      math_utils.nearest_pd(self.predicted_covariance,
+                                            "Updated covariance"))
+        np.add(self.predicted_covariance, Q, out=self.predicted_covariance)
+
+        #Saturate the predicted state
+        np.clip(new_state, self.lower_state_limit, self.upper_state_limit,
+                out=self.predicted_state)
+
+        ## Measurement step
+        #Reuse the previous jacobean if there is not enough time left to
+        # calculate a new one
+        elapsed = time.perf_counter() - start
+        self.degraded = self.jacobean_age < self.max_jacobean_age \
+            and elapsed + self.measurement_time \
+                > self.degrade_threshold*self.deadline
+
+        if self.degraded:
+            expected_measurements = \
+                self.measurement_model.evaluate_h_func(self.predicted_state)
+            self.jacobean_age += 1
+            self.degraded_steps += 1
+        else:
+            measurement_start = time.perf_counter()
+            expected_measurements, H = \
+                self.measurement_model.evaluate_h_and_dh_func(
+                    self.predicted_state)
+            np.copyto(self.H, H)
+            self.jacobean_age = 0
+
+            #Exponential moving average of the measurement model time
+            measurement_time = time.perf_counter() - measurement_start
+            if self.measurement_time is None:
+                self.measurement_time = measurement_time
+            else:
+                self.measurement_time += 0.1*(measurement_time
+                                              - self.measurement_time)
+
+        self.calculated_measurement_ = expected_measurements
+        H = self.H
+
+        #Calculate the innovation
+        np.subtract(sensor_measurements, expected_measurements,
+                    out=self.y_tilde)
+
+        #S = H P H^T + R, verify that S-R is PD before adding R. Repair it
+        # the same way as the base filter
+        np.matmul(self.predicted_covariance, H.T, out=self.PHT)
+        np.matmul(H, self.PHT, out=self.S)
+        if not self._validate_pd(self.S, "S-R"):
+            np.copyto(self.S, math_utils.nearest_pd(self.S, "S-R"))
+        np.add(self.S, R, out=self.S)
+
+        #Calculate the Kalman Gain K = P H^T S^-1 by factorizing S in place
+        # and solving K^T = S^-1 H P in place. Raise the same error as the
+        # base filter if the factorization fails
+        np.copyto(self._KT, self.PHT.T)
+        S_factor, info = dpotrf(self.S, lower=1, overwrite_a=1, clean=0)
+        if info != 0:
+            raise AssertionError("S is not positive definite")
+        KT, _ = dpotrs(S_factor, self._KT, lower=1, overwrite_b=1)
+        K = KT.T
+
+        #Calculate the updated covariance
+        np.matmul(K, H, out=self._KH)
+        np.subtract(self._identity, self._KH, out=self._I_KH)
+        if self.covariance_update == self.JOSEPH_UPDATE:
+            np.matmul(self._I_KH, self.predicted_covariance, out=self._I_KH_P)
+            np.matmul(self._I_KH_P, self._I_KH.T, out=self.P)
+            np.matmul(K, R, out=self._KR)
+            np.matmul(self._KR, K.T, out=self._KRKT)
+            np.add(self.P, self._KRKT, out=self.P)
+        else:
+            np.matmul(self._I_KH, self.predicted_covariance, out=self.P)
+
+        #Calculate the updated state and saturate it
+        np.matmul(K, self.y_tilde, out=self.delta_state)
+        np.add(self.predicted_state, self.delta_state, out=self.x)
+        np.clip(self.x, self.lower_state_limit, self.upper_state_limit,
+                out=self.x)
+
+        #Verify that updated covariance is done
+        if not self._validate_pd(self.P, "Updated Covariance"):
+            np.copyto(self.P, math_utils.nearest_pd(self.P,
+                                                    "Updated Covariance"))
+
+        # Calculate the output
+        if (self.output_model is not None):
+            self.output = self.output_model.evaluate_h_func(self.x)
+
+        self._record_latency(time.perf_counter() - start)
+
+        return self.x, self.P
+
+
+    def _record_latency(self, latency):
+        """
+        Store the latency of a step and check the deadline
+        """
+        self.latencies[self.num_steps % self.latencies.shape[0]] = latency
+        self.num_steps += 1
+
+        if latency > self.worst_case_latency:
+            self.worst_case_latency = latency
+
+        self.deadline_missed = latency > self.deadline
+        if self.deadline_missed:
+            self.deadline_misses += 1
+
+
+
+def replay_latency(ekf: RealTimeExtendedKalmanFilter,
+                   sensor_measurements: np.ndarray, time_step: float,
+                   warmup_steps: int = 0) -> LatencyReport:
+    """
+    Run the filter over a recorded trial and report the step latency
+
+    Keyword Arguments
+    ekf -- real time filter to run
+    sensor_measurements -- measurements of every step
+        shape(num_steps, num_measurements)
+    time_step -- time between measurements in seconds
+    warmup_steps -- the first steps are not included in the report, e.g.
+        to let the caches and workspaces warm up
+
+    Returns
+    report -- latency of the steps after the warm up
+    """
+    #Column vectors of every measurement, created before the run
+    measurement_columns = sensor_measurements[:,:,np.newaxis]
+
+    for i in range(measurement_columns.shape[0]):
+        if i == warmup_steps:
+            ekf.reset_latency_stats()
+        ekf.calculate_next_estimates(time_step, measurement_columns[i])
+
+    return ekf.get_latency_report()
@@ -0,0 +1,162 @@
+"""
+This file defines an offline replay engine that runs a filter over a
+recorded trial
+
+The loop only calls the filter and copies its estimates into preallocated
+arrays. Everything else, e.g. the innovations and the rmse, is calculated
+with vectorized operations after the run
+"""
+
+#Standard Imports
+import numpy as np
+
+#For docstring
+from typing import Callable, Union
+from dataclasses import dataclass
+
+
+def phase_distance(phase_a : np.ndarray, phase_b : np.ndarray) -> np.ndarray:
+    """
+    Distance between phases that accounts for the modular arithmetic of
+    phase. The output is between 0 and 0.5
+    """
+    distance = np.abs(phase_a - phase_b)
+    return np.where(distance < 0.5, distance, 1 - distance)
+
+
+def calculate_state_rmse(estimated_states : np.ndarray,
+                         true_states : np.ndarray,
+                         start_index : int = 0,
+                         num_datapoints : int = None,
+                         phase_index : int = 0) -> np.ndarray:
+    """
+    Calculate the rmse of every state using the phase distance for phase
+
+    Keyword Arguments:
+    estimated_states -- shape(num_steps, num_states) or more states than
+        true_states, the extra states are ignored
+    true_states -- shape(num_steps, num_states)
+    start_index -- first step that is included, e.g. to skip the
+        convergence of the filter
+    num_datapoints -- the squared errors are divided by this. Defaults to
+        the amount of steps that are included
+    phase_index -- index of the phase state
+
+    Returns:
+    rmse -- shape(num_states,)
+    """
+    num_states = true_states.shape[1]
+    errors = estimated_states[start_index:,:num_states] \
+        - true_states[start_index:]
+    errors[:,phase_index] = phase_distance(
+        estimated_states[start_index:,phase_index],
+        true_states[start_index:,phase_index])
+
+    if num_datapoints is None:
+        num_datapoints = errors.shape[0]
+
+    return np.sqrt(np.einsum('ij,ij->j', errors, errors)/num_datapoints)
+
+
+@dataclass(repr=False)
+class ReplayResult:
+    """
+    This class stores the estimates of every step of a replay. The first
+    axis of every array is the step
+    """
+    #State after the update step, shape(num_steps, num_states)
+    states: np.ndarray
+    #Diagonal of the updated covariance, shape(num_steps, num_states)
+    covariance_diagonals: np.ndarray
+    #Expected measurements at the predicted state
+    # shape(num_steps, num_measurements)
+    predicted_measurements: np.ndarray
+    #Sensor measurements that were replayed
+    # shape(num_steps, num_measurements)
+    measurements: np.ndarray
+
+    @property
+    def innovations(self) -> np.ndarray:
+        """
+        Measurements minus the expected measurements
+        shape(num_steps, num_measurements)
+        """
+        return self.measurements - self.predicted_measurements
+
+
+    def get_state_rmse(self, true_states : np.ndarray, start_index : int = 0,
+                       num_datapoints : int = None) -> np.ndarray:
+        """
+        Rmse of the states against the ground truth, see calculate_state_rmse
+        """
+        return calculate_state_rmse(self.states, true_states, start_index,
+                                    num_datapoints)
+
+
+    def get_measurement_rmse(self, start_index : int = 0,
+                             num_datapoints : int = None) -> np.ndarray:
+        """
+        Rmse of the expected measurements against the sensor measurements
+
+        Keyword Arguments:
+        start_index -- first step that is included
+        num_datapoints -- the squared errors are divided by this. Defaults
+            to the amount of steps that are included
+
+        Returns:
+        rmse -- shape(num_measurements,)
+        """
+        innovations = self.innovations[start_index:]
+
+        if num_datapoints is None:
+            num_datapoints = innovations.shape[0]
+
+        return np.sqrt(np.einsum('ij,ij->j', innovations, innovations)
+                       / num_datapoints)
+
+
+def replay_ekf(ekf, sensor_measurements : np.ndarray,
+               time_steps : Union[float, np.ndarray],
+               step_callback : Callable = None) -> ReplayResult:
+    """
+    Run the filter over every measurement of a trial
+
+    Keyword Arguments:
+    ekf -- Extended_Kalman_Filter or any filter with the same interface
+    sensor_measurements -- shape(num_steps, num_measurements)
+    time_steps -- time step of every measurement, shape(num_steps,), or
+        one time step for all of them
+    step_callback -- optional, called with (step_index, ekf) after every
+        step, e.g. to plot in real time
+
+    Returns:
+    ReplayResult
+    """
+    num_steps, num_measurements = sensor_measurements.shape
+    num_states = ekf.num_states
+
+    time_steps = np.broadcast_to(np.asarray(time_steps, dtype=float),
+                                 (num_steps,))
+
+    #Column vectors of every measurement, created before the run
+    measurement_columns = sensor_measurements[:,:,np.newaxis]
+
+    states = np.empty((num_steps, num_states))
+    covariance_diagonals = np.empty((num_steps, num_states))
+    predicted_measurements = np.empty((num_steps, num_measurements))
+
+    for i in range(num_steps):
+        state, covariance = ekf.calculate_next_estimates(
+            time_steps[i], measurement_columns[i])
+
+        states[i] = state[:,0]
+        covariance_diagonals[i] = np.diagonal(covariance)
+        predicted_measurements[i] = ekf.calculated_measurement_[:,0]
+
+        if step_callback is not None:
+            step_callback(i, ekf)
+
+    return ReplayResult(states=states,
+                        covariance_diagonals=covariance_diagonals,
+                        predicted_measurements=predicted_measurements,
+                        measurements=sensor_measurements)
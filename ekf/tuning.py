@@ -0,0 +1,334 @@
+"""
+This file implements a process noise tuner based on successive halving
+
+Every candidate process noise is evaluated on a short prefix of a validation
+trial. The best fraction of the candidates continue to longer prefixes and
+the rest are dropped, until the survivors run on the whole trial. The
+survivors continue from their current estimates, so no step is filtered
+twice. Candidates that diverge, i.e. their states are not finite, too far
+from the ground truth or their covariance fails the positive definite check,
+are stopped as soon as it is detected
+
+The candidates can run one Extended_Kalman_Filter at a time or all together
+in a BatchedExtendedKalmanFilter
+
+E.g.
+    def create_filter(q_diagonal):
+        return Extended_Kalman_Filter(..., np.diag(q_diagonal), ...)
+
+    result = successive_halving(state_data, sensor_data, time_steps,
+                                q_diagonals, create_filter=create_filter)
+    print(result.best_q_diagonal)
+"""
+
+#Standard Imports
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass, field
+
+#Import from same folder
+from .replay import replay_ekf, phase_distance
+from .context import math_utils
+
+#For docstring
+from typing import Callable, List, Tuple
+
+
+@dataclass(repr=False)
+class TuningResult:
+    """
+    Scores of every candidate at the last prefix that it was evaluated on
+    """
+    #Process noise diagonal of every candidate
+    # shape(num_candidates, num_states)
+    q_diagonals: np.ndarray
+    #Weighted sum of the state rmse, inf if the candidate diverged
+    # shape(num_candidates,)
+    scores: np.ndarray
+    #Rmse of every state, shape(num_candidates, num_ground_truth_states)
+    rmse: np.ndarray
+    #Amount of steps that every candidate ran
+    steps_run: np.ndarray
+    #True if the candidate diverged
+    diverged: np.ndarray
+    #Prefix length and candidates of every round
+    rounds: List[Tuple[int, np.ndarray]] = field(default_factory=list)
+
+    @property
+    def best_index(self) -> int:
+        """
+        Candidate with the lowest score among the ones that ran the most
+        steps
+        """
+        scores = np.where(self.steps_run == self.steps_run.max(),
+                          self.scores, np.inf)
+        return int(np.argmin(scores))
+
+    @property
+    def best_q_diagonal(self) -> np.ndarray:
+        return self.q_diagonals[self.best_index]
+
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns a dataframe with one row per candidate
+        """
+        dataframe = pd.DataFrame(self.q_diagonals,
+            columns=[f"q_{i}" for i in range(self.q_diagonals.shape[1])])
+        for i in range(self.rmse.shape[1]):
+            dataframe[f"rmse_{i}"] = self.rmse[:,i]
+        dataframe['score'] = self.scores
+        dataframe['steps_run'] = self.steps_run
+        dataframe['diverged'] = self.diverged
+        return dataframe
+
+
+
+class _SequentialCandidates():
+    """
+    Runs the candidates one filter at a time with the replay engine
+    """
+
+    def __init__(self, create_filter : Callable, q_diagonals : np.ndarray):
+        self.filters = [create_filter(q_diagonal)
+                        for q_diagonal in q_diagonals]
+
+
+    def run(self, sensor_data : np.ndarray, time_steps : np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the states, shape(num_steps, num_candidates, num_states), and
+        the candidates that failed. Less steps are returned if a candidate
+        failed before the last step
+        """
+        states = np.full((sensor_data.shape[0], len(self.filters),
+                          self.filters[0].num_states), np.nan)
+        failed = np.zeros(len(self.filters), dtype=bool)
+
+        for i, ekf in enumerate(self.filters):
+            try:
+                states[:,i] = replay_ekf(ekf, sensor_data, time_steps).states
+            #Positive definite check failures and cholesky failures
+            except (AssertionError, np.linalg.LinAlgError):
+                failed[i] = True
+
+        return states, failed
+
+
+    def keep(self, mask : np.ndarray):
+        self.filters = [ekf for ekf, keep in zip(self.filters, mask) if keep]
+
+
+
+class _BatchedCandidates():
+    """
+    Runs all the candidates in one batched filter
+    """
+
+    def __init__(self, create_batched_filter : Callable,
+                 q_diagonals : np.ndarray):
+        self.batched_filter = create_batched_filter(q_diagonals)
+
+        #A failed check would raise for all the candidates at once
+        if not self.batched_filter.repair_covariance:
+            raise ValueError("The batched filter has to repair the "
+                             "covariances so that the candidates that "
+                             "fail the positive definite check can be "
+                             "stopped individually")
+
+        #The covariances of every step have to be checked, otherwise a
+        # candidate that is not positive definite is not stopped
+        if math_utils.pd_check_policy in (math_utils.PD_CHECK_OFF,
+                                          math_utils.PD_CHECK_EVERY_N):
+            raise ValueError("The batched candidates need the 'on_failure' "
+                             "or 'full' positive definite check policy")
+
+
+    def run(self, sensor_data : np.ndarray, time_steps : np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        batched_filter = self.batched_filter
+        states = np.empty((sensor_data.shape[0], batched_filter.num_filters,
+                           batched_filter.num_states))
+
+        measurement_columns = sensor_data[:,:,np.newaxis]
+        for i in range(sensor_data.shape[0]):
+            states[i], _ = batched_filter.calculate_next_estimates(
+                time_steps[i], measurement_columns[i])
+
+            #Return early so that the failed candidates are stopped before
+            # their estimates blow up. The repair only handles covariances
+            # that are finite, so the ones that are not are stopped too
+            failed = (batched_filter.pd_failures > 0) | ~self._is_finite()
+            if np.any(failed):
+                return states[:i+1], failed
+
+        return states, failed
+
+
+    def _is_finite(self) -> np.ndarray:
+        """
+        Returns True for the candidates whose states and covariances are
+        finite
+        """
+        batched_filter = self.batched_filter
+        return np.all(np.isfinite(batched_filter.x), axis=1) \
+            & np.all(np.isfinite(batched_filter.P), axis=(1,2))
+
+
+    def keep(self, mask : np.ndarray):
+        self.batched_filter.select_filters(mask)
+
+
+
+def get_prefix_lengths(min_steps : int, max_steps : int,
+                       reduction_factor : int) -> List[int]:
+    """
+    Returns the prefix length of every round, min_steps multiplied by the
+    reduction factor every round and ending at max_steps
+    """
+    prefix_lengths = []
+    prefix_length = min_steps
+    while prefix_length < max_steps:
+        prefix_lengths.append(prefix_length)
+        prefix_length *= reduction_factor
+    prefix_lengths.append(max_steps)
+    return prefix_lengths
+
+
+def successive_halving(state_data : np.ndarray, sensor_data : np.ndarray,
+                       time_steps : np.ndarray, q_diagonals : np.ndarray,
+                       create_filter : Callable = None,
+                       create_batched_filter : Callable = None,
+                       min_steps : int = 10*150, max_steps : int = None,
+                       reduction_factor : int = 3,
+                       rmse_start_index : int = 0,
+                       state_weights : np.ndarray = None,
+                       max_state_error : np.ndarray = None,
+                       check_interval : int = 150) -> TuningResult:
+    """
+    Find the process noise with the lowest weighted state rmse
+
+    Keyword Arguments:
+    state_data -- ground truth states, shape(num_steps, num_states)
+    sensor_data -- measurements, shape(num_steps, num_measurements)
+    time_steps -- time step of every measurement, shape(num_steps,)
+    q_diagonals -- process noise diagonal of every candidate
+        shape(num_candidates, num_filter_states)
+    create_filter -- function that creates an Extended_Kalman_Filter for a
+        process noise diagonal
+    create_batched_filter -- alternative to create_filter, function that
+        creates a BatchedExtendedKalmanFilter with repair_covariance set for
+        a stack of process noise diagonals. The math_utils positive definite
+        check policy has to be 'on_failure' or 'full' so that the candidates
+        that fail are found every step
+    min_steps -- prefix length of the first round
+    max_steps -- prefix length of the last round. Defaults to all the steps
+    reduction_factor -- only 1/reduction_factor of the candidates continue
+        to the next round, whose prefix is reduction_factor times longer
+    rmse_start_index -- steps before this are not scored, e.g. to let the
+        filter converge. It has to be less than min_steps
+    state_weights -- weight of the rmse of every state in the score.
+        Defaults to one over the standard deviation of every state
+    max_state_error -- optional, a candidate diverged if the error of a
+        state is larger than this, shape(num_states,). Phase uses the phase
+        distance
+    check_interval -- amount of steps between divergence checks
+
+    Returns:
+    TuningResult
+    """
+    if (create_filter is None) == (create_batched_filter is None):
+        raise ValueError("Set either create_filter or create_batched_filter")
+
+    q_diagonals = np.atleast_2d(np.asarray(q_diagonals, dtype=float))
+    num_candidates = q_diagonals.shape[0]
+    num_states = state_data.shape[1]
+
+    if max_steps is None:
+        max_steps = state_data.shape[0]
+    min_steps = min(min_steps, max_steps)
+    if rmse_start_index >= min_steps:
+        raise ValueError("rmse_start_index has to be less than min_steps")
+
+    time_steps = np.broadcast_to(np.asarray(time_steps, dtype=float),
+                                 (state_data.shape[0],))
+
+    if state_weights is None:
+        state_std = np.std(state_data[:max_steps], axis=0)
+        state_weights = np.reciprocal(np.where(state_std > 0, state_std, 1))
+
+    if create_filter is not None:
+        candidates = _SequentialCandidates(create_filter, q_diagonals)
+    else:
+        candidates = _BatchedCandidates(create_batched_filter, q_diagonals)
+
+    squared_errors = np.zeros((num_candidates, num_states))
+    rmse = np.full((num_candidates, num_states), np.nan)
+    scores = np.full(num_candidates, np.nan)
+    steps_run = np.zeros(num_candidates, dtype=np.int64)
+    diverged = np.zeros(num_candidates, dtype=bool)
+    rounds = []
+
+    #Indices of the candidates that are still running
+    active = np.arange(num_candidates)
+    step = 0
+
+    prefix_lengths = get_prefix_lengths(min_steps, max_steps,
+                                        reduction_factor)
+
+    for round_index, prefix_length in enumerate(prefix_lengths):
+
+        #Continue the candidates from the end of the previous prefix
+        while step < prefix_length and active.shape[0] > 0:
+            end = min(step + check_interval, prefix_length)
+
+            states, failed = candidates.run(sensor_data[step:end],
+                                            time_steps[step:end])
+            end = step + states.shape[0]
+
+            #Errors of the active candidates
+            # shape(num_steps, num_active, num_states)
+            true_states = state_data[step:end, np.newaxis]
+            errors = states[:,:,:num_states] - true_states
+            errors[:,:,0] = phase_distance(states[:,:,0], true_states[:,:,0])
+
+            scored_errors = errors[max(rmse_start_index - step, 0):]
+            squared_errors[active] += np.einsum('tij,tij->ij', scored_errors,
+                                                scored_errors)
+
+            #Stop the candidates that diverged
+            failed |= ~np.all(np.isfinite(states), axis=(0,2))
+            if max_state_error is not None:
+                with np.errstate(invalid='ignore'):
+                    failed |= np.any(np.abs(errors[-1]) > max_state_error,
+                                     axis=1)
+
+            steps_run[active] = end
+            if np.any(failed):
+                diverged[active[failed]] = True
+                active = active[~failed]
+                candidates.keep(~failed)
+
+            step = end
+
+        #Score the candidates that finished the prefix
+        rmse[active] = np.sqrt(squared_errors[active]
+                               / (step - rmse_start_index))
+        scores[active] = rmse[active] @ state_weights
+        rounds.append((prefix_length, active.copy()))
+
+        if round_index == len(prefix_lengths) - 1 or active.shape[0] == 0:
+            break
+
+        #Keep the best candidates
+        num_keep = int(np.ceil(active.shape[0]/reduction_factor))
+        keep = np.zeros(active.shape[0], dtype=bool)
+        keep[np.argsort(scores[active], kind='stable')[:num_keep]] = True
+        active = active[keep]
+        candidates.keep(keep)
+
+    scores[diverged] = np.inf
+
+    return TuningResult(q_diagonals=q_diagonals, scores=scores, rmse=rmse,
+                        steps_run=steps_run, diverged=diverged,
+                        rounds=rounds)
@@ -38,6 +38,19 @@ class FitModel(KroneckerModel):
         raise NotImplementedError("Please implement this method")
 
 
+    def get_model_fit(self) -> np.ndarray:
+        """
+        This is an abstract method that returns the model fit vector that 
+        evaluate uses by default, such that 
+        evaluate(x) = get_kronecker_output(x) @ get_model_fit().T
+
+        Returns
+        model_fit: numpy array with shape (1, model_output_size)
+        """
+
+        raise NotImplementedError("Please implement this method")
+
+
     def get_kronecker_output(self,input_data:np.ndarray):
         """
         This function is meant to allow access to the vector output of the 
@@ -101,6 +114,13 @@ class SimpleFitModel(FitModel):
         return output
 
 
+    def get_model_fit(self) -> np.ndarray:
+        """
+        Returns the model fit with shape (1, model_output_size)
+        """
+        return self.model_fit
+
+
 
 class PersonalKModel(FitModel):
 
@@ -163,6 +183,39 @@ class PersonalKModel(FitModel):
         #Keep the output name
         self.output_name = output_name
 
+        #Fold the average fit, personalization map and gait fingerprint 
+        # into one fit vector so that it is not recalculated every evaluation
+        self._fold_personalized_fit()
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+
+        #Models pickled before the fit was folded need to calculate it
+        if 'personalized_fit' not in state:
+            self._fold_personalized_fit()
+
+    def _fold_personalized_fit(self):
+        """
+        Calculate the model fit vector for the stored gait fingerprint
+        """
+        if self.subject_gait_fingerprint is None:
+            self.personalized_fit = None
+        else:
+            self.personalized_fit = self.average_fit + \
+                                    self.subject_gait_fingerprint @ self.pmap
+
+    def get_model_fit(self) -> np.ndarray:
+        """
+        Returns the fit vector used in the default evaluation (EVAL_GF_FIT)
+        with shape (1, model_output_size)
+        """
+        #Return error if the object was not initialized 
+        if(self.personalized_fit is None):
+            raise AttributeError("Object was not initialized \
+                        with a personalized_fit parameter")
+
+        return self.personalized_fit
+
     def get_subject_name(self):
         """
         Returns the subjects name, if any
@@ -176,6 +229,7 @@ class PersonalKModel(FitModel):
         Set the personalization map of the model
         """
         self.pmap = new_pmap
+        self._fold_personalized_fit()
 
 
     def evaluate(self, input_data:np.ndarray, 
@@ -224,22 +278,13 @@ class PersonalKModel(FitModel):
         #Calculate the output of the kronecker model
         # shape(num_datapoints, model_output_size)
         if kronecker_output is None:
-            kronecker_output = self.model.evaluate(input_data)
+            kronecker_output = self.get_kronecker_output(input_data)
 
         #Get the gait_fingerprints
         if(eval_cond == self.EVAL_GF_FIT):
 
-            #Return error if the object was not initialized 
-            if(self.subject_gait_fingerprint is None):
-                raise AttributeError("Object was not initialized \
-                            with a personalized_fit parameter")
-                
-            #Use the gait fingerprint stored
-            gait_fingerprints = self.subject_gait_fingerprint
-
-            #Calculate the model fit vector
-            model_fit_vector = self.average_fit + \
-                                 gait_fingerprints @ self.pmap
+            #Use the pre-calculated fit for the stored gait fingerprint
+            model_fit_vector = self.get_model_fit()
 
         #Don't do any personalization and use the average fit
         elif(eval_cond == self.EVAL_AVERAGE_FIT):
@@ -258,7 +303,7 @@ class PersonalKModel(FitModel):
             
             #Default behaviour, use the gait fingerprints from the dataset
             #The gait fingeprints will be after the model variables
-            gait_fingerprints = input_data[:, self.num_models:]
+            gait_fingerprints = input_data[:, self.num_basis:]
             
             #Use the gait fingerprint with the personalization map
             model_fit_vector = self.average_fit + \
@@ -20,10 +20,58 @@ class Basis:
         self.n = n
         self.var_name = var_name
 
+    def __setstate__(self, state):
+        #Recreate the pre-computed attributes so that bases pickled with 
+        # older versions of this file still load
+        self.__dict__.update(state)
+        self.__init__(self.n, self.var_name)
+
     #Need to implement with other subclasses
     def evaluate(self,x):
         pass
 
+    def evaluate_into(self,x,out,scratch=None):
+        """
+        Evaluate the basis at x and store the result in out
+
+        Subclasses override this to evaluate without allocating memory
+
+        Keyword Arguments
+        x -- points to evaluate the basis at, shape(num_datapoints, 1)
+        out -- buffer for the result, shape(num_datapoints, size)
+        scratch -- buffer for intermediate results, shape(num_datapoints, 1)
+        """
+        out[:] = self.evaluate(x).reshape(out.shape)
+
+    def evaluate_derivative_into(self,x,order,out,scratch=None):
+        """
+        Evaluate the derivative of the basis at x and store the result in out
+
+        Subclasses override this to evaluate without allocating memory
+
+        Keyword Arguments
+        x -- points to evaluate the basis at, shape(num_datapoints, 1)
+        order -- order of the derivative, must be at least one
+        out -- buffer for the result, shape(num_datapoints, size)
+        scratch -- buffer for intermediate results, shape(num_datapoints, 1)
+        """
+        out[:] = self.evaluate_derivative(x, order)
+
+    #Need to implement with other subclasses
+    def evaluate_derivative(self,x,order=1):
+        """
+        Evaluate the derivative of every basis function at x
+
+        Keyword Arguments
+        x -- points to evaluate the basis at, shape(num_datapoints, 1)
+        order -- order of the derivative, must be at least one
+
+        Returns
+        output -- derivative of each basis function
+                  shape(num_datapoints, size)
+        """
+        raise NotImplementedError("Please implement this method")
+
 
 ##Define classes that will be used to calculate kronecker products in real time
 
@@ -40,6 +88,9 @@ class PolynomialBasis(Basis):
         #Pre-allocate memory to 
         self.__one_array = np.ones((1,n))
         self.__one_array_copy = np.ones((1,n))
+        #Cache the (coefficient, power) pairs for every derivative order
+        self.__derivative_terms = {}
+
     #This function will evaluate the model at the given x value
     def evaluate(self,x,derivative=0):
         
@@ -48,23 +99,56 @@ class PolynomialBasis(Basis):
             return np.power(x * self.__one_array,self.__powers)
         
         elif derivative > 0:
-            #Temprorarily change one array to zero out elements
-            # this avoids memory allocation in run time
-            self.__one_array[:derivative] = 0
-            #Get the correct power values using max, out argument places the 
-            # results in the powers matrix
-            self.__powers = np.max(0, self.__powers - derivative,
-                                    out=self.__powers)
-            out = np.power(x * self.__one_array,self.__powers)
-            #Reset values
-            self.__one_array[:] = self.__one_array_copy
-            self.__powers[:] = self.__powers_copy
-            
-            return out
+            return self.evaluate_derivative(x, derivative)
         else:
             raise ValueError("Derivative must be greater than zero")
         #return np.polynomial.polynomial.polyvander(x, self.n-1)
 
+    def evaluate_derivative(self,x,order=1):
+        """
+        Evaluate the derivative of every monomial at x
+
+        d^k/dx^k x^p = p!/(p-k)! x^(p-k), which is zero when p < k
+
+        Keyword Arguments
+        x -- points to evaluate the basis at, shape(num_datapoints, 1)
+        order -- order of the derivative, must be at least one
+
+        Returns
+        output -- derivative of each monomial
+                  shape(num_datapoints, n)
+        """
+        coefficients, powers = self.__get_derivative_terms(order)
+
+        return coefficients * np.power(x.reshape(-1,1) * self.__one_array,
+                                       powers)
+
+    def __get_derivative_terms(self, order):
+        """
+        Returns the falling factorial coefficients and reduced powers for a 
+        derivative order. They are only calculated once
+        """
+        if order < 1:
+            raise ValueError("Derivative must be greater than zero")
+
+        if order not in self.__derivative_terms:
+            coefficients = np.ones(self.n)
+            for i in range(order):
+                coefficients *= (self.__powers_copy - i)
+            powers = np.maximum(self.__powers_copy - order, 0)
+            self.__derivative_terms[order] = (coefficients.reshape(1,-1),
+                                              powers)
+
+        return self.__derivative_terms[order]
+
+    def evaluate_into(self,x,out,scratch=None):
+        np.power(x, self.__powers_copy, out=out)
+
+    def evaluate_derivative_into(self,x,order,out,scratch=None):
+        coefficients, powers = self.__get_derivative_terms(order)
+        np.power(x, powers, out=out)
+        np.multiply(out, coefficients, out=out)
+
 
          
 
@@ -99,22 +183,116 @@ class FourierBasis(Basis):
         self.size = 2*n+1
         self.name = "Fourier"
 
+        #Angular frequency of every harmonic
+        self.frequencies = 2*np.pi*np.arange(1,n+1).reshape(1,-1)
+
+        #Cache the derivative scale for every derivative order
+        self._derivative_scales = {}
+
     #This function will evaluate the model at the given x value
     def evaluate(self,x):
         x = x.reshape(-1,1)
 
-        #l is used to generate the coefficients of the series
-        l = np.arange(1,self.n+1).reshape(1,-1)
-        
         #Initialize everything as empty for speed increase to get 
         result = np.empty((x.shape[0],self.size))
 
-        result[:,0] = 1
-        result[:,1:self.n+1] = np.sin(2*np.pi*x @ l)
-        result[:,self.n+1:] =  np.cos(2*np.pi*x @ l)
+        self.evaluate_into(x, result)
         
         return result
 
+    def evaluate_into(self,x,out,scratch=None):
+        #Use the sine columns to store the angle of every harmonic
+        sin_columns = out[:,1:self.n+1]
+        np.multiply(x, self.frequencies, out=sin_columns)
+        np.cos(sin_columns, out=out[:,self.n+1:])
+        np.sin(sin_columns, out=sin_columns)
+        out[:,0] = 1
+
+    def _get_derivative_scale(self, order):
+        """
+        Returns w^k for the derivative order k. Only calculated once
+        """
+        if order < 1:
+            raise ValueError("Derivative must be greater than zero")
+
+        if order not in self._derivative_scales:
+            self._derivative_scales[order] = np.power(self.frequencies, order)
+
+        return self._derivative_scales[order]
+
+    def evaluate_derivative(self,x,order=1):
+        """
+        Evaluate the derivative of the fourier series terms at x
+
+        The k-th derivative of sin(wx) is w^k sin(wx + k*pi/2) and 
+        the k-th derivative of cos(wx) is w^k cos(wx + k*pi/2). The 
+        constant term vanishes
+
+        Keyword Arguments
+        x -- points to evaluate the basis at, shape(num_datapoints, 1)
+        order -- order of the derivative, must be at least one
+
+        Returns
+        output -- derivative of each term, shape(num_datapoints, 2*n + 1)
+        """
+        x = x.reshape(-1,1)
+
+        result = np.empty((x.shape[0],self.size))
+
+        self.evaluate_derivative_into(x, order, result)
+
+        return result
+
+    def evaluate_derivative_into(self,x,order,out,scratch=None):
+        scale = self._get_derivative_scale(order)
+
+        #Argument of the trigonometric functions with the derivative shift
+        sin_columns = out[:,1:self.n+1]
+        cos_columns = out[:,self.n+1:]
+        np.multiply(x, self.frequencies, out=sin_columns)
+        np.add(sin_columns, order*np.pi/2, out=sin_columns)
+        np.cos(sin_columns, out=cos_columns)
+        np.sin(sin_columns, out=sin_columns)
+        np.multiply(sin_columns, scale, out=sin_columns)
+        np.multiply(cos_columns, scale, out=cos_columns)
+        out[:,0] = 0
+
+
+def _orthogonal_polynomial_derivative(x, n, order, vander, der,
+                                      derivative_cache):
+    """
+    Evaluate the derivative of an orthogonal polynomial family
+
+    The derivative of the k-th polynomial is expressed in the same family
+    with the derivative matrix from numpy, such that
+    d^m/dx^m vander(x, n-1) = vander(x, n-1-m) @ der(I, m)
+
+    Keyword Arguments
+    x -- points to evaluate the basis at
+    n -- number of polynomials in the basis
+    order -- order of the derivative
+    vander -- numpy vandermonde function for the family
+    der -- numpy differentiation function for the family
+    derivative_cache -- dictionary to store the derivative matrices
+
+    Returns
+    output -- derivative of each polynomial, shape(num_datapoints, n)
+    """
+    if order < 1:
+        raise ValueError("Derivative must be greater than zero")
+
+    x = x.reshape(-1)
+
+    #Every polynomial is differentiated to zero
+    if order >= n:
+        return np.zeros((x.shape[0], n))
+
+    #Only calculate the derivative matrix once
+    if order not in derivative_cache:
+        derivative_cache[order] = der(np.eye(n), order)
+
+    return vander(x, n-1-order) @ derivative_cache[order]
+
 
 class LegendreBasis(Basis):
     "Legendre polynomials are on [-1,1]"
@@ -122,10 +300,31 @@ class LegendreBasis(Basis):
         Basis.__init__(self, n, var_name)
         self.size = n
         self.name = "Legendre"
+        self._derivative_matrices = {}
 
     def evaluate(self,x):
         return np.polynomial.legendre.legvander(x, self.n-1)
 
+    def evaluate_into(self,x,out,scratch=None):
+        if scratch is None:
+            scratch = np.empty((x.shape[0],1))
+
+        #Bonnet recursion (k+1)P_k+1 = (2k+1)xP_k - kP_k-1
+        out[:,0] = 1
+        if self.n > 1:
+            out[:,1:2] = x
+        for k in range(1,self.n-1):
+            column = out[:,k+1:k+2]
+            np.multiply(x, out[:,k:k+1], out=column)
+            np.multiply(column, (2*k+1)/(k+1), out=column)
+            np.multiply(out[:,k-1:k], k/(k+1), out=scratch)
+            np.subtract(column, scratch, out=column)
+
+    def evaluate_derivative(self,x,order=1):
+        return _orthogonal_polynomial_derivative(x, self.n, order,
+            np.polynomial.legendre.legvander, np.polynomial.legendre.legder,
+            self._derivative_matrices)
+
 
 class ChebyshevBasis(Basis):
 
@@ -134,10 +333,27 @@ class ChebyshevBasis(Basis):
         Basis.__init__(self, n, var_name)
         self.size = n
         self.name = "Chebyshev"
+        self._derivative_matrices = {}
 
     def evaluate(self, x):
         return np.polynomial.chebyshev.chebvander(x, self.n-1)
 
+    def evaluate_into(self,x,out,scratch=None):
+        #Recursion T_k+1 = 2xT_k - T_k-1
+        out[:,0] = 1
+        if self.n > 1:
+            out[:,1:2] = x
+        for k in range(1,self.n-1):
+            column = out[:,k+1:k+2]
+            np.multiply(x, out[:,k:k+1], out=column)
+            np.multiply(column, 2, out=column)
+            np.subtract(column, out[:,k-1:k], out=column)
+
+    def evaluate_derivative(self,x,order=1):
+        return _orthogonal_polynomial_derivative(x, self.n, order,
+            np.polynomial.chebyshev.chebvander, np.polynomial.chebyshev.chebder,
+            self._derivative_matrices)
+
 
 class HermiteBasis(Basis):
     "Hermite polynomials are on [-inf,inf]"
@@ -145,6 +361,26 @@ class HermiteBasis(Basis):
         Basis.__init__(self, n, var_name)
         self.size = n
         self.name = "Hermite"
+        self._derivative_matrices = {}
 
     def evaluate(self,x):
         return np.polynomial.hermite_e.hermevander(x, self.n-1)
+
+    def evaluate_into(self,x,out,scratch=None):
+        if scratch is None:
+            scratch = np.empty((x.shape[0],1))
+
+        #Recursion He_k+1 = xHe_k - kHe_k-1
+        out[:,0] = 1
+        if self.n > 1:
+            out[:,1:2] = x
+        for k in range(1,self.n-1):
+            column = out[:,k+1:k+2]
+            np.multiply(x, out[:,k:k+1], out=column)
+            np.multiply(out[:,k-1:k], k, out=scratch)
+            np.subtract(column, scratch, out=column)
+
+    def evaluate_derivative(self,x,order=1):
+        return _orthogonal_polynomial_derivative(x, self.n, order,
+            np.polynomial.hermite_e.hermevander, np.polynomial.hermite_e.hermeder,
+            self._derivative_matrices)
@@ -8,10 +8,128 @@ that takes different function bases and combines them
 import pandas as pd
 import numpy as np
 from .function_bases import Basis
-from typing import List, Union
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+
+class _KroneckerWorkspace():
+    """
+    Pre-allocated buffers to evaluate the kronecker rows for a fixed number 
+    of datapoints and list of derivatives without allocating memory
+
+    The returned output buffer is overwritten every time that evaluate 
+    is called
+    """
+
+    def __init__(self, basis_list: List[Basis], num_datapoints: int,
+                 derivative_list: List[Tuple[int, ...]]):
+        """
+        Keyword arguments:
+        basis_list -- function bases of the kronecker model
+        num_datapoints -- number of rows that will be evaluated
+        derivative_list -- list of tuples with the derivative order for each
+                           basis
+        """
+
+        num_basis = len(basis_list)
+        basis_sizes = [basis.size for basis in basis_list]
+        output_size = int(np.prod(basis_sizes))
+
+        self.basis_list = basis_list
+        self.num_datapoints = num_datapoints
+
+        #Buffer for every (basis, derivative order) pair
+        self.basis_buffers = OrderedDict()
+        for derivative_orders in derivative_list:
+            for i,order in enumerate(derivative_orders):
+                if (i,order) not in self.basis_buffers:
+                    self.basis_buffers[(i,order)] = \
+                        np.empty((num_datapoints, basis_sizes[i]))
+
+        #Scratch column for the basis recursions
+        self.scratch = np.empty((num_datapoints,1))
+
+        #Output for every derivative in the list
+        self.output = np.empty((len(derivative_list), num_datapoints,
+                                output_size))
+
+        #Views to the output of every derivative
+        self.output_views = list(self.output)
+
+        #Intermediate kronecker products, shared between all derivatives
+        # since they are consumed right away
+        level_buffers = [np.empty((num_datapoints,
+                                   int(np.prod(basis_sizes[:k+1]))))
+                         for k in range(num_basis - 1)]
+
+        #Pre-compute the views that are multiplied together so that 
+        # evaluate only has to call np.multiply
+        self.products = []
+        self.copies = []
+        for l,derivative_orders in enumerate(derivative_list):
+            previous = self.basis_buffers[(0,derivative_orders[0])]
+
+            #With one basis the kronecker row is the basis itself
+            if num_basis == 1:
+                self.copies.append((self.output_views[l], previous))
+                continue
+
+            for k in range(1,num_basis):
+                current = self.basis_buffers[(k,derivative_orders[k])]
+
+                #The last product is written into the output
+                if k == num_basis - 1:
+                    target = self.output_views[l]
+                else:
+                    target = level_buffers[k]
+
+                #Same ordering as KroneckerModel._evaluate_numpy
+                self.products.append((current[:,:,np.newaxis],
+                                      previous[:,np.newaxis,:],
+                                      target.reshape(num_datapoints,
+                                                     basis_sizes[k], -1)))
+                previous = target
+
+
+    def evaluate(self, np_dataset: np.ndarray) -> np.ndarray:
+        """
+        Evaluate the kronecker rows
+
+        Keyword arguments:
+        np_dataset -- numpy dataset with 
+                      shape (num_datapoints, num_basis)
+
+        Returns:
+        output -- workspace buffer with the kronecker rows
+                  shape (num_derivatives, num_datapoints, output_size)
+        """
+
+        #Evaluate every basis into its buffer
+        for (i,order),buffer in self.basis_buffers.items():
+            state_t = np_dataset[:,i:i+1]
+            if order == 0:
+                self.basis_list[i].evaluate_into(state_t, buffer, 
+                                                 self.scratch)
+            else:
+                self.basis_list[i].evaluate_derivative_into(state_t, order,
+                                                            buffer, 
+                                                            self.scratch)
+
+        #Aggregate the kronecker products
+        for current, previous, target in self.products:
+            np.multiply(current, previous, out=target)
+
+        for target, source in self.copies:
+            np.copyto(target, source)
+
+        return self.output
+
 
 class KroneckerModel():
 
+    #Maximum amount of workspaces that are kept per model
+    MAX_WORKSPACES = 8
+
 
     def __init__(self, basis_list: List[Basis]):
         """
@@ -34,7 +152,76 @@ class KroneckerModel():
         # the output array is the product of the size of all the functions
         self.output_size = np.product([basis.size for basis in basis_list])
 
-        #self
+        #Evaluate with pre-allocated buffers. Disabled by default since the 
+        # returned array is overwritten in the next call
+        self.use_workspace = False
+
+        #Workspaces keyed by (num_datapoints, derivative_list)
+        self._workspaces = OrderedDict()
+
+
+    def __getstate__(self):
+        #The workspaces are just buffers, don't pickle them
+        state = self.__dict__.copy()
+        state['_workspaces'] = OrderedDict()
+        return state
+
+
+    def __setstate__(self, state):
+        #Models pickled before workspaces existed do not have the attributes
+        state.setdefault('use_workspace', False)
+        state['_workspaces'] = OrderedDict()
+        self.__dict__.update(state)
+
+
+    def set_workspace_mode(self, use_workspace: bool):
+        """
+        Enable or disable the evaluation with pre-allocated buffers
+
+        When enabled, evaluate and evaluate_partial_derivatives with numpy 
+        inputs do not allocate memory after the first call with a given 
+        number of datapoints. The returned array is owned by the model and 
+        will be overwritten in the next call, copy it if you need to keep it
+
+        Keyword arguments:
+        use_workspace -- True to use the workspaces
+        """
+        self.use_workspace = use_workspace
+
+        #Free the buffers if they are not going to be used
+        if use_workspace == False:
+            self._workspaces.clear()
+
+
+    def _get_workspace(self, num_datapoints: int,
+                       derivative_list: List[Tuple[int, ...]]) \
+            -> _KroneckerWorkspace:
+        """
+        Returns the workspace for the number of datapoints and derivatives,
+        creating it if it does not exist. Only the most recently used 
+        workspaces are kept
+
+        Keyword arguments:
+        num_datapoints -- number of rows that will be evaluated
+        derivative_list -- list of tuples with the derivative order for each
+                           basis
+        """
+        key = (num_datapoints, tuple(derivative_list))
+
+        workspace = self._workspaces.get(key)
+
+        if workspace is None:
+            workspace = _KroneckerWorkspace(self.basis_list, num_datapoints,
+                                            derivative_list)
+            self._workspaces[key] = workspace
+
+            #Remove the least recently used workspace
+            if len(self._workspaces) > self.MAX_WORKSPACES:
+                self._workspaces.popitem(last=False)
+        else:
+            self._workspaces.move_to_end(key)
+
+        return workspace
 
 
     def get_basis_names(self):
@@ -119,6 +306,13 @@ class KroneckerModel():
 
         #Get the number of rows that we are evaluating
         num_datapoints = np_dataset.shape[0]
+
+        #Evaluate in the pre-allocated buffers
+        if self.use_workspace == True:
+            workspace = self._get_workspace(num_datapoints,
+                                            [(0,)*self.num_basis])
+            workspace.evaluate(np_dataset)
+            return workspace.output_views[0]
         
         #Make sure we only have the amount of states that correspond to our basis
         basis_variables = np_dataset[:,:self.num_basis]
@@ -179,6 +373,81 @@ class KroneckerModel():
 
 
 
+    def evaluate_partial_derivatives(self, np_dataset: np.ndarray,
+            derivative_list: List[Tuple[int, ...]],
+            use_workspace: bool = None) -> np.ndarray:
+        """
+        Evaluate partial derivatives of the kronecker row with the product
+        rule, e.g. d/dx_j (f_1 x ... x f_m) = f_1 x ... x f_j' x ... x f_m
+
+        Every basis function and derivative order is only evaluated once and
+        shared between all the requested partial derivatives
+
+        Keyword arguments:
+        np_dataset -- numpy dataset with 
+                      shape (num_datapoints, num_basis)
+        derivative_list -- list of tuples with the derivative order for each
+                           basis. E.g. (1,0,0,0) is the derivative with 
+                           respect to the first basis variable and 
+                           (0,0,0,0) is the kronecker row itself
+        use_workspace -- evaluate in the pre-allocated buffers. The output
+                         will be overwritten in the next call. Defaults to 
+                         the mode set with set_workspace_mode
+
+        Returns:
+        output -- one evaluation per entry in derivative_list,
+                  shape (len(derivative_list), num_datapoints, output_size)
+        """
+
+        #Get the number of rows that we are evaluating
+        num_datapoints = np_dataset.shape[0]
+
+        if use_workspace is None:
+            use_workspace = self.use_workspace
+
+        #Evaluate in the pre-allocated buffers
+        if use_workspace == True:
+            workspace = self._get_workspace(num_datapoints,
+                [tuple(derivative_orders) 
+                 for derivative_orders in derivative_list])
+            return workspace.evaluate(np_dataset)
+
+        #Cache the evaluation of each (basis, derivative order) pair
+        basis_evaluation_cache = {}
+
+        output_array = np.empty((len(derivative_list), num_datapoints,
+                                 self.output_size))
+
+        for l,derivative_orders in enumerate(derivative_list):
+
+            #Initialize the output variable that will be updated in the loop
+            output = np.ones((num_datapoints,1))
+
+            for i,(func,order) in enumerate(zip(self.basis_list,
+                                                derivative_orders)):
+
+                #Evaluate the basis only if it has not been done already
+                if (i,order) not in basis_evaluation_cache:
+                    state_t = np_dataset[:,i].reshape(-1,1)
+                    if order == 0:
+                        eval_value = func.evaluate(state_t)
+                    else:
+                        eval_value = func.evaluate_derivative(state_t, order)
+                    basis_evaluation_cache[(i,order)] = \
+                        eval_value.reshape(num_datapoints,-1)
+
+                eval_value = basis_evaluation_cache[(i,order)]
+
+                #Aggregate the kronecker product with the same ordering as 
+                # _evaluate_numpy
+                output = (eval_value[:,:,np.newaxis] * output[:,np.newaxis,:])\
+                    .reshape(num_datapoints,-1)
+
+            output_array[l] = output
+
+        return output_array
+
+
     def evaluate_derivative(self,np_dataset : np.ndarray) -> np.ndarray:
         """ 
         This function calculates the jacobian of the model
@@ -204,7 +473,8 @@ class KroneckerModel():
             delta = 1e-7
 
             #Evaluate the kronecker model at the original state
-            eval_at_state = self._evaluate_numpy(np_dataset)
+            # Need to make copy since the workspace is reused
+            eval_at_state = self._evaluate_numpy(np_dataset).copy()
 
             #Create the delta state
             # Need to make copy since np array is mutable
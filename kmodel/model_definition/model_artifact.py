@@ -0,0 +1,331 @@
+"""
+This file defines the format that is used to store fitted models on disk
+
+An artifact is a directory with a json header and one .npy file per array.
+The header describes the basis functions with plain values (type, n and
+variable name) instead of pickled objects, so it can still be read when the
+classes change. The arrays are loaded with np.load(mmap_mode) so only the
+bytes that are used are read, e.g. loading one subject's fit does not read
+the fits or gram matrices of every other subject
+
+E.g.
+    jointangles_knee_x_optimal/
+        header.json
+        model_fits.npy
+        RTR.npy
+        ...
+"""
+
+#Common imports
+import os
+import json
+import numpy as np
+
+#For docstring
+from typing import Dict, List
+
+#Custom imports
+from .function_bases import Basis, PolynomialBasis, FourierBasis, \
+    LegendreBasis, ChebyshevBasis, HermiteBasis
+from .fitted_model import SimpleFitModel, PersonalKModel
+from .personal_measurement_function import PersonalMeasurementFunction
+
+
+#Increase if the layout changes in a way that old readers can't handle
+ARTIFACT_VERSION = 1
+
+#Name of the header file inside the artifact directory
+HEADER_FILE_NAME = 'header.json'
+
+#Basis classes that can be stored, keyed by the class name in the header
+BASIS_TYPES = {basis_class.__name__: basis_class
+               for basis_class in [PolynomialBasis, FourierBasis,
+                                   LegendreBasis, ChebyshevBasis,
+                                   HermiteBasis]}
+
+
+def basis_to_header(basis : Basis) -> dict:
+    """
+    Describe a basis with plain values that can be saved to json
+    """
+    basis_type = type(basis).__name__
+
+    if basis_type not in BASIS_TYPES:
+        raise TypeError(f"Can't save basis of type {basis_type}")
+
+    return {'type': basis_type, 'n': int(basis.n),
+            'var_name': basis.var_name}
+
+
+def basis_from_header(basis_header : dict) -> Basis:
+    """
+    Create the basis described by basis_to_header
+    """
+    return BASIS_TYPES[basis_header['type']](basis_header['n'],
+                                             basis_header['var_name'])
+
+
+def is_artifact(directory : str) -> bool:
+    """
+    Returns true if the directory contains a model artifact
+    """
+    return os.path.isfile(os.path.join(directory, HEADER_FILE_NAME))
+
+
+def get_artifact_signature(directory : str) -> tuple:
+    """
+    Returns a tuple that changes when the artifact is saved again. The
+    header is written last, so its modification time is used
+    """
+    header_stat = os.stat(os.path.join(directory, HEADER_FILE_NAME))
+    return (header_stat.st_mtime_ns, header_stat.st_size)
+
+
+def save_artifact(directory : str,
+                  arrays : Dict[str, np.ndarray],
+                  basis_list : List[Basis] = None,
+                  **metadata):
+    """
+    Save arrays and metadata as a model artifact
+
+    Keyword Arguments:
+    directory -- directory that the artifact is stored in. It is created if
+        it does not exist
+    arrays -- dictionary with the numpy arrays to save
+    basis_list -- basis functions of the model
+    metadata -- extra json serializable values to store in the header
+
+    Returns:
+    None
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    array_info = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        file_name = name + '.npy'
+        np.save(os.path.join(directory, file_name), array)
+        array_info[name] = {'file': file_name,
+                            'shape': list(array.shape),
+                            'dtype': array.dtype.str}
+
+    header = {'format version': ARTIFACT_VERSION,
+              'arrays': array_info,
+              'metadata': metadata}
+
+    if basis_list is not None:
+        header['basis list'] = [basis_to_header(basis)
+                                for basis in basis_list]
+
+    #Write the header last and replace it in one step so that readers
+    # never see a header that describes arrays that are not saved yet
+    header_file_name = os.path.join(directory, HEADER_FILE_NAME)
+    with open(header_file_name + '.tmp', 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+    os.replace(header_file_name + '.tmp', header_file_name)
+
+
+class ModelArtifact():
+    """
+    This class reads an artifact saved with save_artifact. Arrays are only
+    loaded when they are accessed
+    """
+
+    def __init__(self, directory : str, mmap_mode : str = 'r'):
+        """
+        Keyword Arguments:
+        directory -- directory that the artifact is stored in
+        mmap_mode -- passed to np.load. 'r' memory maps the arrays read
+            only, None reads them into memory
+        """
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+        with open(os.path.join(directory, HEADER_FILE_NAME), 'r') \
+                as header_file:
+            self.header = json.load(header_file)
+
+        if self.header['format version'] > ARTIFACT_VERSION:
+            raise ValueError(f"Artifact {directory} has format version "
+                             f"{self.header['format version']}, this "
+                             f"code can only read up to {ARTIFACT_VERSION}")
+
+        self.metadata = self.header['metadata']
+        self._arrays = {}
+
+
+    def __contains__(self, name : str) -> bool:
+        return name in self.header['arrays']
+
+
+    def __getitem__(self, name : str) -> np.ndarray:
+        if name not in self._arrays:
+            array_info = self.header['arrays'][name]
+            self._arrays[name] = np.load(
+                os.path.join(self.directory, array_info['file']),
+                mmap_mode=self.mmap_mode)
+
+        return self._arrays[name]
+
+
+    def keys(self) -> List[str]:
+        return list(self.header['arrays'].keys())
+
+
+    def get_basis_list(self) -> List[Basis]:
+        """
+        Create the basis functions that are described in the header
+        """
+        return [basis_from_header(basis_header)
+                for basis_header in self.header['basis list']]
+
+
+
+def save_measurement_function(model : PersonalMeasurementFunction,
+                              directory : str):
+    """
+    Save a measurement function as a model artifact. All the models must be
+    of the same type and use the same basis functions
+
+    Keyword Arguments:
+    model -- measurement function with SimpleFitModel or PersonalKModel
+        models
+    directory -- directory that the artifact is stored in
+    """
+    kmodels = model.kmodels
+    model_type = type(kmodels[0]).__name__
+
+    if any(type(kmodel).__name__ != model_type for kmodel in kmodels):
+        raise TypeError("All the models must have the same type")
+
+    basis_header = [basis_to_header(basis)
+                    for basis in kmodels[0].basis_list]
+    for kmodel in kmodels:
+        if [basis_to_header(basis) for basis in kmodel.basis_list] \
+                != basis_header:
+            raise ValueError("All the models must have the same basis list")
+
+    #Stack the arrays of every model
+    if model_type == 'SimpleFitModel':
+        arrays = {'model_fits': np.stack([kmodel.model_fit
+                                          for kmodel in kmodels])}
+
+    elif model_type == 'PersonalKModel':
+        arrays = {'average_fits': np.stack([kmodel.average_fit
+                                            for kmodel in kmodels]),
+                  'personalization_maps': np.stack([kmodel.pmap
+                                                    for kmodel in kmodels])}
+
+        #Optional arrays are only stored if every model has them
+        if all(kmodel.optimal_fit is not None for kmodel in kmodels):
+            arrays['optimal_fits'] = np.stack([kmodel.optimal_fit
+                                               for kmodel in kmodels])
+
+        if all(kmodel.subject_gait_fingerprint is not None
+               for kmodel in kmodels):
+            arrays['gait_fingerprints'] = np.stack(
+                [kmodel.subject_gait_fingerprint for kmodel in kmodels])
+
+    else:
+        raise TypeError(f"Can't save model of type {model_type}")
+
+    save_artifact(directory, arrays, kmodels[0].basis_list,
+                  **{'model type': model_type,
+                     'output names': list(model.output_names),
+                     'model output names': [kmodel.output_name
+                                            for kmodel in kmodels],
+                     'subject name': model.subject_name})
+
+
+def load_measurement_function(directory : str, mmap_mode : str = 'r') \
+        -> PersonalMeasurementFunction:
+    """
+    Load a measurement function saved with save_measurement_function
+
+    Keyword Arguments:
+    directory -- directory that the artifact is stored in
+    mmap_mode -- passed to np.load
+
+    Returns:
+    model -- the measurement function
+    """
+    artifact = ModelArtifact(directory, mmap_mode)
+    metadata = artifact.metadata
+    model_type = metadata['model type']
+    model_output_names = metadata['model output names']
+
+    kmodels = []
+    for i, output_name in enumerate(model_output_names):
+
+        #Every model gets its own basis objects, same as unpickling
+        basis_list = artifact.get_basis_list()
+
+        if model_type == 'SimpleFitModel':
+            kmodels.append(SimpleFitModel(basis_list,
+                                          artifact['model_fits'][i],
+                                          output_name))
+        elif model_type == 'PersonalKModel':
+            gait_fingerprint = artifact['gait_fingerprints'][i] \
+                if 'gait_fingerprints' in artifact else None
+            optimal_fit = artifact['optimal_fits'][i] \
+                if 'optimal_fits' in artifact else None
+
+            kmodels.append(PersonalKModel(basis_list, output_name,
+                                          artifact['average_fits'][i],
+                                          artifact['personalization_maps'][i],
+                                          gait_fingerprint,
+                                          metadata['subject name'],
+                                          optimal_fit))
+        else:
+            raise TypeError(f"Can't load model of type {model_type}")
+
+    return PersonalMeasurementFunction(kmodels, metadata['output names'],
+                                       metadata['subject name'])
+
+
+
+def save_optimal_fits(directory : str,
+                      output_name : str,
+                      basis_list : List[Basis],
+                      subject_names : List[str],
+                      model_fits : List[np.ndarray],
+                      RTR_list : List[np.ndarray],
+                      num_datapoints_list : List[int],
+                      residual_list : List[float] = None,
+                      residual_variance_list : List[float] = None,
+                      avg_residual_variance_list : List[float] = None,
+                      l2_regularization : float = 0.0):
+    """
+    Save the per subject optimal fits of one output, e.g. the results of
+    calculate_optimal_fits.py
+
+    Keyword Arguments:
+    directory -- directory that the artifact is stored in
+    output_name -- name of the model output
+    basis_list -- basis functions of the model
+    subject_names -- name of every subject, in the same order as the lists
+    model_fits -- fit of every subject, each with shape (1, model_size)
+    RTR_list -- regressor matrix of every subject
+    num_datapoints_list -- number of datapoints of every subject
+    residual_list -- optional, residual of every subject
+    residual_variance_list -- optional, residual variance of every subject
+    avg_residual_variance_list -- optional, residual variance of the
+        average model for every subject
+    l2_regularization -- lambda used in the fits
+    """
+    arrays = {'model_fits': np.stack(model_fits),
+              'RTR': np.stack(RTR_list),
+              'num_datapoints': np.array(num_datapoints_list)}
+
+    #Optional arrays
+    for name, values in [('residuals', residual_list),
+                         ('residual_variances', residual_variance_list),
+                         ('avg_residual_variances',
+                          avg_residual_variance_list)]:
+        if values is not None:
+            arrays[name] = np.array(values, dtype=float)
+
+    save_artifact(directory, arrays, basis_list,
+                  **{'output name': output_name,
+                     'subject names': list(subject_names),
+                     'l2 regularization': float(l2_regularization)})
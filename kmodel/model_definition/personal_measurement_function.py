@@ -44,7 +44,30 @@ class PersonalMeasurementFunction:
         #Store the subject name
         self.subject_name = subject_name
 
-    def evaluate(self, input_data:np.ndarray):
+        #Stack the fits of all the models so that they are evaluated with 
+        # one matrix multiplication
+        self.update_model_fits()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        #Objects pickled before the fits were stacked need to calculate them
+        if 'model_fit_matrix' not in state:
+            self.update_model_fits()
+
+    def update_model_fits(self):
+        """
+        Stack the model fit of every model into one contiguous matrix with
+        shape (model_output_size, num_kmodels)
+
+        Call this again if the fit of any of the models is changed
+        """
+        self.model_fit_matrix = np.ascontiguousarray(
+            np.concatenate([kmodel.get_model_fit().reshape(1,-1)
+                            for kmodel in self.kmodels], axis=0).T)
+
+    def evaluate(self, input_data:np.ndarray, kronecker_output=None,
+                 out=None):
         """
         Evaluate a Kronecker Model multiplied by 
             the (average fit plus personalization map times gait fingerprint) 
@@ -63,6 +86,11 @@ class PersonalMeasurementFunction:
         Keyword arguments:
         input_data -- numpy array that contains the model inputs and the gait fingeprints
                    shape (num_datapoints, num_models + num_gait_fingerprints)
+        kronecker_output -- kronecker model output can be feed in externally,
+                   e.g. to evaluate the models with a differentiated 
+                   kronecker row. shape (num_datapoints, model_output_size)
+        out -- optional buffer to store the output in
+                   shape (num_datapoints, num_kmodels)
                    
 
         Returns
@@ -76,22 +104,10 @@ class PersonalMeasurementFunction:
         use_average_fit is
         """
     
-        #Calculate the number of data points
-        num_datapoints = input_data.shape[0]
-        
-        #Pre-allocate output buffer so that it is faster than concatenating
-        output_buffer = np.zeros((num_datapoints, self.num_kmodels))
-
         #Since all the joint angles use the same model, precalculate the kronecker output
-        kronecker_output = self.kmodels[0].get_kronecker_output(input_data)
-
-        #Evaluate every model on the input]
-        for i, kmodel in enumerate(self.kmodels):
-            
-            #Set the corresponding column
-            #Reshape to make sure numpy broadcasting rules hold
-            output_buffer[:,[i]] = kmodel.evaluate(input_data, 
-                                                   kronecker_output=kronecker_output).reshape(num_datapoints,1)
+        if kronecker_output is None:
+            kronecker_output = self.kmodels[0].get_kronecker_output(input_data)
 
-        return output_buffer
+        #Evaluate every model on the input with one matrix multiplication
+        return np.matmul(kronecker_output, self.model_fit_matrix, out=out)
 
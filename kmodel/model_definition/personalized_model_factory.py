@@ -11,13 +11,15 @@ from .model_fitting.k_model_fitting import KModelFitter
 from .personal_k_model import PersonalKModel
 from .k_model import KroneckerModel
 from .personal_measurement_function import PersonalMeasurementFunction
+from .model_artifact import save_measurement_function, \
+    load_measurement_function, is_artifact
 #Import PCA library
 from sklearn.decomposition import PCA
 
 #Import special type for hints that have lists
 from typing import List, Union
 
-#Imoprt serialization module
+#Imoprt serialization module, used to load old models
 import pickle
 
 class PersonalizedKModelFactory:
@@ -84,6 +86,13 @@ class PersonalizedKModelFactory:
         #Generate the fitter object
         fitter = KModelFitter()
 
+        #Fit all the outputs of every subject with one regressor pass
+        # contains tuples of (subject fits, (fit rmses, RTR, num_datapoints))
+        subject_fit_list = [fitter.fit_data_multi(k_model, subject_data, 
+                                                  output_name, 
+                                                  l2_lambda=l2_lambda)
+                            for _,subject_data in subject_data_list]
+
         #Outer loop is through the different output functions
         for output_i,output in enumerate(output_name): 
 
@@ -98,20 +107,13 @@ class PersonalizedKModelFactory:
             output_datapoints = 0
 
             #Calculate the subject fit for every person
-            for subject_name,subject_data in subject_data_list:
-                
-               
-                
-                #Get the appropriate l2 regularization
-                if(isinstance(l2_lambda,list)):
-                    curr_l2_lambda = l2_lambda[output_i]
-                else:
-                    curr_l2_lambda = l2_lambda
+            for (subject_name,_), (subject_fits, (fit_rmses, RTR, 
+                                                  num_datapoints)) \
+                    in zip(subject_data_list, subject_fit_list):
 
-                #Get the subject fit
-                subject_fit, (fit_rmse, RTR, num_datapoints) = \
-                    fitter.fit_data(k_model, subject_data, 
-                                    output,l2_lambda=curr_l2_lambda)
+                #Get the subject fit for this output
+                subject_fit = subject_fits[[output_i]]
+                fit_rmse = fit_rmses[output_i]
 
 
                 #Skip if the subject name is in the left out pool
@@ -201,6 +203,10 @@ class PersonalizedKModelFactory:
                 RTR_prime_total = 0
                 RTy_prime_total = 0
 
+                #Get the regression matrices for all the outputs at once
+                regressor = KModelFitter().calculate_regressor_multi(k_model,
+                    subject_data, output_name)
+
                 for i,output in enumerate(output_name):
 
                     #Get the pmap and average fit for this model
@@ -210,7 +216,8 @@ class PersonalizedKModelFactory:
                     #Get the regressor matrix for this model
                     RTR_prime_j, RTy_prime_j = \
                         self._calculate_gait_fingerprint_regressor(k_model,
-                            subject_data,output, pmap, xi_avg)
+                            subject_data,output, pmap, xi_avg, 
+                            regressor=regressor, output_index=i)
 
                     #Add tho the solution matrix
                     RTR_prime_total += RTR_prime_j
@@ -305,7 +312,8 @@ class PersonalizedKModelFactory:
 
 
     def _calculate_gait_fingerprint_regressor(self,k_model: KroneckerModel, data: list, output_name: str,
-                                              pmap: np.ndarray, average_fit: np.ndarray): 
+                                              pmap: np.ndarray, average_fit: np.ndarray,
+                                              regressor: tuple = None, output_index: int = 0): 
         """
         This function will calcualte the gait fingerprint fit based on the previous models
 
@@ -315,17 +323,26 @@ class PersonalizedKModelFactory:
         output_name -- name of the output variable that will be used to fit
         data -- pandas dataframe with the data to perform the fit 
         output_name -- column in data that will be used as the 'y' data
+        regressor -- optional, output of calculate_regressor_multi so that
+            the regressor is not recalculated for every output
+        output_index -- index of output_name in the regressor
 
         Returns:
         RTR_prime -- gait fingerprint regressor matrix
         RTy_prime -- gait fingerprint regressor matrix
         """
 
-        #Create a model fitter object
-        data_fitter = KModelFitter()
-
         #Get regression matrices
-        RTR, RTy, yTR, yTy = data_fitter.calculate_regressor(k_model, data, output_name)
+        if regressor is None:
+            #Create a model fitter object
+            data_fitter = KModelFitter()
+            RTR, RTy, yTR, yTy = data_fitter.calculate_regressor(k_model, data, output_name)
+        else:
+            RTR, RTY, YTR, YTY = regressor
+            j = output_index
+            RTy = RTY[:,[j]]
+            yTR = YTR[[j]]
+            yTy = YTY[[j]][:,[j]]
         
         #Use the personalization map to calculate the components of the least squares equation
         RTR_prime = (pmap @ RTR @ pmap.T)
@@ -423,29 +440,35 @@ class PersonalizedKModelFactory:
     #Save the model so that you can use them later
     def save_model(self,model : PersonalMeasurementFunction,filename):
         """
-        Saves a model to a pickle file
+        Saves a model as a model artifact directory
 
         Keyword Arguments:
         model: the personal measurement function that will be saved
+        filename: directory that the model artifact is saved in
 
         Returns: 
         None
         """
-        with open(filename,'wb') as file:
-            pickle.dump(model,file)
+        save_measurement_function(model, filename)
 
     #Load the model from a file
-    def load_model(self,filename) -> PersonalMeasurementFunction:
+    def load_model(self,filename,mmap_mode='r') -> PersonalMeasurementFunction:
         """
-        Loads a model from a pickle file
+        Loads a model from a model artifact directory. Models that were 
+        saved as a pickle file can still be loaded
 
         Keyword Arguments:
         filename: string that corresponds to the file that will be loaded
+        mmap_mode: passed to np.load, 'r' memory maps the arrays
 
         Returns: 
         model: the personal measurement function corresponding to the name
 
         """
+        if is_artifact(filename):
+            return load_measurement_function(filename, mmap_mode)
+
+        #Old models were saved as pickle files
         with open(filename,'rb') as file:
             return pickle.load(file)
 
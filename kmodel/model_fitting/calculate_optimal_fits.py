@@ -11,10 +11,10 @@ import numpy as np
 #Personal imports
 from context import model_definition
 from model_definition.function_bases import FourierBasis, PolynomialBasis
-from k_model_fitting import KModelFitter
+from model_fitting.parallel_fitting import ParallelKModelFitter
 from model_definition.k_model import KroneckerModel
 from model_definition.fitted_model import SimpleFitModel
-import pickle
+from model_definition.model_artifact import save_optimal_fits
 
 ###############################################################################
 ###############################################################################
@@ -60,99 +60,127 @@ file_location = lambda subject : ("../../data/flattened_dataport/training/"
 #Save location
 save_location = "../../data/optimal_model_fits/"
 
-# Get the data for all the subjects
-# contains tuples of (subject name, subject data)
-subject_data_list = [(sub,pd.read_parquet(file_location(sub))) for sub in subjects]
-
-
-#Initialize the model fitter object
-model_fitter = KModelFitter()
-
-#Calculate the optimal models for each joint
-for output_name in output_list:
-    
-    #Create lists for this output 
-    model_fits = []
-    RTR_list = []
-    residual_list = []
-    residual_variance_list = []
-    num_datapoints_list = []
-
-    
-    for subject_name, subject_data in subject_data_list:
-        
-        #Filter for NaNs in data
-        subject_data = subject_data[output_list + states + extra_info].dropna()
-        
-        #Get the model fit for the subject
-        model_fit, (residual,RTR,num_datapoints) =\
-            model_fitter.fit_data(k_model_instance,
-                                  subject_data,
-                                  output_name,
-                                  l2_lambda=l2_regularization,
-                                  weight_col='Steps in Condition')
-        
-        if np.isnan(model_fit).sum() > 0:
+###############################################################################
+###############################################################################
+# Fit and save the models
+
+def main():
+    """
+    Fit the models of every subject and save them with the average model
+    residuals
+
+    The process pool re-imports this file in every worker with the spawn
+    start method, so nothing can run when it is imported
+    """
+    # Get the data for all the subjects
+    # contains tuples of (subject name, subject data)
+    subject_data_list = [(sub,pd.read_parquet(file_location(sub)))
+                         for sub in subjects]
+
+
+    #Initialize the model fitter object, uses all the cores by default
+    model_fitter = ParallelKModelFitter()
+
+    #Filter for NaNs in data
+    subject_data_list = [(subject_name, 
+                          subject_data[output_list + states + extra_info]
+                            .dropna())
+                         for subject_name, subject_data in subject_data_list]
+
+    #Fit all the joints of all the subjects in parallel, with one pass of the 
+    # regressor per subject
+    # contains tuples of (model fits, residuals, RTR, num_datapoints)
+    subject_fit_list = []
+    for subject_model_fits, (subject_residuals,RTR,num_datapoints) in \
+            model_fitter.fit_subjects(k_model_instance,
+                                      subject_data_list,
+                                      output_list,
+                                      l2_lambda=l2_regularization,
+                                      weight_col='Steps in Condition'):
+
+        if np.isnan(subject_model_fits).sum() > 0:
             raise ValueError
-        
-        #Calculate residual variance
-        subject_model = SimpleFitModel(basis_list, model_fit, output_name)
-        #Get the expected output
-        expected_output = subject_model.evaluate(subject_data)
-        #Get the true output to compare
-        true_output = subject_data[output_name].values.reshape(-1,1)
-        #Calculate the residual variance using numpy
-        residual_variance = np.var(true_output - expected_output)
-        
-        #Store the results in the list
-        model_fits.append(model_fit)
-        residual_list.append(residual)
-        residual_variance_list.append(residual_variance)
-        RTR_list.append(RTR)
-        num_datapoints_list.append(num_datapoints)
-        
-    
-    ##Calculate the average model residual variance
-    avg_model_fit = np.mean(model_fits, axis=0)
-    avg_residual_variance_list = []
-
-    #Calculate per subject
-    for subject_name, subject_data in subject_data_list:
-        
-        #Calculate residual variance
-        subject_model = SimpleFitModel(basis_list, avg_model_fit, output_name)
-        #Get the expected output
-        expected_output = subject_model.evaluate(subject_data)
-        #Get the true output to compare
-        true_output = subject_data[output_name].values.reshape(-1,1)
-        #Calculate the residual variance using numpy
-        residual_variance = np.var(true_output - expected_output)
-        #Store the residual variance
-        avg_residual_variance_list.append(residual_variance)
-    
-    #Save the fits for the model into the fit info dataclass object
-    save_data = {"model fits": model_fits, 
-                 "RTR list": RTR_list,
-                 "residual list": residual_list,
-                 "residual variance list": residual_variance_list,
-                 "avg residual variance list": avg_residual_variance_list,
-                 "num datapoints list":num_datapoints_list,
-                 "basis list":basis_list,
-                 "l2 regularization":l2_regularization}
-
-    #Create save file name
-    save_file_name = save_location + output_name + "_optimal.p"
-    
-    #Print status message
-    print(f"Saving {output_name} data: {save_data}")
-    
-    #Save the data to a file
-    with open(save_file_name, 'wb') as save_file:
-        pickle.dump(save_data, save_file)
-    
-    print(f"Done with {output_name}")
-    
-
-
-    
 
+        subject_fit_list.append((subject_model_fits, subject_residuals, 
+                                 RTR, num_datapoints))
+
+    #Calculate the optimal models for each joint
+    for output_i, output_name in enumerate(output_list):
+
+        #Create lists for this output 
+        model_fits = []
+        RTR_list = []
+        residual_list = []
+        residual_variance_list = []
+        num_datapoints_list = []
+
+
+        for (subject_name, subject_data), \
+            (subject_model_fits, subject_residuals, RTR, num_datapoints) \
+                in zip(subject_data_list, subject_fit_list):
+
+            #Get the model fit for the subject
+            model_fit = subject_model_fits[[output_i]]
+            residual = subject_residuals[output_i]
+
+            #Calculate residual variance
+            subject_model = SimpleFitModel(basis_list, model_fit, output_name)
+            #Get the expected output
+            expected_output = subject_model.evaluate(subject_data)
+            #Get the true output to compare
+            true_output = subject_data[output_name].values.reshape(-1,1)
+            #Calculate the residual variance using numpy
+            residual_variance = np.var(true_output - expected_output)
+
+            #Store the results in the list
+            model_fits.append(model_fit)
+            residual_list.append(residual)
+            residual_variance_list.append(residual_variance)
+            RTR_list.append(RTR)
+            num_datapoints_list.append(num_datapoints)
+
+
+        ##Calculate the average model residual variance
+        avg_model_fit = np.mean(model_fits, axis=0)
+        avg_residual_variance_list = []
+
+        #Calculate per subject
+        for subject_name, subject_data in subject_data_list:
+
+            #Calculate residual variance
+            subject_model = SimpleFitModel(basis_list, avg_model_fit,
+                                           output_name)
+            #Get the expected output
+            expected_output = subject_model.evaluate(subject_data)
+            #Get the true output to compare
+            true_output = subject_data[output_name].values.reshape(-1,1)
+            #Calculate the residual variance using numpy
+            residual_variance = np.var(true_output - expected_output)
+            #Store the residual variance
+            avg_residual_variance_list.append(residual_variance)
+
+        #Create save directory name
+        save_directory = save_location + output_name + "_optimal"
+
+        #Print status message
+        print(f"Saving {output_name} data to {save_directory}")
+
+        #Save the fits as a model artifact, where every array is in its own 
+        # file so that it can be memory mapped when it is loaded
+        save_optimal_fits(save_directory, output_name, basis_list,
+                          subject_names=subjects,
+                          model_fits=model_fits,
+                          RTR_list=RTR_list,
+                          num_datapoints_list=num_datapoints_list,
+                          residual_list=residual_list,
+                          residual_variance_list=residual_variance_list,
+                          avg_residual_variance_list=\
+                              avg_residual_variance_list,
+                          l2_regularization=l2_regularization)
+
+        print(f"Done with {output_name}")
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+This file implements leave one subject out cross validation of the
+personalized kronecker models without refitting the models
+
+The regressor matrices R^T R, R^T y, y^T R and y^T y of every subject are
+calculated once. Every leave one out average fit, gram matrix and
+personalization map, and the rmse of the left out subject, is then calculated
+from those matrices without touching the data again. Therefore, a study with
+N subjects costs about the same as one fit instead of N fits
+"""
+
+#Common imports
+import numpy as np
+
+#For docstring
+from typing import List, Tuple, Union
+from dataclasses import dataclass
+
+#Kronecker model imports
+from .context import model_definition
+from model_definition.k_model import KroneckerModel
+from .k_model_fitting import RegressorAccumulator
+from .parallel_fitting import ParallelKModelFitter, SubjectData
+
+
+@dataclass(repr=False)
+class CrossValidationResult:
+    """
+    This class stores the result of leave one subject out cross validation.
+    The first axis of every array is the subject that was left out
+    """
+    #Name of every subject, in the same order as the arrays
+    subject_names: List[str]
+    #Name of every output
+    output_names: List[str]
+    #Average fit of the other subjects
+    # shape(num_subjects, num_outputs, k_model_output_size)
+    average_fits: np.ndarray
+    #Personalization map calculated with the other subjects
+    # shape(num_subjects, num_pca_vectors, num_outputs, k_model_output_size)
+    personalization_maps: np.ndarray
+    #Least squares gait fingerprint of the left out subject
+    # shape(num_subjects, num_pca_vectors)
+    gait_fingerprints: np.ndarray
+    #Rmse of the subject's own least squares fit
+    # shape(num_subjects, num_outputs)
+    optimal_fit_rmse: np.ndarray
+    #Rmse of the average fit on the left out subject
+    # shape(num_subjects, num_outputs)
+    average_fit_rmse: np.ndarray
+    #Rmse of the personalized fit on the left out subject
+    # shape(num_subjects, num_outputs)
+    gait_fingerprint_rmse: np.ndarray
+
+
+class LeaveOneOutCrossValidator():
+    """
+    This class calculates leave one subject out cross validation of the
+    average and personalized models from the regressor matrices of every
+    subject
+    """
+
+    def __init__(self, accumulators : List[RegressorAccumulator],
+                 subject_names : List[str],
+                 l2_lambda : Union[float, List[float]] = 0.0):
+        """
+        Keyword Arguments:
+        accumulators -- regressor matrices of every subject, all with the
+            same list of outputs, e.g. from
+            ParallelKModelFitter.calculate_regressors
+        subject_names -- name of every subject
+        l2_lambda -- lambda in l2 regularization, or a list with one lambda
+            per output
+        """
+        if len(accumulators) < 3:
+            raise ValueError("Leave one out cross validation needs at least "
+                             "three subjects")
+
+        self.subject_names = list(subject_names)
+        self.output_names = list(accumulators[0].output_names)
+        self.num_subjects = len(accumulators)
+
+        #Stack the regressor matrices of all the subjects
+        # shape(num_subjects, k_model_output_size, k_model_output_size)
+        self.RTR = np.stack([accumulator.RTR for accumulator in accumulators])
+        # shape(num_subjects, k_model_output_size, num_outputs)
+        self.RTY = np.stack([accumulator.RTy for accumulator in accumulators])
+        # shape(num_subjects, num_outputs, k_model_output_size)
+        self.YTR = np.stack([accumulator.yTR for accumulator in accumulators])
+        # shape(num_subjects, num_outputs, num_outputs)
+        self.YTY = np.stack([accumulator.yTy for accumulator in accumulators])
+        # shape(num_subjects,)
+        self.num_datapoints = np.array([accumulator.num_datapoints
+                                        for accumulator in accumulators])
+
+        #The least squares fit of every subject is the same for every fold
+        subject_fit_list = ParallelKModelFitter(num_processes=1)\
+            .solve_accumulators(accumulators, l2_lambda)
+
+        # shape(num_subjects, num_outputs, k_model_output_size)
+        self.subject_fits = np.stack([subject_fits for subject_fits,_
+                                      in subject_fit_list])
+        # shape(num_subjects, num_outputs)
+        self.optimal_fit_rmse = np.stack([residuals for _,(residuals,_,_)
+                                          in subject_fit_list])
+
+        #Totals used to remove one subject at a time
+        self.subject_fit_sum = self.subject_fits.sum(axis=0)
+        self.RTR_sum = self.RTR.sum(axis=0)
+        self.num_datapoints_sum = self.num_datapoints.sum()
+
+
+    @classmethod
+    def from_data(cls, k_model : KroneckerModel,
+                  subject_data_list : List[Tuple[str, SubjectData]],
+                  output_names : List[str],
+                  l2_lambda : Union[float, List[float]] = 0.0,
+                  weight_col : str = None,
+                  num_processes : int = 1,
+                  data_splits : int = 50) -> 'LeaveOneOutCrossValidator':
+        """
+        Calculate the regressor matrices of every subject once and create
+        the cross validator
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object
+        subject_data_list -- list with tuples of the form
+            (subject_name, pandas dataframe or parquet file(s))
+        output_names -- columns in the data that will be used as the 'y' data
+        l2_lambda -- lambda in l2 regularization, or a list with one lambda
+            per output
+        weight_col -- column that stores the weight information from weighted
+            least squares
+        num_processes -- amount of processes used to calculate the regressors
+        data_splits -- amount of chunks that dataframes are split into
+        """
+        fitter = ParallelKModelFitter(num_processes, data_splits)
+        accumulators = fitter.calculate_regressors(k_model, subject_data_list,
+                                                   output_names, weight_col)
+
+        return cls(accumulators, [name for name,_ in subject_data_list],
+                   l2_lambda)
+
+
+    def get_average_fits(self) -> np.ndarray:
+        """
+        Returns the average fit without each subject by removing the subject
+        from the sum of all the fits
+
+        Returns:
+        average_fits -- shape(num_subjects, num_outputs, k_model_output_size)
+        """
+        return (self.subject_fit_sum - self.subject_fits) \
+            / (self.num_subjects - 1)
+
+
+    def get_gram_matrix(self, left_out_index : int) -> np.ndarray:
+        """
+        Returns the gram matrix of all the subjects except for one, same as
+        PersonalizedKModelFactory (sum of RTR over the sum of datapoints)
+        """
+        return (self.RTR_sum - self.RTR[left_out_index]) \
+            / (self.num_datapoints_sum - self.num_datapoints[left_out_index])
+
+
+    def calculate_rmse(self, fits : np.ndarray) -> np.ndarray:
+        """
+        Calculate the rmse of a fit for every subject and output using the
+        subject's regressor matrices
+
+        Keyword Arguments:
+        fits -- fit to evaluate on each subject
+            shape(num_subjects, num_outputs, k_model_output_size)
+
+        Returns:
+        rmse -- shape(num_subjects, num_outputs)
+        """
+        #residual = sqrt((x^T R^T Rx - x^T R^T y - y^T Rx + y^T y)/num_datapoints)
+        # for every subject and output
+        squared_error = np.einsum('njk,nkl,njl->nj', fits, self.RTR, fits) \
+            - np.einsum('njk,nkj->nj', fits, self.RTY) \
+            - np.einsum('njk,njk->nj', self.YTR, fits) \
+            + np.diagonal(self.YTY, axis1=1, axis2=2)
+
+        #Clip rounding errors of fits that are almost exact
+        return np.sqrt(np.maximum(squared_error, 0)
+                       / self.num_datapoints[:,np.newaxis])
+
+
+    def cross_validate(self, num_pca_vectors : int = 2,
+                       vanilla_pca : bool = False) -> CrossValidationResult:
+        """
+        Leave every subject out, calculate the average fit and
+        personalization map with the rest of the subjects and evaluate them
+        on the left out subject
+
+        Keyword Arguments:
+        num_pca_vectors -- number of gait fingerprints
+        vanilla_pca -- if false, the pca is calculated in the orthonormal
+            space of the gram matrix, same as PersonalizedKModelFactory
+
+        Returns:
+        CrossValidationResult
+        """
+        num_subjects, num_outputs, k_model_output_size = \
+            self.subject_fits.shape
+
+        if num_pca_vectors > num_subjects - 2:
+            raise ValueError(f"Can't calculate {num_pca_vectors} pca vectors "
+                             f"with {num_subjects - 1} subjects")
+
+        average_fits = self.get_average_fits()
+        personalization_maps = np.empty((num_subjects, num_pca_vectors,
+                                         num_outputs, k_model_output_size))
+        gait_fingerprints = np.empty((num_subjects, num_pca_vectors))
+
+        for i in range(num_subjects):
+
+            #Fits of the other subjects minus their average
+            # shape(num_subjects - 1, num_outputs, k_model_output_size)
+            XI_0 = np.delete(self.subject_fits, i, axis=0) - average_fits[i]
+
+            #Convert to the orthonormal function space. The gram matrix
+            # is the same for every output since they share the regressor
+            if vanilla_pca == False:
+                eig, O = np.linalg.eigh(self.get_gram_matrix(i))
+                #Q G Q = I
+                Qinv = (O * np.sqrt(eig)) @ O.T
+                Q = (O / np.sqrt(eig)) @ O.T
+                XI_0 = XI_0 @ Qinv
+
+            #The outputs are concatenated for the pca
+            pmap = self._principal_components(
+                XI_0.reshape(num_subjects - 1, -1), num_pca_vectors)\
+                .reshape(num_pca_vectors, num_outputs, k_model_output_size)
+
+            #Convert back from the orthonormal function space
+            if vanilla_pca == False:
+                pmap = pmap @ Q
+
+            personalization_maps[i] = pmap
+
+            #Calculate the gait fingerprint of the left out subject with
+            # its regressor matrices, same as the factory
+            # RTR' = sum_j P_j RTR P_j^T
+            # RTy' = sum_j P_j RTy_j - P_j RTR xi_avg_j^T
+            RTR_prime = np.einsum('gjk,kl,hjl->gh', pmap, self.RTR[i], pmap)
+            RTy_prime = np.einsum('gjk,kj->g', pmap, self.RTY[i]) \
+                - np.einsum('gjk,kl,jl->g', pmap, self.RTR[i],
+                            average_fits[i])
+            gait_fingerprints[i] = np.linalg.solve(RTR_prime, RTy_prime)
+
+        #Personalized fit of every left out subject
+        gait_fingerprint_fits = average_fits + np.einsum('ng,ngjk->njk',
+                                                        gait_fingerprints,
+                                                        personalization_maps)
+
+        return CrossValidationResult(
+            subject_names=self.subject_names,
+            output_names=self.output_names,
+            average_fits=average_fits,
+            personalization_maps=personalization_maps,
+            gait_fingerprints=gait_fingerprints,
+            optimal_fit_rmse=self.optimal_fit_rmse,
+            average_fit_rmse=self.calculate_rmse(average_fits),
+            gait_fingerprint_rmse=self.calculate_rmse(gait_fingerprint_fits))
+
+
+    @staticmethod
+    def _principal_components(XI_0 : np.ndarray,
+                              num_pca_vectors : int) -> np.ndarray:
+        """
+        Calculate the principal components of the rows of XI_0, which are
+        already centered. Same as sklearn's PCA().fit(XI_0).components_
+        up to the sign of each component
+
+        Returns:
+        components -- shape(num_pca_vectors, XI_0.shape[1])
+        """
+        #There are only a few subjects, so the svd is cheap
+        _, _, Vt = np.linalg.svd(XI_0, full_matrices=False)
+        components = Vt[:num_pca_vectors]
+
+        #Make the largest element of each component positive so that the
+        # sign is deterministic
+        max_index = np.argmax(np.abs(components), axis=1)
+        signs = np.sign(components[np.arange(num_pca_vectors), max_index])
+
+        return components * signs[:,np.newaxis]
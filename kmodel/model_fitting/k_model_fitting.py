@@ -4,7 +4,7 @@ import pandas as pd
 import numpy as np
 
 #For docstring
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Mapping, Union
 from dataclasses import dataclass
 
 #Kronecker model imports
@@ -14,6 +14,232 @@ from model_definition.k_model import KroneckerModel
 from model_definition.function_bases import Basis
 import pandas as pd
 
+
+class RegressorAccumulator():
+    """
+    This class accumulates the matrices that are required to calculate 
+    least squares, R^T R, R^T y, y^T R and y^T y, one chunk of data at a time
+
+    The sums of different accumulators can be merged, e.g. to combine the 
+    results of several files or processes
+
+    With a list of outputs, the regressor R is evaluated once per chunk and 
+    shared between all the outputs. In that case y has one column per output
+    """
+
+    def __init__(self, k_model : KroneckerModel, 
+                 output_name : Union[str, List[str]],
+                 weight_col : str = None):
+        """
+        Keyword Arguments:
+        k_model -- KroneckerModel object, or any object with evaluate method
+        output_name -- column (or list of columns) in the data that will be 
+            used as the 'y' data
+        weight_col -- column that stores the weight information for weighted
+            least squares
+        """
+        self.k_model = k_model
+        self.output_name = output_name
+        self.weight_col = weight_col
+
+        #Keep a list of the outputs to treat one or many outputs the same way
+        if isinstance(output_name, str):
+            self.output_names = [output_name]
+        else:
+            self.output_names = list(output_name)
+        num_outputs = len(self.output_names)
+
+        #Get the size of the model
+        k_model_size = k_model.get_output_size()
+
+        #Initialize all the sums to zero
+        self.RTR = np.zeros((k_model_size, k_model_size))
+        self.yTR = np.zeros((num_outputs,k_model_size))
+        self.RTy = np.zeros((k_model_size,num_outputs))
+        self.yTy = np.zeros((num_outputs,num_outputs))
+        self.num_datapoints = 0
+
+
+    def get_required_columns(self) -> List[str]:
+        """
+        Returns the columns that have to be read from the dataset
+        """
+        columns = self.k_model.get_basis_names() + self.output_names
+
+        if self.weight_col is not None:
+            columns.append(self.weight_col)
+
+        return columns
+
+
+    def update(self, chunk : Union[pd.DataFrame, Mapping[str, np.ndarray]]):
+        """
+        Add a chunk of data to the sums
+
+        Keyword Arguments:
+        chunk -- pandas dataframe or mapping from column name to a 1D array 
+            with at least the columns in get_required_columns()
+        """
+        #Get the regressor matrix
+        # shape(sub_datapoints, k_model_output_size)
+        if isinstance(chunk, pd.DataFrame):
+            R = self.k_model.evaluate(chunk)
+        else:
+            R = self.k_model.evaluate(np.column_stack(
+                [np.asarray(chunk[name], dtype=float) 
+                 for name in self.k_model.get_basis_names()]))
+
+        #Get the expected output as 2D
+        # shape(sub_datapoints, num_outputs)
+        y = np.column_stack([np.asarray(chunk[name], dtype=float) 
+                             for name in self.output_names])
+
+        #If the weight column is not defined, use the same weight for all
+        if self.weight_col is None:
+            R_W = R
+            y_W = y
+        else:
+            W = np.asarray(chunk[self.weight_col], dtype=float).reshape(-1,1)
+            R_W = R * W
+            y_W = y * W
+
+        #Calculate the rank update
+        self.RTR += R.T @ R_W
+        self.yTR += y.T @ R_W
+        self.RTy += R.T @ y_W
+        
+        if np.isnan(self.RTy).sum() > 0:
+            raise ValueError(f"NaN in the regressor for {self.output_name}")
+        
+        self.yTy += y.T @ y_W
+        self.num_datapoints += y.shape[0]
+
+        return self
+
+
+    def update_from_chunks(self, 
+            chunks : Iterable[Union[pd.DataFrame, Mapping[str, np.ndarray]]]):
+        """
+        Add every chunk of an iterator to the sums, e.g. the output of 
+        iterate_parquet_chunks
+        """
+        for chunk in chunks:
+            self.update(chunk)
+
+        return self
+
+
+    def merge(self, other : 'RegressorAccumulator'):
+        """
+        Add the sums of another accumulator to this one
+
+        Keyword Arguments:
+        other -- RegressorAccumulator for the same model and output
+        """
+        if other.RTR.shape != self.RTR.shape or \
+                other.RTy.shape != self.RTy.shape:
+            raise ValueError("Can't merge accumulators with different model "
+                             f"sizes {self.RTy.shape} and {other.RTy.shape}")
+
+        self.RTR += other.RTR
+        self.yTR += other.yTR
+        self.RTy += other.RTy
+        self.yTy += other.yTy
+        self.num_datapoints += other.num_datapoints
+
+        return self
+
+
+    def get_regressor(self):
+        """
+        Returns:
+        RTR, RTy, yTR, yTy. With multiple outputs RTy has 
+        shape(k_model_output_size, num_outputs) and yTy has
+        shape(num_outputs, num_outputs)
+        """
+        return self.RTR, self.RTy, self.yTR, self.yTy
+
+
+def iterate_parquet_chunks(file_paths : Union[str, List[str]],
+                           columns : List[str],
+                           batch_size : int = None
+                           ) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Read parquet files one row group at a time, only loading the 
+    requested columns
+
+    Keyword Arguments:
+    file_paths -- parquet file or list of parquet files
+    columns -- columns to read
+    batch_size -- if defined, row groups are read in batches of at most 
+        this amount of rows to bound the memory footprint
+
+    Returns:
+    iterator of dictionaries from column name to a 1D numpy array
+    """
+    #Only required when reading parquet files
+    import pyarrow.parquet as pq
+
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+
+    for file_path in file_paths:
+        parquet_file = pq.ParquetFile(file_path)
+
+        if batch_size is None:
+            batches = (parquet_file.read_row_group(i, columns=columns)
+                       for i in range(parquet_file.num_row_groups))
+        else:
+            batches = parquet_file.iter_batches(batch_size=batch_size,
+                                                columns=columns)
+
+        for batch in batches:
+            yield {name: batch.column(name).to_numpy() for name in columns}
+
+
+@dataclass(repr=False)
+class RegularizationPath:
+    """
+    This class stores the l2 regularized least squares fits of several 
+    outputs for a vector of lambdas, see KModelFitter.solve_regularization_path
+    """
+    #Lambdas in the path, shape(num_lambdas,)
+    l2_lambdas: np.ndarray
+    #Fits, shape(num_lambdas, num_outputs, k_model_output_size)
+    model_fits: np.ndarray
+    #Residual of every fit (same as fit_data), shape(num_lambdas, num_outputs)
+    residuals: np.ndarray
+    #Effective degrees of freedom, trace of the hat matrix 
+    # shape(num_lambdas,)
+    degrees_of_freedom: np.ndarray
+    #Generalized cross validation score, shape(num_lambdas, num_outputs)
+    gcv: np.ndarray
+
+    def get_best_index(self) -> np.ndarray:
+        """
+        Returns the index of the lambda with the smallest generalized cross 
+        validation score for every output, shape(num_outputs,)
+        """
+        return np.argmin(self.gcv, axis=0)
+
+    def get_best_fits(self):
+        """
+        Returns the fit with the smallest generalized cross validation score
+        for every output
+
+        Returns:
+        l2_lambdas -- selected lambda per output, shape(num_outputs,)
+        model_fits -- shape(num_outputs, k_model_output_size)
+        residuals -- shape(num_outputs,)
+        """
+        best_index = self.get_best_index()
+        output_index = np.arange(len(best_index))
+
+        return self.l2_lambdas[best_index], \
+            self.model_fits[best_index, output_index], \
+            self.residuals[best_index, output_index]
+
+
 class KModelFitter():
 
     """
@@ -60,6 +286,270 @@ class KModelFitter():
                                                       data_splits, 
                                                       weight_col)
     
+        #Calculate the number of datapoints 
+        num_datapoints = len(data.index)
+
+        return self.solve_regressor(RTR, RTy, yTR, yTy, num_datapoints, 
+                                    l2_lambda)
+
+
+    def fit_data_multi(self, k_model : KroneckerModel, data : pd.DataFrame,
+                       output_names : List[str], data_splits : int = 50,
+                       l2_lambda : Union[float, List[float]] = 0.0,
+                       weight_col : str = None):
+        """
+        Least squares fit of several outputs that share the same regressor.
+        The regressor is only evaluated once for all the outputs
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object, or any object with evaluate method
+        data -- pandas dataframe with the data to perform the fit 
+        output_names -- columns in data that will be used as the 'y' data
+        data_splits -- scalar that indicates how many times to sub-divide 
+            the data
+        l2_lambda -- lambda in l2 regularization, or a list with one lambda 
+            per output
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        model_fits -- best fit of the model for every output with 
+                      shape(num_outputs, k_model_output_size)
+        (model_residuals, RTR, num_datapoints) -- model_residuals has 
+            shape(num_outputs,)
+        """
+        RTR, RTY, YTR, YTY = self.calculate_regressor_multi(k_model, data,
+                                                            output_names,
+                                                            data_splits,
+                                                            weight_col)
+
+        return self.solve_regressor_multi(RTR, RTY, YTR, YTY, len(data.index),
+                                          l2_lambda)
+
+
+    def solve_regressor_multi(self, RTR, RTY, YTR, YTY, num_datapoints,
+                              l2_lambda : Union[float, List[float]] = 0.0):
+        """
+        Calculate the least squares fits and residuals of several outputs 
+        from the regressor matrices. See fit_data_multi
+        """
+        num_outputs = RTY.shape[1]
+        identity = np.eye(RTR.shape[0])
+
+        #With the same regularization, solve all outputs at the same time
+        if isinstance(l2_lambda, (list, tuple, np.ndarray)):
+            X = np.concatenate([np.linalg.solve(RTR + l2_lambda_j * identity,
+                                                RTY[:,[j]]).T
+                                for j,l2_lambda_j in enumerate(l2_lambda)],
+                               axis=0)
+        else:
+            X = np.linalg.solve(RTR + l2_lambda * identity, RTY).T
+
+        residuals = self.calculate_residuals_multi(X, RTR, RTY, YTR, YTY,
+                                                   num_datapoints)
+
+        return X, (residuals, RTR, num_datapoints)
+
+
+    def fit_data_path(self, k_model : KroneckerModel, data : pd.DataFrame,
+                      output_name : Union[str, List[str]],
+                      l2_lambdas : np.ndarray, data_splits : int = 50,
+                      weight_col : str = None) -> RegularizationPath:
+        """
+        Fit the data for every lambda in l2_lambdas. The regressor is 
+        calculated once and RTR is only decomposed once for all the lambdas
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object, or any object with evaluate method
+        data -- pandas dataframe with the data to perform the fit 
+        output_name -- column (or list of columns) in data that will be used 
+            as the 'y' data
+        l2_lambdas -- lambdas in l2 regularization, e.g. np.logspace(-3,3,50)
+        data_splits -- scalar that indicates how many times to sub-divide 
+            the data
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        RegularizationPath with the fits for all the lambdas
+        """
+        if isinstance(output_name, str):
+            output_name = [output_name]
+
+        RTR, RTY, YTR, YTY = self.calculate_regressor_multi(k_model, data,
+                                                            output_name,
+                                                            data_splits,
+                                                            weight_col)
+
+        return self.solve_regularization_path(RTR, RTY, YTR, YTY, 
+                                              len(data.index), l2_lambdas)
+
+
+    def fit_data_gcv(self, k_model : KroneckerModel, data : pd.DataFrame,
+                     output_names : List[str], 
+                     l2_lambdas : np.ndarray = np.logspace(-4, 4, 41),
+                     data_splits : int = 50, weight_col : str = None):
+        """
+        Least squares fit of several outputs where the lambda of every 
+        output is selected with generalized cross validation
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object, or any object with evaluate method
+        data -- pandas dataframe with the data to perform the fit 
+        output_names -- columns in data that will be used as the 'y' data
+        l2_lambdas -- lambdas that are considered
+        data_splits -- scalar that indicates how many times to sub-divide 
+            the data
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        model_fits -- shape(num_outputs, k_model_output_size)
+        (model_residuals, RTR, num_datapoints) -- same as fit_data_multi
+        l2_lambdas -- selected lambda per output, shape(num_outputs,)
+        """
+        RTR, RTY, YTR, YTY = self.calculate_regressor_multi(k_model, data,
+                                                            output_names,
+                                                            data_splits,
+                                                            weight_col)
+        num_datapoints = len(data.index)
+
+        path = self.solve_regularization_path(RTR, RTY, YTR, YTY, 
+                                              num_datapoints, l2_lambdas)
+        best_lambdas, model_fits, residuals = path.get_best_fits()
+
+        return model_fits, (residuals, RTR, num_datapoints), best_lambdas
+
+
+    def solve_regularization_path(self, RTR, RTY, YTR, YTY, num_datapoints,
+                                  l2_lambdas : np.ndarray) \
+            -> RegularizationPath:
+        """
+        Calculate the l2 regularized fits and residuals of several outputs 
+        for every lambda from one eigendecomposition of RTR
+
+        With RTR = V diag(s) V^T and z = V^T RTy
+            x(lambda) = V z/(s + lambda)
+            |y - Rx|^2 = yTy - sum(z^2 (s + 2 lambda)/(s + lambda)^2)
+            degrees of freedom = sum(s/(s + lambda))
+            gcv = num_datapoints |y - Rx|^2/(num_datapoints - dof)^2
+
+        Keyword Arguments:
+        RTR, RTY, YTR, YTY -- output of calculate_regressor_multi. RTY can 
+            also be the RTy of a single output
+        num_datapoints -- number of datapoints in the regressor
+        l2_lambdas -- lambdas in l2 regularization
+
+        Returns:
+        RegularizationPath with the fits for all the lambdas
+        """
+        l2_lambdas = np.atleast_1d(np.asarray(l2_lambdas, dtype=float))
+
+        #Decompose RTR once for all the lambdas
+        s, V = np.linalg.eigh(RTR)
+
+        #Rounding can make the eigenvalues of singular matrices negative
+        s = np.maximum(s, 0)
+
+        #Project the outputs into the eigenvectors
+        # shape(k_model_output_size, num_outputs)
+        Z = V.T @ RTY
+
+        #Shrinkage factor of every eigenvector for every lambda
+        # shape(num_lambdas, k_model_output_size)
+        inverse_eig = 1/(s[np.newaxis,:] + l2_lambdas[:,np.newaxis])
+
+        #Fits for every lambda and output
+        # shape(num_lambdas, num_outputs, k_model_output_size)
+        model_fits = np.einsum('kl,lj,nl->njk', V, Z, inverse_eig)
+
+        #Squared error of every fit with respect to the data
+        # shape(num_lambdas, num_outputs)
+        fit_reduction = np.einsum('lj,nl->nj', Z**2, 
+            (s[np.newaxis,:] + 2*l2_lambdas[:,np.newaxis]) * inverse_eig**2)
+        squared_error = np.maximum(np.diag(np.atleast_2d(YTY)) 
+                                   - fit_reduction, 0)
+
+        residuals = np.sqrt(squared_error/num_datapoints)
+
+        #Effective number of parameters for the generalized cross validation
+        degrees_of_freedom = (s[np.newaxis,:] * inverse_eig).sum(axis=1)
+        gcv = num_datapoints * squared_error \
+            / (num_datapoints - degrees_of_freedom[:,np.newaxis])**2
+
+        return RegularizationPath(l2_lambdas, model_fits, residuals,
+                                  degrees_of_freedom, gcv)
+
+
+    def calculate_residuals_multi(self, X, RTR, RTY, YTR, YTY, 
+                                  num_datapoints):
+        """
+        Calculate the residual of every output from the regressor matrices
+
+        Returns:
+        residuals -- shape(num_outputs,)
+        """
+        #residual = sqrt((x^T R^T Rx - x^T R^T y - y^T Rx + y^T y)/num_datapoints)
+        # for every output
+        return np.sqrt((np.einsum('jk,kl,jl->j', X, RTR, X) 
+                        - np.einsum('jk,kj->j', X, RTY) 
+                        - np.einsum('jk,jk->j', YTR, X)
+                        + np.diag(YTY))/num_datapoints)
+
+
+    def fit_accumulator(self, accumulator : RegressorAccumulator,
+                        l2_lambda : float = 0.0):
+        """
+        Least squares fit from the sums of a RegressorAccumulator, 
+        e.g. after streaming parquet files. Same output as fit_data, or 
+        fit_data_multi if the accumulator has a list of outputs
+        """
+        if isinstance(accumulator.output_name, str):
+            return self.solve_regressor(*accumulator.get_regressor(), 
+                                        accumulator.num_datapoints, l2_lambda)
+
+        return self.solve_regressor_multi(*accumulator.get_regressor(), 
+                                          accumulator.num_datapoints, 
+                                          l2_lambda)
+
+
+    def fit_parquet(self, k_model : KroneckerModel, 
+                    file_paths : Union[str, List[str]], 
+                    output_name : Union[str, List[str]],
+                    l2_lambda : float = 0.0, weight_col : str = None,
+                    batch_size : int = 100000):
+        """
+        Least squares fit streaming the data from parquet files instead of 
+        loading all of it in memory. Same output as fit_data
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object
+        file_paths -- parquet file or list of parquet files
+        output_name -- column (or list of columns) in data that will be used 
+            as the 'y' data
+        l2_lambda -- lambda in l2 regularization
+        weight_col -- column that stores the weight information from weighted
+            least squares
+        batch_size -- maximum amount of rows that are read at the same time
+        """
+        accumulator = RegressorAccumulator(k_model, output_name, weight_col)
+        accumulator.update_from_chunks(iterate_parquet_chunks(file_paths,
+            accumulator.get_required_columns(), batch_size))
+
+        return self.fit_accumulator(accumulator, l2_lambda)
+
+
+    def solve_regressor(self, RTR, RTy, yTR, yTy, num_datapoints, 
+                        l2_lambda : float = 0.0):
+        """
+        Calculate the least squares fit and residual from the 
+        regressor matrices
+
+        Returns:
+        model_fit -- best fit of the model to the data with 
+                     shape(1,k_model_output_size)
+        (model_residual, RTR, num_datapoints)
+        """
         #Calculate the least squares fit
         # x = (R^T R - lambda*I)^-1 R^T y
         x = np.linalg.solve(RTR + l2_lambda * np.eye(RTR.shape[0]),RTy).T
@@ -67,9 +557,6 @@ class KModelFitter():
         #Debug shapes
         #print(f"RTR: {RTR.shape} yTR {yTR.shape} RTy: {RTy.shape} yTy: {yTy.shape} x {x.shape}")
 
-        #Calculate the number of datapoints 
-        num_datapoints = len(data.index)
-
 
         #residual = sqrt((x^T R^T Rx - x^T R^T y - y^T Rx + y^T y)/num_datapoints)
         residual = np.sqrt((x @ RTR @ x.T - x @ RTy - yTR @ x.T + yTy)/num_datapoints)
@@ -105,59 +592,56 @@ class KModelFitter():
         Throws: 
         Exception when the R cannot be inverted
         """
-        #If the weight column is not defined, initialize as list of all ones
-        if weight_col is None:
-            W_total = np.ones((len(data),1))
-            
-        #If it is defined, just get it from the dataset
-        else:
-            W_total = data[weight_col].values.reshape(-1,1)
-            
-        #Get the size of the model
-        k_model_size = k_model.get_output_size()
-
         #Assumes that we are solving for x in Rx = y
         # R - k_model evaluated at corresponding states
         # y - output variable
         # R has too many rows to invert directly, therefore, another method is used
         # To solve least squares, we need x = (R^T R)^-1 R^T y
         # Therefore we need R^T R and R^T y
-        RTR = np.zeros((k_model_size, k_model_size))
-        yTR = np.zeros((1,k_model_size))
-
         # In addition, the residual can be calculated by 
         # sqrt((x^T R^T Rx - x^T R^T y - y^T Rx + y^T y)/num_datapoints)
         # Therefore, store RTy and y^T y and get num_datapoints
-        RTy = np.zeros((k_model_size,1))
-        yTy = np.zeros((1,1))
+        accumulator = RegressorAccumulator(k_model, output_name, weight_col)
 
         #Divide the dataframe into multiple, smaller dataframes 
         # to calculate the desired matrices for the fit
-        data_weight_list = zip(np.array_split(data, data_splits),
-                               np.array_split(W_total, data_splits))
-        
-        #Do sub dataframe updates
-        for sub_datafrmae, W in data_weight_list:
-            
-            #Get the regressor matrix
-            # shape(sub_datapoints, k_model_output_size)
-            R = k_model.evaluate(sub_datafrmae)
-
-            #Get the expected output as 2D
-            # shape(sub_datapoints, 1)
-            y = sub_datafrmae[output_name].values.reshape(-1,1)
-
-            #Calculate the rank update
-            RTR += R.T @ (R * W)
-            yTR += y.T @ (R * W)
-            RTy += R.T @ (y * W)
-            
-            if np.isnan(RTy).sum() > 0:
-                raise ValueError
-            
-            yTy += y.T @ (y * W)
+        for sub_dataframe in np.array_split(data, data_splits):
+            accumulator.update(sub_dataframe)
+
+        return accumulator.get_regressor()
+
+
+    def calculate_regressor_multi(self, k_model : KroneckerModel, 
+                                  data : pd.DataFrame, 
+                                  output_names : List[str],
+                                  data_splits : int = 50,
+                                  weight_col : str = None):
+        """
+        Calculate the regressor matrices of several outputs evaluating the 
+        kronecker model only once per chunk
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object, or any object with evaluate method
+        data -- pandas dataframe with the data to perform the fit 
+        output_names -- columns in data that will be used as the 'y' data
+        data_splits -- scalar that indicates how many times to sub-divide 
+            the data
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        RTR -- shape(k_model_output_size, k_model_output_size)
+        RTY -- shape(k_model_output_size, num_outputs)
+        YTR -- shape(num_outputs, k_model_output_size)
+        YTY -- shape(num_outputs, num_outputs)
+        """
+        accumulator = RegressorAccumulator(k_model, list(output_names), 
+                                           weight_col)
+
+        for sub_dataframe in np.array_split(data, data_splits):
+            accumulator.update(sub_dataframe)
 
-        return RTR, RTy, yTR, yTy
+        return accumulator.get_regressor()
 
     
     
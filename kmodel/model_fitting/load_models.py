@@ -5,6 +5,7 @@ and joint model
 
 
 
+import os
 import pickle
 import pathlib
 from typing import List
@@ -14,6 +15,7 @@ from .context import model_definition, model_fitting
 from model_definition.k_model import KroneckerModel
 from model_definition.fitted_model import SimpleFitModel, PersonalKModel
 from model_definition.personal_measurement_function import PersonalMeasurementFunction
+from model_definition import model_artifact
 from model_fitting.k_model_fitting import KModelFitter
  
 import numpy as np 
@@ -25,6 +27,223 @@ from sklearn.decomposition import PCA
 #Make a definition so that the users know how to access the average fit
 AVG_FIT = "AVG"
 
+#Location of the fits that are saved by calculate_optimal_fits.py
+save_location = str(pathlib.Path(__file__).parent.resolve()) + \
+    '/../../data/optimal_model_fits/'
+
+#Cache of the loaded fit files, keyed by output name. Every entry is checked 
+# against the file on disk before it is used so that refitting the models 
+# invalidates it
+_fit_file_cache = {}
+
+#Cache of the personalization maps, keyed by 
+# (output names, left out subject number, num pca vectors, normalized pca)
+_personalization_cache = {}
+
+
+def clear_model_cache():
+    """
+    Remove all the fit files and personalization maps from the cache
+    """
+    _fit_file_cache.clear()
+    _personalization_cache.clear()
+
+
+def _get_file_signature(file_name:str):
+    """
+    Returns a tuple that changes when the file is modified
+    """
+    file_stat = os.stat(file_name)
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def _read_only(array:np.ndarray) -> np.ndarray:
+    """
+    Mark an array that is shared through the cache as read only so that 
+    users can't modify the cache by accident
+    """
+    array.flags.writeable = False
+    return array
+
+
+class _FitFileCacheEntry():
+    """
+    This class stores the contents of a fit file and the sums that are needed 
+    to calculate the leave one out averages in constant time per subject
+    
+    The arrays can be memory mapped, so the sums are only calculated when 
+    an average is requested
+    """
+
+    def __init__(self, model_fits:np.ndarray, RTR_list:List[np.ndarray], 
+                 num_datapoints_list:List[int], basis_list:list, 
+                 signature:tuple):
+        
+        self.signature = signature
+        self.basis_list = basis_list
+
+        #shape (num_subjects, 1, model_size)
+        self.model_fits = model_fits
+        self.num_subjects = self.model_fits.shape[0]
+        
+        #Only used by the normalized pca
+        self.RTR_list = RTR_list
+        self.num_datapoints_list = num_datapoints_list
+        
+        #Sum of all the fits, used to remove one subject from the average
+        self.model_fit_sum = None
+        self.average_fit = None
+        
+        #The leave one out averages are calculated when they are needed
+        self.leave_out_average_fits = {}
+
+        #The gram matrices are only calculated for the normalized pca
+        self.gram_matrices = None
+        self.gram_matrix_sum = None
+
+
+    def get_average_fit(self, leave_out_number:int=None) -> np.ndarray:
+        """
+        Returns the average fit with shape (1, model_size), optionally 
+        without one of the subjects
+        """
+        if self.model_fit_sum is None:
+            self.model_fit_sum = self.model_fits.sum(axis=0)
+            #Average of all the subjects
+            self.average_fit = _read_only(np.mean(self.model_fits, axis=0))
+
+        if leave_out_number is None:
+            return self.average_fit
+
+        if leave_out_number not in self.leave_out_average_fits:
+            #Remove the subject from the sum instead of averaging again
+            leave_out_fit = (self.model_fit_sum 
+                             - self.model_fits[leave_out_number])\
+                                / (self.num_subjects - 1)
+            self.leave_out_average_fits[leave_out_number] = \
+                _read_only(leave_out_fit)
+
+        return self.leave_out_average_fits[leave_out_number]
+
+    
+    def get_gram_matrix(self, leave_out_number:int) -> np.ndarray:
+        """
+        Returns the sum of the gram matrices (RTR normalized by the number 
+        of datapoints) of all the subjects except for one
+        """
+        if self.gram_matrices is None:
+            self.gram_matrices = [RTR/num_datapoints 
+                                  for RTR, num_datapoints 
+                                  in zip(self.RTR_list,
+                                         self.num_datapoints_list)]
+            self.gram_matrix_sum = sum(self.gram_matrices)
+
+        return self.gram_matrix_sum - self.gram_matrices[leave_out_number]
+
+
+def _load_fit_file(model_output_name:str) -> _FitFileCacheEntry:
+    """
+    Load the fits saved by calculate_optimal_fits.py for one output. The 
+    fits are only read again if they changed since the last time they were
+    loaded
+    
+    The model artifact directory is used if it exists, otherwise the old
+    pickle file is loaded
+
+    Keyword Arguments:
+    model_output_name -- name of the model output
+
+    Returns
+    cache entry with the fit information
+    """
+    artifact_directory = save_location + model_output_name + "_optimal"
+    
+    if model_artifact.is_artifact(artifact_directory):
+        save_file_name = artifact_directory
+        signature = model_artifact.get_artifact_signature(artifact_directory)
+    else:
+        save_file_name = save_location + model_output_name + "_optimal.p"
+        signature = _get_file_signature(save_file_name)
+
+    cache_entry = _fit_file_cache.get(model_output_name)
+    
+    #Use the cache if the same file did not change
+    if cache_entry is not None and cache_entry.signature == \
+            (save_file_name, signature):
+        return cache_entry
+    
+    if save_file_name == artifact_directory:
+        #The arrays are memory mapped so only the subjects that are used 
+        # are read
+        artifact = model_artifact.ModelArtifact(artifact_directory)
+        cache_entry = _FitFileCacheEntry(artifact['model_fits'],
+                                         artifact['RTR'],
+                                         artifact['num_datapoints'],
+                                         artifact.get_basis_list(),
+                                         (save_file_name, signature))
+    else:
+        with open(save_file_name,'rb') as data_file:
+            fit_results = pickle.load(data_file)
+        
+        #shape (num_subjects, 1, model_size)
+        model_fits = _read_only(np.array(fit_results["model fits"]))
+        cache_entry = _FitFileCacheEntry(model_fits,
+                                         fit_results['RTR list'],
+                                         fit_results['num datapoints list'],
+                                         fit_results['basis list'],
+                                         (save_file_name, signature))
+        
+    _fit_file_cache[model_output_name] = cache_entry
+
+    return cache_entry
+
+
+#Names of the artifact arrays with the residuals, keyed by the name that they
+# have in the old pickle file
+_RESIDUAL_ARRAY_NAMES = {'residual list': 'residuals',
+                         'residual variance list': 'residual_variances',
+                         'avg residual variance list':
+                             'avg_residual_variances'}
+
+
+def load_optimal_fit_info(model_output_name:str) -> dict:
+    """
+    Load the residuals and basis functions saved by calculate_optimal_fits.py
+    for one output, e.g. to build the measurement noise of the ekf
+
+    The model artifact directory is used if it exists, otherwise the old
+    pickle file is loaded. The same keys as the old pickle file are used so
+    that both can be read the same way
+
+    Keyword Arguments:
+    model_output_name -- name of the model output
+
+    Returns
+    dictionary with the 'basis list' and, if they were saved, the
+    'residual list', 'residual variance list' and
+    'avg residual variance list'
+    """
+    artifact_directory = save_location + model_output_name + "_optimal"
+
+    if not model_artifact.is_artifact(artifact_directory):
+        save_file_name = save_location + model_output_name + "_optimal.p"
+        with open(save_file_name,'rb') as data_file:
+            fit_results = pickle.load(data_file)
+
+        return {key: fit_results[key]
+                for key in ['basis list', *_RESIDUAL_ARRAY_NAMES]
+                if key in fit_results}
+
+    artifact = model_artifact.ModelArtifact(artifact_directory)
+    fit_info = {'basis list': artifact.get_basis_list()}
+
+    for key, array_name in _RESIDUAL_ARRAY_NAMES.items():
+        if array_name in artifact:
+            fit_info[key] = np.array(artifact[array_name])
+
+    return fit_info
+
+
 
 def get_subject_number(subject_name:str):
     """
@@ -72,28 +291,19 @@ def load_simple_models(model_output_name:str,
     
     
     #Load in the saved model parameters
-    current_file_path = str(pathlib.Path(__file__).parent.resolve()) + "/"
-    save_location = current_file_path + '../../data/optimal_model_fits/' 
-    save_file_name = save_location + model_output_name + "_optimal.p"
-
-    #Load file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
-    
-    #Get the model fit list
-    model_fit_list = fit_results["model fits"]
+    fit_file = _load_fit_file(model_output_name)
     
     #Manage the average fit case
-    if (subject_name == "AVG"):
+    if (subject_name == AVG_FIT):
         
+        #Get the leave subject out number 
         if leave_subject_out is not None:
-            #Get the leave subject out number 
             leave_out_number = get_subject_number(leave_subject_out)
-            #Remove that element from the list before calculating the average
-            model_fit_list.pop(leave_out_number)
+        else:
+            leave_out_number = None
         
-        #Calculate the mean model fit
-        model_fit = np.mean(model_fit_list, axis=0)
+        #Get the mean model fit
+        model_fit = fit_file.get_average_fit(leave_out_number)
         
     #If its not the average, it should be a subject number
     else:
@@ -102,11 +312,11 @@ def load_simple_models(model_output_name:str,
         model_fit_number = get_subject_number(subject_name)
         
         #Get the model fit for the subject
-        model_fit = model_fit_list[model_fit_number]
+        model_fit = fit_file.model_fits[model_fit_number]
     
     
     #Load in the model basis list
-    function_basis_list = fit_results["basis list"]
+    function_basis_list = fit_file.basis_list
     
     #Create the simple model fit object
     simple_fit_object = SimpleFitModel(function_basis_list, 
@@ -120,80 +330,40 @@ def load_simple_models(model_output_name:str,
 num_pca_vectors = 2
 
 
-def load_personalized_models(model_output_name_list:List[str],
-                             subject_name:str,
-                             subject_data:pd.DataFrame = None,
-                             normalized_pca:bool = True
-                            ) -> PersonalMeasurementFunction:
-   
+def _calculate_personalization_maps(fit_file_list:List[_FitFileCacheEntry],
+                                    subject_number:int,
+                                    num_pca_vectors:int,
+                                    normalized_pca:bool):
     """
-    This function is meant to load and possibly train a personalized model 
-
-    Args
-    
-    model_output_name_list: This is a list of the output names
+    Calculate the average fit and the personalization map for every output 
+    when one subject is left out
     
-    subject: Subject name
+    Keyword Arguments:
+    fit_file_list -- fit file cache entries, one per output
+    subject_number -- subject that is left out
+    num_pca_vectors -- number of rows of the personalization maps
+    normalized_pca -- if true, the pca is calculated in the orthonormal space 
+        of the gram matrix
     
-    subject_data: This is the subject data to fit the model. It is optional 
-        and if it is not supplied then the model will not be fit and it 
-        will not have the personalized fit. 
+    Returns
+    average_fit_per_joint_model -- list of leave one out average fits
+    personalization_map_per_joint_model -- list of personalization maps
     """
-   
-    #Get the integer number from the string name
-    subject_number = get_subject_number(subject_name)    
     
+    ## Calculate the average fit without the subject
+    average_fit_per_joint_model = [fit_file.get_average_fit(subject_number)
+                                   for fit_file in fit_file_list]
     
-    ##Load in all the saved model information
-    fit_info_per_joint = []
-    
-    #Append a fit info file for each of the model output names
-    for model_output_name in model_output_name_list:
-    
-        #Load in the saved model parameters
-        current_file_path = str(pathlib.Path(__file__).parent.resolve()) + "/"
-        save_location = current_file_path + '../../data/optimal_model_fits/' 
-        save_file_name = save_location + model_output_name + "_optimal.p"
-        
-        #Load file
-        with open(save_file_name,'rb') as data_file:
-            fit_results = pickle.load(data_file)
-        
-        #Add the fit information to the list    
-        fit_info_per_joint.append(fit_results)
-            
-    
-    #Get a list of model fits
-    model_fits_per_joint = [saved_info['model fits'] 
-                            for saved_info 
-                            in fit_info_per_joint]
-    
-    
-    #Create list with model fits and remove fits from 
-    # fits_excluding_desired_subject in one line
-    subject_optimal_fits = [subject_fit_list.pop(subject_number) 
-                            for subject_fit_list 
-                            in model_fits_per_joint]
-    
-    ## Calculate the average fit
-    average_fit_per_joint_model = [np.mean(model_fit_list,axis=0)
-                             for model_fit_list in 
-                             model_fits_per_joint]
-    
-    #Transpose all the fits
-    average_fit_per_joint_model_T = [avg_fit.T
-                                for avg_fit 
-                                in average_fit_per_joint_model]
-    
-    #Concatenate per subject
-    XI_per_joint_np = [np.concatenate(model_fit_list,axis=0).T 
-                       for model_fit_list 
-                       in model_fits_per_joint]
+    #Get the fits of the rest of the subjects
+    # shape (num_subjects - 1, model_size)
+    XI_per_joint_np = [np.delete(fit_file.model_fits[:,0,:],
+                                 subject_number, axis=0)
+                       for fit_file in fit_file_list]
     
     #Substract the average vector per joint
-    XI_0_per_joint = [(XI - XI_avg ).T
+    XI_0_per_joint = [XI - XI_avg 
                       for XI, XI_avg 
-                      in zip(XI_per_joint_np, average_fit_per_joint_model_T) ]
+                      in zip(XI_per_joint_np, average_fit_per_joint_model)]
     
     #Create a list of pca objects that we later fit to 
     pca_fit_list = [PCA() for i in range(len(XI_0_per_joint))]
@@ -202,26 +372,9 @@ def load_personalized_models(model_output_name_list:List[str],
     #Calculate the personalization map based on our stuff
     if normalized_pca == True:
         
-        #Calculate the gramian list by dividing the RTR over the number of
-        # datapoints
-        G_list_per_joint = []
-        
-        #Iterate through all the saved joints
-        for save_info in fit_info_per_joint:
-            #Set the accumulator to zero
-            G_for_joint = 0 
-            #Remove the cross validation subject
-            save_info['RTR list'].pop(subject_number)
-            save_info['num datapoints list'].pop(subject_number)
-            
-            #Iterate through all the RTR lists to normalize by the number 
-            # of datapoints
-            for RTR, num_datapoints in zip(save_info['RTR list'], 
-                                           save_info['num datapoints list']):
-                G_for_joint += (RTR/num_datapoints)
-
-            #Add the gram matrix to the per joint list
-            G_list_per_joint.append(G_for_joint)
+        #Get the gram matrices without the cross validation subject
+        G_list_per_joint = [fit_file.get_gram_matrix(subject_number)
+                            for fit_file in fit_file_list]
             
         #Convert to the orthonormal space that corresponds to rmse error
         XI_0_per_joint = convert_to_orthonormal(XI_0_per_joint, 
@@ -242,10 +395,75 @@ def load_personalized_models(model_output_name_list:List[str],
             personalization_map_per_joint_model, G_list_per_joint
         )
     
+    #The maps are shared through the cache
+    personalization_map_per_joint_model = [_read_only(pmap) for pmap 
+                                       in personalization_map_per_joint_model]
+    
+    return average_fit_per_joint_model, personalization_map_per_joint_model
+
+
+def load_personalized_models(model_output_name_list:List[str],
+                             subject_name:str,
+                             subject_data:pd.DataFrame = None,
+                             normalized_pca:bool = True,
+                             num_gait_fingerprints:int = None
+                            ) -> PersonalMeasurementFunction:
+   
+    """
+    This function is meant to load and possibly train a personalized model 
+
+    Args
+    
+    model_output_name_list: This is a list of the output names
+    
+    subject: Subject name
+    
+    subject_data: This is the subject data to fit the model. It is optional 
+        and if it is not supplied then the model will not be fit and it 
+        will not have the personalized fit. 
+    
+    normalized_pca: if true, the pca is calculated in the orthonormal space 
+        that corresponds to the rmse error
+    
+    num_gait_fingerprints: number of pca vectors in the personalization map. 
+        Defaults to num_pca_vectors
+    """
+   
+    #Get the integer number from the string name
+    subject_number = get_subject_number(subject_name)    
+    
+    if num_gait_fingerprints is None:
+        num_gait_fingerprints = num_pca_vectors
+    
+    ##Load in all the saved model information, only reads files that changed
+    fit_file_list = [_load_fit_file(model_output_name)
+                     for model_output_name in model_output_name_list]
+    
+    #Get the optimal fit of the subject for every joint
+    subject_optimal_fits = [fit_file.model_fits[subject_number]
+                            for fit_file in fit_file_list]
+    
+    #Reuse the personalization maps if the fit files did not change
+    cache_key = (tuple(model_output_name_list), subject_number, 
+                 num_gait_fingerprints, bool(normalized_pca))
+    signatures = [fit_file.signature for fit_file in fit_file_list]
+    cache_entry = _personalization_cache.get(cache_key)
+    
+    if cache_entry is None or cache_entry[0] != signatures:
+        personalization_maps = _calculate_personalization_maps(fit_file_list,
+                                                               subject_number,
+                                                        num_gait_fingerprints,
+                                                               normalized_pca)
+        cache_entry = (signatures, personalization_maps)
+        _personalization_cache[cache_key] = cache_entry
+
+    average_fit_per_joint_model, personalization_map_per_joint_model = \
+        cache_entry[1]
+    
     
     #To do least squares, we need to calculate the regressor, to do that we 
     # need a kronecker model
-    basis_list = fit_results["basis list"]
+    basis_list = fit_file_list[0].basis_list
     k_model = KroneckerModel(basis_list)
     
     #Get regression matrices
@@ -365,7 +583,8 @@ def convert_to_orthonormal(XI_0_list:List[np.ndarray],
 
         #This is based on the equation in eq:Qdef
         # Q G Q = I
-        Qinv = sum([O[:,[i]] @ O[:,[i]].T * np.sqrt(eig[i]) for i in range(len(eig))])
+        # Qinv = sum_i O_i O_i^T sqrt(eig_i)
+        Qinv = (O * np.sqrt(eig)) @ O.T
 
         #Calculate the model's fit in the orthonormal space
         XI_0_scaled = XI_0 @ Qinv
@@ -402,7 +621,8 @@ def convert_from_orthonormal(XI_0_list:List[np.ndarray],
 
         #This is based on the equation in eq:Qdef
         # Q G Q = I
-        Q = sum([O[:,[i]] @ O[:,[i]].T * 1/np.sqrt(eig[i]) for i in range(len(eig))])
+        # Q = sum_i O_i O_i^T 1/sqrt(eig_i)
+        Q = (O / np.sqrt(eig)) @ O.T
 
         #Calculate the model's fit in the orthonormal space
         XI_0_original = XI_0 @ Q
@@ -0,0 +1,200 @@
+"""
+This file defines a driver that fits kronecker models for many subjects
+with a process pool
+
+Every subject is accumulated in one task with exactly the same chunks and
+operations as KModelFitter, and the results are reduced in subject order.
+Therefore the fits are bit for bit the same as the serial path
+"""
+
+#Common imports
+import os
+import copy
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+#For docstring
+from typing import List, Tuple, Union
+
+#Kronecker model imports
+from .context import model_definition
+from model_definition.k_model import KroneckerModel
+from .k_model_fitting import KModelFitter, RegressorAccumulator, \
+    iterate_parquet_chunks
+
+
+#Data for a subject, either a dataframe or parquet file(s) that are
+# streamed by the worker
+SubjectData = Union[pd.DataFrame, str, List[str]]
+
+
+def _accumulate_subject(k_model : KroneckerModel, subject_data : SubjectData,
+                        output_names : List[str], data_splits : int,
+                        weight_col : str, batch_size : int) \
+        -> RegressorAccumulator:
+    """
+    Calculate the regressor of one subject. This runs in the worker process
+
+    Dataframes are split the same way as KModelFitter.calculate_regressor_multi
+    and parquet files are streamed the same way as KModelFitter.fit_parquet
+    """
+    accumulator = RegressorAccumulator(k_model, list(output_names),
+                                       weight_col)
+
+    if isinstance(subject_data, pd.DataFrame):
+        for sub_dataframe in np.array_split(subject_data, data_splits):
+            accumulator.update(sub_dataframe)
+    else:
+        accumulator.update_from_chunks(iterate_parquet_chunks(subject_data,
+            accumulator.get_required_columns(), batch_size))
+
+    #The model does not need to be sent back to the main process
+    accumulator.k_model = None
+
+    return accumulator
+
+
+class ParallelKModelFitter():
+    """
+    This class fits the same kronecker model to the data of many subjects
+    using a process pool
+    """
+
+    def __init__(self, num_processes : int = None, data_splits : int = 50,
+                 batch_size : int = 100000):
+        """
+        Keyword Arguments:
+        num_processes -- amount of worker processes. Defaults to the number
+            of cores. With one process everything runs in this process
+        data_splits -- amount of chunks that dataframes are split into,
+            same as KModelFitter.fit_data
+        batch_size -- maximum amount of rows read at once from parquet files
+        """
+        if num_processes is None:
+            num_processes = os.cpu_count()
+
+        self.num_processes = num_processes
+        self.data_splits = data_splits
+        self.batch_size = batch_size
+
+        #Used to solve the least squares problems
+        self.fitter = KModelFitter()
+
+
+    def calculate_regressors(self, k_model : KroneckerModel,
+                             subject_data_list : List[Tuple[str, SubjectData]],
+                             output_names : List[str],
+                             weight_col : str = None) \
+            -> List[RegressorAccumulator]:
+        """
+        Calculate the regressor matrices of every subject in parallel
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object
+        subject_data_list -- list with tuples of the form
+            (subject_name, pandas dataframe or parquet file(s))
+        output_names -- columns in the data that will be used as the 'y' data
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        accumulators -- one per subject in the same order as
+            subject_data_list
+        """
+        num_subjects = len(subject_data_list)
+        arguments = ([k_model]*num_subjects,
+                     [subject_data for _,subject_data in subject_data_list],
+                     [output_names]*num_subjects,
+                     [self.data_splits]*num_subjects,
+                     [weight_col]*num_subjects,
+                     [self.batch_size]*num_subjects)
+
+        #Don't pay for the pool if there is nothing to parallelize
+        if self.num_processes == 1 or num_subjects <= 1:
+            return list(map(_accumulate_subject, *arguments))
+
+        #map returns the results in the submission order
+        with ProcessPoolExecutor(min(self.num_processes, num_subjects)) \
+                as executor:
+            return list(executor.map(_accumulate_subject, *arguments))
+
+
+    def fit_subjects(self, k_model : KroneckerModel,
+                     subject_data_list : List[Tuple[str, SubjectData]],
+                     output_names : List[str],
+                     l2_lambda : Union[float, List[float]] = 0.0,
+                     weight_col : str = None):
+        """
+        Fit every output of every subject. The least squares problems of all
+        the subjects are solved as a batch
+
+        Keyword Arguments:
+        k_model -- KroneckerModel object
+        subject_data_list -- list with tuples of the form
+            (subject_name, pandas dataframe or parquet file(s))
+        output_names -- columns in the data that will be used as the 'y' data
+        l2_lambda -- lambda in l2 regularization, or a list with one lambda
+            per output
+        weight_col -- column that stores the weight information from weighted
+            least squares
+
+        Returns:
+        list with one tuple per subject, in the same order as
+            subject_data_list, with the same output as
+            KModelFitter.fit_data_multi
+            (model_fits, (model_residuals, RTR, num_datapoints))
+        """
+        accumulators = self.calculate_regressors(k_model, subject_data_list,
+                                                 output_names, weight_col)
+
+        return self.solve_accumulators(accumulators, l2_lambda)
+
+
+    def solve_accumulators(self, accumulators : List[RegressorAccumulator],
+                           l2_lambda : Union[float, List[float]] = 0.0):
+        """
+        Solve the least squares problem of every accumulator as a batch.
+        Same output as calling KModelFitter.fit_accumulator on each one
+        """
+        RTR = np.stack([accumulator.RTR for accumulator in accumulators])
+        RTY = np.stack([accumulator.RTy for accumulator in accumulators])
+        identity = np.eye(RTR.shape[1])
+
+        #Same systems as KModelFitter.solve_regressor_multi
+        if isinstance(l2_lambda, (list, tuple, np.ndarray)):
+            #shape(num_subjects, num_outputs, k_model_size, k_model_size)
+            A = np.stack([RTR + l2_lambda_j * identity
+                          for l2_lambda_j in l2_lambda], axis=1)
+            b = RTY.transpose(0,2,1)[:,:,:,np.newaxis]
+            X = np.linalg.solve(A, b)[:,:,:,0]
+        else:
+            X = np.linalg.solve(RTR + l2_lambda * identity, RTY)\
+                .transpose(0,2,1)
+
+        results = []
+        for accumulator, subject_fits in zip(accumulators, X):
+            residuals = self.fitter.calculate_residuals_multi(subject_fits,
+                *accumulator.get_regressor(), accumulator.num_datapoints)
+            results.append((subject_fits, (residuals, accumulator.RTR,
+                                           accumulator.num_datapoints)))
+
+        return results
+
+
+    @staticmethod
+    def merge_accumulators(accumulators : List[RegressorAccumulator]) \
+            -> RegressorAccumulator:
+        """
+        Add the sums of all the accumulators in order, e.g. to calculate the
+        gram matrix of all the subjects. The inputs are not modified
+        """
+        #Copy the sums of the first accumulator to not modify it
+        merged = copy.copy(accumulators[0])
+        for name in ['RTR', 'RTy', 'yTR', 'yTy']:
+            setattr(merged, name, getattr(merged, name).copy())
+
+        for accumulator in accumulators[1:]:
+            merged.merge(accumulator)
+
+        return merged
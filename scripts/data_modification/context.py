@@ -0,0 +1,7 @@
+import os, sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+import kmodel
+import ekf
+import utils
\ No newline at end of file
@@ -6,6 +6,7 @@ from pandas import DataFrame
 import threading
 from functools import lru_cache
 import os
+import shutil
 from scipy.io import loadmat
 
 
@@ -249,6 +250,76 @@ def add_nan_columns_to_experiments2(endpoint_string):
                 experiment_data_list[i] = new_data
 
 
+def get_experiment_conditions(experiment_name):
+    """
+    Get the task information that is stored in the trial name, such as 
+    velocity and inclination
+
+    Keyword Arguments
+    experiment_name: endpoint string, the first level is the ambulation
+    mode and the second level contains info about the trial
+
+    Returns
+    experiment_type: ambulation mode
+    incline_deg: incline of the experiment, nan if it is not defined
+    speed: speed of the experiment, nan if it is not defined
+    """
+    #Split the string to get the different parts
+    experiment_content = experiment_name.split('/')
+    
+    #The first entry has the ambulation mode
+    experiment_type = experiment_content[0]
+    #The second entry contains info about the trial
+    experiment_info = experiment_content[1]
+
+    #Handle every experiment type 
+    if(experiment_type == 'Run'):
+        
+        #Running incline is always 0                
+        incline_deg = 0
+        
+        #Get running speed
+        speed = float(experiment_info[1:].replace('x','.'))
+
+    elif(experiment_type == 'Stair'):
+        
+        #Get incline from experiment info
+        incline_deg_string, incline_number_string = experiment_info.split('_')
+        
+        #For the experiment number odd is ascent. Even, descent
+        incline_sign = 1 if int(incline_number_string)%2 == 0 else -1
+        #The degrees are in the second and third positions
+        incline_deg = incline_sign*float(incline_deg_string[1:2])
+
+        #The walking speed is user selected and not specified
+        speed = np.nan
+
+    elif(experiment_type == 'Sts' or experiment_type == 'SitStand'):
+
+        #There is no speed or incline in sit to stand
+        incline_deg = np.nan
+        speed = np.nan
+
+    elif(experiment_type == 'Tread'):
+        
+        #The walking speed is set at random based on the protocol
+        speed = np.nan
+
+        #The incline is specified in experiment info
+        incline_sign = 1 if experiment_info[0] == 'i' else -1
+        incline_deg = incline_sign*float(experiment_info[1:])
+
+    elif(experiment_type == 'Wtr'):
+
+        #There is no speed or incline in walk to run
+        incline_deg = np.nan
+        speed = np.nan
+    else:
+        raise ValueError(f"Experiment Type not recognized: {experiment_type}")
+
+    return experiment_type, incline_deg, speed
+
+
 def add_experiment_info(random_endpoint_list, df):
         """
         This function will add information stored in the trial name
@@ -268,13 +339,9 @@ def add_experiment_info(random_endpoint_list, df):
         
         for experiment_name, experiment_num_rows in sorted_random_endpoint_list:
             
-            #Split the string to get the different parts
-            experiment_content = experiment_name.split('/')
-            
-            #The first entry has the ambulation mode
-            experiment_type = experiment_content[0]
-            #The second entry contains info about the trial
-            experiment_info = experiment_content[1]
+            #Get the ambulation mode, incline and speed from the name
+            experiment_type, incline_deg, speed = \
+                get_experiment_conditions(experiment_name)
 
             #Get the experiment type vector
             experiment_type_vector = [experiment_type]*experiment_num_rows
@@ -283,56 +350,9 @@ def add_experiment_info(random_endpoint_list, df):
             dt = 1.0/100.0
             experiment_time_vector = [dt*i for i in range(experiment_num_rows)]
 
-            #Handle every experiment type 
-            ## thisadd experiment speed and incline
-            if(experiment_type == 'Run'):
-                
-                #Running incline is always 0                
-                experiment_incline_vector = [0]*experiment_num_rows
-                
-                #Get running speed
-                speed = float(experiment_info[1:].replace('x','.'))
-                experiment_speed_vector = [speed]*experiment_num_rows
-
-
-            elif(experiment_type == 'Stair'):
-                
-                #Get incline from experiment info
-                incline_deg_string, incline_number_string = experiment_info.split('_')
-                
-                #For the experiment number odd is ascent. Even, descent
-                incline_sign = 1 if int(incline_number_string)%2 == 0 else -1
-                #The degrees are in the second and third positions
-                incline_deg = float(incline_deg_string[1:2])
-                #Create the incline vector for this experiment
-                experiment_incline_vector = [incline_sign*incline_deg]*experiment_num_rows
-
-                #The walking speed is user selected and not specified
-                experiment_speed_vector = [np.nan]*experiment_num_rows
-
-            elif(experiment_type == 'Sts' or experiment_type == 'SitStand'):
-
-                #There is no speed or incline in sit to stand
-                experiment_incline_vector = [np.nan]*experiment_num_rows
-                experiment_speed_vector = [np.nan]*experiment_num_rows
-
-            elif(experiment_type == 'Tread'):
-                
-                #The walking speed is set at random based on the protocol
-                experiment_speed_vector = [np.nan]*experiment_num_rows
-
-                #The incline is specified in experiment info
-                incline_sign = 1 if experiment_info[0] == 'i' else -1
-                incline_deg = float(experiment_info[1:])
-                experiment_incline_vector = [incline_sign*incline_deg]*experiment_num_rows
-
-            elif(experiment_type == 'Wtr'):
-
-                #There is no speed or incline in walk to run
-                experiment_incline_vector = [np.nan]*experiment_num_rows
-                experiment_speed_vector = [np.nan]*experiment_num_rows
-            else:
-                raise ValueError(f"Experiment Type not recognized: {experiment_type}")
+            #Add experiment speed and incline
+            experiment_incline_vector = [incline_deg]*experiment_num_rows
+            experiment_speed_vector = [speed]*experiment_num_rows
 
             #Add all the info for the experiment
             type_vector.extend(experiment_type_vector)
@@ -342,7 +362,7 @@ def add_experiment_info(random_endpoint_list, df):
 
 
         df['ambulationMode'] = type_vector
-        df['inclineDeg'] = incline_deg
+        df['inclineDeg'] = incline_vector
         df['speed'] = speed_vector
         df['time'] = time_vector
 
@@ -432,6 +452,209 @@ def flatten_r01():
         df.to_parquet(path = abs_save_name)
 
 
+
+#Suffix of every channel of an endpoint
+CHANNEL_SUFFIXES = {0:'x',1:'y',2:'z',3:'e'}
+
+#Endpoints that contain any of these strings are not read
+ENDPOINT_FILTER_STRINGS = ['events', 'LHS', 'RHS', 'cvel', 'footStrikes',
+                           'ParticipantDetail', 'rvel']
+
+#The force plates are sampled at 1kHz and everything else at 100Hz
+FORCEPLATE_DECIMATION = 10
+
+#Sample time after the force plates are decimated
+R01_DT = 1.0/100.0
+
+
+def get_experiment_end_points_R01(data, num_last_keys=2):
+    """
+    Get the name of every endpoint grouped by experiment without reading
+    any data. The endpoints are filtered the same way as get_end_points_R01
+    and the columns that flatten_r01 skips are not added, so experiments
+    that only have skipped endpoints, e.g. Run/s1x8/CutPoints, are left out
+
+    Keyword Arguments
+    data: h5py group of the subject
+    num_last_keys: amount of keys used to create the column name
+
+    Returns
+    experiment_dict: dictionary that maps the experiment name to the list of
+    (endpoint name, column name) of the experiment
+    column_names: every column name with the channel suffix, in the same
+    order as get_end_points_R01
+    """
+    experiment_dict = {}
+    column_names = {}
+
+    def add_end_point(name, item):
+        
+        # Where the magic happens when you reach an end point
+        if not isinstance(item, h5py.Dataset):
+            return
+
+        column_string = get_column_name(name.split('/')[-num_last_keys:],
+                                        num_last_keys)
+        temp_column_name = name+"_"+column_string
+
+        if any(filter_string in temp_column_name 
+               for filter_string in ENDPOINT_FILTER_STRINGS):
+            return
+
+        #Filter based on the endpoint name, same as flatten_r01
+        if skip_column(column_string):
+            return
+
+        #The channels are the second to last dimension. The shape is 
+        # available without reading the data
+        num_channels = 1 if len(item.shape) == 1 else item.shape[-2]
+        for i in range(num_channels):
+            column_names[column_string+"_"+CHANNEL_SUFFIXES[i]] = None
+
+        experiment_dict.setdefault(remove_endpoint_feature(name), [])\
+            .append((name, column_string))
+
+    data.visititems(add_end_point)
+
+    return experiment_dict, list(column_names)
+
+
+def read_channels(dataset):
+    """
+    Read an endpoint as a 2D array with one row per channel. Row i is the 
+    same as v[:,i,:].ravel() in get_end_points_R01
+    """
+    v = dataset[()]
+
+    #If you have only one stride then it is converted into a 2D array
+    # Turn it into a 3d array
+    if len(v.shape) == 1:
+        v = v.reshape(1,1,v.shape[0])
+
+    if len(v.shape) == 2:
+        v = v.reshape(1,v.shape[0],v.shape[1])
+
+    return v.transpose(1,0,2).reshape(v.shape[1],-1)
+
+
+def flatten_r01_experiment(data, experiment_name, end_points, column_names,
+                           is_streaming):
+    """
+    Flatten one experiment of a subject. This is the same as the part of the
+    flattened file that flatten_r01 creates for the experiment
+
+    Keyword Arguments
+    data: h5py group of the subject
+    experiment_name: name of the experiment, e.g. Run/s1x8
+    end_points: list of (endpoint name, column name) of the experiment
+    column_names: every column name of the subject, features that the 
+    experiment does not have are filled with nan
+    is_streaming: if true, the force plates are decimated to 100Hz
+
+    Returns
+    df: dataframe with the data of the experiment
+    """
+    #Read all the channels of the experiment
+    channel_dict = {}
+    for end_point, column_string in end_points:
+
+        channels = read_channels(data[end_point])
+
+        #Decimate all the channels at once
+        if is_streaming and "forceplate" in end_point:
+            channels = channels[:,::FORCEPLATE_DECIMATION]
+
+        for i, channel in enumerate(channels):
+            channel_dict[column_string+"_"+CHANNEL_SUFFIXES[i]] = channel
+
+    #Features that are shorter than the experiment are padded with nan
+    # at the end, same as add_nan_columns_to_experiments2
+    num_rows = max(channel.shape[0] for channel in channel_dict.values())
+
+    column_dict = {}
+    for column_name in column_names:
+        column = np.full(num_rows, np.nan)
+        if column_name in channel_dict:
+            channel = channel_dict[column_name]
+            column[:channel.shape[0]] = channel
+
+        column_dict[column_name] = column
+
+    #Add experiment information such as speed and incline
+    _, incline_deg, speed = get_experiment_conditions(experiment_name)
+    column_dict['inclineDeg'] = np.full(num_rows, incline_deg, dtype=float)
+    column_dict['speed'] = np.full(num_rows, speed, dtype=float)
+    column_dict['time'] = R01_DT*np.arange(num_rows)
+    column_dict['dt'] = np.full(num_rows, R01_DT)
+
+    return DataFrame(column_dict)
+
+
+def flatten_r01_streaming(dataset='Streaming', subjects=None):
+    """
+    Flatten the R01 dataset one experiment at a time, so that the memory 
+    is bounded by the size of one experiment instead of one subject
+
+    Every experiment is saved as a parquet file in a dataset that is 
+    partitioned by subject and ambulation mode, e.g. 
+    r01_Streaming_flattened/subject=AB01/ambulationMode=Run/Run_s1x8.parquet
+    The whole dataset can be read with pd.read_parquet on the directory
+
+    Keyword Arguments
+    dataset: name of the dataset, 'Streaming' or 'Normalized'
+    subjects: list of subjects to flatten. Defaults to all the subjects
+    """
+
+    #Get the file
+    file_name = f'../../data/r01_dataset/{dataset}.mat'
+    save_location = os.path.abspath(
+        f'../../data/r01_dataset/r01_{dataset}_flattened')
+
+    #The force plates are only sampled at 1kHz in the streaming dataset
+    is_streaming = 'Streaming' in file_name
+
+    with h5py.File(file_name, 'r') as h5py_file:
+
+        if subjects is None:
+            subjects = list(h5py_file[dataset].keys())
+
+        for subject in subjects:
+
+            print("Flattening subject: " + subject)
+
+            #Get the data for the subject
+            data = h5py_file[dataset][subject]
+
+            # Obtain the names of the end points for each experiment
+            experiment_dict, column_names = get_experiment_end_points_R01(data)
+
+            #Remove the previous version of the subject so that there are
+            # no experiments left over
+            subject_location = os.path.join(save_location, f'subject={subject}')
+            if os.path.isdir(subject_location):
+                shutil.rmtree(subject_location)
+
+            # Use the same experiment order as flatten_r01
+            for experiment_name in sorted(experiment_dict):
+
+                df = flatten_r01_experiment(data, experiment_name,
+                                            experiment_dict[experiment_name],
+                                            column_names, is_streaming)
+
+                #The ambulation mode is stored in the directory name
+                ambulation_mode, _, _ = \
+                    get_experiment_conditions(experiment_name)
+                experiment_location = os.path.join(
+                    subject_location, f'ambulationMode={ambulation_mode}')
+                os.makedirs(experiment_location, exist_ok=True)
+
+                df.to_parquet(os.path.join(experiment_location,
+                    experiment_name.replace('/','_') + '.parquet'),
+                    index=False)
+
+        print(f"Saved in {save_location}")
+
+
         
  
 
@@ -464,5 +687,6 @@ def flatten_r01():
 
 if __name__ == '__main__':
     flatten_r01()
+    # flatten_r01_streaming()
     # determine_different_strides()
 
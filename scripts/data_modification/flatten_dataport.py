@@ -9,11 +9,18 @@ Created on Wed Apr 14 22:17:32 2021
 # %%
 
 from os import remove
+import os
 import h5py
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from functools import lru_cache
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+
+#Used to write the parquet files with one row group per trial
+from context import utils
+from utils.dataport_dataset import write_row_groups
 
 
 def get_column_name(column_string_list, num_last_keys):
@@ -174,91 +181,149 @@ def determine_different_strides():
     # I think they are all on the left leg
 #%%
 
-def quick_flatten_dataport():
-    pass
-    # %%
-    file_name = '../../data/InclineExperiment.mat'
-    h5py_file = h5py.File(file_name)['Gaitcycle']
+#Default location of the dataport dataset and the flattened files
+DATAPORT_FILE_NAME = '../../data/InclineExperiment.mat'
+FLATTENED_FILE_NAME = ('../../data/flattened_dataport/'
+                       'dataport_flattened_partial_{}.parquet')
 
-    # Iterate through all the subjects, make a file per subject to keep it RAM bound
-    for subject in h5py_file.keys():
-        
-        #Uncomment if you want to debug a specific subject
-        # if subject != "AB05":
-        #     continue
+# Which column will be used to get information about each row
+SELECTED_COLUMN = 'jointangles_ankle_x'
 
+# If the enpoints contain any of this, ignore the endpoint
+IGNORED_COLUMN_STRINGS = ['subjectdetails', 'cycles', 'stepsout',
+                          'description', 'mean', 'std']
 
-        print("Flattening subject: " + subject)
-        # Initialize variables for the subject
-        data = h5py_file[subject]
-        save_name = '../../data/flattened_dataport/dataport_flattened_partial_{}.parquet'.format(
-            subject)
-        # Store all the end points
-        columns_to_endpoint_list = {}
-        get_end_points(data, columns_to_endpoint_list)
-        # This dictionary stores dataframes based on the amount of strides that
-        # they have
-        strides_to_dataframes_dict = {}
-        # Which column will be used to get information about each row
-        selected_column = 'jointangles_ankle_x'
+#Amount of points in every stride
+POINTS_PER_STRIDE = 150
 
-        # Main loop - process each potential column
-        for column_name, endpoint_list in columns_to_endpoint_list.items():
 
-            # If the enpoints contain any of this, ignore the endpoint
-            if('subjectdetails' in column_name or
-                'cycles' in column_name or
-                'stepsout' in column_name or
-                'description' in column_name or
-                'mean' in column_name or
-                    'std' in column_name):
-                #print(column_name + " " +       str(len(endpoint_list[1])) + " (ignored)")
-                continue
+def get_end_point_names(group, num_last_keys=4):
+    """
+    Same as get_end_points but only stores the name of the endpoints.
+    h5py walks the tree in the same order as get_end_points, so the
+    endpoints of every column are in the same order
 
-            # Else: this is a valid column
-            #print(column_name + " " + str(len(endpoint_list[1])))
+    Keyword Arguments:
+    group -- h5py group to walk
+    num_last_keys -- amount of keys used to create the column name
 
-            # Filter the endpoint list for bad 
-            #This version removes elements just in the end
-            bad_run_filter = lambda x: (x[:,:],[]) if (np.count_nonzero(x[-1,:]) or np.count_nonzero(x[-2,:]) == 0) else (x[:-1,:],[x.shape[0]-1])
-            
-            #This version removes elements in the middle 
-            # def bad_run_filter(trial_dataset):
-            #     remove_list = []
-            #     for row_index,row in enumerate(trial_dataset):
-            #         num_digits = np.count_nonzero(row)
-            #         if(num_digits == 0):
-            #             remove_list.append(row_index)
-                
-            #     #Remove elements
-            #     # if remove list is empty, nothing is deleted
-            #     return np.delete(trial_dataset[:,:], remove_list, axis=0), remove_list
+    Returns:
+    out_dict -- dictionary that maps the column name to the list of
+        endpoint names relative to the group
+    """
+    out_dict = {}
 
-            endpoint_list_filtered = [bad_run_filter(x)[0] for x in endpoint_list[1]]
-        
-            # Get the data to add it to a dataframe
-            data_array = np.concatenate(endpoint_list_filtered, axis=0).flatten()
+    def add_end_point(name, item):
+        # Where the magic happens when you reach an end point
+        if isinstance(item, h5py.Dataset):
+            column_string = get_column_name(name.split('/')[-num_last_keys:],
+                                            num_last_keys)
+            out_dict.setdefault(column_string, []).append(name)
+
+    group.visititems(add_end_point)
+
+    return out_dict
 
 
-            # Calculate how many strides are in the dataframe
-            len_arr = data_array.shape[0]
-            len_key = len_arr/150.0
+def get_num_good_strides(dataset):
+    """
+    Returns the amount of strides that are kept by the bad run filter in
+    quick_flatten_dataport. The last stride is removed if it is all zeros
+    and the stride before it is not. Only the last two strides are read
+    """
+    if (np.count_nonzero(dataset[-1,:])
+            or np.count_nonzero(dataset[-2,:]) == 0):
+        return dataset.shape[0]
+    else:
+        return dataset.shape[0] - 1
 
-            # Add the key to the dataframe
-            try:
-                strides_to_dataframes_dict[len_key][column_name] = data_array
-            except KeyError:
-                strides_to_dataframes_dict[len_key] = DataFrame()
-                strides_to_dataframes_dict[len_key][column_name] = data_array
 
-        # All the dataframes have been created, add information about phase and task
+def read_column(datasets, num_strides_list):
+    """
+    Read the good strides of every dataset straight into one preallocated
+    array, same as concatenating and flattening them
 
-        # Helper functions to get time, ramp to append task information to dataframe
+    Keyword Arguments:
+    datasets -- h5py datasets of the column
+    num_strides_list -- amount of strides to read from each dataset
 
-        @lru_cache(maxsize=5)
-        def get_time(trial, leg):
-            return data[trial]['cycles'][leg]['time']
+    Returns:
+    column -- flat numpy array
+    """
+    num_points = sum(num_strides * dataset.shape[1] for dataset, num_strides
+                     in zip(datasets, num_strides_list))
+    column = np.empty(num_points,
+                      dtype=np.result_type(*[dataset.dtype
+                                             for dataset in datasets]))
+
+    start = 0
+    for dataset, num_strides in zip(datasets, num_strides_list):
+        end = start + num_strides * dataset.shape[1]
+        #The slice of a contiguous array is contiguous, so h5py can
+        # copy the data into it without a temporary array
+        if num_strides > 0:
+            dataset.read_direct(column[start:end].reshape(num_strides, -1),
+                                source_sel=np.s_[:num_strides, :])
+        start = end
+
+    return column
+
+
+def flatten_subject(file_name, subject, save_name,
+                    selected_column=SELECTED_COLUMN):
+    """
+    Flatten the data of one subject into a parquet file with one row group
+    per trial. This is the same as one iteration of quick_flatten_dataport
+    and runs in the worker process, so the file is opened read only
+
+    Keyword Arguments:
+    file_name -- InclineExperiment.mat file
+    subject -- subject name, e.g. AB01
+    save_name -- name of the parquet file
+    selected_column -- column that is used to get information about each row
+
+    Returns:
+    num_rows -- number of rows that were saved
+    """
+    with h5py.File(file_name, 'r') as h5py_file:
+
+        data = h5py_file['Gaitcycle'][subject]
+
+        # Store the name of all the end points
+        columns_to_endpoint_list = get_end_point_names(data)
+
+        #The selected column determines the rows of the file
+        selected_datasets = [data[endpoint] for endpoint
+                             in columns_to_endpoint_list[selected_column]]
+        selected_strides = [get_num_good_strides(dataset)
+                            for dataset in selected_datasets]
+        num_rows = sum(num_strides * dataset.shape[1] for dataset, num_strides
+                       in zip(selected_datasets, selected_strides))
+
+        # Main loop - process each potential column
+        column_dict = {}
+        for column_name, endpoint_list in columns_to_endpoint_list.items():
 
+            if any(ignored in column_name
+                   for ignored in IGNORED_COLUMN_STRINGS):
+                continue
+
+            datasets = [data[endpoint] for endpoint in endpoint_list]
+            num_strides_list = [get_num_good_strides(dataset)
+                                for dataset in datasets]
+
+            #Only the columns with the same amount of data as the selected
+            # column are saved. Check before reading anything else
+            num_points = sum(num_strides * dataset.shape[1]
+                             for dataset, num_strides
+                             in zip(datasets, num_strides_list))
+            if num_points != num_rows:
+                continue
+
+            column_dict[column_name] = read_column(datasets,
+                                                   num_strides_list)
+
+        # Helper functions to get ramp and speed to append task information
         @lru_cache(maxsize=5)
         def get_ramp(trial):
             return data[data[trial]['description'][1][1]][0][0]
@@ -267,69 +332,144 @@ def quick_flatten_dataport():
         def get_speed(trial):
             return data[data[trial]['description'][1][0]][0][0]
 
-        # Iterate by row to get phase information
-
-        # Ugly but effective
-        # We need to use the unfiltered version to get the remove_list again
-        # This is used to filter the time column
-        endpoint_list = columns_to_endpoint_list[selected_column]
-
-        # Create lists to store all the phase dot and stride length information
+        # Get the task information for every dataset of the selected column
         trials = []
         legs = []
+        points_per_dataset = []
         phase_dot_list = []
         stride_length_list = []
 
-        # Iterate by trial to get time, speed
-        for experiment_name, dataset in zip(*endpoint_list):
-            
-            filtered_dataset, remove_list = bad_run_filter(dataset)
-            
+        for experiment_name, dataset, num_strides in \
+                zip(columns_to_endpoint_list[selected_column],
+                    selected_datasets, selected_strides):
+
             endpoint_split = experiment_name.split('/')
 
             trial = endpoint_split[0]
             leg = endpoint_split[-3]
 
-            trials.extend([trial]*filtered_dataset.shape[0]*filtered_dataset.shape[1])
-            legs.extend([leg]*filtered_dataset.shape[0]*filtered_dataset.shape[1])
-
-            time = get_time(trial, leg)
-            speed = get_speed(trial)
+            trials.append(trial)
+            legs.append(leg)
+            points_per_dataset.append(num_strides * dataset.shape[1])
 
             #Filter out times that are not being used since there is no data
-            time = np.delete(time,remove_list,axis=0)
-
+            time = data[trial]['cycles'][leg]['time'][()]
+            time = np.delete(time, list(range(num_strides, dataset.shape[0])),
+                             axis=0)
 
             time_delta = (time[:, -1]-time[:, 0])
-            phase_dot_list.append(np.repeat(1/time_delta, 150))
-            stride_length_list.append(np.repeat(speed*time_delta, 150))
-
-        # Get the corresponding dataframe to the selected column
-        df = None
-        for dataframe in strides_to_dataframes_dict.values():
-            if selected_column in dataframe.columns:
-                df = dataframe
-
-        # print(len(trials))
-        # print(df.shape[0])
-
-        df['ramp'] = [get_ramp(trial) for trial in trials]
-        df['speed'] = [get_speed(trial) for trial in trials]
-        df['trial'] = trials
-        # We don't want phase to reach one because 0=1 in terms of phase
-        phase = np.linspace(0, (1-1/150), 150)
-        df['leg'] = legs
-        df['phase'] = np.tile(phase, int(df.shape[0]/150))
-        df['phase_dot'] = np.concatenate(phase_dot_list, axis=0)
-        df['stride_length'] = np.concatenate(stride_length_list, axis=0)
-        # print("Number of columns: " + str(len(df.columns)))
-        # print("Columns: " + df.columns)
-        # print("strides to length " + str([(strides,len(dataset.columns)) for strides, dataset in strides_to_dataframes_dict.items()]))
-        # Comment out to not save
-        df.to_parquet(save_name)
-
-        # Uncomment break to just get one person
-        #break
+            phase_dot_list.append(np.repeat(1/time_delta, POINTS_PER_STRIDE))
+            stride_length_list.append(np.repeat(get_speed(trial)*time_delta,
+                                                POINTS_PER_STRIDE))
+
+        column_dict['ramp'] = np.repeat([get_ramp(trial) for trial in trials],
+                                        points_per_dataset)
+        column_dict['speed'] = np.repeat([get_speed(trial)
+                                          for trial in trials],
+                                         points_per_dataset)
+
+    column_dict['trial'] = np.repeat(np.array(trials, dtype=object),
+                                     points_per_dataset)
+    column_dict['leg'] = np.repeat(np.array(legs, dtype=object),
+                                   points_per_dataset)
+    # We don't want phase to reach one because 0=1 in terms of phase
+    phase = np.linspace(0, (1-1/POINTS_PER_STRIDE), POINTS_PER_STRIDE)
+    column_dict['phase'] = np.tile(phase, num_rows//POINTS_PER_STRIDE)
+    column_dict['phase_dot'] = np.concatenate(phase_dot_list, axis=0)
+    column_dict['stride_length'] = np.concatenate(stride_length_list, axis=0)
+
+    #The datasets of a trial are next to each other, so every trial is
+    # one row group
+    row_group_lengths = [sum(points for _, points in trial_points)
+                         for _, trial_points
+                         in groupby(zip(trials, points_per_dataset),
+                                    key=lambda x: x[0])]
+
+    write_row_groups(DataFrame(column_dict), save_name, row_group_lengths)
+
+    return num_rows
+
+
+def write_trial_row_groups(dataframe, save_name):
+    """
+    Save a flattened subject with one row group per trial, the same as
+    flatten_subject. Used by the steps that modify the flattened files so
+    that they keep the row groups
+
+    Keyword Arguments:
+    dataframe -- flattened subject data with the trial column
+    save_name -- name of the parquet file
+    """
+    #The rows of a trial are next to each other
+    row_group_lengths = [sum(1 for _ in trial_rows)
+                         for _, trial_rows in groupby(dataframe['trial'])]
+
+    write_row_groups(dataframe, save_name, row_group_lengths)
+
+
+def is_up_to_date(file_name, save_name):
+    """
+    Returns true if the flattened file is newer than the dataset file
+    """
+    return (os.path.exists(save_name) and
+            os.path.getmtime(save_name) > os.path.getmtime(file_name))
+
+
+def flatten_dataport(file_name=DATAPORT_FILE_NAME,
+                     save_name=FLATTENED_FILE_NAME,
+                     subjects=None, num_processes=None, force=False):
+    """
+    Flatten every subject into its own parquet file with a process pool.
+    Subjects whose parquet file is newer than the dataset file are skipped
+
+    Keyword Arguments:
+    file_name -- InclineExperiment.mat file
+    save_name -- name of the parquet files, formatted with the subject name
+    subjects -- list of subjects to flatten. Defaults to all the subjects
+    num_processes -- amount of worker processes. Defaults to the number of
+        cores
+    force -- if true, flatten the subjects even if they are up to date
+
+    Returns:
+    flattened_subjects -- list of the subjects that were flattened
+    """
+    if subjects is None:
+        with h5py.File(file_name, 'r') as h5py_file:
+            subjects = list(h5py_file['Gaitcycle'].keys())
+
+    if num_processes is None:
+        num_processes = os.cpu_count()
+
+    flattened_subjects = []
+    for subject in subjects:
+        if force or not is_up_to_date(file_name, save_name.format(subject)):
+            flattened_subjects.append(subject)
+        else:
+            print("Skipping subject (up to date): " + subject)
+
+    num_subjects = len(flattened_subjects)
+    arguments = ([file_name]*num_subjects,
+                 flattened_subjects,
+                 [save_name.format(subject) for subject in flattened_subjects])
+
+    print("Flattening subjects: " + str(flattened_subjects))
+
+    #Don't pay for the pool if there is nothing to parallelize
+    if num_processes == 1 or num_subjects <= 1:
+        list(map(flatten_subject, *arguments))
+    else:
+        with ProcessPoolExecutor(min(num_processes, num_subjects)) \
+                as executor:
+            list(executor.map(flatten_subject, *arguments))
+
+    return flattened_subjects
+
+
+def quick_flatten_dataport():
+    pass
+    # %%
+    #Only the subjects that changed since the last run are flattened again
+    flatten_dataport()
 # %%
 
 
@@ -465,7 +605,7 @@ def add_global_shank_angle():
         # find_min_stride = lambda dataset: min([((dataset.speed == speed) & (dataset.ramp==0.0)).sum() for speed in speed_list])
         # print(f"{subject[0]} min strides {find_min_stride(df)/150}")
 
-        df.to_parquet(subject[1])
+        write_trial_row_groups(df, subject[1])
 
 
 def fix_stride_length():
@@ -534,7 +674,7 @@ def fix_stride_length():
         stride_reshape = np.repeat(stride_length_per_step,150)
 
         subject_data['stride_length'] = stride_reshape
-        subject_data.to_parquet(subject_file)
+        write_trial_row_groups(subject_data, subject_file)
         print(f"saved {subject}")
         pass
         
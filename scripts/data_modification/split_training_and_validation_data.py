@@ -8,6 +8,9 @@ import pandas as pd
 import numpy as np 
 from itertools import product
 
+from context import utils
+from utils.dataport_dataset import write_row_groups, write_stride_index
+
 #Get the relative file location
 original_file_location = ("../../data/flattened_dataport/"
                           "dataport_flattened_partial_{}.parquet")
@@ -159,13 +162,21 @@ for subject_index, subject in enumerate(subject_list):
     #Create the validation set by aggregating the lists
     validation_set = pd.concat(validation_set_list, ignore_index=True)
     
-    #Save the training set
+    #Save the training set with one row group per condition so that 
+    # readers can skip the conditions that they don't use
     training_file_name = training_file_location.format(subject)
-    training_set.to_parquet(training_file_name)
+    write_row_groups(training_set, training_file_name,
+                     [len(split) for split in training_set_list])
+    
+    #Save the first row of every stride per condition, the fake data does 
+    # not have a condition and is not included
+    write_stride_index(training_set, training_file_name)
     
     #Save the validation set
     validation_file_name = validation_file_location.format(subject)
-    validation_set.to_parquet(validation_file_name)
+    write_row_groups(validation_set, validation_file_name,
+                     [len(split) for split in validation_set_list])
+    write_stride_index(validation_set, validation_file_name)
     
 print(f"Minimum validation steps {min_steps_validation}")
 print(min_steps_per_person)
\ No newline at end of file
@@ -23,13 +23,13 @@ import numpy as np
 from context import kmodel
 from context import ekf
 
-from kmodel.model_fitting.load_models import load_simple_models
+from kmodel.model_fitting.load_models import load_simple_models, \
+    load_optimal_fit_info
 from kmodel.model_definition.personal_measurement_function import PersonalMeasurementFunction
 from ekf.measurement_model import MeasurementModel
 from ekf.dynamic_model import GaitDynamicModel
 from ekf.ekf import Extended_Kalman_Filter
 
-import pickle
 from rtplot import client
 
 #Define the states of the system
@@ -127,13 +127,8 @@ joint_fit_info_list = []
 
 for joint in joint_list:
     
-    #Get the saved fit info files
-    save_location = '../../data/optimal_model_fits/' 
-    save_file_name = save_location + joint + "_optimal.p"
-
-    #Open and load the file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_optimal_fit_info(joint)
 
     #append the fit information
     joint_fit_info_list.append(fit_results)
@@ -0,0 +1,145 @@
+"""
+This file uploads the runs that run_ekf_simulation saved in the results sink
+to google sheets
+
+Every run is sent with one append request and one format request, so the
+simulations do not need to be online or wait for google sheets
+
+E.g. to upload the last run and run 12
+    python export_results_to_google_sheets.py
+    python export_results_to_google_sheets.py --run-ids 12
+"""
+
+#Import Common libraries
+import argparse
+import numpy as np
+
+#Import custom library
+from context import utils
+from utils.results_sink import create_results_sink
+
+#Imoprt google sheet library to store results
+import gspread
+from gspread.utils import rowcol_to_a1
+
+
+#Name of the google sheets file
+GOOGLE_FILE_NAME = "EKF Simulation Results"
+
+#Default location of the results of run_ekf_simulation
+RESULTS_LOCATION = "ekf_simulation_results.db"
+
+#Metadata that is not part of the metadata rows
+EXPORTER_METADATA = ["Experiment Comment", "Worksheet"]
+
+
+#Create function to normalize colors to how google sheets expects [0-1]
+nc = lambda color: color/255.0
+
+#Define the light grey color for the two metadata rows
+METADATA_FORMAT = {"backgroundColorStyle":{"rgbColor":
+    {"red":nc(239.0), "green":nc(239.0), "blue":nc(239.0)}}}
+#Define the rgb values for light green for the mean
+MEAN_FORMAT = {"backgroundColor":
+    {"red":nc(217.0),"green":nc(234.0),"blue":nc(211.0)}}
+#Define the rgb values for light red for the variance
+VAR_FORMAT = {"backgroundColor":
+    {"red":nc(244.0),"green":nc(204.0),"blue":nc(204.0)}}
+
+
+def create_run_rows(metadata, results):
+    """
+    Create the rows of a run with the same layout as the rows that
+    run_ekf_simulation used to append one by one
+
+    Returns:
+    rows -- list of rows, every row is a list of values
+    row_formats -- list of (row index, format) of the rows that are
+        formatted
+    """
+    test_metadata = {key: value for key, value in metadata.items()
+                     if key not in EXPORTER_METADATA}
+
+    #Remove the name from each of the subjects
+    results_np = results.iloc[:,1:].to_numpy(dtype=float)
+
+    rows = [
+        #Header and values of the test metadata
+        list(test_metadata.keys()),
+        list(test_metadata.values()),
+        #Add a line for comments for the experiment
+        # I'm leaving three columns blank so that the comment can be seen
+        # clearly without needing the merge columns
+        ['Experiment Comment', metadata.get("Experiment Comment", ''),
+         '','','', 'Results Comments'],
+        #Trial header to display test results
+        list(results.columns)]
+
+    #Add subject trial for all the subjects
+    rows += results.values.tolist()
+
+    #Add mean and variance information
+    rows.append(["Mean"] + np.mean(results_np, axis=0).tolist())
+    rows.append(["Variance"] + np.var(results_np, axis=0).tolist())
+
+    row_formats = [(0, METADATA_FORMAT), (1, METADATA_FORMAT),
+                   (len(rows) - 2, MEAN_FORMAT), (len(rows) - 1, VAR_FORMAT)]
+
+    return rows, row_formats
+
+
+def export_run(google_file, metadata, results):
+    """
+    Append a run to its worksheet and format it
+    """
+    worksheet = google_file.worksheet(metadata["Worksheet"])
+    rows, row_formats = create_run_rows(metadata, results)
+
+    #Send all the rows at once
+    append_info = worksheet.append_rows(rows)
+
+    #Get the first row that was updated, e.g. 'Incoming Data'!A10:P20
+    updated_range = append_info['updates']['updatedRange']
+    first_cell = updated_range[updated_range.index('!')+1:].split(':')[0]
+    first_row = int(''.join(filter(str.isdigit, first_cell)))
+
+    #Format after the data has been stored to be robust against formatting
+    # errors losing the data
+    formats = []
+    for row_index, row_format in row_formats:
+        row_number = first_row + row_index
+        formats.append({
+            'range': f"A{row_number}:"
+                     f"{rowcol_to_a1(row_number, len(rows[row_index]))}",
+            'format': row_format})
+    worksheet.batch_format(formats)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Upload ekf simulation results to google sheets")
+    parser.add_argument('--results-location', default=RESULTS_LOCATION,
+                        help="results sink that run_ekf_simulation wrote")
+    parser.add_argument('--run-ids', type=int, nargs='*',
+                        help="runs to upload, defaults to the last run")
+    args = parser.parse_args()
+
+    sink = create_results_sink(args.results_location)
+    run_ids = args.run_ids
+    if not run_ids:
+        run_ids = sink.get_run_ids()[-1:]
+
+    #Log in based on the service_account key found in ~/.config/gspread
+    sa = gspread.service_account()
+
+    #Get the file that we want
+    google_file = sa.open(GOOGLE_FILE_NAME)
+
+    for run_id in run_ids:
+        metadata, results = sink.read_run(run_id)
+        export_run(google_file, metadata, results)
+        print(f"Exported test {run_id} to {metadata['Worksheet']}")
+
+
+if __name__ == '__main__':
+    main()
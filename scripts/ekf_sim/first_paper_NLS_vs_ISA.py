@@ -23,6 +23,7 @@ from ekf_loader import ekf_loader
 from context import kmodel
 from context import ekf
 from context import utils
+from kmodel.model_fitting.load_models import load_optimal_fit_info
 
 
 ###############################################################################
@@ -47,13 +48,8 @@ joint_fit_info_list = []
 
 for joint in JOINT_NAMES:
     
-    #Get the saved fit info files
-    save_location = '../../data/optimal_model_fits/' 
-    save_file_name = save_location + joint + "_optimal.p"
-
-    #Open and load the file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_optimal_fit_info(joint)
 
     #append the fit information
     joint_fit_info_list.append(fit_results)
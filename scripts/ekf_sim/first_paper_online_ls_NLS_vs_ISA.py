@@ -12,8 +12,7 @@ import json
 
 #Common imports
 import numpy as np
-import pandas as pd
-from itertools import product
+from functools import lru_cache
 from fit_least_squares_model import fit_measurement_model
 
 #Import custom library
@@ -21,7 +20,6 @@ from simulate_ekf import simulate_ekf
 from generate_simulation_validation_data import generate_data
 from generate_simulation_validation_data import generate_random_condition
 from generate_partial_ramp_speed_conditions import task_data_constraint_list
-from generate_partial_ramp_speed_conditions import filter_data_for_condition
 from ekf_loader import ekf_loader
 from context import kmodel
 from context import ekf
@@ -33,6 +31,8 @@ from kmodel.model_definition import function_bases
 from kmodel.model_definition import k_model
 from kmodel.model_definition import personal_measurement_function
 from ekf.measurement_model import MeasurementModel
+from utils.dataport_dataset import DataportDataset
+from utils.sweep_runner import expand_grid, run_sweep, SweepResultStore
 
 ###############################################################################
 ###############################################################################
@@ -77,13 +77,8 @@ joint_fit_info_list = []
 
 for joint in JOINT_NAMES:
     
-    #Get the saved fit info files
-    save_location = '../../data/optimal_model_fits/' 
-    save_file_name = save_location + joint + "_optimal.p"
-
-    #Open and load the file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_models.load_optimal_fit_info(joint)
 
     #append the fit information
     joint_fit_info_list.append(fit_results)
@@ -125,23 +120,27 @@ HETEROSCHEDASTHIC_MODEL = True
 ###############################################################################
 # Setup Noise Parameters of the EKF while updating the gait fingerprints online
 
-#Optimal test results from empirical testing
-q_diag = [0, 1e-6, 3.75e-7, 8.125e-4]
-Q = np.diag(q_diag)
+#Optimal test results from empirical testing. Every process model noise in 
+# the list is a sweep dimension
+q_diag_list = [(0, 1e-6, 3.75e-7, 8.125e-4)]
 
 
 #Set the noise model to the average model noise parameters
-#Measurement covarience, Innovation
-RESIDUAL_POWER = 1
-
-#Get the joint degree tracking error and then joint velocity measurement error
-r_diag = [(residual**RESIDUAL_POWER) 
-        for residual
-        in residual_list] + \
-        [(residual**RESIDUAL_POWER) 
-        for residual
-        in residual_list]
-R = np.diag(r_diag)
+#Measurement covarience, Innovation. Every power in the list is a sweep 
+# dimension
+residual_power_list = [1]
+
+def get_measurement_noise(residual_power):
+    
+    #Get the joint degree tracking error and then joint velocity measurement 
+    # error
+    r_diag = [(residual**residual_power) 
+            for residual
+            in residual_list] + \
+            [(residual**residual_power) 
+            for residual
+            in residual_list]
+    return np.diag(r_diag)
 
 #State initial covariance
 COV_DIAG = 1e-5
@@ -172,77 +171,71 @@ column_headers = STATE_NAMES + JOINT_NAMES \
 
 
 
+
+
+
 ###############################################################################
 ###############################################################################
-# Load the stored data
-
+# Define the sweep
+
+#Name of the models that are compared
+#NLS -- naive least squares fit of the subject data
+#PCA_GF -- gait fingerprint fit of the subject data
+#ISA -- inter subject average, does not use the subject data
+MODEL_TYPES = ['NLS', 'PCA_GF', 'ISA']
+
+#Every combination is one job, e.g. 125 task constraints x 10 subjects x 
+# 3 models
+sweep_grid = {'task_data_constraint': task_data_constraint_list,
+              'subject': subject_list,
+              'model_type': MODEL_TYPES,
+              'q_diag': q_diag_list,
+              'residual_power': residual_power_list,
+              'steps_to_train_on': [150]}
+
+#The results are added to the store as the jobs finish so that a restart 
+# skips the jobs that are done. The csv is exported from the store
+STORE_FILE_NAME = "online_ls_test.db"
 SAVE_FILE_NAME = "online_ls_test.csv"
 
-#Verify current progress
-try:
-    #Load in existing process if 
-    dataframe = pd.read_csv(SAVE_FILE_NAME)
+#Real time plotting only works in one process
+NUM_PROCESSES = 1 if RT_PLOT else None
 
-    first_test_number_of_trials = 125*10
-   
-    
-#If the file is not found, create a new pandas object to keep track of progress
-except FileNotFoundError:
-    dataframe = pd.DataFrame(columns=column_headers).astype('object')
-    start_index = 0
 
 #Load the speed ramp condition, it will be fixed for every subject and  
 # process model tuning
 with open('random_ramp_speed_condition.pickle','rb') as file:
     random_test_condition = pickle.load(file)
 
-#Create a string that contains the file information
-file_location = ("../../data/flattened_dataport/training/"
-                    "dataport_flattened_training_{}.parquet")
-    
-#Iterate through the task constraints to do least squares with 
-for task_index, task_data_constraint in enumerate(task_data_constraint_list):
+#Keep the training data of every subject in memory so that every file is 
+# only read once for all the task constraints in every worker process
+training_dataset = DataportDataset(cache_size=len(subject_list))
+
+#Columns that are used to fit the least squares models
+training_columns = STATE_NAMES + output_list + ['Steps in Condition']
+
+
+@lru_cache(maxsize=None)
+def get_validation_data(subject):
+    """
+    Generate the validation data for a subject once per worker process
+    """
+    state_data, sensor_data, steps_per_condition, condition_list\
+        = generate_data(subject, 
+                        STATE_NAMES,
+                        JOINT_NAMES,
+                        random_test_condition)
+    return state_data, sensor_data
+
 
-    print((f"Testing Least Squares Condition {task_data_constraint}"
-          f" -- {task_index}/{len(task_data_constraint_list)}"))
+def get_measurement_model(subject, model_type, task_data_constraint, 
+                          steps_to_train_on):
+    """
+    Fit or load the measurement model of one of the compared models
+    """
     
-   
-    #Run the simulation for all the subjects
-    for subject_index, subject in enumerate(subject_list):
-        
-        
-        ###################################################################
-        ###################################################################
-        # Do least squares fit for each the naive least squares and the 
-        # gait fingerprint least squares
-        
-        #Get the subject-specific fit 
-        subject_data = pd.read_parquet(file_location.format(subject))
-        
-        #Filter for a particular amount of steps
-        steps_to_train_on = 150
-        
-        #Filter the data to only contain the current conditions and
-        # number of steps to train on
-        subject_data = filter_data_for_condition(subject_data,
-                                                 task_data_constraint,
-                                                 steps_to_train_on)
-        
-        
-        # optimal least squares
-        least_squares_measurement_model = fit_measurement_model(subject, 
-            subject_data,output_list)
-        
-        # Craete the personalized least squares model
-        gait_fingerprint_model_list = load_models.load_personalized_models(
-            output_list,subject,subject_data)
-        
-        #Create a measurement model using the gait fingerprint personal model
-        gait_fingerprint_measurement_model = \
-            MeasurementModel(gait_fingerprint_model_list, 
-                             calculate_output_derivative=True)
-        
-        
+    #The inter subject average does not use the subject data
+    if model_type == 'ISA':
         
         #Load the intersubject average
         fitted_model_list = [load_models.load_simple_models(joint,"AVG",
@@ -250,158 +243,88 @@ for task_index, task_data_constraint in enumerate(task_data_constraint_list):
                                 for joint 
                                 in output_list]
        
-        
         #Generate a Personal measurement function 
-        model = personal_measurement_function.PersonalMeasurementFunction(fitted_model_list, 
-                                            output_list, subject)
-        #Initialize the measurement model
-        ISA_measurement_model = MeasurementModel(model,
-                                            calculate_output_derivative=True)
+        model = personal_measurement_function.PersonalMeasurementFunction(
+            fitted_model_list, output_list, subject)
         
-            
-        ###################################################################
-        ###################################################################
-        #Generate the validation data for this subject
-        state_data, sensor_data, steps_per_condition, condition_list\
-            = generate_data(subject, 
-                            STATE_NAMES,
-                            JOINT_NAMES,
-                            random_test_condition)
-        
-        #Convert conditoin list to a tuple instead so that it is hashable
-        condition_list = tuple(condition_list)
-        
-        #Do not real time plot after subject AB01
-        if subject_index > 0:
-            RT_PLOT = False
-        
-        #Wait for the plotter to catch up, if not it will crash
-        if RT_PLOT:
-            input("Press enter between tests")
-        print(f"{subject} Naive Least Squares")
-        
-        ###################################################################
-        ###################################################################
-        ## Do the personalized model fit 
-        ekf_instance = ekf_loader(subject, JOINT_NAMES, 
-                                initial_state, initial_state_covar, Q, R, 
-                                lower_limits, upper_limits,
-                                measurement_model=least_squares_measurement_model)
-        
-        #Run the simulation
-        try:
-            rmse_testr, measurement_rmse, rmse_delay\
-                    = simulate_ekf(ekf_instance,state_data,sensor_data,
-                                plot_local=RT_PLOT)
-            print((f"State rmse {rmse_testr}, "
-                    f"measurement rmse {measurement_rmse}"))
-            
-            results = [*rmse_testr, *measurement_rmse]
-            
-            
-        except AssertionError:
-            print(f"Failed Assertion on {q_diag}")
-            #Set data to invalid
-            results = ([None]*10)
-               
-        #Get the data to save
-        data = [[*results, *q_diag, subject,'NLS',task_data_constraint, 
-                 len(task_data_constraint),steps_to_train_on]]
-            
-        #Add to stored data
-        dataframe = pd.concat([dataframe,pd.DataFrame(data,columns=column_headers)],
-                            ignore_index=True)
-
-        ###################################################################
-        ###################################################################
-        # Do the gait fingerprint analysis
+        #Initialize the measurement model
+        return MeasurementModel(model, calculate_output_derivative=True)
+    
+    #Get the subject-specific data, only containing the current 
+    # conditions and number of steps to train on
+    subject_data = training_dataset.load(subject, 'training',
+                                         training_columns)\
+        .select_conditions(task_data_constraint, steps_to_train_on)\
+        .to_dataframe()
+    
+    # optimal least squares
+    if model_type == 'NLS':
+        return fit_measurement_model(subject, subject_data, output_list)
+    
+    # Craete the personalized least squares model
+    gait_fingerprint_model_list = load_models.load_personalized_models(
+        output_list,subject,subject_data)
+    
+    #Create a measurement model using the gait fingerprint personal model
+    return MeasurementModel(gait_fingerprint_model_list, 
+                            calculate_output_derivative=True)
+
+
+def run_job(job):
+    """
+    Fit the measurement model of a job and run the ekf on the validation 
+    data of the subject
+    """
+    subject = job['subject']
+    model_type = job['model_type']
+    task_data_constraint = job['task_data_constraint']
+    q_diag = job['q_diag']
+    
+    measurement_model = get_measurement_model(subject, model_type, 
+                                              task_data_constraint,
+                                              job['steps_to_train_on'])
+    state_data, sensor_data = get_validation_data(subject)
+    
+    #Wait for the plotter to catch up, if not it will crash
+    if RT_PLOT:
+        input("Press enter between tests")
+    
+    ekf_instance = ekf_loader(subject, JOINT_NAMES, 
+                            initial_state, initial_state_covar, 
+                            np.diag(q_diag), 
+                            get_measurement_noise(job['residual_power']), 
+                            lower_limits, upper_limits,
+                            measurement_model=measurement_model)
+    
+    #Run the simulation
+    try:
+        rmse_testr, measurement_rmse, rmse_delay\
+                = simulate_ekf(ekf_instance,state_data,sensor_data,
+                            plot_local=RT_PLOT)
         
-        #Wait for the plotter to catch up, if not it will crash
-        if RT_PLOT:
-            input("Press enter between tests")
+        results = [*rmse_testr, *measurement_rmse]
         
-        print(f"{subject} Gait Fingerprint")
-        #Run the test for the subject with avearge model fit
-        ## Do the personalized model fit 
-        ekf_instance = ekf_loader(subject, JOINT_NAMES, 
-                                initial_state, initial_state_covar, Q, R, 
-                                lower_limits, upper_limits,
-                                measurement_model=gait_fingerprint_measurement_model)
-        try:
-            #Run the simulation
-            rmse_testr, measurement_rmse, rmse_delay\
-                        = simulate_ekf(ekf_instance,state_data,sensor_data,
-                                    plot_local=RT_PLOT)
-                    
-            print(f"State rmse {rmse_testr}, "
-                  f"measurement rmse {measurement_rmse}")
-            
-            #Create CSV data vector
-            results = [*rmse_testr, *measurement_rmse]
-
-            
-        except AssertionError:
-            print(f"Failed Assertion on {q_diag}")
-            #Set data to invalid
-            results = ([None]*10)
-
-        data = [[*results, *q_diag, subject, 'PCA_GF',task_data_constraint, 
-                 len(task_data_constraint),steps_to_train_on]]
-            
-        #Add to stored data
-        dataframe = pd.concat([dataframe,pd.DataFrame(data,columns=column_headers)],
-                            ignore_index=True)
+    except AssertionError:
+        print(f"Failed Assertion on {q_diag}")
+        #Set data to invalid
+        results = ([None]*10)
+    
+    #Get the data to save, the conditions are saved with the same format
+    # that the plotting scripts expect
+    data = [*results, *q_diag, subject, model_type, 
+            repr(task_data_constraint), len(task_data_constraint),
+            job['steps_to_train_on']]
+    
+    return dict(zip(column_headers, data))
 
+
+if __name__ == '__main__':
+    
+    with SweepResultStore(STORE_FILE_NAME) as store:
         
-        
-        ###################################################################
-        ###################################################################
-        # Do the intersubject average model
-        
-        #Wait for the plotter to catch up, if not it will crash
-        if RT_PLOT:
-            input("Press enter between tests")
-        
-        print(f"{subject} Inter Subject Average")
-        #Run the test for the subject with avearge model fit
-        ## Do the personalized model fit 
-        ekf_instance = ekf_loader(subject, JOINT_NAMES, 
-                                initial_state, initial_state_covar, Q, R, 
-                                lower_limits, upper_limits,
-                                measurement_model=ISA_measurement_model)
-        try:
-            #Run the simulation
-            rmse_testr, measurement_rmse, rmse_delay\
-                        = simulate_ekf(ekf_instance,state_data,sensor_data,
-                                    plot_local=RT_PLOT)
-                    
-            print(f"State rmse {rmse_testr}, "
-                  f"measurement rmse {measurement_rmse}")
-            
-            #Create CSV data vector
-            results = [*rmse_testr, *measurement_rmse]
-            
-        except AssertionError:
-            print(f"Failed Assertion on {q_diag}")
-            #Set data to invalid
-            results = ([None]*10)
-
-        data = [[*results, *q_diag, subject, 'ISA',task_data_constraint, 
-                 len(task_data_constraint),steps_to_train_on]]
-        
-        #Add to stored data
-        dataframe = pd.concat([dataframe,pd.DataFrame(data,
-                                                      columns=column_headers)],
-                            ignore_index=True)
-        
-        
-        ###################################################################
-        ###################################################################
-        # Save the data
-        
-        ##Since I had to run duplicate tests due to a bug, make sure that 
-        # we don't have duplicate rows which can alter the data analysis
-        dataframe.drop_duplicates(ignore_index=True)
+        run_sweep(run_job, expand_grid(sweep_grid), store,
+                  num_processes=NUM_PROCESSES)
         
         ##Save to CSV
-        dataframe.to_csv(SAVE_FILE_NAME, sep=',')
\ No newline at end of file
+        store.to_dataframe().reindex(columns=column_headers)\
+            .to_csv(SAVE_FILE_NAME, sep=",")
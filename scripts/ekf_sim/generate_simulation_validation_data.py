@@ -9,12 +9,17 @@ randomize them
 
 
 import numpy as np 
-import pandas as pd
 import random
 import itertools
 
 from typing import List, Tuple
 
+from context import utils
+from utils.dataport_dataset import DataportDataset
+
+
+#Keep the validation data in memory between calls
+validation_dataset = DataportDataset()
 
 
 def generate_random_condition(num_conditions:int=0):
@@ -133,21 +138,6 @@ def generate_data(subject:str,
         raise ValueError("You did not use the inputs correctly")
     
     
-    ### Load the datasets
-    #File relative imports
-    # file_location = \
-    # '../../data/r01_dataset/r01_Streaming_flattened_{}.parquet'
-    file_location = ("../../data/flattened_dataport/validation/"
-                     "dataport_flattened_validation_{}.parquet")
-
-    #Get the file for the corresponding subject
-    filename = file_location.format(subject)
-    # print(f"Looking for {filename}")
-
-    #Read in the parquet dataframe
-    total_data = pd.read_parquet(filename)
-    
-    
     # print(total_data.columns)
     #Define the steps per conditoin
     num_steps_per_condition = 10
@@ -167,10 +157,19 @@ def generate_data(subject:str,
     
     #Create a list that has both the joint and the joint velocity
     total_joint_list = joint_list + joint_velocity_list
+    num_states = len(state_list)
+
+    
+    ### Load the dataset
+    #Only the columns that are used are read, and they are cached for the 
+    # next call with the same subject
+    total_data = validation_dataset.load(subject, 'validation',
+                                         state_list + total_joint_list)
     
-    #Pre-allocate memory
-    state_data_np = np.zeros((datapoints,len(state_list)))
-    joint_data_np = np.zeros((datapoints,len(total_joint_list)))
+    #Index from every condition to the rows of its strides, saved when the
+    # data was split
+    stride_index = validation_dataset.load_stride_index(subject, 
+                                                        'validation')
 
     #Skip steps, don't do this by default
     skip = 0
@@ -178,37 +177,30 @@ def generate_data(subject:str,
     if(subject == "AB02"):
         skip = 1
 
+    #Calculate the rows of every condition, the data is copied at the end
+    # with one fancy index
+    condition_rows_list = []
+    
     #Create the data array based on the setup above
     for i,condition in enumerate(condition_list_to_use):
         
         #Get the desired incline and speed from the condition
         ramp, speed = condition
 
-        #Get the filtered data based on the condition
-        mask = (total_data['ramp'] == ramp) & (total_data['speed'] == speed)
-        filtered_data = total_data[mask]
+        #Get the rows of the condition
+        filtered_rows = stride_index.get_rows(ramp, speed)
 
         #Verify that you have enough steps to validate this condition
-        if (len(filtered_data) > points_per_condition):
+        if (len(filtered_rows) > points_per_condition):
                 
-            #Get the sensor data
-            state_data_np[i*points_per_condition: 
-                          (i+1)*points_per_condition,:] = \
-                filtered_data[state_list]\
-                    .values[skip*points_per_condition:
-                            (skip+1)*points_per_condition,:]
-
-            #Get the ground truth data
-            joint_data_np[i*points_per_condition: 
-                          (i+1)*points_per_condition,:] = \
-                filtered_data[total_joint_list]\
-                    .values[skip*points_per_condition:
-                            (skip+1)*points_per_condition,:]
+            #Get the rows of the steps that are used
+            condition_rows = filtered_rows[skip*points_per_condition:
+                                           (skip+1)*points_per_condition]
         
         #If you don't have enough data per condition, just repeat it
         else:
             #Get the number of times that the datset needs to be repeated
-            len_filt_data = len(filtered_data)
+            len_filt_data = len(filtered_rows)
             repeats = points_per_condition/len_filt_data
             
             #Get the integer part to loop over the set
@@ -217,30 +209,26 @@ def generate_data(subject:str,
             #Get the fractional part to fill the remaining step repeatitions
             fractional_part = repeats%1
             
-            #Repeat sensor data
-            repeated_state_data = np.concatenate(
-                [np.repeat(filtered_data[state_list].values, 
-                           integer_repeat,axis=0),
-                filtered_data[state_list]\
-                    .values[:int(fractional_part*len_filt_data),:]]
-            ,axis=0)
-            
-            #Repeat State Data
-            state_data_np[i*points_per_condition: 
-                          (i+1)*points_per_condition,:] = repeated_state_data
-                
-                
-            #Repeat ground truth data
-            repeated_joint_data = np.concatenate(
-                [np.repeat(filtered_data[total_joint_list].values,
-                           integer_repeat,axis=0),
-                filtered_data[total_joint_list]\
-                    .values[:int(fractional_part*len_filt_data)]
-                ]
-            ,axis=0)
-            
-            joint_data_np[i*points_per_condition: \
-                          (i+1)*points_per_condition,:] = repeated_joint_data
+            #Repeat every row and then fill with the first rows
+            condition_rows = np.concatenate(
+                [np.repeat(filtered_rows, integer_repeat),
+                 filtered_rows[:int(fractional_part*len_filt_data)]])
+        
+        if len(condition_rows) != points_per_condition:
+            raise ValueError(f"{subject} does not have {points_per_condition}"
+                             f" datapoints for condition {condition}")
+        
+        condition_rows_list.append(condition_rows)
+
+    #Get all the conditions at once
+    # columns are the states and then the joints
+    if num_trials > 0:
+        condition_data = total_data.values[np.concatenate(condition_rows_list)]
+    else:
+        condition_data = np.zeros((0, total_data.values.shape[1]))
+    
+    state_data_np = np.ascontiguousarray(condition_data[:,:num_states])
+    joint_data_np = np.ascontiguousarray(condition_data[:,num_states:])
 
         
     return state_data_np, joint_data_np,\
@@ -9,19 +9,18 @@ from datetime import date
 import json
 from collections import OrderedDict
 import time
-import pickle
 
 #Common imports
 import numpy as np
+import pandas as pd
 
 #Import custom library
 from simulate_ekf import simulate_ekf
 from context import kmodel
 from context import ekf
 from context import utils
-
-#Imoprt google sheet library to store results
-import gspread
+from kmodel.model_fitting.load_models import load_optimal_fit_info
+from utils.results_sink import create_results_sink
 
 
 ###############################################################################
@@ -51,13 +50,8 @@ joint_fit_info_list = []
 
 for joint in JOINT_NAMES:
     
-    #Get the saved fit info files
-    save_location = '../../data/optimal_model_fits/' 
-    save_file_name = save_location + joint + "_optimal.p"
-
-    #Open and load the file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_optimal_fit_info(joint)
 
     #append the fit information
     joint_fit_info_list.append(fit_results)
@@ -69,17 +63,15 @@ residual_list = [np.mean(joint_fit['residual list'])
 
 ###############################################################################
 ###############################################################################
-# Setup up google sheets writter
-
-#Log in based on the service_account key found in ~/.config/gspread
-sa = gspread.service_account()
+# Setup up the results sink
 
-#Get the file that we want
-google_file = sa.open("EKF Simulation Results")
+#The results of every run are written locally in one batch at the end of the
+# run. Use export_results_to_google_sheets.py to upload them afterwards
+RESULTS_LOCATION = "ekf_simulation_results.db"
 
-#Get the worksheet
-google_worksheet = google_file.worksheet("Incoming Data")
-calibration_worksheet = google_file.worksheet("Calibration Testing")
+#Worksheets that the exporter uses
+RESULTS_WORKSHEET = "Incoming Data"
+CALIBRATION_WORKSHEET = "Calibration Testing"
 
 
 ###############################################################################
@@ -250,8 +242,8 @@ RT_PLOT = True
 #Update the initial covariance between subjects
 UPDATE_COVAR_BETWEEN_SUBJECTS = False
 
-#Save to google sheets
-SAVE_TO_GOOGLE_SHEETS = True
+#Save to the results sink
+SAVE_RESULTS = True
 
 #Repeast Tests to converte the initial covariance
 NUM_REPEAT_TESTS = 1
@@ -432,29 +424,21 @@ print("Done")
 
 ###########################################################################
 ###########################################################################
-# Send Data to google sheets
-#If you do not want it to be saved in the main sheet
-if SAVE_TO_GOOGLE_SHEETS is True:
+# Save the data to the results sink
+#If you do not want it to be saved
+if SAVE_RESULTS is True:
 
-    #If we are doing calibrations, save to separate sheet
+    #If we are doing calibrations, export to separate sheet
     if UPDATE_COVAR_BETWEEN_SUBJECTS is True:
-        google_worksheet = calibration_worksheet
-
-    #Create helper function to convert numpy arrays into json format
-    np_to_json = lambda arr: json.dumps(arr.tolist())
-
-    #Create function to normalize colors to how google sheets expects [0-1]
-    nc = lambda color: color/255.0
-
-    #Create function that formats updated range field that is sent back
-    # when append_row is called
-    format_range = lambda range: range[range.index('!')+1:]
+        worksheet_name = CALIBRATION_WORKSHEET
+    else:
+        worksheet_name = RESULTS_WORKSHEET
 
     #Get the local counter for the test id
     test_id = int(np.load("test_id.npy"))
 
     #Create the header to store results
-    google_sheet_test_metadata_dict = OrderedDict([
+    test_metadata_dict = OrderedDict([
         ("Experiment", 
             TEST_NAME),
         ("Process Model Phase Noise", 
@@ -474,9 +458,9 @@ if SAVE_TO_GOOGLE_SHEETS is True:
         ("Measurement Model",
             json.dumps(JOINT_NAMES)),
         ("Initial Condition",
-            np_to_json(initial_conditions)),
+            json.dumps(initial_conditions.tolist())),
         ("Initial Covariance",
-            np_to_json(initial_state_covariance)),
+            json.dumps(initial_state_covariance.tolist())),
         ("Heteroschedastic Model",
             HETEROSCHEDASTHIC_MODEL),
         ("Test Conditions (Incline, Speed)",
@@ -493,132 +477,44 @@ if SAVE_TO_GOOGLE_SHEETS is True:
     # accordingly
     if not (DO_GF is True or DO_GF_NULL is True):
 
-        google_sheet_test_metadata_dict["Process Model Phase Noise"] \
+        test_metadata_dict["Process Model Phase Noise"] \
             = PHASE_VAR_AVG
-        google_sheet_test_metadata_dict["Process Model Phase_Rate Noise"] \
+        test_metadata_dict["Process Model Phase_Rate Noise"] \
             = PHASE_DOT_VAR_AVG
-        google_sheet_test_metadata_dict["Process Model Stride Length Noise"] \
+        test_metadata_dict["Process Model Stride Length Noise"] \
             = STRIDE_LENGTH_VAR_AVG
-        google_sheet_test_metadata_dict["Process Model Ramp Noise"] \
+        test_metadata_dict["Process Model Ramp Noise"] \
             = RAMP_VAR_AVG
-        google_sheet_test_metadata_dict[("Process Model Gait "
+        test_metadata_dict[("Process Model Gait "
             "Fingerprint Noise")] = "N/A"
-        google_sheet_test_metadata_dict["Number of Gait Fingerprints"] \
+        test_metadata_dict["Number of Gait Fingerprints"] \
             = "N/A"
 
+    #The comment and the worksheet are used by the exporter
+    run_metadata = dict(test_metadata_dict)
+    run_metadata["Experiment Comment"] = experiment_comment
+    run_metadata["Worksheet"] = worksheet_name
 
-    #Convert ordered dict into two lists
-    google_sheet_test_header = \
-        list(google_sheet_test_metadata_dict.keys())
-    google_sheet_test_description_data = \
-        list(google_sheet_test_metadata_dict.values())
-
-    #Add header for the test metadata
-    metadata_row1_info = google_worksheet.append_row(google_sheet_test_header)
-    #Add test metadata
-    metadata_row2_info = \
-        google_worksheet.append_row(google_sheet_test_description_data)
-
-    #Add a line for comments for the experiment 
-    # I'm leaving three columns blank so that the comment can be seen clearly
-    # without needing the merge columns
-    google_worksheet.append_row(['Experiment Comment',
-                                experiment_comment,'','','',
-                                'Results Comments'])
-
-
-    #Create the subject trial metadata
-    google_sheet_subject_trial_header = [
+    #Create the subject trial table
+    subject_trial_header = [
         "Subject",
         "Phase RMSE",
         "Phase Dot RMSE",
         "Stride Length RMSE",
         "Ramp RMSE"
     ] 
+    results_dataframe = pd.DataFrame(subject_results, 
+                                     columns=subject_trial_header)
 
-    #Add trial header to display test results
-    google_worksheet.append_row(google_sheet_subject_trial_header)
-    #Add subject trial for all the subjects
-    for trial in subject_results:
-        google_worksheet.append_row(trial)
-
-    #Add mean and variance information
-    #First, remove the name from each of the subjects
-    subject_results_without_names = [trial[1:] for trial in subject_results]
-    #Convert into a numpy array
-    results_results_np = np.array(subject_results_without_names)\
-                                .reshape(len(subject_list),NUM_STATES)
-
-    #Get mean and variance from numpy built in functions
-    mean_per_state = np.mean(results_results_np,axis=0)
-    var_per_state = np.var(results_results_np,axis=0)
-
-    #Add text header
-    mean_with_header = ["Mean"] + \
-        [mean_per_state[i] for i in range(NUM_STATES)]
-    var_with_header = ["Variance"] + \
-        [var_per_state[i] for i in range(NUM_STATES)]
-
-    #Save to google sheets and store the reply information
-    mean_update_info = google_worksheet.append_row(mean_with_header)
-    var_update_info = google_worksheet.append_row(var_with_header)
-
-
-
-    #Add formatting to the metadata so that it is easy to distinguish tests
-    # from one another. Format after the data has been stored to be robust
-    # against formatting errors crashing the program
-
-
-    #Define the light grey color for the two metadata rows
-    light_grey = {"red":nc(239.0), "green":nc(239.0), "blue":nc(239.0)}
-    #Create the metadata format
-    meatadata_format = {"backgroundColorStyle":{"rgbColor":light_grey}}
-    #Get the rows that will be updated for the first row
-    metadata_row1_range = metadata_row1_info['updates']['updatedRange']
-    #Remove the worksheet from the name
-    metadata_row1_range = format_range(metadata_row1_range)
-    #Update metadata row 1 to have light grey background
-    google_worksheet.format(metadata_row1_range,meatadata_format)
-    #Get the rows that will be updated for the second row
-    metadata_row2_range = metadata_row2_info['updates']['updatedRange']
-    #Remove the worksheet from the name
-    metadata_row2_range = format_range(metadata_row2_range)
-    #Update metadata row 2 to have light grey background
-    google_worksheet.format(metadata_row2_range,meatadata_format)
-
-
-    # Format the mean so it is easier to read
-    #Get the range to update
-    mean_update_range = mean_update_info['updates']['updatedRange']
-    #Remove the worksheet name from the range
-    mean_update_range = format_range(mean_update_range)
-    #Define the rgb values for light green
-    light_green = {"red":nc(217.0),"green":nc(234.0),"blue":nc(211.0)}
-    #Define the google sheets format dictionary
-    mean_format = {"backgroundColor":light_green}
-    #Send the request
-    google_worksheet.format(mean_update_range,mean_format)
-
-
-    # Format the variance so it is easier to read
-    #Get the range to update
-    var_update_range = var_update_info['updates']['updatedRange']
-    #Remove the worksheet name from the range
-    var_update_range = format_range(var_update_range)
-    #Define the rgb values for light red
-    light_red = {"red":nc(244.0),"green":nc(204.0),"blue":nc(204.0)}
-    #Define the google sheets format dictionary
-    var_format = {"backgroundColor":light_red}
-    #Send the request
-    google_worksheet.format(var_update_range,var_format)
-
+    #Write the whole run at once
+    create_results_sink(RESULTS_LOCATION).write_run(test_id, run_metadata,
+                                                    results_dataframe)
 
     #Print confirmation
-    print("Saved results to google sheets")
+    print(f"Saved results of test {test_id} to {RESULTS_LOCATION}")
 
-#If we are not saving the test that we are doing online, make sure to 
-# save the text description offline
+#If we are not saving the results, make sure to save the text description
+# offline
 else:
     
     #Write to the local file for storing test cases
@@ -5,7 +5,6 @@
 from calendar import c
 import pandas as pd
 import numpy as np
-import sys
 
 #Relative Imports
 from context import kmodel
@@ -15,6 +14,7 @@ from kmodel.model_definition.personal_measurement_function import PersonalMeasur
 from ekf.measurement_model import MeasurementModel
 from ekf.dynamic_model import GaitDynamicModel
 from ekf.ekf import Extended_Kalman_Filter
+from ekf.replay import replay_ekf
 from rtplot import client
 from generate_simulation_validation_data import generate_data
 
@@ -30,13 +30,6 @@ np.set_printoptions(linewidth=10000)
 
 
 
-def phase_dist(phase_a, phase_b):
-    # computes a distance that accounts for the modular arithmetic of phase
-    # guarantees that the output is between 0 and .5
-    dist_prime = np.abs(phase_a-phase_b)
-    return np.square(dist_prime) if dist_prime<.5 else np.square(1-dist_prime)
-
-
 def simulate_ekf(ekf_instance, 
                  state_validation_data,
                  sensor_validation_data,
@@ -159,105 +152,47 @@ def simulate_ekf(ekf_instance,
     time_step = (np.reciprocal(state_validation_data[:,1])*1/150).reshape(-1)
 
 
-    #Get the least squared estimated gait fingerprint
-    # ls_gf = model.kmodels[0].subject_gait_fingerprint
-
-    #Initialize RMSE
-    error_squared_acumulator = np.zeros((num_states))
-    output_moment_accumulator = 0
-    measurement_error_acumulator = np.zeros((num_measurements))
+    #Only send the estimates to the plot when it is being used
+    def plot_step(i, ekf_instance):
 
-    #State buffer
-    predicted_state_buffer = np.zeros((total_datapoints,num_states))
-
-    #Iterate through all the datapoints
-    for i in range(total_datapoints):
-        
-        #Get the current joint angles
+        next_state = ekf_instance.x.T
         curr_data = sensor_validation_data[i].reshape(-1,1)
-
-        #Calculate the next state with the ekf
-        next_state,predicted_covar = \
-            ekf_instance.calculate_next_estimates(time_step[i], curr_data)
-            
-        next_state = next_state.T
-        # next_output = ekf_instance.get_output()
-
-        #Store predicted state in buffer
-        predicted_state_buffer[i,:] = next_state[0,:num_states].copy()
-
-        #Get the predicted measurements
-        predicted_measurements = ekf_instance.calculated_measurement_
         calculated_angles = ekf_instance.calculated_measurement_[:3]
         calculated_speeds = ekf_instance.calculated_measurement_[3:6]
 
-        #Get ground truth state
-        actual_state = state_validation_data[i,:num_states]
-
-        #Track RMSE after certain amount of steady state steps
-        track_rmse_after_steps = 20
-        if i > track_rmse_after_steps*points_per_step:
-            #Add to the rmse accumulator
-            error_squared_acumulator[0] += phase_dist(next_state[0,0], 
-                                                      actual_state[0])
-            error_squared_acumulator[1:] += np.power(next_state[0,1:num_states]
-                                                     -actual_state[1:], 2)
+        #Both send measurements in case they are being plotted
+        #use subject average does not send gait fingerprints
+        plot_array = np.concatenate([next_state[0,0].reshape(-1,1),                    #phase,
+                                state_validation_data[i,0].reshape(-1,1),                  #phase, 
+                                next_state[0,1:3].reshape(-1,1),                   # phase_dot, stride_length 
+                                state_validation_data[i,1:3].reshape(-1,1),                # phase_dot, stride_length from dataset
+                                next_state[0,3].reshape(-1,1),                     #ramp
+                                state_validation_data[i,3].reshape(-1,1) ,                 #ramp from dataset
+                                curr_data[:3].reshape(-1,1),                       #Sensor Angle Data
+                                calculated_angles.reshape(-1,1),                   #Predicted Angle 
+                                curr_data[3:].reshape(-1,1),                       #Sensor Angle Velocity Data
+                                calculated_speeds.reshape(-1,1)                    #Predicted Velocity 
 
-            #Add to the measurement output acumulator
-            measurement_error_acumulator += np.power(predicted_measurements - curr_data, 2).reshape(-1)
+                                ])
 
-            #Add the error for torque
-            # output_moment_accumulator += np.power(next_output - multiple_step_ground_truth[i,-1],2)
+        client.send_array(plot_array)
 
-        #Decide to plot or not
-        if(plot_local == True):
-
-            #Both send measurements in case they are being plotted
-            #use subject average does not send gait fingerprints
-            plot_array = np.concatenate([next_state[0,0].reshape(-1,1),                    #phase,
-                                    state_validation_data[i,0].reshape(-1,1),                  #phase, 
-                                    next_state[0,1:3].reshape(-1,1),                   # phase_dot, stride_length 
-                                    state_validation_data[i,1:3].reshape(-1,1),                # phase_dot, stride_length from dataset
-                                    next_state[0,3].reshape(-1,1),                     #ramp
-                                    state_validation_data[i,3].reshape(-1,1) ,                 #ramp from dataset
-                                    curr_data[:3].reshape(-1,1),                       #Sensor Angle Data
-                                    calculated_angles.reshape(-1,1),                   #Predicted Angle 
-                                    curr_data[3:].reshape(-1,1),                       #Sensor Angle Velocity Data
-                                    calculated_speeds.reshape(-1,1)                    #Predicted Velocity 
-
-                                    ])
-    
-        
-            client.send_array(plot_array)
-        
-        # #Save steady state covariance
-        # if(i == 30000):
-        #     if(use_subject_average == True):
-        #         np.save('pred_cov_avg',ekf_instance.predicted_covariance)
-        #     else:
-        #         np.save('pred_cov_gf',ekf_instance.predicted_covariance)
-        
-        
-        sys.stdout.write("\033[K")
-        # print((f'\r{i} out of {total_datapoints}'
-        #        f' state rmse {np.sqrt(error_squared_acumulator/(i+1))}'
-        #        f' measurement rmse {np.sqrt(measurement_error_acumulator/(i+1))}'
-        #     #    f' state {next_state}'
-        #     #    f' expected state {multiple_step_ground_truth[i,:4]}'
-        #     #    f' expected gf {ls_gf}'
-        #         # f' predicted covariance {np.diagonal(predicted_covar)}'
-        #     )
-        #        ,end="")
-        
+    #Run the filter through all the datapoints. The estimates are stored in 
+    # arrays and the errors are calculated after the run
+    replay_result = replay_ekf(ekf_instance, sensor_validation_data, time_step,
+                               step_callback=plot_step if plot_local else None)
 
-    #Print a new line since the current status text is supposed to be in line
-    # print("\n\r")
+    #Track RMSE after certain amount of steady state steps
+    track_rmse_after_steps = 20
+    rmse_start_index = track_rmse_after_steps*points_per_step + 1
 
     #Calculate the rmse
-    rmse = np.sqrt(error_squared_acumulator/total_datapoints)
+    rmse = replay_result.get_state_rmse(state_validation_data, 
+                                        rmse_start_index, total_datapoints)
 
     #Calculate the measurement rmse
-    measurement_rmse = np.sqrt(measurement_error_acumulator/(i+1))
+    measurement_rmse = replay_result.get_measurement_rmse(rmse_start_index,
+                                                          total_datapoints)
     
 
     #Get the test id
@@ -8,7 +8,6 @@ This file is meant to run the stroke kinematics through the ekf
 import numpy as np
 import pandas as pd
 from itertools import product
-import pickle
 import matplotlib.pyplot as plt
 
 
@@ -60,13 +59,8 @@ joint_fit_info_list = []
 
 for joint in JOINT_NAMES:
     
-    #Get the saved fit info files
-    save_location = '../../data/optimal_model_fits/' 
-    save_file_name = save_location + joint + "_optimal.p"
-
-    #Open and load the file
-    with open(save_file_name,'rb') as data_file:
-        fit_results = pickle.load(data_file)
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_models.load_optimal_fit_info(joint)
 
     #append the fit information
     joint_fit_info_list.append(fit_results)
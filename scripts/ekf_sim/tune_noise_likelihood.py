@@ -0,0 +1,160 @@
+"""
+This file is meant to tune the process model noise and the measurement noise
+of the EKF by minimizing the innovation negative log likelihood with L-BFGS
+instead of simulating a grid of noise values
+
+The gradient of the likelihood is calculated with the forward sensitivities
+of the filter, so every iteration runs the validation data of a subject
+once. The process model noise of the successive halving tuner or the hand
+tuned values are good starting points
+"""
+
+#Import Common libraries
+import pickle
+
+#Common imports
+import numpy as np
+import pandas as pd
+
+#Import custom library
+from generate_simulation_validation_data import generate_data
+from ekf_loader import ekf_loader
+from context import kmodel
+from context import ekf
+from kmodel.model_fitting.load_models import load_optimal_fit_info
+from ekf.noise_tuning import tune_noise
+
+
+###############################################################################
+###############################################################################
+# Define constants to use later on
+
+#Subjects that the noise is tuned for
+subject_list = [f"AB{i:02}" for i in range(1,11)]
+
+#Define the joint names
+JOINT_NAMES = ['jointangles_thigh_x',
+               'jointangles_shank_x',
+               'jointangles_foot_x']
+
+STATE_NAMES = ['phase', 'phase_dot', 'stride_length', 'ramp']
+
+NUM_STATES = len(STATE_NAMES)
+
+###############################################################################
+###############################################################################
+# Load the fit data so that we can use the average subject residual
+
+#Path to model
+#Load in the saved model parameters
+joint_fit_info_list = []
+
+for joint in JOINT_NAMES:
+
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_optimal_fit_info(joint)
+
+    #append the fit information
+    joint_fit_info_list.append(fit_results)
+
+residual_list = [np.mean(joint_fit['residual variance list'])
+                for joint_fit
+                in joint_fit_info_list]
+
+###############################################################################
+###############################################################################
+# Setup the EKF
+
+#Start with the joint degree tracking error and then joint velocity
+# measurement error
+R = np.diag(residual_list*2)
+
+#Start with the hand tuned process model noise. Phase has no process noise
+# and is not tuned
+Q = np.diag([0, 4e-9, 5e-9, 6e-6])
+
+#State initial covariance
+COV_DIAG = 1e-5
+initial_state_covar = np.diag([COV_DIAG]*NUM_STATES)
+
+#Static initial condition near the expected values
+initial_state = np.array([0,0.9,0.5,0]).reshape(-1,1)
+
+#Define the limits for the state
+upper_limits = np.array([ np.inf, np.inf, np.inf, 15]).reshape(-1,1)
+lower_limits = np.array([-np.inf, 0.6,0.5,-15]).reshape(-1,1)
+
+#Run the heteroschedastic model to add noise near the intersection
+HETEROSCHEDASTHIC_MODEL = True
+
+###############################################################################
+###############################################################################
+# Tuning settings
+
+#Every step in the validation data is 1/150 of a stride
+POINTS_PER_STEP = 150
+
+#Do not score the first steps so that the filter can converge
+SCORE_START_INDEX = 5*POINTS_PER_STEP
+
+#Amount of L-BFGS iterations, every one runs the validation data once
+MAX_ITERATIONS = 30
+
+#Bounds of the log of every noise entry
+LOG_BOUNDS = (np.log(1e-14), np.log(1e3))
+
+SAVE_FILE_NAME = "noise_likelihood_tuning.csv"
+
+#Load the speed ramp condition, it will be fixed for every subject
+with open('random_ramp_speed_condition.pickle','rb') as file:
+    random_test_condition = pickle.load(file)
+
+
+###############################################################################
+###############################################################################
+# Tune every subject
+
+subject_results = []
+
+for subject in subject_list:
+
+    #Generate the validation data for this subject
+    state_data, sensor_data, steps_per_condition, condition_list\
+        = generate_data(subject,
+                        STATE_NAMES,
+                        JOINT_NAMES,
+                        random_test_condition)
+
+    #Calculate the time step based on the fact that phase_dot = dphase/dt
+    time_steps = np.reciprocal(state_data[:,1])/POINTS_PER_STEP
+
+    #Use the inter subject average model that leaves the subject out
+    subject_ekf = ekf_loader(subject, JOINT_NAMES,
+                             initial_state, initial_state_covar, Q, R,
+                             lower_limits, upper_limits,
+                             use_subject_average=True,
+                             heteroschedastic_model=HETEROSCHEDASTHIC_MODEL)
+
+    result = tune_noise(subject_ekf, sensor_data, time_steps,
+                        max_iterations=MAX_ITERATIONS,
+                        log_bounds=LOG_BOUNDS,
+                        score_start_index=SCORE_START_INDEX)
+
+    print(f"{subject} negative log likelihood {result.initial_value} -> "
+          f"{result.value}\n"
+          f"  process model noise {result.q_diagonal}\n"
+          f"  measurement noise {result.r_diagonal}")
+
+    #Store the tuned diagonals
+    subject_result = {'Subject': subject,
+                      'Initial NLL': result.initial_value,
+                      'NLL': result.value,
+                      'Iterations': result.optimize_result.nit}
+    for state_name, q in zip(STATE_NAMES, result.q_diagonal):
+        subject_result[f"Q {state_name}"] = q
+    for i, r in enumerate(result.r_diagonal):
+        subject_result[f"R {i}"] = r
+    subject_results.append(subject_result)
+
+    ##Save to CSV after every subject
+    pd.DataFrame(subject_results).to_csv(SAVE_FILE_NAME, sep=',')
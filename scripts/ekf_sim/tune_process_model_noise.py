@@ -0,0 +1,193 @@
+"""
+This file is meant to tune the process model noise of the EKF with successive
+halving instead of simulating every sample of the dense grid that
+generate_process_model_noise_samples creates on the full trials
+
+All the candidates run in one batched filter on a short prefix of the
+validation data of a subject. Only the best third continue to a three times
+longer prefix, until the survivors run on the whole validation data.
+Candidates that diverge are stopped as soon as it is detected
+"""
+
+#Import Common libraries
+import pickle
+import itertools
+
+#Common imports
+import numpy as np
+import pandas as pd
+
+#Import custom library
+from generate_simulation_validation_data import generate_data
+from ekf_loader import ekf_loader
+from context import kmodel
+from context import ekf
+from kmodel.model_fitting.load_models import load_optimal_fit_info
+from ekf.dynamic_model import GaitDynamicModel
+from ekf.batched_ekf import BatchedExtendedKalmanFilter
+from ekf.tuning import successive_halving
+
+
+###############################################################################
+###############################################################################
+# Define constants to use later on
+
+#Subjects that the process model noise is tuned for
+subject_list = [f"AB{i:02}" for i in range(1,11)]
+
+#Define the joint names
+JOINT_NAMES = ['jointangles_thigh_x',
+               'jointangles_shank_x',
+               'jointangles_foot_x']
+
+STATE_NAMES = ['phase', 'phase_dot', 'stride_length', 'ramp']
+
+NUM_STATES = len(STATE_NAMES)
+
+###############################################################################
+###############################################################################
+# Load the fit data so that we can use the average subject residual
+
+#Path to model
+#Load in the saved model parameters
+joint_fit_info_list = []
+
+for joint in JOINT_NAMES:
+
+    #Get the saved fit info, the model artifact is used if it exists
+    fit_results = load_optimal_fit_info(joint)
+
+    #append the fit information
+    joint_fit_info_list.append(fit_results)
+
+residual_list = [np.mean(joint_fit['residual variance list'])
+                for joint_fit
+                in joint_fit_info_list]
+
+###############################################################################
+###############################################################################
+# Setup the EKF
+
+#Get the joint degree tracking error and then joint velocity measurement error
+R = np.diag(residual_list*2)
+
+#State initial covariance
+COV_DIAG = 1e-5
+initial_state_covar = np.diag([COV_DIAG]*NUM_STATES)
+
+#Static initial condition near the expected values
+initial_state = np.array([0,0.9,0.5,0]).reshape(-1,1)
+
+#Define the limits for the state
+upper_limits = np.array([ np.inf, np.inf, np.inf, 15]).reshape(-1,1)
+lower_limits = np.array([-np.inf, 0.6,0.5,-15]).reshape(-1,1)
+
+#Run the heteroschedastic model to add noise near the intersection
+HETEROSCHEDASTHIC_MODEL = True
+
+###############################################################################
+###############################################################################
+# Create the candidates
+
+#Different order of magnitudes for every process model noise
+phase_noise_values = [0]
+phase_rate_noise_values = [1*np.power(10.0,-i) for i in range(0,9)]
+stride_length_noise_values = [1*np.power(10.0,-i) for i in range(3,11)]
+ramp_noise_values = [1*np.power(10.0,-i) for i in range(1,8)]
+
+#Get the cartesian product of each
+q_diagonals = np.array(list(itertools.product(phase_noise_values,
+                                              phase_rate_noise_values,
+                                              stride_length_noise_values,
+                                              ramp_noise_values)))
+
+###############################################################################
+###############################################################################
+# Tuning settings
+
+#Every step in the validation data is 1/150 of a stride
+POINTS_PER_STEP = 150
+
+#Length of the first prefix, only one third of the candidates continue to a
+# three times longer prefix
+MIN_STEPS = 10*POINTS_PER_STEP
+REDUCTION_FACTOR = 3
+
+#Do not score the first steps so that the filter can converge
+RMSE_START_INDEX = 5*POINTS_PER_STEP
+
+#A candidate diverged if the error of a state is larger than this
+MAX_STATE_ERROR = np.array([0.5, 1.0, 1.0, 20.0])
+
+#Weight of the rmse of every state in the score
+STATE_WEIGHTS = np.array([1/0.1, 1/0.1, 1/0.1, 1/2.5])
+
+SAVE_FILE_NAME = "process_model_noise_tuning.csv"
+
+#Load the speed ramp condition, it will be fixed for every subject and
+# process model tuning
+with open('random_ramp_speed_condition.pickle','rb') as file:
+    random_test_condition = pickle.load(file)
+
+
+###############################################################################
+###############################################################################
+# Tune every subject
+
+subject_results = []
+
+for subject in subject_list:
+
+    #Generate the validation data for this subject
+    state_data, sensor_data, steps_per_condition, condition_list\
+        = generate_data(subject,
+                        STATE_NAMES,
+                        JOINT_NAMES,
+                        random_test_condition)
+
+    #Calculate the time step based on the fact that phase_dot = dphase/dt
+    time_steps = np.reciprocal(state_data[:,1])/POINTS_PER_STEP
+
+    #Use the inter subject average model that leaves the subject out
+    measurement_model = ekf_loader(subject, JOINT_NAMES,
+                                   initial_state, initial_state_covar,
+                                   np.diag(q_diagonals[0]), R,
+                                   lower_limits, upper_limits,
+                                   use_subject_average=True)\
+        .measurement_model
+
+    def create_batched_filter(q_diagonals):
+        num_filters = q_diagonals.shape[0]
+        return BatchedExtendedKalmanFilter(
+            np.repeat(initial_state.T, num_filters, axis=0),
+            initial_state_covar, GaitDynamicModel(),
+            np.stack([np.diag(q_diagonal) for q_diagonal in q_diagonals]),
+            measurement_model, R,
+            lower_state_limit=lower_limits, upper_state_limit=upper_limits,
+            heteroschedastic_model=HETEROSCHEDASTHIC_MODEL,
+            repair_covariance=True)
+
+    print(f"Tuning {subject} with {q_diagonals.shape[0]} candidates")
+
+    result = successive_halving(state_data, sensor_data, time_steps,
+                                q_diagonals,
+                                create_batched_filter=create_batched_filter,
+                                min_steps=MIN_STEPS,
+                                reduction_factor=REDUCTION_FACTOR,
+                                rmse_start_index=RMSE_START_INDEX,
+                                state_weights=STATE_WEIGHTS,
+                                max_state_error=MAX_STATE_ERROR,
+                                check_interval=POINTS_PER_STEP)
+
+    print(f"{subject} best process model noise {result.best_q_diagonal} "
+          f"rmse {result.rmse[result.best_index]} "
+          f"diverged {result.diverged.sum()}")
+
+    #Store the scores of every candidate
+    subject_result = result.to_dataframe()
+    subject_result['Subject'] = subject
+    subject_results.append(subject_result)
+
+    ##Save to CSV after every subject
+    pd.concat(subject_results, ignore_index=True)\
+        .to_csv(SAVE_FILE_NAME, sep=',')
@@ -13,6 +13,9 @@ if __name__ == "__main__":
 #Insert directory into path
 sys.path.insert(0, dir_to_add)
 
+#Add the repository root so that the ekf and utils packages can be imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+
 #Import the relevant modules
 # import kmodel
 import model_definition
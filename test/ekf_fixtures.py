@@ -0,0 +1,137 @@
+"""
+Shared setup of the ekf tests so that every test file does not need to
+define its own measurement model, trial and filter
+
+The measurement models have random fits with the same shapes that are used
+in the ekf so that the tests do not need any dataset files
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.fitted_model import SimpleFitModel
+from model_definition.personal_measurement_function import \
+    PersonalMeasurementFunction
+from ekf.measurement_model import MeasurementModel
+from ekf.dynamic_model import GaitDynamicModel
+from ekf.ekf import Extended_Kalman_Filter
+from ekf.batched_ekf import BatchedExtendedKalmanFilter
+
+import numpy as np
+
+
+BASIS_LIST = [FourierBasis(3,'phase'), PolynomialBasis(2,'phase_dot'),
+              PolynomialBasis(2,'stride_length'), PolynomialBasis(2,'ramp')]
+OUTPUT_NAMES = ['jointangles_thigh_x', 'jointangles_shank_x',
+                'jointangles_foot_x']
+
+NUM_STATES = 4
+TIME_STEP = 1/150
+
+#Tuning of the filters
+INITIAL_STATE = np.array([[0.0, 1.0, 1.2, 0.0]]).T
+INITIAL_COVARIANCE = np.diag([1e-3, 1e-3, 1e-3, 1e-2])
+PROCESS_NOISE = np.diag([0, 1e-4, 1e-5, 1e-3])
+LOWER_LIMIT = np.array([[-np.inf, 0.0, 0.0, -10]]).T
+UPPER_LIMIT = np.array([[np.inf, 2.0, 2.0, 10]]).T
+
+#Subject that walks at a constant speed, stride length and ramp
+TRUE_STATE = np.array([0.0, 1.1, 1.3, 0.5])
+
+
+def create_personal_model(seed, output_names=OUTPUT_NAMES,
+                          coefficient_scale=1.0):
+    """
+    Create a PersonalMeasurementFunction with random fits
+
+    Keyword Arguments:
+    seed -- seed of the random fits
+    output_names -- outputs of the model
+    coefficient_scale -- scale of the random fits
+    """
+    rng = np.random.default_rng(seed)
+    output_size = np.prod([basis.size for basis in BASIS_LIST])
+    models = [SimpleFitModel(BASIS_LIST,
+                             coefficient_scale*rng.normal(size=(1,output_size)),
+                             output_name)
+              for output_name in output_names]
+    return PersonalMeasurementFunction(models, list(output_names), 'AB01')
+
+
+def create_measurement_model(seed, output_names=OUTPUT_NAMES,
+                             coefficient_scale=1.0,
+                             jacobean_method='analytic'):
+    """
+    Create a MeasurementModel with random fits that also measures the
+    derivative of the outputs
+    """
+    return MeasurementModel(create_personal_model(seed, output_names,
+                                                  coefficient_scale),
+                            True, jacobean_method=jacobean_method)
+
+
+def generate_trial(measurement_model, num_steps, seed, initial_phase=0.0,
+                   time_step=TIME_STEP):
+    """
+    Create noisy measurements of a subject walking at a constant speed
+
+    Keyword Arguments:
+    measurement_model -- model that calculates the measurements
+    num_steps -- amount of measurements
+    seed -- seed of the measurement noise
+    initial_phase -- phase before the first step
+
+    Returns:
+    states -- true states with shape (num_steps, num_states)
+    measurements -- measurements with shape (num_steps, num_measurements)
+    """
+    rng = np.random.default_rng(seed)
+    states = np.tile(TRUE_STATE, (num_steps, 1))
+    states[:,0] = (initial_phase
+                   + np.arange(1, num_steps + 1)*TRUE_STATE[1]*time_step) % 1
+
+    measurements = np.stack([measurement_model.evaluate_h_func(
+        state.reshape(-1,1))[:,0] for state in states])
+    measurements += rng.normal(scale=0.1, size=measurements.shape)
+
+    return states, measurements
+
+
+def create_filter(measurement_model, filter_class=Extended_Kalman_Filter,
+                  process_noise=PROCESS_NOISE, observation_noise=None,
+                  initial_state=INITIAL_STATE,
+                  initial_covariance=INITIAL_COVARIANCE, dynamic_model=None,
+                  lower_state_limit=LOWER_LIMIT,
+                  upper_state_limit=UPPER_LIMIT, **kwargs):
+    """
+    Create a single filter, the observation noise defaults to the identity
+    and the rest of the keyword arguments are passed to the filter
+    """
+    if observation_noise is None:
+        observation_noise = np.eye(len(measurement_model.output_names))
+    if dynamic_model is None:
+        dynamic_model = GaitDynamicModel()
+
+    return filter_class(initial_state.copy(), initial_covariance.copy(),
+                        dynamic_model, process_noise, measurement_model,
+                        observation_noise,
+                        lower_state_limit=lower_state_limit,
+                        upper_state_limit=upper_state_limit, **kwargs)
+
+
+def create_batched_filter(measurement_model, num_filters,
+                          process_noise=PROCESS_NOISE, observation_noise=None,
+                          initial_covariance=INITIAL_COVARIANCE,
+                          lower_state_limit=LOWER_LIMIT,
+                          upper_state_limit=UPPER_LIMIT, **kwargs):
+    """
+    Create a batched filter where every filter starts at the initial state.
+    The noise matrices are shared or have one matrix per filter
+    """
+    if observation_noise is None:
+        observation_noise = np.eye(len(measurement_model.output_names))
+
+    return BatchedExtendedKalmanFilter(
+        np.repeat(INITIAL_STATE.T, num_filters, axis=0), initial_covariance,
+        GaitDynamicModel(), process_noise, measurement_model,
+        observation_noise, lower_state_limit=lower_state_limit,
+        upper_state_limit=upper_state_limit, **kwargs)
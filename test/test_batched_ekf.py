@@ -0,0 +1,202 @@
+"""
+This file is meant to test that the batched extended kalman filter matches
+running every filter separately
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf_fixtures import TIME_STEP as time_step, NUM_STATES as num_states
+from ekf.dynamic_model import GaitDynamicModel
+from ekf.batched_ekf import BatchedExtendedKalmanFilter
+import utils.math_utils as math_utils
+
+import numpy as np
+import pytest
+
+
+measurement_model = ekf_fixtures.create_measurement_model(3)
+
+num_filters = 4
+
+#Different noise matrices per filter
+process_noise = np.stack([ekf_fixtures.PROCESS_NOISE*(i+1)
+                          for i in range(num_filters)])
+observation_noise = np.stack([np.eye(6)*(i+1) for i in range(num_filters)])
+
+
+def generate_measurements(num_steps):
+    _, measurements = ekf_fixtures.generate_trial(measurement_model,
+                                                  num_steps, 2)
+    return measurements[:,:,np.newaxis]
+
+
+def create_filter(i=0, **kwargs):
+    #The noise of the filter can be replaced
+    kwargs = {'process_noise': process_noise[i],
+              'observation_noise': observation_noise[i], **kwargs}
+    return ekf_fixtures.create_filter(measurement_model, **kwargs)
+
+
+def create_batched_filter(num_filters=num_filters, **kwargs):
+    kwargs = {'process_noise': process_noise[:num_filters],
+              'observation_noise': observation_noise[:num_filters], **kwargs}
+    return ekf_fixtures.create_batched_filter(measurement_model, num_filters,
+                                              **kwargs)
+
+
+@pytest.mark.parametrize("heteroschedastic_model", [True, False])
+@pytest.mark.parametrize("covariance_update", 
+                         ['standard', 'joseph', 'square_root'])
+def test_batched_matches_single(heteroschedastic_model, covariance_update):
+    single_filters = [create_filter(i,
+        heteroschedastic_model=heteroschedastic_model,
+        covariance_update=covariance_update)
+        for i in range(num_filters)]
+
+    batched_filter = create_batched_filter(
+        heteroschedastic_model=heteroschedastic_model,
+        covariance_update=covariance_update)
+
+    for measurement in generate_measurements(200):
+        batched_states, batched_covariances = \
+            batched_filter.calculate_next_estimates(time_step, measurement)
+
+        for i,single_filter in enumerate(single_filters):
+            state, covariance = \
+                single_filter.calculate_next_estimates(time_step, measurement)
+            np.testing.assert_allclose(batched_states[i], state[:,0], 
+                                       rtol=1e-8, atol=1e-10)
+            np.testing.assert_allclose(batched_covariances[i], covariance,
+                                       rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize("covariance_update", ['joseph', 'square_root'])
+def test_covariance_updates_match_standard(covariance_update):
+    standard_filter = create_filter(covariance_update='standard')
+    test_filter = create_filter(covariance_update=covariance_update)
+
+    for measurement in generate_measurements(200):
+        state, covariance = \
+            test_filter.calculate_next_estimates(time_step, measurement)
+        expected_state, expected_covariance = \
+            standard_filter.calculate_next_estimates(time_step, measurement)
+
+        np.testing.assert_allclose(state, expected_state, atol=1e-6)
+        np.testing.assert_allclose(covariance, expected_covariance, 
+                                   atol=1e-8)
+        #Both update forms keep the covariance symmetric
+        np.testing.assert_allclose(covariance, covariance.T, atol=1e-15)
+
+
+def test_invalid_covariance_update():
+    with pytest.raises(ValueError):
+        create_filter(covariance_update='cholesky')
+
+
+def test_repair_covariance():
+    #Initial covariance that is not positive definite
+    bad_covariance = np.diag([1e-3, -1e-3, 1e-3, 1e-2])
+    measurement = generate_measurements(1)[0]
+
+    with pytest.raises(AssertionError):
+        create_filter(initial_covariance=bad_covariance)\
+            .calculate_next_estimates(time_step, measurement)
+
+    _, covariance = create_filter(initial_covariance=bad_covariance,
+                                  repair_covariance=True)\
+        .calculate_next_estimates(time_step, measurement)
+    assert np.linalg.eigvalsh(covariance).min() > 0
+
+    #Only the filters with a bad covariance are repaired
+    batched_filter = create_batched_filter(2,
+        initial_covariance=np.stack([ekf_fixtures.INITIAL_COVARIANCE,
+                                     bad_covariance]),
+        repair_covariance=True)
+    _, covariances = batched_filter.calculate_next_estimates(time_step, 
+                                                             measurement)
+    assert np.linalg.eigvalsh(covariances).min() > 0
+    assert batched_filter.pd_failures[0] == 0
+    assert batched_filter.pd_failures[1] > 0
+
+    _, expected_covariance = create_filter()\
+        .calculate_next_estimates(time_step, measurement)
+    np.testing.assert_allclose(covariances[0], expected_covariance, 
+                               rtol=1e-8)
+
+
+def test_innovation_covariances_not_pd_without_check():
+    #The second filter has a process noise that makes S not positive definite
+    batched_process_noise = np.stack([process_noise[0], -np.eye(num_states)])
+    measurement = generate_measurements(1)[0]
+
+    def create_bad_batched_filter(repair_covariance):
+        return create_batched_filter(2, process_noise=batched_process_noise,
+                                     repair_covariance=repair_covariance)
+
+    #The check is skipped, so the failure is found by the factorization
+    math_utils.set_pd_check_policy(math_utils.PD_CHECK_OFF)
+    try:
+        batched_filter = create_bad_batched_filter(True)
+        states, _ = batched_filter.calculate_next_estimates(time_step,
+                                                            measurement)
+        assert np.all(np.isfinite(states))
+        np.testing.assert_array_equal(batched_filter.pd_failures, [0, 1])
+
+        with pytest.raises(AssertionError):
+            create_bad_batched_filter(False).calculate_next_estimates(
+                time_step, measurement)
+    finally:
+        math_utils.set_pd_check_policy(math_utils.PD_CHECK_ON_FAILURE)
+
+    #The filter that did not fail is the same as running it by itself
+    expected_state, _ = create_filter()\
+        .calculate_next_estimates(time_step, measurement)
+    np.testing.assert_allclose(states[0], expected_state[:,0], rtol=1e-10)
+
+
+def test_batched_dynamic_model():
+    d_model = GaitDynamicModel()
+    states = np.array([[0.99, 3.0, 1.0, 0.0],
+                       [0.1, -30.0, 1.0, 0.0],
+                       [0.5, 1.0, 1.0, 0.0]])
+
+    new_states = d_model.f_function_batch(states, time_step)
+    for state, new_state in zip(states, new_states):
+        expected = d_model.f_function(state.reshape(-1,1).copy(), time_step)
+        np.testing.assert_allclose(new_state, expected[:,0])
+
+    F = d_model.f_jacobean_batch(states, time_step)
+    assert F.shape == (3, num_states, num_states)
+    np.testing.assert_allclose(F[1], 
+        d_model.f_jacobean(states[[1]].T, time_step))
+
+
+def test_invalid_shapes():
+    with pytest.raises(ValueError):
+        BatchedExtendedKalmanFilter(np.zeros((num_filters, num_states)),
+            np.eye(num_states), GaitDynamicModel(), np.zeros((3,4,4)),
+            measurement_model, np.eye(6))
+
+
+def test_select_filters():
+    expected_filter = create_batched_filter(heteroschedastic_model=True)
+    test_filter = create_batched_filter(heteroschedastic_model=True)
+    measurements = generate_measurements(100)
+
+    for measurement in measurements[:50]:
+        expected_filter.calculate_next_estimates(time_step, measurement)
+        test_filter.calculate_next_estimates(time_step, measurement)
+
+    #The selected filters continue from their estimates
+    test_filter.select_filters(np.array([True, False, True, False]))
+    assert test_filter.num_filters == 2
+
+    for measurement in measurements[50:]:
+        expected_states, expected_covariances = \
+            expected_filter.calculate_next_estimates(time_step, measurement)
+        states, covariances = \
+            test_filter.calculate_next_estimates(time_step, measurement)
+
+    np.testing.assert_allclose(states, expected_states[[0,2]], rtol=1e-12)
+    np.testing.assert_allclose(covariances, expected_covariances[[0,2]],
+                               rtol=1e-12)
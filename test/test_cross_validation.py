@@ -0,0 +1,122 @@
+"""
+This file is meant to test that the closed form leave one out cross 
+validation matches refitting without each subject
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+from model_fitting.k_model_fitting import KModelFitter
+from model_fitting.cross_validation import LeaveOneOutCrossValidator
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.decomposition import PCA
+
+
+basis_list = [FourierBasis(2,'phase'), PolynomialBasis(2,'phase_dot')]
+k_model = KroneckerModel(basis_list)
+output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+num_subjects = 6
+
+
+def create_subject_data(seed, num_datapoints=300):
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0,1,num_datapoints)
+    phase_dot = rng.uniform(0.6,1.4,num_datapoints)
+    offset = rng.normal(size=2)
+    return pd.DataFrame({'phase': phase, 'phase_dot': phase_dot,
+        'jointangles_thigh_x': np.sin(2*np.pi*phase)*(1+offset[0]) 
+            + 0.1*rng.normal(size=num_datapoints),
+        'jointangles_knee_x': np.cos(2*np.pi*phase)*phase_dot + offset[1]
+            + 0.1*rng.normal(size=num_datapoints),
+        'weight': rng.uniform(0.5,2,num_datapoints)})
+
+
+subject_data_list = [(f'AB{i:02}', create_subject_data(i)) 
+                     for i in range(1,num_subjects+1)]
+
+
+def direct_rmse(fits, data):
+    R = k_model.evaluate(data)
+    y = data[output_names].values
+    return np.sqrt(np.mean((y - R @ fits.T)**2, axis=0))
+
+
+def make_sign_positive(components):
+    index = np.argmax(np.abs(components), axis=1)
+    return components * np.sign(components[np.arange(len(index)), index])\
+        .reshape(-1,1)
+
+
+@pytest.mark.parametrize("vanilla_pca", [False, True])
+def test_matches_refitting(vanilla_pca):
+    num_pca_vectors = 2
+    l2_lambda = [0.0, 0.1]
+    cross_validator = LeaveOneOutCrossValidator.from_data(k_model, 
+        subject_data_list, output_names, l2_lambda=l2_lambda, data_splits=5)
+    result = cross_validator.cross_validate(num_pca_vectors, vanilla_pca)
+
+    fitter = KModelFitter()
+    subject_fits = [fitter.fit_data_multi(k_model, data, output_names,
+                                          data_splits=5, 
+                                          l2_lambda=l2_lambda)[0]
+                    for _, data in subject_data_list]
+
+    for i, (subject_name, left_out_data) in enumerate(subject_data_list):
+        assert result.subject_names[i] == subject_name
+
+        #Refit without the subject 
+        other_fits = np.stack(subject_fits[:i] + subject_fits[i+1:])
+        average_fit = other_fits.mean(axis=0)
+        np.testing.assert_allclose(result.average_fits[i], average_fit,
+                                   rtol=1e-9, atol=1e-12)
+
+        XI_0 = (other_fits - average_fit).reshape(num_subjects-1, -1)
+        if not vanilla_pca:
+            other_data = pd.concat([data for j,(_,data) 
+                                    in enumerate(subject_data_list) if j!=i])
+            R = k_model.evaluate(other_data)
+            G = R.T @ R / len(other_data)
+            eig, O = np.linalg.eigh(G)
+            Qinv = (O * np.sqrt(eig)) @ O.T
+            Q = (O / np.sqrt(eig)) @ O.T
+            XI_0 = (XI_0.reshape(num_subjects-1, 2, -1) @ Qinv)\
+                .reshape(num_subjects-1, -1)
+
+        pmap = PCA().fit(XI_0).components_[:num_pca_vectors]
+        pmap = make_sign_positive(pmap).reshape(num_pca_vectors, 2, -1)
+        if not vanilla_pca:
+            pmap = pmap @ Q
+        np.testing.assert_allclose(result.personalization_maps[i], pmap,
+                                   rtol=1e-6, atol=1e-8)
+
+        #Least squares gait fingerprint directly with the data
+        R = k_model.evaluate(left_out_data)
+        y = left_out_data[output_names].values
+        A = np.concatenate([R @ pmap[:,j,:].T for j in range(2)], axis=0)
+        b = np.concatenate([y[:,j] - R @ average_fit[j] for j in range(2)])
+        gait_fingerprint = np.linalg.lstsq(A, b, rcond=None)[0]
+        np.testing.assert_allclose(result.gait_fingerprints[i], 
+                                   gait_fingerprint, rtol=1e-6, atol=1e-8)
+
+        #Held out rmse directly with the data
+        np.testing.assert_allclose(result.average_fit_rmse[i],
+                                   direct_rmse(average_fit, left_out_data),
+                                   rtol=1e-7)
+        personalized_fit = average_fit + np.einsum('g,gjk->jk', 
+                                                   gait_fingerprint, pmap)
+        np.testing.assert_allclose(result.gait_fingerprint_rmse[i],
+                                   direct_rmse(personalized_fit, 
+                                               left_out_data), rtol=1e-6)
+        np.testing.assert_allclose(result.optimal_fit_rmse[i],
+                                   direct_rmse(subject_fits[i], 
+                                               left_out_data), rtol=1e-7)
+
+
+def test_too_many_pca_vectors():
+    cross_validator = LeaveOneOutCrossValidator.from_data(k_model, 
+        subject_data_list[:3], output_names)
+    with pytest.raises(ValueError):
+        cross_validator.cross_validate(num_pca_vectors=2)
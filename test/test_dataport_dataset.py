@@ -0,0 +1,144 @@
+"""
+This file is meant to test the columnar dataport loader against filtering 
+the dataframes with pandas
+"""
+
+from context import model_definition
+from utils.dataport_dataset import DataportDataset, StrideIndex, \
+    write_row_groups, write_stride_index, POINTS_PER_STEP
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+
+conditions = [(ramp, speed) for ramp in [-5.0, 0.0, 7.5] 
+              for speed in [0.8, 1.2]]
+
+
+@pytest.fixture
+def dataset_location(tmp_path):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / 'training')
+
+    condition_list = []
+    for ramp, speed in conditions:
+        num_steps = rng.integers(2,5)
+        num_datapoints = num_steps*POINTS_PER_STEP
+        condition_list.append(pd.DataFrame({
+            'phase': np.tile(np.linspace(0,1,POINTS_PER_STEP), num_steps),
+            'jointangles_foot_x': rng.normal(size=num_datapoints),
+            'jointangles_thigh_x': rng.normal(size=num_datapoints),
+            'ramp': ramp, 'speed': speed}))
+
+    data = pd.concat(condition_list, ignore_index=True)
+    file_name = str(tmp_path/'training'/
+                    'dataport_flattened_training_AB01.parquet')
+    write_row_groups(data, file_name, [len(df) for df in condition_list])
+    
+    return tmp_path, data
+
+
+def pandas_filter(data, condition_list, num_steps=None):
+    df_list = []
+    for ramp, speed in condition_list:
+        df_filtered = data[(data['ramp']==ramp) & (data['speed']==speed)]
+        if num_steps is not None:
+            df_filtered = df_filtered.iloc[:num_steps*POINTS_PER_STEP]
+        df_list.append(df_filtered)
+    return pd.concat(df_list)
+
+
+def test_one_row_group_per_condition(dataset_location):
+    location, _ = dataset_location
+    dataset = DataportDataset(str(location))
+    parquet_file = pq.ParquetFile(dataset.get_file_name('AB01', 'training'))
+    assert parquet_file.num_row_groups == len(conditions)
+
+
+@pytest.mark.parametrize("from_cache", [False, True])
+@pytest.mark.parametrize("num_steps", [None, 2])
+def test_matches_pandas(dataset_location, from_cache, num_steps):
+    location, data = dataset_location
+    dataset = DataportDataset(str(location))
+    columns = ['jointangles_thigh_x', 'phase']
+    condition_list = [(7.5, 0.8), (-5, 1.2), (0, 0.8)]
+
+    if from_cache:
+        dataset.load('AB01', 'training', columns)
+
+    selected = dataset.load('AB01', 'training', columns, condition_list,
+                            num_steps)
+    expected = pandas_filter(data, condition_list, num_steps)
+
+    np.testing.assert_array_equal(selected.values, expected[columns].values)
+    np.testing.assert_array_equal(selected['phase'], expected['phase'].values)
+    pd.testing.assert_frame_equal(selected.to_dataframe(),
+                                  expected[columns].reset_index(drop=True))
+
+    #The selection can be filtered again
+    np.testing.assert_array_equal(
+        selected.select_conditions([(0, 0.8)]).values,
+        pandas_filter(data, [(0, 0.8)], num_steps)[columns].values)
+
+
+def test_cache_and_read_only(dataset_location):
+    location, data = dataset_location
+    dataset = DataportDataset(str(location), cache_size=2)
+    columns = ['jointangles_foot_x']
+
+    first = dataset.load('AB01', 'training', columns)
+    assert dataset.load('AB01', 'training', columns) is first
+    assert first['jointangles_foot_x'].flags.c_contiguous
+    with pytest.raises(ValueError):
+        first.values[0,0] = 1
+
+    #Different columns and data types are different entries
+    single = dataset.load('AB01', 'training', columns, dtype=np.float32)
+    assert single.values.dtype == np.float32
+    np.testing.assert_allclose(single.values, first.values, rtol=1e-6)
+
+    #The least recently used entry is removed
+    dataset.load('AB01', 'training', ['phase'])
+    assert dataset.load('AB01', 'training', columns) is not first
+
+
+@pytest.mark.parametrize("persisted", [False, True])
+def test_stride_index(dataset_location, persisted):
+    location, data = dataset_location
+    dataset = DataportDataset(str(location))
+    file_name = dataset.get_file_name('AB01', 'training')
+
+    if persisted:
+        write_stride_index(data, file_name)
+
+    stride_index = dataset.load_stride_index('AB01', 'training')
+    assert dataset.load_stride_index('AB01', 'training') is stride_index
+
+    for ramp, speed in conditions:
+        expected_rows = np.flatnonzero((data['ramp']==ramp) 
+                                       & (data['speed']==speed))
+        np.testing.assert_array_equal(stride_index.get_rows(ramp, speed),
+                                      expected_rows)
+        np.testing.assert_array_equal(
+            stride_index.get_stride_starts(ramp, speed),
+            expected_rows[::POINTS_PER_STEP])
+
+    assert len(stride_index.get_rows(2.5, 1.0)) == 0
+
+
+def test_stride_index_skips_rows_without_condition(tmp_path):
+    ramp = np.r_[np.zeros(2*POINTS_PER_STEP), np.full(10, 5.0)]
+    speed = np.r_[np.ones(2*POINTS_PER_STEP), np.full(10, np.nan)]
+    stride_index = StrideIndex.from_conditions(ramp, speed)
+
+    np.testing.assert_array_equal(stride_index.conditions, [[0.0, 1.0]])
+
+    #Save and load the index
+    file_name = str(tmp_path/'index.npz')
+    stride_index.save(file_name)
+    loaded = StrideIndex.load(file_name)
+    np.testing.assert_array_equal(loaded.get_rows(0, 1), 
+                                  np.arange(2*POINTS_PER_STEP))
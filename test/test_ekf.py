@@ -0,0 +1,72 @@
+"""
+This file is meant to test that the extended kalman filter handles an
+innovation covariance that is not positive definite and that it only
+caches the cholesky factors of its noise matrices
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf_fixtures import TIME_STEP as time_step, NUM_STATES as num_states
+import utils.math_utils as math_utils
+
+import numpy as np
+import pytest
+
+
+measurement_model = ekf_fixtures.create_measurement_model(3)
+
+_, measurements = ekf_fixtures.generate_trial(measurement_model, 50, 2)
+measurements = measurements[:,:,np.newaxis]
+
+
+def create_filter(**kwargs):
+    return ekf_fixtures.create_filter(measurement_model, **kwargs)
+
+
+def test_innovation_covariance_not_pd():
+    #Process noise that makes the predicted covariance and S not positive
+    # definite
+    bad_process_noise = -np.eye(num_states)
+
+    def create_bad_filter(repair_covariance):
+        return create_filter(process_noise=bad_process_noise,
+                             repair_covariance=repair_covariance)
+
+    #S is repaired like in the batched filter
+    state, covariance = create_bad_filter(True)\
+        .calculate_next_estimates(time_step, measurements[0])
+    assert np.all(np.isfinite(state))
+    assert np.linalg.eigvalsh(covariance).min() > 0
+
+    #Without the check, the cholesky failure is raised as a failed check
+    math_utils.set_pd_check_policy(math_utils.PD_CHECK_OFF)
+    try:
+        with pytest.raises(AssertionError):
+            create_bad_filter(False).calculate_next_estimates(time_step,
+                                                              measurements[0])
+    finally:
+        math_utils.set_pd_check_policy(math_utils.PD_CHECK_ON_FAILURE)
+
+
+def test_noise_sqrt_cache():
+    test_filter = create_filter(covariance_update='square_root',
+                                heteroschedastic_model=True)
+
+    for measurement in measurements:
+        test_filter.calculate_next_estimates(time_step, measurement)
+
+    #One factor per noise attribute, no matter how many steps run
+    assert set(test_filter._sqrt_cache) <= {'Q', 'R', 'R_h'}
+    np.testing.assert_allclose(test_filter._get_sqrt(test_filter.R),
+                               np.linalg.cholesky(test_filter.R))
+
+    #A new noise matrix replaces the cached factor
+    test_filter.R = 2*test_filter.R
+    np.testing.assert_allclose(test_filter._get_sqrt(test_filter.R),
+                               np.linalg.cholesky(test_filter.R))
+
+    #Matrices that are not noise attributes are not cached
+    matrix = 3*np.eye(6)
+    np.testing.assert_allclose(test_filter._get_sqrt(matrix),
+                               np.linalg.cholesky(matrix))
+    assert set(test_filter._sqrt_cache) <= {'Q', 'R', 'R_h'}
@@ -0,0 +1,144 @@
+"""
+This file is meant to test that the ekf instrumentation does not change the
+estimates, that it counts every stage and that it can be removed again
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf_fixtures import TIME_STEP as time_step
+from ekf.instrumentation import EKFInstrumentation, STAGES
+
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+
+output_names = ekf_fixtures.OUTPUT_NAMES[:2]
+
+num_steps = 50
+
+
+def create_filter(jacobean_method='analytic', covariance_update='standard',
+                  upper_limit=None, repair_covariance=False):
+    measurement_model = ekf_fixtures.create_measurement_model(4,
+        output_names, jacobean_method=jacobean_method)
+    return ekf_fixtures.create_filter(measurement_model,
+        observation_noise=np.eye(4), lower_state_limit=None,
+        upper_state_limit=upper_limit, covariance_update=covariance_update,
+        repair_covariance=repair_covariance)
+
+
+def generate_measurements():
+    measurement_rng = np.random.default_rng(5)
+    return [measurement_rng.normal(size=(4,1)) for _ in range(num_steps)]
+
+
+@pytest.mark.parametrize("jacobean_method", ['analytic', 'numerical'])
+@pytest.mark.parametrize("covariance_update", ['standard', 'square_root'])
+def test_instrumentation_matches_filter(jacobean_method, covariance_update):
+    expected_filter = create_filter(jacobean_method, covariance_update)
+    test_filter = create_filter(jacobean_method, covariance_update)
+    instrumentation = test_filter.enable_instrumentation()
+
+    for measurement in generate_measurements():
+        expected_state, expected_covariance = \
+            expected_filter.calculate_next_estimates(time_step, measurement)
+        state, covariance = \
+            test_filter.calculate_next_estimates(time_step, measurement)
+        np.testing.assert_array_equal(state, expected_state)
+        np.testing.assert_array_equal(covariance, expected_covariance)
+
+    calls = instrumentation.stage_calls
+    assert instrumentation.num_steps == num_steps
+    #f_function and f_jacobean
+    assert calls['dynamic_model'] == 2*num_steps
+    assert calls['measurement_model'] == num_steps
+    assert calls['kalman_gain'] == num_steps
+    assert calls['jacobean'] == \
+        (num_steps if jacobean_method == 'numerical' else 0)
+    assert calls['covariance_update'] == \
+        (num_steps if covariance_update == 'standard' else 0)
+    assert calls['pd_check'] > 0
+    assert instrumentation.pd_failures == {}
+
+    #The stages run inside the step
+    table = instrumentation.get_stage_table().set_index('stage')
+    assert table.loc[STAGES, 'total_time'].sum() \
+        <= table.loc['step', 'total_time']
+    assert instrumentation.latency_histogram.sum() == num_steps
+    assert instrumentation.get_latency_percentile(99) \
+        <= instrumentation.max_step_time
+
+
+def test_disable_instrumentation():
+    test_filter = create_filter()
+    measurement_model = test_filter.measurement_model
+    dynamic_model = test_filter.dynamic_model
+
+    instrumentation = test_filter.enable_instrumentation()
+    with pytest.raises(ValueError):
+        test_filter.enable_instrumentation()
+
+    test_filter.disable_instrumentation()
+    assert test_filter.instrumentation is None
+    assert test_filter.measurement_model is measurement_model
+    assert test_filter.dynamic_model is dynamic_model
+    assert 'calculate_next_estimates' not in vars(test_filter)
+
+    #Nothing is recorded after the instrumentation is removed
+    test_filter.calculate_next_estimates(time_step,
+                                         generate_measurements()[0])
+    assert instrumentation.num_steps == 0
+
+
+def test_clipping_and_pd_failures():
+    #Stride length starts at the upper limit, so it is clipped at least in
+    # the first prediction
+    upper_limit = np.array([[np.inf, 2.0, 1.2, 10]]).T
+    test_filter = create_filter(upper_limit=upper_limit,
+                                repair_covariance=True)
+    instrumentation = test_filter.enable_instrumentation()
+
+    for measurement in generate_measurements():
+        test_filter.calculate_next_estimates(time_step, measurement)
+
+    num_clipped_steps = instrumentation.num_clipped_steps['predicted']
+    assert num_clipped_steps >= 1
+    assert instrumentation.clipped_states['predicted'][2] == num_clipped_steps
+    assert instrumentation.clipped_states['predicted'][0] == 0
+
+    #Failures are counted per check name
+    not_pd_matrix = np.array([[1.0, 2.0], [2.0, 1.0]])
+    assert not test_filter._validate_pd(not_pd_matrix, "test")
+    assert instrumentation.pd_failures == {"test": 1}
+
+    test_filter.repair_covariance = False
+    with pytest.raises(AssertionError):
+        test_filter._validate_pd(not_pd_matrix, "test")
+    assert instrumentation.pd_failures == {"test": 2}
+
+
+def test_export(tmp_path):
+    test_filter = create_filter()
+    instrumentation = test_filter.enable_instrumentation(
+        EKFInstrumentation(latency_bins=np.logspace(-6, -1, 11)))
+
+    for measurement in generate_measurements():
+        test_filter.calculate_next_estimates(time_step, measurement)
+
+    instrumentation.to_json(tmp_path / 'timing.json')
+    instrumentation.to_csv(tmp_path / 'timing.csv')
+
+    with open(tmp_path / 'timing.json') as json_file:
+        saved = json.load(json_file)
+    assert saved['steps']['calls'] == num_steps
+    assert sum(saved['latency_histogram']['counts']) == num_steps
+    assert len(saved['latency_histogram']['bin_edges']) == 11
+
+    table = pd.read_csv(tmp_path / 'timing.csv')
+    assert list(table['stage']) == STAGES + ['step']
+
+    instrumentation.reset()
+    assert instrumentation.num_steps == 0
+    assert instrumentation.stage_calls['measurement_model'] == 0
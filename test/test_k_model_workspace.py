@@ -0,0 +1,93 @@
+"""
+This file is meant to test that evaluating the kronecker model with the 
+pre-allocated workspaces matches the default evaluation
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis, \
+    LegendreBasis, ChebyshevBasis, HermiteBasis
+from model_definition.k_model import KroneckerModel
+
+import pickle
+import numpy as np
+
+
+basis_list = [FourierBasis(4,'phase'), PolynomialBasis(3,'phase_dot'),
+              LegendreBasis(4,'stride_length'), ChebyshevBasis(3,'ramp'),
+              HermiteBasis(4,'extra')]
+
+rng = np.random.default_rng(2)
+input_data = rng.uniform(-1,1,(50,5))
+
+
+def test_basis_evaluate_into():
+    x = input_data[:,[0]]
+    for basis in basis_list:
+        out = np.empty((x.shape[0],basis.size))
+        scratch = np.empty((x.shape[0],1))
+        basis.evaluate_into(x, out, scratch)
+        np.testing.assert_allclose(out, 
+            basis.evaluate(x).reshape(x.shape[0],-1), atol=1e-12)
+
+        for order in [1,2]:
+            basis.evaluate_derivative_into(x, order, out, scratch)
+            np.testing.assert_allclose(out, 
+                basis.evaluate_derivative(x, order), atol=1e-10)
+
+
+def test_workspace_evaluation():
+    k_model = KroneckerModel(basis_list)
+    expected = k_model.evaluate(input_data)
+
+    k_model.set_workspace_mode(True)
+    np.testing.assert_allclose(k_model.evaluate(input_data), expected)
+
+    #The buffer is reused between calls with the same size
+    first = k_model.evaluate(input_data)
+    second = k_model.evaluate(input_data)
+    assert first is second
+
+    #Single row evaluation
+    for i in range(5):
+        np.testing.assert_allclose(k_model.evaluate(input_data[[i]]),
+                                   expected[[i]])
+
+
+def test_workspace_partial_derivatives():
+    k_model = KroneckerModel(basis_list)
+    derivative_list = [(0,0,0,0,0), (1,0,0,0,0), (0,0,1,0,0), (2,0,0,0,0), 
+                       (1,0,0,0,1)]
+
+    expected = k_model.evaluate_partial_derivatives(input_data, 
+                                                    derivative_list)
+    output = k_model.evaluate_partial_derivatives(input_data, derivative_list,
+                                                  use_workspace=True)
+
+    assert output.shape == (len(derivative_list), 50, k_model.output_size)
+    np.testing.assert_allclose(output, expected, atol=1e-10)
+    np.testing.assert_allclose(output[0], k_model.evaluate(input_data))
+
+
+def test_single_basis_workspace():
+    k_model = KroneckerModel([FourierBasis(3,'phase')])
+    expected = k_model.evaluate(input_data)
+    k_model.set_workspace_mode(True)
+    np.testing.assert_allclose(k_model.evaluate(input_data), expected)
+
+
+def test_workspace_limit_and_pickle():
+    k_model = KroneckerModel(basis_list)
+    k_model.set_workspace_mode(True)
+
+    for num_datapoints in range(1, KroneckerModel.MAX_WORKSPACES + 3):
+        k_model.evaluate(input_data[:num_datapoints])
+    assert len(k_model._workspaces) == KroneckerModel.MAX_WORKSPACES
+
+    loaded_model = pickle.loads(pickle.dumps(k_model))
+    assert len(loaded_model._workspaces) == 0
+    assert loaded_model.use_workspace == True
+    np.testing.assert_allclose(loaded_model.evaluate(input_data),
+                               KroneckerModel(basis_list).evaluate(input_data))
+
+    k_model.set_workspace_mode(False)
+    assert len(k_model._workspaces) == 0
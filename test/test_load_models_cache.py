@@ -0,0 +1,175 @@
+"""
+This file is meant to test that the model cache in load_models gives the same
+models as recalculating everything and that it notices when a fit file
+changes
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+from model_fitting import load_models
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.decomposition import PCA
+
+
+basis_list = [FourierBasis(2,'phase'), PolynomialBasis(2,'phase_dot')]
+model_size = KroneckerModel(basis_list).get_output_size()
+output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+num_subjects = 5
+
+
+def save_fit_file(location, output_name, seed):
+    rng = np.random.default_rng(seed)
+    RTR_list = []
+    for _ in range(num_subjects):
+        R = rng.normal(size=(50, model_size))
+        RTR_list.append(R.T @ R)
+
+    save_data = {"model fits": [rng.normal(size=(1,model_size))
+                                for _ in range(num_subjects)],
+                 "RTR list": RTR_list,
+                 "num datapoints list": [50 + i for i in range(num_subjects)],
+                 "basis list": basis_list}
+
+    with open(os.path.join(location, output_name + "_optimal.p"), 'wb') \
+            as save_file:
+        pickle.dump(save_data, save_file)
+
+    return save_data
+
+
+@pytest.fixture
+def fit_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_models, 'save_location', str(tmp_path) + '/')
+    load_models.clear_model_cache()
+    saved = {name: save_fit_file(tmp_path, name, i)
+             for i, name in enumerate(output_names)}
+    yield tmp_path, saved
+    load_models.clear_model_cache()
+
+
+def create_subject_data(num_datapoints=200):
+    rng = np.random.default_rng(10)
+    return pd.DataFrame({'phase': rng.uniform(0,1,num_datapoints),
+                         'phase_dot': rng.uniform(0.6,1.4,num_datapoints),
+                         'jointangles_thigh_x': rng.normal(size=num_datapoints),
+                         'jointangles_knee_x': rng.normal(size=num_datapoints)})
+
+
+def test_leave_one_out_average(fit_files):
+    _, saved = fit_files
+    model_fits = saved[output_names[0]]["model fits"]
+
+    for i in range(num_subjects):
+        model = load_models.load_simple_models(output_names[0], "AVG",
+                                               f"AB{i+1:02}")
+        expected = np.mean(model_fits[:i] + model_fits[i+1:], axis=0)
+        np.testing.assert_allclose(model.model_fit, expected,
+                                   rtol=1e-12, atol=1e-12)
+
+    #The leave out subject does not change the full average
+    model = load_models.load_simple_models(output_names[0], "AVG")
+    np.testing.assert_allclose(model.model_fit, np.mean(model_fits, axis=0))
+
+    model = load_models.load_simple_models(output_names[0], "AB03")
+    np.testing.assert_array_equal(model.model_fit, model_fits[2])
+
+
+def test_cache_invalidated_when_file_changes(fit_files):
+    location, _ = fit_files
+    first = load_models.load_simple_models(output_names[0], "AVG", "AB01")
+    second = load_models.load_simple_models(output_names[0], "AVG", "AB01")
+    assert first.model_fit is second.model_fit
+
+    #Write a different fit file and make sure that the modification time
+    # changes even on filesystems with coarse timestamps
+    file_name = os.path.join(location, output_names[0] + "_optimal.p")
+    new_data = save_fit_file(location, output_names[0], 100)
+    file_time = os.stat(file_name).st_mtime_ns + 10**9
+    os.utime(file_name, ns=(file_time, file_time))
+
+    third = load_models.load_simple_models(output_names[0], "AVG", "AB01")
+    expected = np.mean(new_data["model fits"][1:], axis=0)
+    np.testing.assert_allclose(third.model_fit, expected, rtol=1e-12)
+
+
+def calculate_expected_pmaps(saved, subject_number, num_pca, normalized):
+    """
+    Calculate the personalization maps the same way as before the cache
+    """
+    pmaps = []
+    for name in output_names:
+        model_fits = list(saved[name]["model fits"])
+        model_fits.pop(subject_number)
+        XI = np.concatenate(model_fits, axis=0)
+        XI_0 = XI - np.mean(model_fits, axis=0)
+
+        if normalized:
+            G = sum(RTR/n for j, (RTR, n)
+                    in enumerate(zip(saved[name]["RTR list"],
+                                     saved[name]["num datapoints list"]))
+                    if j != subject_number)
+            XI_0 = load_models.convert_to_orthonormal([XI_0], [G])[0]
+
+        pmap = PCA().fit(XI_0).components_[:num_pca,:]
+
+        if normalized:
+            pmap = load_models.convert_from_orthonormal([pmap], [G])[0]
+
+        pmaps.append(pmap)
+    return pmaps
+
+
+@pytest.mark.parametrize("normalized_pca", [True, False])
+def test_personalized_model_matches_recalculation(fit_files, normalized_pca):
+    _, saved = fit_files
+    subject_data = create_subject_data()
+
+    for subject_number in [0, 3]:
+        subject_name = f"AB{subject_number+1:02}"
+        model = load_models.load_personalized_models(output_names,
+                                                     subject_name,
+                                                     subject_data,
+                                                     normalized_pca,
+                                                     num_gait_fingerprints=3)
+        expected_pmaps = calculate_expected_pmaps(saved, subject_number, 3,
+                                                  normalized_pca)
+
+        for personal_model, expected_pmap in zip(model.kmodels,
+                                                 expected_pmaps):
+            #The sign of the pca vectors is the same since the input
+            # only differs by rounding
+            np.testing.assert_allclose(personal_model.pmap, expected_pmap,
+                                       rtol=1e-7, atol=1e-9)
+            np.testing.assert_array_equal(personal_model.optimal_fit,
+                saved[personal_model.output_name]["model fits"][subject_number])
+
+
+def test_personalization_maps_are_memoized(fit_files):
+    _, saved = fit_files
+    subject_data = create_subject_data()
+
+    first = load_models.load_personalized_models(output_names, "AB02",
+                                                 subject_data)
+    second = load_models.load_personalized_models(output_names, "AB02",
+                                                  subject_data)
+    for first_model, second_model in zip(first.kmodels,
+                                         second.kmodels):
+        assert first_model.pmap is second_model.pmap
+
+    #Different keys get different entries
+    third = load_models.load_personalized_models(output_names, "AB02",
+                                                 subject_data,
+                                                 normalized_pca=False)
+    assert third.kmodels[0].pmap is not \
+        first.kmodels[0].pmap
+
+    #The loaded fits are not modified by leaving a subject out
+    fit_file = load_models._load_fit_file(output_names[0])
+    assert fit_file.model_fits.shape[0] == num_subjects
+    assert len(fit_file.RTR_list) == num_subjects
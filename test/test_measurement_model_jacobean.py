@@ -0,0 +1,90 @@
+"""
+This file is meant to test the analytic jacobean of the measurement model
+against finite differences
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis,\
+    LegendreBasis, ChebyshevBasis, HermiteBasis
+from model_definition.fitted_model import SimpleFitModel
+from model_definition.personal_measurement_function import \
+    PersonalMeasurementFunction
+from ekf.measurement_model import MeasurementModel
+
+import numpy as np
+import pytest
+
+
+def create_measurement_model(basis_list, num_outputs=3, 
+                             calculate_output_derivative=True,
+                             jacobean_method='analytic'):
+    """
+    Create a measurement model with random model fits
+    """
+    rng = np.random.default_rng(0)
+    output_size = np.prod([basis.size for basis in basis_list])
+    output_names = [f'jointangles_joint{i}_x' for i in range(num_outputs)]
+    models = [SimpleFitModel(basis_list, rng.normal(size=(1,output_size)), name)
+              for name in output_names]
+    personal_model = PersonalMeasurementFunction(models, output_names, 'AB01')
+    return MeasurementModel(personal_model, calculate_output_derivative,
+                            jacobean_method=jacobean_method)
+
+
+basis_lists = [
+    [FourierBasis(4,'phase'), PolynomialBasis(3,'phase_dot'),
+     PolynomialBasis(2,'stride_length'), PolynomialBasis(3,'ramp')],
+    [FourierBasis(2,'phase'), LegendreBasis(3,'phase_dot'),
+     ChebyshevBasis(4,'stride_length'), HermiteBasis(3,'ramp')],
+]
+
+
+@pytest.mark.parametrize("basis_list", basis_lists)
+def test_basis_derivatives(basis_list):
+    x = np.linspace(-0.9, 0.9, 7).reshape(-1,1)
+    delta = 1e-6
+    for basis in basis_list:
+        for order in [1,2]:
+            lower = basis.evaluate(x - delta).reshape(x.shape[0],-1) \
+                if order == 1 else basis.evaluate_derivative(x - delta, 1)
+            upper = basis.evaluate(x + delta).reshape(x.shape[0],-1) \
+                if order == 1 else basis.evaluate_derivative(x + delta, 1)
+            expected = (upper - lower)/(2*delta)
+            np.testing.assert_allclose(basis.evaluate_derivative(x, order),
+                                       expected, rtol=1e-5, atol=1e-4)
+
+
+@pytest.mark.parametrize("basis_list", basis_lists)
+@pytest.mark.parametrize("calculate_output_derivative", [True, False])
+def test_analytic_jacobean(basis_list, calculate_output_derivative):
+    model = create_measurement_model(basis_list, 
+        calculate_output_derivative=calculate_output_derivative)
+    state = np.array([[0.3, 0.9, 1.1, 0.2]]).T
+
+    h, H = model.evaluate_h_and_dh_func(state)
+
+    assert h.shape == (len(model.output_names), 1)
+    assert H.shape == (len(model.output_names), 4)
+    np.testing.assert_allclose(model.evaluate_dh_func(state), H)
+    assert model.check_jacobean(state) < 1e-4 * max(1, np.abs(H).max())
+
+
+@pytest.mark.parametrize("basis_list", basis_lists)
+def test_analytic_matches_numerical(basis_list):
+    analytic = create_measurement_model(basis_list)
+    numerical = create_measurement_model(basis_list, 
+                                         jacobean_method='numerical')
+    state = np.array([[0.7, 1.1, 1.3, -0.4]]).T
+
+    h_analytic, H_analytic = analytic.evaluate_h_and_dh_func(state)
+    h_numerical, H_numerical = numerical.evaluate_h_and_dh_func(state)
+
+    np.testing.assert_allclose(h_analytic, h_numerical, 
+                               atol=1e-4*np.abs(h_analytic).max())
+
+    #The numerical jacobean of the time derivative outputs nests two finite
+    # differences, therefore only compare the joint angle rows
+    num_angles = analytic.personal_model.num_kmodels
+    scale = np.abs(H_analytic[:num_angles]).max()
+    np.testing.assert_allclose(H_analytic[:num_angles], 
+                               H_numerical[:num_angles], atol=1e-4*scale)
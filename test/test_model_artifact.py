@@ -0,0 +1,167 @@
+"""
+This file is meant to test that models saved as model artifacts load back 
+the same and that load_models reads the artifacts
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis, \
+    LegendreBasis, ChebyshevBasis, HermiteBasis
+from model_definition.fitted_model import SimpleFitModel, PersonalKModel
+from model_definition.personal_measurement_function import \
+    PersonalMeasurementFunction
+from model_definition import model_artifact
+from model_fitting import load_models
+
+import os
+import json
+import pickle
+import numpy as np
+import pytest
+
+
+basis_list = [FourierBasis(2,'phase'), PolynomialBasis(2,'phase_dot'),
+              LegendreBasis(3,'ramp')]
+model_size = 5*2*3
+output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+
+rng = np.random.default_rng(0)
+test_states = np.column_stack([rng.uniform(0,1,20), rng.uniform(0.6,1.4,20),
+                               rng.uniform(-1,1,20)])
+
+
+def test_basis_header_round_trip():
+    for basis in [FourierBasis(3,'phase'), PolynomialBasis(2,'phase_dot'),
+                  LegendreBasis(4,'ramp'), ChebyshevBasis(3,'ramp'),
+                  HermiteBasis(3,'stride_length')]:
+        header = model_artifact.basis_to_header(basis)
+        #Must be json serializable
+        new_basis = model_artifact.basis_from_header(
+            json.loads(json.dumps(header)))
+        assert type(new_basis) is type(basis)
+        assert new_basis.n == basis.n
+        assert new_basis.var_name == basis.var_name
+        x = np.linspace(-1,1,7).reshape(-1,1)
+        np.testing.assert_array_equal(new_basis.evaluate(x),
+                                      basis.evaluate(x))
+
+
+@pytest.mark.parametrize("model_type", ['simple', 'personal'])
+def test_measurement_function_round_trip(tmp_path, model_type):
+    if model_type == 'simple':
+        models = [SimpleFitModel(basis_list, rng.normal(size=(1,model_size)),
+                                 name)
+                  for name in output_names]
+    else:
+        gait_fingerprint = rng.normal(size=(1,2))
+        models = [PersonalKModel(basis_list, name,
+                                 rng.normal(size=(1,model_size)),
+                                 rng.normal(size=(2,model_size)),
+                                 gait_fingerprint, 'AB01',
+                                 rng.normal(size=(1,model_size)))
+                  for name in output_names]
+    model = PersonalMeasurementFunction(models, output_names, 'AB01')
+
+    directory = str(tmp_path / 'model')
+    model_artifact.save_measurement_function(model, directory)
+    loaded = model_artifact.load_measurement_function(directory)
+
+    assert loaded.output_names == output_names
+    assert loaded.subject_name == 'AB01'
+    np.testing.assert_array_equal(loaded.evaluate(test_states),
+                                  model.evaluate(test_states))
+
+    if model_type == 'personal':
+        for loaded_model, saved_model in zip(loaded.kmodels, models):
+            #Memory mapped from the file
+            assert isinstance(loaded_model.pmap, np.memmap)
+            np.testing.assert_array_equal(loaded_model.pmap, saved_model.pmap)
+            np.testing.assert_array_equal(loaded_model.optimal_fit,
+                                          saved_model.optimal_fit)
+
+
+def test_newer_version_is_rejected(tmp_path):
+    directory = str(tmp_path / 'model')
+    model_artifact.save_artifact(directory, {'a': np.zeros(3)}, basis_list)
+
+    header_file_name = os.path.join(directory, model_artifact.HEADER_FILE_NAME)
+    with open(header_file_name) as header_file:
+        header = json.load(header_file)
+    header['format version'] = model_artifact.ARTIFACT_VERSION + 1
+    with open(header_file_name, 'w') as header_file:
+        json.dump(header, header_file)
+
+    with pytest.raises(ValueError):
+        model_artifact.ModelArtifact(directory)
+
+
+def test_load_models_reads_artifact(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_models, 'save_location', str(tmp_path) + '/')
+    load_models.clear_model_cache()
+
+    num_subjects = 4
+    model_fits = [rng.normal(size=(1,model_size)) for _ in range(num_subjects)]
+    RTR_list = [np.eye(model_size)*(i+1) for i in range(num_subjects)]
+    num_datapoints_list = [100]*num_subjects
+
+    #The old pickle has different fits so that we know which one is used
+    with open(str(tmp_path / (output_names[0] + "_optimal.p")), 'wb') \
+            as save_file:
+        pickle.dump({"model fits": [fit + 1 for fit in model_fits],
+                     "RTR list": RTR_list,
+                     "num datapoints list": num_datapoints_list,
+                     "basis list": basis_list}, save_file)
+
+    pickle_model = load_models.load_simple_models(output_names[0], "AB02")
+    np.testing.assert_array_equal(pickle_model.model_fit, model_fits[1] + 1)
+
+    model_artifact.save_optimal_fits(
+        str(tmp_path / (output_names[0] + "_optimal")), output_names[0],
+        basis_list, [f'AB{i+1:02}' for i in range(num_subjects)], model_fits,
+        RTR_list, num_datapoints_list, residual_list=[0.1]*num_subjects)
+
+    #The artifact is preferred over the pickle file
+    subject_model = load_models.load_simple_models(output_names[0], "AB02")
+    np.testing.assert_array_equal(subject_model.model_fit, model_fits[1])
+    assert isinstance(subject_model.model_fit, np.memmap)
+    assert [type(basis) for basis in subject_model.basis_list] == \
+        [type(basis) for basis in basis_list]
+
+    average_model = load_models.load_simple_models(output_names[0], "AVG",
+                                                   "AB01")
+    np.testing.assert_allclose(average_model.model_fit,
+                               np.mean(model_fits[1:], axis=0))
+
+    load_models.clear_model_cache()
+
+
+def test_load_optimal_fit_info(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_models, 'save_location', str(tmp_path) + '/')
+
+    #The old pickle file is used if there is no artifact
+    with open(str(tmp_path / (output_names[0] + "_optimal.p")), 'wb') \
+            as save_file:
+        pickle.dump({"model fits": [np.zeros((1,model_size))],
+                     "residual variance list": [1.0, 2.0],
+                     "avg residual variance list": [3.0, 4.0],
+                     "basis list": basis_list}, save_file)
+
+    fit_info = load_models.load_optimal_fit_info(output_names[0])
+    assert fit_info['residual variance list'] == [1.0, 2.0]
+    assert 'residual list' not in fit_info
+
+    model_artifact.save_optimal_fits(
+        str(tmp_path / (output_names[0] + "_optimal")), output_names[0],
+        basis_list, ['AB01', 'AB02'], [np.zeros((1,model_size))]*2,
+        [np.eye(model_size)]*2, [100]*2, residual_list=[0.5, 0.6],
+        residual_variance_list=[0.1, 0.2],
+        avg_residual_variance_list=[0.3, 0.4])
+
+    #The artifact is preferred over the pickle file
+    fit_info = load_models.load_optimal_fit_info(output_names[0])
+    np.testing.assert_array_equal(fit_info['residual list'], [0.5, 0.6])
+    np.testing.assert_array_equal(fit_info['residual variance list'],
+                                  [0.1, 0.2])
+    np.testing.assert_array_equal(fit_info['avg residual variance list'],
+                                  [0.3, 0.4])
+    assert [basis.var_name for basis in fit_info['basis list']] == \
+        [basis.var_name for basis in basis_list]
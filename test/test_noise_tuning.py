@@ -0,0 +1,128 @@
+"""
+This file is meant to test that the noise tuning objective follows the
+filter, that its gradient matches finite differences and that the optimizer
+reduces it
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf_fixtures import TIME_STEP as time_step
+from ekf.replay import replay_ekf
+from ekf.noise_tuning import NoiseSensitivityObjective, tune_noise
+
+import numpy as np
+import pytest
+
+
+measurement_model = ekf_fixtures.create_measurement_model(10,
+    coefficient_scale=0.1)
+
+num_steps = 200
+
+initial_state = np.array([[0.1, 1.0, 1.2, 0.0]]).T
+q_diagonal = np.array([0, 1e-4, 1e-5, 1e-3])
+r_diagonal = np.full(6, 0.05)
+
+
+def generate_trial():
+    return ekf_fixtures.generate_trial(measurement_model, num_steps, 11,
+                                       initial_phase=0.1)
+
+
+def create_filter(q_diagonal=q_diagonal, r_diagonal=r_diagonal,
+                  heteroschedastic_model=False):
+    return ekf_fixtures.create_filter(measurement_model,
+        process_noise=np.diag(q_diagonal),
+        observation_noise=np.diag(r_diagonal), initial_state=initial_state,
+        heteroschedastic_model=heteroschedastic_model,
+        covariance_update='joseph')
+
+
+@pytest.mark.parametrize("heteroschedastic_model", [False, True])
+def test_objective_follows_filter(heteroschedastic_model):
+    state_data, sensor_data = generate_trial()
+    objective = NoiseSensitivityObjective(
+        create_filter(heteroschedastic_model=heteroschedastic_model),
+        sensor_data, time_step)
+
+    #Only the positive entries are tuned
+    assert objective.num_parameters == 3 + 6
+    parameters = objective.get_initial_parameters()
+    value, _ = objective.evaluate(parameters)
+
+    replay_result = replay_ekf(
+        create_filter(heteroschedastic_model=heteroschedastic_model),
+        sensor_data, time_step)
+    np.testing.assert_allclose(objective.states, replay_result.states,
+                               atol=1e-8)
+
+    #Mean negative log likelihood of the innovations of the filter
+    ekf = create_filter(heteroschedastic_model=heteroschedastic_model)
+    expected_value = 0
+    for measurement in sensor_data:
+        R = ekf.R_h if (ekf.x[0] > 0.95 or ekf.x[0] < 0.05) \
+            and heteroschedastic_model else ekf.R
+        ekf.calculate_next_estimates(time_step, measurement.reshape(-1,1))
+        H = measurement_model.evaluate_h_and_dh_func(ekf.predicted_state)[1]
+        S = H @ ekf.predicted_covariance @ H.T + R
+        y = ekf.y_tilde[:,0]
+        expected_value += 0.5*(np.linalg.slogdet(S)[1]
+                               + y @ np.linalg.solve(S, y)
+                               + 6*np.log(2*np.pi))
+    np.testing.assert_allclose(value, expected_value/num_steps, rtol=1e-8)
+
+
+@pytest.mark.parametrize("objective_name", ['nll', 'state_error'])
+def test_gradient(objective_name):
+    state_data, sensor_data = generate_trial()
+    objective = NoiseSensitivityObjective(create_filter(heteroschedastic_model=
+                                                        True),
+                                          sensor_data, time_step, state_data,
+                                          objective=objective_name,
+                                          score_start_index=20)
+    parameters = objective.get_initial_parameters() \
+        + np.random.default_rng(0).normal(scale=0.3,
+                                          size=objective.num_parameters)
+    _, gradient = objective.evaluate(parameters)
+
+    #Central finite differences
+    step = 1e-5
+    expected_gradient = np.empty(objective.num_parameters)
+    for i in range(objective.num_parameters):
+        offset = np.zeros(objective.num_parameters)
+        offset[i] = step
+        expected_gradient[i] = (objective.evaluate(parameters + offset)[0]
+                                - objective.evaluate(parameters - offset)[0])\
+            / (2*step)
+
+    np.testing.assert_allclose(gradient, expected_gradient, rtol=1e-4,
+                               atol=1e-7)
+
+
+def test_tune_noise():
+    state_data, sensor_data = generate_trial()
+
+    #Start with an observation noise that is too large
+    ekf = create_filter(r_diagonal=np.full(6, 1.0))
+    result = tune_noise(ekf, sensor_data, time_step, max_iterations=20,
+                        log_bounds=(-20, 5))
+
+    assert result.value < result.initial_value
+    assert result.q_diagonal[0] == 0
+    assert np.all(result.r_diagonal < 1.0)
+
+    #The filter is not modified
+    np.testing.assert_array_equal(np.diag(ekf.R), np.full(6, 1.0))
+
+
+def test_invalid_arguments():
+    state_data, sensor_data = generate_trial()
+
+    with pytest.raises(ValueError):
+        NoiseSensitivityObjective(create_filter(), sensor_data, time_step,
+                                  objective='state_error')
+
+    ekf = create_filter()
+    ekf.R = ekf.R + 0.01
+    with pytest.raises(ValueError):
+        NoiseSensitivityObjective(ekf, sensor_data, time_step)
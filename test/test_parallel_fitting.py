@@ -0,0 +1,88 @@
+"""
+This file is meant to test that the parallel fitting driver is bit for bit 
+the same as the serial fitting
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+from model_fitting.k_model_fitting import KModelFitter
+from model_fitting.parallel_fitting import ParallelKModelFitter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+basis_list = [FourierBasis(3,'phase'), PolynomialBasis(2,'phase_dot'),
+              PolynomialBasis(3,'ramp')]
+k_model = KroneckerModel(basis_list)
+output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+
+
+def create_subject_data(seed, num_datapoints=500):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'phase': rng.uniform(0,1,num_datapoints),
+                         'phase_dot': rng.uniform(0.6,1.4,num_datapoints),
+                         'ramp': rng.uniform(-10,10,num_datapoints),
+                         'jointangles_thigh_x': rng.normal(size=num_datapoints),
+                         'jointangles_knee_x': rng.normal(size=num_datapoints),
+                         'weight': rng.uniform(0.5,2,num_datapoints)})
+
+
+subject_data_list = [(f'AB{i:02}', create_subject_data(i)) 
+                     for i in range(1,5)]
+
+
+@pytest.mark.parametrize("num_processes", [1, 2])
+@pytest.mark.parametrize("l2_lambda", [0.0, [0.5, 2.0]])
+def test_parallel_matches_serial(num_processes, l2_lambda):
+    parallel_fitter = ParallelKModelFitter(num_processes, data_splits=7)
+    results = parallel_fitter.fit_subjects(k_model, subject_data_list, 
+                                           output_names, l2_lambda, 
+                                           weight_col='weight')
+    assert len(results) == len(subject_data_list)
+
+    serial_fitter = KModelFitter()
+    for (_, subject_data), (fits, (residuals, RTR, num_datapoints)) \
+            in zip(subject_data_list, results):
+        expected_fits, (expected_residuals, expected_RTR, 
+                        expected_datapoints) = \
+            serial_fitter.fit_data_multi(k_model, subject_data, output_names,
+                                         data_splits=7, l2_lambda=l2_lambda,
+                                         weight_col='weight')
+
+        np.testing.assert_array_equal(fits, expected_fits)
+        np.testing.assert_array_equal(residuals, expected_residuals)
+        np.testing.assert_array_equal(RTR, expected_RTR)
+        assert num_datapoints == expected_datapoints
+
+
+def test_parquet_sources_and_merge(tmp_path):
+    file_list = []
+    for subject_name, subject_data in subject_data_list:
+        file_path = str(tmp_path/f'{subject_name}.parquet')
+        subject_data.to_parquet(file_path, row_group_size=100)
+        file_list.append((subject_name, file_path))
+
+    parallel_fitter = ParallelKModelFitter(2, batch_size=64)
+    accumulators = parallel_fitter.calculate_regressors(k_model, file_list,
+                                                        output_names)
+
+    serial_fitter = KModelFitter()
+    for (_, file_path), accumulator in zip(file_list, accumulators):
+        expected_fits, _ = serial_fitter.fit_parquet(k_model, file_path, 
+                                                     output_names, 
+                                                     batch_size=64)
+        fits, _ = serial_fitter.fit_accumulator(accumulator)
+        np.testing.assert_array_equal(fits, expected_fits)
+
+    #Ordered reduction of the gram matrices without modifying the inputs
+    first_RTR = accumulators[0].RTR.copy()
+    merged = ParallelKModelFitter.merge_accumulators(accumulators)
+    expected_RTR = 0
+    for accumulator in accumulators:
+        expected_RTR += accumulator.RTR
+    np.testing.assert_array_equal(merged.RTR, expected_RTR)
+    np.testing.assert_array_equal(accumulators[0].RTR, first_RTR)
+    assert merged.num_datapoints == 4*500
@@ -0,0 +1,87 @@
+"""
+This file is meant to test the positive definite check policies and the 
+covariance repair in math_utils
+"""
+
+from context import model_definition
+import utils.math_utils as math_utils
+
+import numpy as np
+import pytest
+
+
+pd_matrix = np.array([[2.0, 0.5], [0.5, 1.0]])
+not_pd_matrix = np.array([[1.0, 2.0], [2.0, 1.0]])
+not_symmetric_matrix = np.array([[1.0, 0.5], [0.0, 1.0]])
+
+
+@pytest.fixture(autouse=True)
+def reset_policy():
+    math_utils.reset_pd_check_counters()
+    yield
+    math_utils.set_pd_check_policy(math_utils.PD_CHECK_ON_FAILURE, 100)
+    math_utils.reset_pd_check_counters()
+
+
+@pytest.mark.parametrize("policy", ['on_failure', 'full'])
+def test_check_pd(policy):
+    math_utils.set_pd_check_policy(policy)
+
+    assert math_utils.check_pd(pd_matrix, "test")
+    assert not math_utils.check_pd(not_pd_matrix, "test")
+    assert not math_utils.check_pd(not_symmetric_matrix, "test")
+
+    with pytest.raises(AssertionError):
+        math_utils.assert_pd(not_pd_matrix, "test")
+
+    counter = math_utils.get_pd_check_counters()["test"]
+    assert counter['calls'] == 4
+    assert counter['checks'] == 4
+    assert counter['failures'] == 3
+
+    #The cholesky check only runs the eigenvalue check on a failure
+    if policy == 'on_failure':
+        assert counter['full_checks'] == 3
+    else:
+        assert counter['full_checks'] == 4
+
+
+def test_off_and_every_n():
+    math_utils.set_pd_check_policy('off')
+    assert math_utils.check_pd(not_pd_matrix, "off")
+    assert math_utils.get_pd_check_counters()["off"]['checks'] == 0
+
+    math_utils.set_pd_check_policy('every_n', interval=3)
+    results = [math_utils.check_pd(not_pd_matrix, "every_n") 
+               for _ in range(7)]
+    assert results == [False, True, True, False, True, True, False]
+    assert math_utils.get_pd_check_counters()["every_n"]['checks'] == 3
+
+    with pytest.raises(ValueError):
+        math_utils.set_pd_check_policy('sometimes')
+
+
+def test_check_pd_stack():
+    stack = np.stack([pd_matrix, not_pd_matrix, pd_matrix])
+    np.testing.assert_array_equal(math_utils.check_pd(stack, "stack"),
+                                  [True, False, True])
+
+    with pytest.raises(AssertionError):
+        math_utils.assert_pd_batch(stack, "stack")
+
+    math_utils.assert_pd_batch(stack[[0,2]], "stack")
+
+
+def test_nearest_pd():
+    repaired = math_utils.nearest_pd(not_pd_matrix, "repair")
+    np.testing.assert_allclose(repaired, repaired.T)
+    assert np.linalg.eigvalsh(repaired).min() > 0
+    assert math_utils.check_pd(repaired)
+    assert math_utils.get_pd_check_counters()["repair"]['repairs'] == 1
+
+    #PD matrices are not modified
+    np.testing.assert_allclose(math_utils.nearest_pd(pd_matrix), pd_matrix)
+
+    #Stacks are repaired per matrix
+    stack = math_utils.nearest_pd(np.stack([pd_matrix, not_pd_matrix]))
+    np.testing.assert_allclose(stack[1], repaired)
@@ -0,0 +1,62 @@
+"""
+This file is meant to test that the fused evaluation of the personal 
+measurement function matches evaluating every model separately
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.fitted_model import SimpleFitModel, PersonalKModel
+from model_definition.personal_measurement_function import \
+    PersonalMeasurementFunction
+
+import numpy as np
+
+
+basis_list = [FourierBasis(5,'phase'), PolynomialBasis(2,'phase_dot'),
+              PolynomialBasis(2,'stride_length'), PolynomialBasis(3,'ramp')]
+output_size = np.prod([basis.size for basis in basis_list])
+output_names = ['jointangles_thigh_x', 'jointangles_shank_x', 
+                'jointangles_foot_x']
+
+rng = np.random.default_rng(1)
+input_data = np.column_stack([rng.uniform(0,1,100), rng.uniform(0.6,1.4,100),
+                              rng.uniform(0.8,1.6,100), rng.uniform(-10,10,100)])
+
+
+def test_simple_fit_models():
+    models = [SimpleFitModel(basis_list, rng.normal(size=(1,output_size)), name)
+              for name in output_names]
+    function = PersonalMeasurementFunction(models, output_names, 'AB01')
+
+    expected = np.concatenate([model.evaluate(input_data) for model in models],
+                              axis=1)
+    np.testing.assert_allclose(function.evaluate(input_data), expected)
+
+    #Evaluate into a caller-supplied buffer
+    out = np.empty((100, len(models)))
+    result = function.evaluate(input_data, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, expected)
+
+
+def test_personal_k_models():
+    num_gf = 2
+    models = [PersonalKModel(basis_list, name, 
+                             rng.normal(size=(1,output_size)),
+                             rng.normal(size=(num_gf,output_size)),
+                             rng.normal(size=(1,num_gf)), 'AB01')
+              for name in output_names]
+    function = PersonalMeasurementFunction(models, output_names, 'AB01')
+
+    kronecker_output = models[0].get_kronecker_output(input_data)
+    expected = np.concatenate(
+        [kronecker_output @ (model.average_fit + 
+                             model.subject_gait_fingerprint @ model.pmap).T
+         for model in models], axis=1)
+    np.testing.assert_allclose(function.evaluate(input_data), expected)
+
+    #Changing the personalization map requires restacking the fits
+    models[0].set_pmap(np.zeros((num_gf,output_size)))
+    function.update_model_fits()
+    np.testing.assert_allclose(function.evaluate(input_data)[:,0],
+                               (kronecker_output @ models[0].average_fit.T)[:,0])
@@ -0,0 +1,183 @@
+"""
+This file is meant to test that the real time extended kalman filter gives
+the same estimates as the regular filter, that it reports the step latency
+and that the degraded path reuses the jacobean
+"""
+
+from context import model_definition
+from ekf_fixtures import TIME_STEP as time_step, create_measurement_model, \
+    generate_trial, create_filter
+from ekf.dynamic_model import GaitDynamicModel
+from ekf.ekf import Extended_Kalman_Filter
+from ekf.realtime_ekf import RealTimeExtendedKalmanFilter, replay_latency
+import utils.math_utils as math_utils
+
+import numpy as np
+import pytest
+
+
+measurement_model = create_measurement_model(6)
+
+num_steps = 300
+
+_, measurements = generate_trial(measurement_model, num_steps, 7)
+
+
+@pytest.mark.parametrize("heteroschedastic_model", [True, False])
+@pytest.mark.parametrize("covariance_update", ['standard', 'joseph'])
+def test_matches_filter(heteroschedastic_model, covariance_update):
+    expected_filter = create_filter(measurement_model, Extended_Kalman_Filter,
+        heteroschedastic_model=heteroschedastic_model,
+        covariance_update=covariance_update)
+    #An infinite deadline never uses the degraded path
+    test_filter = create_filter(measurement_model,
+        RealTimeExtendedKalmanFilter,
+        heteroschedastic_model=heteroschedastic_model,
+        covariance_update=covariance_update, deadline=np.inf)
+
+    for measurement in measurements:
+        expected_state, expected_covariance = \
+            expected_filter.calculate_next_estimates(time_step,
+                                                     measurement[:,None])
+        state, covariance = \
+            test_filter.calculate_next_estimates(time_step,
+                                                 measurement[:,None])
+
+        np.testing.assert_allclose(state, expected_state,
+                                   rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(covariance, expected_covariance,
+                                   rtol=1e-10, atol=1e-14)
+
+    #The estimates are written into the same buffers every step
+    assert state is test_filter.x
+    assert covariance is test_filter.P
+
+    report = test_filter.get_latency_report()
+    assert report.num_steps == num_steps
+    assert report.deadline_misses == 0
+    assert report.degraded_steps == 0
+    assert report.meets_deadline()
+
+
+@pytest.mark.parametrize("max_jacobean_age", [0, 1, 4])
+def test_degraded_path(max_jacobean_age):
+    #Every step runs out of time
+    test_filter = create_filter(measurement_model,
+                                RealTimeExtendedKalmanFilter, deadline=1e-12,
+                                max_jacobean_age=max_jacobean_age)
+
+    report = replay_latency(test_filter, measurements, time_step)
+
+    #The jacobean is calculated once and then reused max_jacobean_age times
+    num_full_steps = int(np.ceil(num_steps/(max_jacobean_age + 1)))
+    assert report.degraded_steps == num_steps - num_full_steps
+    assert report.deadline_misses == num_steps
+    assert not report.meets_deadline()
+    assert test_filter.deadline_missed
+    assert np.all(np.isfinite(test_filter.x))
+
+
+def test_degraded_step_reuses_jacobean():
+    test_filter = create_filter(measurement_model,
+                                RealTimeExtendedKalmanFilter,
+                                max_jacobean_age=1)
+
+    test_filter.calculate_next_estimates(time_step, measurements[0][:,None])
+    previous_H = test_filter.H.copy()
+    assert not test_filter.degraded
+
+    #Force the next step to run out of time
+    test_filter.deadline = 1e-12
+    test_filter.calculate_next_estimates(time_step, measurements[1][:,None])
+    assert test_filter.degraded
+    np.testing.assert_array_equal(test_filter.H, previous_H)
+
+
+def test_latency_report():
+    test_filter = create_filter(measurement_model,
+                                RealTimeExtendedKalmanFilter,
+                                latency_history=64)
+
+    report = replay_latency(test_filter, measurements, time_step,
+                            warmup_steps=100)
+
+    assert report.num_steps == num_steps - 100
+    assert 0 < report.mean <= report.worst_case
+    assert report.p99 <= report.worst_case
+    assert report.deadline == 1/150
+
+
+class StateDependentDynamicModel(GaitDynamicModel):
+    """
+    Dynamic model whose jacobean changes with the state
+    """
+    jacobean_depends_on_state = True
+
+    def f_jacobean(self, current_state, time_step):
+        jacobean = super().f_jacobean(current_state, time_step)
+        jacobean[2,2] = 1 + current_state[0,0]
+        return jacobean
+
+
+@pytest.mark.parametrize("dynamic_model_class",
+                         [GaitDynamicModel, StateDependentDynamicModel])
+def test_dynamic_model_jacobean(dynamic_model_class):
+    def create_model_filter(filter_class, **kwargs):
+        return create_filter(measurement_model, filter_class,
+                             dynamic_model=dynamic_model_class(), **kwargs)
+
+    expected_filter = create_model_filter(Extended_Kalman_Filter)
+    test_filter = create_model_filter(RealTimeExtendedKalmanFilter,
+                                      deadline=np.inf)
+
+    #The time step does not change, so F is only reused if it does not
+    # depend on the state
+    for measurement in measurements[:20]:
+        expected_state, _ = expected_filter.calculate_next_estimates(
+            time_step, measurement[:,None])
+        state, _ = test_filter.calculate_next_estimates(
+            time_step, measurement[:,None])
+        np.testing.assert_allclose(state, expected_state, rtol=1e-10,
+                                   atol=1e-12)
+
+
+def test_square_root_not_supported():
+    with pytest.raises(ValueError):
+        create_filter(measurement_model, RealTimeExtendedKalmanFilter,
+                      covariance_update='square_root')
+
+
+def test_innovation_covariance_not_pd():
+    #Process noise that makes the predicted covariance and S not positive
+    # definite
+    measurement = measurements[0][:,None]
+
+    def create_bad_filter(filter_class, **kwargs):
+        return create_filter(measurement_model, filter_class,
+                             process_noise=-np.eye(4),
+                             lower_state_limit=None, upper_state_limit=None,
+                             **kwargs)
+
+    #S is repaired the same way as the base filter
+    expected_state, expected_covariance = \
+        create_bad_filter(Extended_Kalman_Filter, repair_covariance=True)\
+        .calculate_next_estimates(time_step, measurement)
+    state, covariance = \
+        create_bad_filter(RealTimeExtendedKalmanFilter, deadline=np.inf,
+                          repair_covariance=True)\
+        .calculate_next_estimates(time_step, measurement)
+    np.testing.assert_allclose(state, expected_state, rtol=1e-8)
+    np.testing.assert_allclose(covariance, expected_covariance, rtol=1e-8,
+                               atol=1e-12)
+
+    #Without the check, the factorization failure is raised as a failed
+    # check
+    math_utils.set_pd_check_policy(math_utils.PD_CHECK_OFF)
+    try:
+        for filter_class in [Extended_Kalman_Filter,
+                             RealTimeExtendedKalmanFilter]:
+            with pytest.raises(AssertionError):
+                create_bad_filter(filter_class)\
+                    .calculate_next_estimates(time_step, measurement)
+    finally:
+        math_utils.set_pd_check_policy(math_utils.PD_CHECK_ON_FAILURE)
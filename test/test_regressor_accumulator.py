@@ -0,0 +1,135 @@
+"""
+This file is meant to test that the streaming regressor accumulation 
+matches the least squares fit of the whole dataset
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+from model_fitting.k_model_fitting import KModelFitter, \
+    RegressorAccumulator, iterate_parquet_chunks
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+basis_list = [FourierBasis(3,'phase'), PolynomialBasis(2,'phase_dot'),
+              PolynomialBasis(3,'ramp')]
+k_model = KroneckerModel(basis_list)
+
+rng = np.random.default_rng(4)
+num_datapoints = 1000
+data = pd.DataFrame({'phase': rng.uniform(0,1,num_datapoints),
+                     'phase_dot': rng.uniform(0.6,1.4,num_datapoints),
+                     'ramp': rng.uniform(-10,10,num_datapoints),
+                     'jointangles_thigh_x': rng.normal(size=num_datapoints),
+                     'jointangles_knee_x': rng.normal(size=num_datapoints),
+                     'weight': rng.uniform(0.5,2,num_datapoints),
+                     'unused': rng.normal(size=num_datapoints)})
+
+
+def expected_regressor(weight_col=None):
+    R = k_model.evaluate(data[['phase','phase_dot','ramp']].values)
+    y = data['jointangles_thigh_x'].values.reshape(-1,1)
+    W = np.ones((num_datapoints,1)) if weight_col is None \
+        else data[weight_col].values.reshape(-1,1)
+    return R.T @ (R*W), R.T @ (y*W), y.T @ (R*W), y.T @ (y*W)
+
+
+@pytest.mark.parametrize("weight_col", [None, 'weight'])
+def test_chunked_accumulation(weight_col):
+    expected = expected_regressor(weight_col)
+
+    #Dataframe chunks
+    regressor = KModelFitter().calculate_regressor(k_model, data, 
+        'jointangles_thigh_x', data_splits=7, weight_col=weight_col)
+    for result, expected_result in zip(regressor, expected):
+        np.testing.assert_allclose(result, expected_result)
+
+    #Column array chunks
+    accumulator = RegressorAccumulator(k_model, 'jointangles_thigh_x', 
+                                       weight_col)
+    chunks = ({name: data[name].values[i:i+128] 
+               for name in accumulator.get_required_columns()}
+              for i in range(0, num_datapoints, 128))
+    accumulator.update_from_chunks(chunks)
+    assert accumulator.num_datapoints == num_datapoints
+    for result, expected_result in zip(accumulator.get_regressor(), expected):
+        np.testing.assert_allclose(result, expected_result)
+
+
+def test_merge():
+    first = RegressorAccumulator(k_model, 'jointangles_thigh_x')
+    second = RegressorAccumulator(k_model, 'jointangles_thigh_x')
+    first.update(data.iloc[:300])
+    second.update(data.iloc[300:])
+
+    merged = first.merge(second)
+    assert merged.num_datapoints == num_datapoints
+    for result, expected_result in zip(merged.get_regressor(), 
+                                       expected_regressor()):
+        np.testing.assert_allclose(result, expected_result)
+
+    with pytest.raises(ValueError):
+        first.merge(RegressorAccumulator(KroneckerModel(basis_list[:2]),
+                                         'jointangles_thigh_x'))
+
+
+def test_fit_parquet(tmp_path):
+    file_path = str(tmp_path/'data.parquet')
+    data.to_parquet(file_path, row_group_size=256)
+
+    chunks = list(iterate_parquet_chunks(file_path, ['phase','ramp']))
+    assert len(chunks) == 4
+    assert set(chunks[0].keys()) == {'phase', 'ramp'}
+
+    fitter = KModelFitter()
+    expected_fit, (expected_residual, _, _) = \
+        fitter.fit_data(k_model, data, 'jointangles_thigh_x', l2_lambda=0.1)
+
+    for batch_size in [None, 100]:
+        fit, (residual, _, fit_datapoints) = fitter.fit_parquet(k_model,
+            [file_path], 'jointangles_thigh_x', l2_lambda=0.1, 
+            batch_size=batch_size)
+        assert fit_datapoints == num_datapoints
+        np.testing.assert_allclose(fit, expected_fit)
+        np.testing.assert_allclose(residual, expected_residual)
+
+
+@pytest.mark.parametrize("weight_col", [None, 'weight'])
+def test_multi_output_regressor(weight_col):
+    output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+    fitter = KModelFitter()
+
+    RTR, RTY, YTR, YTY = fitter.calculate_regressor_multi(k_model, data,
+        output_names, data_splits=5, weight_col=weight_col)
+    assert RTY.shape == (k_model.get_output_size(), 2)
+    assert YTY.shape == (2, 2)
+
+    for j, output_name in enumerate(output_names):
+        RTR_j, RTy_j, yTR_j, yTy_j = fitter.calculate_regressor(k_model, data,
+            output_name, data_splits=5, weight_col=weight_col)
+        np.testing.assert_allclose(RTR, RTR_j)
+        np.testing.assert_allclose(RTY[:,[j]], RTy_j)
+        np.testing.assert_allclose(YTR[[j]], yTR_j)
+        np.testing.assert_allclose(YTY[j,j], yTy_j[0,0])
+
+
+@pytest.mark.parametrize("l2_lambda", [0.0, [0.1, 1.0]])
+def test_fit_data_multi(l2_lambda):
+    output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+    fitter = KModelFitter()
+
+    fits, (residuals, _, fit_datapoints) = fitter.fit_data_multi(k_model, 
+        data, output_names, l2_lambda=l2_lambda)
+    assert fits.shape == (2, k_model.get_output_size())
+    assert fit_datapoints == num_datapoints
+
+    for j, output_name in enumerate(output_names):
+        l2_lambda_j = l2_lambda[j] if isinstance(l2_lambda, list) \
+            else l2_lambda
+        fit, (residual, _, _) = fitter.fit_data(k_model, data, output_name,
+                                                l2_lambda=l2_lambda_j)
+        np.testing.assert_allclose(fits[[j]], fit)
+        np.testing.assert_allclose(residuals[j], residual[0,0])
@@ -0,0 +1,87 @@
+"""
+This file is meant to test that the regularization path gives the same fits 
+as solving the regularized least squares problem for every lambda
+"""
+
+from context import model_definition
+from model_definition.function_bases import FourierBasis, PolynomialBasis
+from model_definition.k_model import KroneckerModel
+from model_fitting.k_model_fitting import KModelFitter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+basis_list = [FourierBasis(4,'phase'), PolynomialBasis(3,'phase_dot')]
+k_model = KroneckerModel(basis_list)
+output_names = ['jointangles_thigh_x', 'jointangles_knee_x']
+
+rng = np.random.default_rng(0)
+num_datapoints = 400
+phase = rng.uniform(0,1,num_datapoints)
+phase_dot = rng.uniform(0.6,1.4,num_datapoints)
+data = pd.DataFrame({'phase': phase, 'phase_dot': phase_dot,
+    'jointangles_thigh_x': np.sin(2*np.pi*phase) 
+        + 0.3*rng.normal(size=num_datapoints),
+    'jointangles_knee_x': np.cos(2*np.pi*phase)*phase_dot 
+        + 0.05*rng.normal(size=num_datapoints),
+    'weight': rng.uniform(0.5,2,num_datapoints)})
+
+l2_lambdas = np.array([0.0, 0.01, 1.0, 30.0, 1000.0])
+
+
+@pytest.mark.parametrize("weight_col", [None, 'weight'])
+def test_path_matches_solve(weight_col):
+    fitter = KModelFitter()
+    path = fitter.fit_data_path(k_model, data, output_names, l2_lambdas,
+                                data_splits=4, weight_col=weight_col)
+
+    assert path.model_fits.shape == (len(l2_lambdas), 2, 
+                                     k_model.get_output_size())
+
+    for i, l2_lambda in enumerate(l2_lambdas):
+        fits, (residuals, _, _) = fitter.fit_data_multi(k_model, data,
+            output_names, data_splits=4, l2_lambda=l2_lambda, 
+            weight_col=weight_col)
+        np.testing.assert_allclose(path.model_fits[i], fits, 
+                                   rtol=1e-7, atol=1e-9)
+        np.testing.assert_allclose(path.residuals[i], residuals, rtol=1e-7)
+
+
+def test_single_output():
+    fitter = KModelFitter()
+    path = fitter.fit_data_path(k_model, data, output_names[0], [0.5],
+                                data_splits=4)
+    fit, (residual, _, _) = fitter.fit_data(k_model, data, output_names[0],
+                                            data_splits=4, l2_lambda=0.5)
+    np.testing.assert_allclose(path.model_fits[0], fit, rtol=1e-7, atol=1e-9)
+    np.testing.assert_allclose(path.residuals[0], residual.ravel(), 
+                               rtol=1e-7)
+
+
+def test_gcv_matches_direct_calculation():
+    fitter = KModelFitter()
+    path = fitter.fit_data_path(k_model, data, output_names, l2_lambdas,
+                                data_splits=4)
+
+    #Calculate the hat matrix directly with the data
+    R = k_model.evaluate(data)
+    y = data[output_names].values
+    for i, l2_lambda in enumerate(l2_lambdas):
+        H = R @ np.linalg.solve(R.T @ R + l2_lambda*np.eye(R.shape[1]), R.T)
+        squared_error = ((y - H @ y)**2).sum(axis=0)
+        gcv = num_datapoints * squared_error \
+            / (num_datapoints - np.trace(H))**2
+        np.testing.assert_allclose(path.degrees_of_freedom[i], np.trace(H),
+                                   rtol=1e-7)
+        np.testing.assert_allclose(path.gcv[i], gcv, rtol=1e-6)
+
+    #The noisy output needs more regularization
+    model_fits, (residuals, _, _), best_lambdas = \
+        fitter.fit_data_gcv(k_model, data, output_names, 
+                            np.logspace(-4, 4, 41), data_splits=4)
+    assert best_lambdas[0] > best_lambdas[1]
+    best_index = path.get_best_index()
+    assert best_index.shape == (2,)
+    assert model_fits.shape == (2, k_model.get_output_size())
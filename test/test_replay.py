@@ -0,0 +1,97 @@
+"""
+This file is meant to test that the replay engine stores the same estimates
+as running the filter step by step and that the vectorized rmse matches the
+rmse that is accumulated every step
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf.ekf import Extended_Kalman_Filter
+from ekf.realtime_ekf import RealTimeExtendedKalmanFilter
+from ekf.replay import replay_ekf, phase_distance, calculate_state_rmse
+
+import numpy as np
+import pytest
+
+
+measurement_model = ekf_fixtures.create_measurement_model(8)
+
+num_steps = 400
+
+
+def generate_trial():
+    return ekf_fixtures.generate_trial(measurement_model, num_steps, 9)
+
+
+def create_filter(filter_class=Extended_Kalman_Filter):
+    return ekf_fixtures.create_filter(measurement_model, filter_class,
+        lower_state_limit=None, upper_state_limit=None,
+        heteroschedastic_model=True)
+
+
+@pytest.mark.parametrize("filter_class", [Extended_Kalman_Filter,
+                                          RealTimeExtendedKalmanFilter])
+def test_replay_matches_loop(filter_class):
+    true_states, measurements = generate_trial()
+    time_steps = 1/(150*true_states[:,1])
+    start_index = 101
+
+    #Run the filter step by step, accumulating the errors like simulate_ekf
+    expected_filter = create_filter(filter_class)
+    expected_states = []
+    expected_diagonals = []
+    state_error = np.zeros(4)
+    measurement_error = np.zeros(6)
+    for i in range(num_steps):
+        measurement = measurements[i].reshape(-1,1)
+        state, covariance = expected_filter.calculate_next_estimates(
+            time_steps[i], measurement)
+        expected_states.append(state[:,0].copy())
+        expected_diagonals.append(np.diagonal(covariance).copy())
+
+        if i >= start_index:
+            phase_error = np.abs(state[0,0] - true_states[i,0])
+            phase_error = min(phase_error, 1 - phase_error)
+            state_error[0] += phase_error**2
+            state_error[1:] += (state[1:,0] - true_states[i,1:])**2
+            measurement_error += ((expected_filter.calculated_measurement_
+                                   - measurement)**2)[:,0]
+
+    result = replay_ekf(create_filter(filter_class), measurements, time_steps)
+
+    np.testing.assert_array_equal(result.states, np.stack(expected_states))
+    np.testing.assert_array_equal(result.covariance_diagonals,
+                                  np.stack(expected_diagonals))
+    np.testing.assert_array_equal(result.innovations,
+        measurements - result.predicted_measurements)
+
+    np.testing.assert_allclose(
+        result.get_state_rmse(true_states, start_index, num_steps),
+        np.sqrt(state_error/num_steps))
+    np.testing.assert_allclose(
+        result.get_measurement_rmse(start_index, num_steps),
+        np.sqrt(measurement_error/num_steps))
+
+
+def test_step_callback():
+    _, measurements = generate_trial()
+    steps = []
+
+    replay_ekf(create_filter(), measurements[:10], 1/150,
+               step_callback=lambda i, ekf: steps.append(i))
+
+    assert steps == list(range(10))
+
+
+def test_phase_distance():
+    np.testing.assert_allclose(
+        phase_distance(np.array([0.0, 0.95, 0.3, 0.1]),
+                       np.array([0.0, 0.05, 0.1, 0.9])),
+        [0.0, 0.1, 0.2, 0.2])
+
+    #The extra states of the estimate are ignored
+    estimated_states = np.array([[0.99, 1.0, 5.0], [0.01, 3.0, 5.0]])
+    true_states = np.array([[0.01, 1.0], [0.99, 1.0]])
+    np.testing.assert_allclose(
+        calculate_state_rmse(estimated_states, true_states),
+        [0.02, np.sqrt(2)])
@@ -0,0 +1,58 @@
+"""
+This file is meant to test that the results sinks read back the runs that
+were written
+"""
+
+from context import model_definition
+from utils.results_sink import create_results_sink, SQLiteResultsSink, \
+    ParquetResultsSink
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def create_run(run_id):
+    metadata = {'Experiment': 'Average Model',
+                'Process Model Ramp Noise': 5e-7,
+                'Heteroschedastic Model': True,
+                'Test ID': np.int64(run_id),
+                'Initial Condition': [[0.0], [0.8]]}
+    results = pd.DataFrame({'Subject': ['AB01', 'AB02'],
+                            'Phase RMSE': [0.01, 0.02*run_id],
+                            'Ramp RMSE': [1.5, 2.0]})
+    return metadata, results
+
+
+@pytest.mark.parametrize("file_name", ['results.db', 'results'])
+def test_write_and_read(tmp_path, file_name):
+    sink = create_results_sink(str(tmp_path / file_name))
+    assert isinstance(sink, SQLiteResultsSink if file_name.endswith('.db')
+                      else ParquetResultsSink)
+    assert sink.get_run_ids() == []
+
+    for run_id in [3, 1]:
+        sink.write_run(run_id, *create_run(run_id))
+    assert sink.get_run_ids() == [3, 1]
+
+    metadata, results = sink.read_run(1)
+    expected_metadata, expected_results = create_run(1)
+    assert metadata == {**expected_metadata, 'Test ID': 1}
+    pd.testing.assert_frame_equal(results, expected_results)
+
+    #Writing a run again replaces it
+    _, new_results = create_run(5)
+    sink.write_run(1, metadata, new_results)
+    pd.testing.assert_frame_equal(sink.read_run(1)[1], new_results)
+
+    #The sink can be opened again
+    all_runs = create_results_sink(str(tmp_path / file_name)).read_runs()
+    assert len(all_runs) == 4
+    assert set(all_runs['run_id']) == {1, 3}
+    assert (all_runs['Experiment'] == 'Average Model').all()
+
+
+def test_missing_run(tmp_path):
+    sink = SQLiteResultsSink(str(tmp_path / 'results.db'))
+    with pytest.raises(KeyError):
+        sink.read_run(0)
@@ -0,0 +1,66 @@
+"""
+This file is meant to test that the sweep runner expands the grid, runs the
+jobs in a process pool and skips the jobs that are already in the store
+"""
+
+from context import model_definition
+from utils.sweep_runner import expand_grid, job_hash, run_sweep, \
+    SweepResultStore
+
+import numpy as np
+import pytest
+
+
+def square_job(job):
+    if job['x'] < 0:
+        raise ValueError("negative x")
+    return {'square': job['x']**2, 'label': f"{job['name']}_{job['x']}"}
+
+
+def test_expand_grid():
+    jobs = expand_grid({'name': ['a','b'], 'x': [1, 2, 3]})
+
+    assert len(jobs) == 6
+    assert jobs[0] == {'name': 'a', 'x': 1}
+    assert jobs[-1] == {'name': 'b', 'x': 3}
+
+
+def test_job_hash():
+    #The hash does not depend on the order of the parameters or on the
+    # sequence type
+    assert job_hash({'a': 1, 'b': ((0.0, 1.2),)}) \
+        == job_hash({'b': [[0.0, 1.2]], 'a': 1})
+    assert job_hash({'a': np.int64(1)}) == job_hash({'a': 1})
+    assert job_hash({'a': 1}) != job_hash({'a': 2})
+
+
+@pytest.mark.parametrize("num_processes", [1, 2])
+def test_run_sweep(tmp_path, num_processes):
+    jobs = expand_grid({'name': ['a','b'], 'x': [-1, 1, 2]})
+
+    with SweepResultStore(str(tmp_path / 'sweep.db')) as store:
+        assert run_sweep(square_job, jobs, store,
+                         num_processes=num_processes) == 6
+
+        results = store.to_dataframe()
+        assert len(results) == 4
+        assert set(results['label']) == {'a_1', 'a_2', 'b_1', 'b_2'}
+        assert (results['square'] == results['x']**2).all()
+
+        #The failed jobs are stored with their traceback
+        failed = store.to_dataframe(include_failed=True)
+        failed = failed[failed['error'].notna()]
+        assert list(failed['x']) == [-1, -1]
+        assert 'negative x' in failed['error'].iloc[0]
+
+        #Finished jobs are skipped, failed jobs only run again if requested
+        assert run_sweep(square_job, jobs, store,
+                         num_processes=num_processes) == 0
+        assert run_sweep(square_job, jobs, store, num_processes=num_processes,
+                         retry_failed=True) == 2
+
+    #The results are kept after the store is closed
+    with SweepResultStore(str(tmp_path / 'sweep.db')) as store:
+        assert len(store.get_finished_hashes()) == 6
+        assert run_sweep(square_job, jobs + [{'name': 'c', 'x': 3}],
+                         store, num_processes=num_processes) == 1
@@ -0,0 +1,136 @@
+"""
+This file is meant to test that the successive halving tuner scores the
+candidates like a full replay, drops the worst candidates every round and
+stops the candidates that diverge
+"""
+
+from context import model_definition
+import ekf_fixtures
+from ekf_fixtures import TIME_STEP as time_step
+from ekf.replay import replay_ekf
+from ekf.tuning import successive_halving, get_prefix_lengths
+import utils.math_utils as math_utils
+
+import numpy as np
+import pytest
+
+
+measurement_model = ekf_fixtures.create_measurement_model(10)
+
+num_steps = 600
+
+observation_noise = np.eye(6)*0.01
+
+#The last candidate has a process noise that is not positive definite
+q_diagonals = np.array([[0, 1e-4*scale, 1e-5*scale, 1e-3*scale]
+                        for scale in np.logspace(-3, 3, 8)]
+                       + [[0, -10.0, -10.0, -10.0]])
+
+
+def generate_trial():
+    return ekf_fixtures.generate_trial(measurement_model, num_steps, 11)
+
+
+def create_filter(q_diagonal):
+    return ekf_fixtures.create_filter(measurement_model,
+        process_noise=np.diag(q_diagonal),
+        observation_noise=observation_noise, covariance_update='joseph')
+
+
+def create_batched_filter(q_diagonals):
+    return ekf_fixtures.create_batched_filter(measurement_model,
+        q_diagonals.shape[0],
+        process_noise=np.stack([np.diag(q) for q in q_diagonals]),
+        observation_noise=observation_noise, covariance_update='joseph',
+        repair_covariance=True)
+
+
+def test_prefix_lengths():
+    assert get_prefix_lengths(100, 1000, 3) == [100, 300, 900, 1000]
+    assert get_prefix_lengths(100, 900, 3) == [100, 300, 900]
+    assert get_prefix_lengths(100, 100, 3) == [100]
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_successive_halving(batched):
+    state_data, sensor_data = generate_trial()
+    state_weights = np.array([1.0, 1.0, 1.0, 0.1])
+
+    if batched:
+        factory = {'create_batched_filter': create_batched_filter}
+    else:
+        factory = {'create_filter': create_filter}
+
+    result = successive_halving(state_data, sensor_data, time_step,
+                                q_diagonals, min_steps=60,
+                                reduction_factor=3, rmse_start_index=30,
+                                state_weights=state_weights,
+                                check_interval=50, **factory)
+
+    #The prefixes are 60, 180, 540 and 600 steps
+    assert [prefix for prefix, _ in result.rounds] == [60, 180, 540, 600]
+
+    #The candidate that is not positive definite is stopped in the first
+    # check. The batched filter checks every step
+    assert result.diverged[-1]
+    assert result.steps_run[-1] == (1 if batched else 50)
+    assert result.scores[-1] == np.inf
+    assert not np.any(result.diverged[:-1])
+
+    #One third of the candidates continue every round
+    assert [len(candidates) for _, candidates in result.rounds] \
+        == [8, 3, 1, 1]
+    best_index = result.best_index
+    assert result.steps_run[best_index] == num_steps
+    np.testing.assert_array_equal(result.best_q_diagonal,
+                                  q_diagonals[best_index])
+
+    #The final score is the same as replaying the whole trial
+    replay_result = replay_ekf(create_filter(q_diagonals[best_index]),
+                               sensor_data, time_step)
+    expected_rmse = replay_result.get_state_rmse(state_data, 30)
+    np.testing.assert_allclose(result.rmse[best_index], expected_rmse,
+                               rtol=1e-6)
+    np.testing.assert_allclose(result.scores[best_index],
+                               expected_rmse @ state_weights, rtol=1e-6)
+
+    #Every candidate is in the dataframe
+    dataframe = result.to_dataframe()
+    assert len(dataframe) == q_diagonals.shape[0]
+    assert dataframe['diverged'].sum() == 1
+
+
+def test_max_state_error():
+    state_data, sensor_data = generate_trial()
+
+    #Every candidate is too far from the ground truth
+    result = successive_halving(state_data, sensor_data, time_step,
+                                q_diagonals[:2], create_filter=create_filter,
+                                min_steps=60, check_interval=20,
+                                max_state_error=np.zeros(4))
+
+    assert np.all(result.diverged)
+    assert np.all(result.steps_run == 20)
+
+
+def test_invalid_arguments():
+    state_data, sensor_data = generate_trial()
+
+    with pytest.raises(ValueError):
+        successive_halving(state_data, sensor_data, time_step, q_diagonals)
+
+    with pytest.raises(ValueError):
+        successive_halving(state_data, sensor_data, time_step, q_diagonals,
+                           create_filter=create_filter, min_steps=60,
+                           rmse_start_index=60)
+
+    #The batched candidates are only stopped if every step is checked
+    math_utils.set_pd_check_policy(math_utils.PD_CHECK_EVERY_N)
+    try:
+        with pytest.raises(ValueError):
+            successive_halving(state_data, sensor_data, time_step,
+                               q_diagonals,
+                               create_batched_filter=create_batched_filter,
+                               min_steps=60)
+    finally:
+        math_utils.set_pd_check_policy(math_utils.PD_CHECK_ON_FAILURE)
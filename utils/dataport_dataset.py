@@ -0,0 +1,526 @@
+"""
+This file implements a columnar loader for the flattened dataport parquet
+files in data/flattened_dataport/{training,validation}
+
+Only the requested columns are read and they are stored as one read only
+numpy array per file. (ramp, speed) conditions are pushed down to pyarrow so
+that only the row groups of the requested conditions are read. The loaded
+arrays are kept in a least recently used cache so that scripts that loop over
+many conditions only read every subject file once
+
+E.g.
+    dataset = DataportDataset()
+    data = dataset.load('AB01', 'training', ['phase','jointangles_foot_x'])
+    foot_angle = data['jointangles_foot_x']
+    level_ground = data.select_conditions([(0.0, 1.2)], num_steps=10)
+"""
+
+#Common imports
+import os
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+#For docstring
+from typing import Dict, List, Sequence, Tuple
+
+
+#Default location of the flattened dataport files
+DATAPORT_LOCATION = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                    '../data/flattened_dataport/'))
+
+#File name of every split, relative to the dataport location
+SPLIT_FILE_NAMES = {
+    'training': "training/dataport_flattened_training_{}.parquet",
+    'validation': "validation/dataport_flattened_validation_{}.parquet",
+    'partial': "dataport_flattened_partial_{}.parquet"}
+
+#Columns that define a condition
+CONDITION_COLUMNS = ['ramp', 'speed']
+
+#Number of datapoints per step in the flattened dataport
+POINTS_PER_STEP = 150
+
+#Type hint for a list of (ramp, speed) tuples
+ConditionList = Sequence[Tuple[float, float]]
+
+
+def _read_only(array:np.ndarray) -> np.ndarray:
+    """
+    Mark an array that is shared through the cache as read only
+    """
+    array.flags.writeable = False
+    return array
+
+
+def _group_condition_rows(ramp:np.ndarray, speed:np.ndarray) \
+        -> Dict[Tuple[float,float], np.ndarray]:
+    """
+    Returns the index of the rows of every (ramp, speed) condition, in file
+    order. The rows are grouped with one stable sort instead of comparing 
+    all the rows for every condition
+    """
+    conditions, condition_id = np.unique(np.column_stack([ramp, speed]), 
+                                         axis=0, return_inverse=True)
+    condition_id = condition_id.ravel()
+
+    #Rows of the same condition are contiguous after the sort
+    sorted_rows = np.argsort(condition_id, kind='stable')
+    boundaries = np.cumsum(np.bincount(condition_id,
+                                       minlength=len(conditions)))[:-1]
+
+    return {(float(condition_ramp), float(condition_speed)): rows
+            for (condition_ramp, condition_speed), rows
+            in zip(conditions, np.split(sorted_rows, boundaries))}
+
+
+class DataportArrays():
+    """
+    This class stores some of the columns of a dataport file as one read
+    only numpy array, with one contiguous column per name
+    """
+
+    def __init__(self, columns:List[str], values:np.ndarray,
+                 ramp:np.ndarray=None, speed:np.ndarray=None):
+        """
+        Keyword Arguments:
+        columns -- name of every column
+        values -- numpy array with shape (num_datapoints, num_columns)
+        ramp -- ramp of every row, used to select conditions
+        speed -- speed of every row, used to select conditions
+        """
+        self.columns = list(columns)
+        self.values = _read_only(values)
+        self._column_index = {name:i for i,name in enumerate(self.columns)}
+
+        #The index from conditions to rows is calculated when it is needed
+        self._ramp = ramp
+        self._speed = speed
+        self._condition_rows = None
+
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+
+    def __getitem__(self, name):
+        """
+        Returns a view of a column, or a copy of several columns in the
+        order of the list
+        """
+        if isinstance(name, str):
+            return self.values[:, self._column_index[name]]
+
+        return self.values[:, [self._column_index[column]
+                               for column in name]]
+
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Returns a pandas dataframe that shares memory with the arrays
+        """
+        return pd.DataFrame(self.values, columns=self.columns, copy=False)
+
+
+    def get_condition_rows(self, ramp:float, speed:float) -> np.ndarray:
+        """
+        Returns the index of the rows of a condition, in file order
+        """
+        if self._condition_rows is None:
+            if self._ramp is None or self._speed is None:
+                raise ValueError("The ramp and speed were not loaded")
+
+            self._condition_rows = _group_condition_rows(self._ramp,
+                                                         self._speed)
+
+        return self._condition_rows.get((float(ramp), float(speed)),
+                                        np.empty(0, dtype=np.intp))
+
+
+    def get_rows(self, conditions:ConditionList,
+                 num_steps:int=None) -> np.ndarray:
+        """
+        Returns the index of the rows of every condition, concatenated in the
+        order of the conditions
+
+        Keyword Arguments:
+        conditions -- list of (ramp, speed) tuples
+        num_steps -- if defined, only the first num_steps steps of every
+            condition are used
+        """
+        row_list = [self.get_condition_rows(ramp, speed)
+                    for ramp, speed in conditions]
+
+        if num_steps is not None:
+            row_list = [rows[:num_steps*POINTS_PER_STEP]
+                        for rows in row_list]
+
+        return np.concatenate(row_list) if len(row_list) > 0 \
+            else np.empty(0, dtype=np.intp)
+
+
+    def select_conditions(self, conditions:ConditionList,
+                          num_steps:int=None) -> 'DataportArrays':
+        """
+        Returns the data of the conditions, in the order of the conditions.
+        Same as filter_data_for_condition in the ekf simulation scripts
+
+        Keyword Arguments:
+        conditions -- list of (ramp, speed) tuples
+        num_steps -- if defined, only the first num_steps steps of every
+            condition are used
+        """
+        rows = self.get_rows(conditions, num_steps)
+
+        #Keep the columns contiguous in the new array
+        values = np.asfortranarray(self.values[rows])
+
+        return DataportArrays(self.columns, values, self._ramp[rows],
+                              self._speed[rows])
+
+
+class StrideIndex():
+    """
+    This class maps every (ramp, speed) condition of a dataport file to the
+    first row of every stride in that condition. It is built once when the
+    data is split and saved next to the parquet file, so that the data of a
+    condition can be selected with fancy indexing without looking at the 
+    ramp and speed of every row
+    """
+
+    def __init__(self, conditions:np.ndarray, offsets:np.ndarray,
+                 stride_starts:np.ndarray, 
+                 points_per_step:int=POINTS_PER_STEP):
+        """
+        Keyword Arguments:
+        conditions -- (ramp, speed) of every condition, shape(num_conditions,2)
+        offsets -- the strides of condition i are 
+            stride_starts[offsets[i]:offsets[i+1]], shape(num_conditions+1,)
+        stride_starts -- first row of every stride, shape(num_strides,)
+        points_per_step -- number of rows per stride
+        """
+        self.conditions = conditions
+        self.offsets = offsets
+        self.stride_starts = stride_starts
+        self.points_per_step = int(points_per_step)
+
+        #Dictionary to find the conditions
+        self._condition_number = {(float(ramp), float(speed)):i 
+                                  for i,(ramp, speed) in enumerate(conditions)}
+
+
+    @classmethod
+    def from_conditions(cls, ramp:np.ndarray, speed:np.ndarray,
+                        points_per_step:int=POINTS_PER_STEP) -> 'StrideIndex':
+        """
+        Build the index from the ramp and speed of every row. Rows without a 
+        condition (NaN), e.g. the fake data in the training set, are skipped
+
+        Keyword Arguments:
+        ramp -- ramp of every row
+        speed -- speed of every row
+        points_per_step -- number of rows per stride
+        """
+        condition_rows = _group_condition_rows(ramp, speed)
+
+        conditions = [condition for condition in condition_rows
+                      if not np.isnan(condition).any()]
+        
+        #Every stride starts points_per_step rows after the previous one
+        stride_start_list = [condition_rows[condition][::points_per_step]
+                             for condition in conditions]
+        offsets = np.cumsum([0] + [len(starts) 
+                                   for starts in stride_start_list])
+
+        if len(conditions) == 0:
+            stride_starts = np.empty(0, dtype=np.intp)
+        else:
+            stride_starts = np.concatenate(stride_start_list)
+
+        return cls(np.array(conditions, dtype=float).reshape(-1,2), offsets,
+                   stride_starts, points_per_step)
+
+
+    def save(self, file_name:str):
+        """
+        Save the index as a npz file
+        """
+        np.savez(file_name, conditions=self.conditions, offsets=self.offsets,
+                 stride_starts=self.stride_starts, 
+                 points_per_step=self.points_per_step)
+
+
+    @classmethod
+    def load(cls, file_name:str) -> 'StrideIndex':
+        """
+        Load an index saved with save
+        """
+        with np.load(file_name) as index_file:
+            return cls(index_file['conditions'], index_file['offsets'],
+                       index_file['stride_starts'],
+                       index_file['points_per_step'])
+
+
+    def get_stride_starts(self, ramp:float, speed:float) -> np.ndarray:
+        """
+        Returns the first row of every stride of a condition, in file order
+        """
+        i = self._condition_number.get((float(ramp), float(speed)))
+
+        if i is None:
+            return self.stride_starts[:0]
+
+        return self.stride_starts[self.offsets[i]:self.offsets[i+1]]
+
+
+    def get_rows(self, ramp:float, speed:float) -> np.ndarray:
+        """
+        Returns the rows of every stride of a condition, in file order
+        """
+        stride_starts = self.get_stride_starts(ramp, speed)
+
+        return (stride_starts[:,np.newaxis] 
+                + np.arange(self.points_per_step)).ravel()
+
+
+class DataportDataset():
+    """
+    This class loads the flattened dataport files and keeps the most
+    recently used ones in memory
+    """
+
+    def __init__(self, location:str=DATAPORT_LOCATION, cache_size:int=32):
+        """
+        Keyword Arguments:
+        location -- directory of the flattened dataport files
+        cache_size -- maximum number of loaded arrays that are kept
+        """
+        self.location = location
+        self.cache_size = cache_size
+
+        #Loaded arrays, ordered from least to most recently used
+        self._cache = OrderedDict()
+
+        #Stride index of every file, keyed by (subject, split)
+        self._stride_indices = {}
+
+
+    def get_file_name(self, subject:str, split:str) -> str:
+        """
+        Returns the file name for a subject in a split, e.g. 'training'
+        """
+        return os.path.join(self.location,
+                            SPLIT_FILE_NAMES[split].format(subject))
+
+
+    def get_stride_index_file_name(self, subject:str, split:str) -> str:
+        """
+        Returns the file name of the stride index for a subject in a split
+        """
+        return get_stride_index_file_name(self.get_file_name(subject, split))
+
+
+    def clear_cache(self):
+        """
+        Remove all the loaded arrays
+        """
+        self._cache.clear()
+        self._stride_indices.clear()
+
+
+    def load_stride_index(self, subject:str, split:str) -> StrideIndex:
+        """
+        Load the stride index that was saved when the data was split. If 
+        it does not exist or is older than the data, it is built from the
+        ramp and speed columns
+
+        Keyword Arguments:
+        subject -- subject name, e.g. 'AB01'
+        split -- 'training', 'validation' or 'partial'
+        """
+        key = (subject, split)
+
+        if key not in self._stride_indices:
+            data_file_name = self.get_file_name(subject, split)
+            index_file_name = get_stride_index_file_name(data_file_name)
+
+            if os.path.isfile(index_file_name) and \
+                    os.path.getmtime(index_file_name) >= \
+                    os.path.getmtime(data_file_name):
+                stride_index = StrideIndex.load(index_file_name)
+            else:
+                data = self.load(subject, split, [])
+                stride_index = StrideIndex.from_conditions(data._ramp,
+                                                           data._speed)
+
+            self._stride_indices[key] = stride_index
+
+        return self._stride_indices[key]
+
+
+    def load(self, subject:str, split:str, columns:List[str],
+             conditions:ConditionList=None, num_steps:int=None,
+             dtype=np.float64) -> DataportArrays:
+        """
+        Load some of the columns of a subject
+
+        If the columns of the subject are already in the cache the conditions
+        are selected from memory. Otherwise only the row groups of the
+        conditions are read from the file
+
+        Keyword Arguments:
+        subject -- subject name, e.g. 'AB01'
+        split -- 'training', 'validation' or 'partial'
+        columns -- columns that are loaded
+        conditions -- optional, list of (ramp, speed) tuples. The rows are
+            returned in the order of the conditions
+        num_steps -- if defined, only the first num_steps steps of every
+            condition are used
+        dtype -- np.float64 or np.float32
+
+        Returns:
+        DataportArrays with read only arrays. Arrays from the cache are
+            shared between calls
+        """
+        columns = tuple(columns)
+        dtype = np.dtype(dtype)
+        all_rows_key = (subject, split, columns, dtype.str)
+
+        #Select the conditions from the columns in memory
+        all_rows = self._get_cached(all_rows_key)
+        if all_rows is not None:
+            if conditions is None:
+                return all_rows
+            return all_rows.select_conditions(conditions, num_steps)
+
+        #Load all the rows and keep them for the next calls
+        if conditions is None:
+            all_rows = self._read(subject, split, columns, dtype)
+            self._add_to_cache(all_rows_key, all_rows)
+            return all_rows
+
+        #Only read the conditions that are requested
+        conditions = tuple((float(ramp), float(speed))
+                           for ramp, speed in conditions)
+        key = all_rows_key + (conditions, num_steps)
+        data = self._get_cached(key)
+
+        if data is None:
+            data = self._read(subject, split, columns, dtype, conditions)\
+                .select_conditions(conditions, num_steps)
+            self._add_to_cache(key, data)
+
+        return data
+
+
+    def _get_cached(self, key) -> DataportArrays:
+        """
+        Returns the cached arrays and marks them as recently used
+        """
+        data = self._cache.get(key)
+
+        if data is not None:
+            self._cache.move_to_end(key)
+
+        return data
+
+
+    def _add_to_cache(self, key, data:DataportArrays):
+        """
+        Add arrays to the cache, removing the least recently used ones
+        """
+        self._cache[key] = data
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+    def _read(self, subject:str, split:str, columns:Tuple[str],
+              dtype:np.dtype, conditions:ConditionList=None) \
+            -> DataportArrays:
+        """
+        Read the columns from the parquet file. With conditions, only the
+        row groups that can contain them are read
+        """
+        #Only required when reading parquet files
+        import pyarrow.parquet as pq
+
+        #The condition columns are always needed to select conditions
+        read_columns = list(columns) + [name for name in CONDITION_COLUMNS
+                                        if name not in columns]
+
+        #Filters in disjunctive normal form, one conjunction per condition
+        if conditions is not None:
+            filters = [[('ramp', '==', ramp), ('speed', '==', speed)]
+                       for ramp, speed in conditions]
+        else:
+            filters = None
+
+        table = pq.read_table(self.get_file_name(subject, split),
+                              columns=read_columns, filters=filters)
+
+        #Copy every column into its place in a column major array
+        values = np.empty((table.num_rows, len(columns)), dtype=dtype,
+                          order='F')
+        for i, name in enumerate(columns):
+            values[:,i] = table.column(name).to_numpy()
+
+        return DataportArrays(columns, values,
+                              table.column('ramp').to_numpy(),
+                              table.column('speed').to_numpy())
+
+
+def get_stride_index_file_name(data_file_name:str) -> str:
+    """
+    Returns the file name of the stride index of a parquet file, e.g.
+    dataport_flattened_validation_AB01_stride_index.npz
+    """
+    return os.path.splitext(data_file_name)[0] + "_stride_index.npz"
+
+
+def write_stride_index(dataframe:pd.DataFrame, data_file_name:str,
+                       points_per_step:int=POINTS_PER_STEP):
+    """
+    Build the stride index of a dataframe and save it next to its parquet
+    file
+
+    Keyword Arguments:
+    dataframe -- data that was saved in data_file_name
+    data_file_name -- parquet file name
+    points_per_step -- number of rows per stride
+    """
+    StrideIndex.from_conditions(dataframe['ramp'].values, 
+                                dataframe['speed'].values, points_per_step)\
+        .save(get_stride_index_file_name(data_file_name))
+
+
+def write_row_groups(dataframe:pd.DataFrame, file_name:str,
+                     row_group_lengths:List[int]):
+    """
+    Write a dataframe to a parquet file with explicit row groups, e.g. one
+    per condition, so that the row group statistics can be used to skip
+    the conditions that are not read
+
+    Keyword Arguments:
+    dataframe -- data to save
+    file_name -- parquet file name
+    row_group_lengths -- number of rows in every row group, must add up to
+        the number of rows in the dataframe
+    """
+    #Only required when writing parquet files
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if sum(row_group_lengths) != len(dataframe):
+        raise ValueError("The row groups don't add up to the dataframe length")
+
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+
+    with pq.ParquetWriter(file_name, table.schema) as writer:
+        start = 0
+        for length in row_group_lengths:
+            #Empty row groups are not written
+            if length > 0:
+                writer.write_table(table.slice(start, length),
+                                   row_group_size=length)
+            start += length
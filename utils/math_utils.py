@@ -10,39 +10,255 @@ import numpy as np
 import pandas as pd
 
 
+#Set this to false to turn off all the positive definite checks
 test_pd = True
-def assert_pd(matrix,name):
-    if test_pd:
-        try: 
-            assert (matrix.shape[0] == matrix.shape[1])
-            assert (len(matrix.shape)==2)
-        except AssertionError:
-            print(name + " NOT EVEN SQUARE: " + str(matrix.shape))
-            print("Assertion on matrix: \n{}".format(matrix))
-    
-            raise AssertionError
-    
-        try:
-            assert (np.linalg.norm(matrix-matrix.T) < 1e-7*np.linalg.norm(matrix))
-        except AssertionError:
-            print(name + " Error with norm: " + str(np.linalg.norm(matrix-matrix.T)))
-            print("Assertion on matrix: \n{}".format(matrix))
-    
-            raise AssertionError
-            
+
+#Policies to validate that a matrix is positive definite
+# off -- never check
+# every_n -- run the full check every pd_check_interval calls per name
+# on_failure -- check symmetry and try a cholesky factorization, the full
+#   eigenvalue check only runs to report a failure
+# full -- symmetry and eigenvalue check on every call
+PD_CHECK_OFF = 'off'
+PD_CHECK_EVERY_N = 'every_n'
+PD_CHECK_ON_FAILURE = 'on_failure'
+PD_CHECK_FULL = 'full'
+
+pd_check_policy = PD_CHECK_ON_FAILURE
+pd_check_interval = 100
+
+#Tolerance for the smallest eigenvalue of a positive definite matrix
+pd_tolerance = 1e-8
+
+#Counters per check name with the amount of calls, checks that ran, 
+# failures and repairs
+pd_check_counters = {}
+
+
+def set_pd_check_policy(policy, interval=None):
+    """
+    Set the policy used by check_pd and assert_pd
+
+    Keyword Arguments
+    policy -- 'off', 'every_n', 'on_failure' or 'full'
+    interval -- amount of calls between checks for the 'every_n' policy
+    """
+    global pd_check_policy, pd_check_interval
+
+    if policy not in (PD_CHECK_OFF, PD_CHECK_EVERY_N, PD_CHECK_ON_FAILURE,
+                      PD_CHECK_FULL):
+        raise ValueError(f"Unknown positive definite check policy {policy}")
+
+    pd_check_policy = policy
+
+    if interval is not None:
+        if interval < 1:
+            raise ValueError("The check interval must be at least one")
+        pd_check_interval = interval
+
+
+def get_pd_check_counters():
+    """
+    Returns a copy of the counters of every check name
+    """
+    return {name: counter.copy() for name, counter in pd_check_counters.items()}
+
+
+def reset_pd_check_counters():
+    pd_check_counters.clear()
+
+
+def _get_pd_counter(name):
+    counter = pd_check_counters.get(name)
+    if counter is None:
+        counter = {'calls': 0, 'checks': 0, 'full_checks': 0, 
+                   'failures': 0, 'repairs': 0}
+        pd_check_counters[name] = counter
+    return counter
+
+
+def _is_symmetric(matrix):
+    #Same test as norm(M - M.T) < 1e-7*norm(M) with the squared norms
+    difference = matrix - np.swapaxes(matrix,-1,-2)
+    if matrix.ndim == 2:
+        difference = difference.ravel()
+        flat_matrix = matrix.ravel()
+        return difference @ difference < 1e-14*(flat_matrix @ flat_matrix)
+
+    return np.einsum('...ij,...ij->...', difference, difference) \
+        < 1e-14*np.einsum('...ij,...ij->...', matrix, matrix)
+
+
+#Identity matrices scaled by the tolerance, keyed by size and tolerance
+_tolerance_identity = {}
+
+
+def _is_square(matrix):
+    return matrix.ndim >= 2 and matrix.shape[-1] == matrix.shape[-2]
+
+
+def _full_pd_check(matrix, name, counter):
+    """
+    Symmetry and eigenvalue check. Prints the reason of the failure
+    Returns a boolean per matrix
+    """
+    counter['full_checks'] += 1
+
+    symmetric = _is_symmetric(matrix)
+    eigenvalues = np.linalg.eigvalsh(matrix)
+    positive = np.all(eigenvalues + pd_tolerance > 0, axis=-1)
+    valid = symmetric & positive
+
+    if not np.all(valid):
+        for i in np.ndindex(valid.shape):
+            if not valid[i]:
+                index = f" in matrix {i[0]}" if len(i) > 0 else ""
+                if not symmetric[i]:
+                    asymmetry = np.linalg.norm(matrix[i]-matrix[i].T)
+                    print(name + index + " Error with norm: " + str(asymmetry))
+                else:
+                    print(name + index + " Error with Evalue: " + str(list(eigenvalues[i])))
+                print("Assertion on matrix: \n{}".format(matrix[i]))
+                break
+
+    return valid
+
+
+def _cholesky_pd_check(matrix, name, counter):
+    """
+    Symmetry check and a cholesky factorization of the matrix shifted by 
+    the tolerance. The full check only runs when that fails
+    Returns a boolean per matrix
+    """
+    symmetric = _is_symmetric(matrix)
+
+    if np.all(symmetric):
         try:
-            for e in np.linalg.eigh(matrix)[0]:
-                assert (e + 1e-8 > 0)
-        except AssertionError:
-            print(name + " Error with Evalue: " + str([e for e in np.linalg.eigh(matrix)[0]]))
-            print("Assertion on matrix: \n{}".format(matrix))
-            raise AssertionError
-        else:
-            return None 
+            key = (matrix.shape[-1], pd_tolerance)
+            if key not in _tolerance_identity:
+                _tolerance_identity[key] = pd_tolerance*np.eye(key[0])
+            np.linalg.cholesky(matrix + _tolerance_identity[key])
+            return symmetric
+        except np.linalg.LinAlgError:
+            pass
+
+    #Diagnose which matrix failed
+    return _full_pd_check(matrix, name, counter)
+
+
+def check_pd(matrix, name="matrix"):
+    """
+    Check that a matrix, or every matrix in a stack, is symmetric positive 
+    definite following pd_check_policy. Does not raise on failure
+
+    Keyword Arguments
+    matrix -- matrix with shape (n, n) or stack with shape (num_matrices, n, n)
+    name -- name that is used in the counters and error messages
+
+    Returns
+    valid -- True if the matrix passed or was not checked. For a stack, 
+             a boolean array with one entry per matrix
+    """
+    counter = _get_pd_counter(name)
+    counter['calls'] += 1
+
+    if matrix.ndim == 3:
+        valid = np.ones(matrix.shape[0], dtype=bool)
+    else:
+        valid = True
+
+    if test_pd == False or pd_check_policy == PD_CHECK_OFF:
+        return valid
+
+    if pd_check_policy == PD_CHECK_EVERY_N and \
+            (counter['calls'] - 1) % pd_check_interval != 0:
+        return valid
+
+    counter['checks'] += 1
+
+    if not _is_square(matrix):
+        print(name + " NOT EVEN SQUARE: " + str(matrix.shape))
+        counter['failures'] += 1
+        return valid & False
+
+    if pd_check_policy == PD_CHECK_ON_FAILURE:
+        valid = _cholesky_pd_check(matrix, name, counter)
     else:
-        #print("Assertions turned off")  
-        pass 
+        valid = _full_pd_check(matrix, name, counter)
+
+    if not np.all(valid):
+        counter['failures'] += 1
+
+    return valid
+
+
+def assert_pd(matrix,name):
+    """
+    Raise AssertionError if the matrix is not positive definite, 
+    see check_pd
+    """
+    if not np.all(check_pd(matrix, name)):
+        raise AssertionError(f"{name} is not positive definite")
+
+
+def assert_pd_batch(matrices,name):
+    """
+    Vectorized version of assert_pd for a stack of matrices 
+    with shape (num_matrices, n, n)
+    """
+    if matrices.ndim != 3:
+        print(name + " NOT EVEN SQUARE: " + str(matrices.shape))
+        raise AssertionError
+
+    assert_pd(matrices, name)
+
+
+def nearest_pd(matrix, name=None, min_eigenvalue=None):
+    """
+    Returns the nearest symmetric positive definite matrix by symmetrizing 
+    and clipping the eigenvalues
+
+    Keyword Arguments
+    matrix -- matrix with shape (n, n) or stack with shape (num_matrices, n, n)
+    name -- if defined, the repair is recorded in the counter for that name
+    min_eigenvalue -- smallest eigenvalue of the result, defaults to 
+                      pd_tolerance
+    """
+    if min_eigenvalue is None:
+        min_eigenvalue = pd_tolerance
+
+    if name is not None:
+        _get_pd_counter(name)['repairs'] += 1
+
+    symmetric = (matrix + np.swapaxes(matrix,-1,-2))/2
+    eigenvalues, eigenvectors = np.linalg.eigh(symmetric)
+    eigenvalues = np.clip(eigenvalues, min_eigenvalue, None)
+    repaired = (eigenvectors * eigenvalues[...,np.newaxis,:]) \
+               @ np.swapaxes(eigenvectors,-1,-2)
+
+    return (repaired + np.swapaxes(repaired,-1,-2))/2
+
+
+def covariance_sqrt(matrix):
+    """
+    Returns a lower triangular factor L such that L @ L.T = matrix
+
+    Positive semi-definite matrices, e.g. process noise with zero variance 
+    states, do not have a cholesky factorization. In that case the factor 
+    is calculated from the eigendecomposition with the negative eigenvalues 
+    clipped to zero and then triangularized with a QR decomposition
 
+    Keyword Arguments
+    matrix -- symmetric positive semi-definite matrix, shape (n, n) 
+              or stacked as shape (num_matrices, n, n)
+    """
+    try:
+        return np.linalg.cholesky(matrix)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+        factor = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))[...,np.newaxis,:]
+        #L.T is the R in the QR decomposition of factor.T
+        return np.swapaxes(np.linalg.qr(np.swapaxes(factor,-1,-2), mode='r'),-1,-2)
 
 
 def get_mean_std_dev(np_array):
@@ -0,0 +1,206 @@
+"""
+This file implements local sinks for the results of the ekf simulations
+
+A run is one execution of a simulation script. It has a dictionary of
+metadata, e.g. the experiment name and the noise parameters, and a dataframe
+of results, e.g. the rmse of every subject. Every run is written in one
+batch, so the simulation never waits on a network round trip per row. The
+runs can be exported to other places, e.g. google sheets, separately
+
+E.g.
+    sink = create_results_sink('ekf_simulation_results.db')
+    sink.write_run(test_id, {'Experiment': 'Average Model'}, results)
+    metadata, results = sink.read_run(test_id)
+"""
+
+#Common imports
+import os
+import json
+import time
+import sqlite3
+import pandas as pd
+
+#Relative imports
+from .sweep_runner import to_json_compatible
+
+#For docstring
+from typing import Dict, List, Tuple
+
+
+class ResultsSink():
+    """
+    This class defines the interface of the results sinks
+    """
+
+    def write_run(self, run_id : int, metadata : Dict,
+                  results : pd.DataFrame):
+        """
+        Store the metadata and results of a run. A run with the same id is
+        replaced
+
+        Keyword Arguments:
+        run_id -- identifier of the run, e.g. the test id
+        metadata -- dictionary with json serializable values
+        results -- dataframe with one row per result
+        """
+        raise NotImplementedError
+
+
+    def read_run(self, run_id : int) -> Tuple[Dict, pd.DataFrame]:
+        """
+        Returns the metadata and results of a run
+        """
+        raise NotImplementedError
+
+
+    def get_run_ids(self) -> List[int]:
+        """
+        Returns the ids of the stored runs in the order they were written
+        """
+        raise NotImplementedError
+
+
+    def read_runs(self) -> pd.DataFrame:
+        """
+        Returns the results of every run with the run id and the metadata
+        as extra columns
+        """
+        runs = []
+        for run_id in self.get_run_ids():
+            metadata, results = self.read_run(run_id)
+            results = results.copy()
+            for key, value in metadata.items():
+                results[key] = value if not isinstance(value, (list, dict)) \
+                    else json.dumps(value)
+            results['run_id'] = run_id
+            runs.append(results)
+
+        if len(runs) == 0:
+            return pd.DataFrame()
+        return pd.concat(runs, ignore_index=True)
+
+
+
+class SQLiteResultsSink(ResultsSink):
+    """
+    Stores every run in an sqlite file. The metadata and the result rows are
+    stored as json so that runs can have different columns
+    """
+
+    def __init__(self, file_name : str):
+        self.file_name = file_name
+        with sqlite3.connect(file_name) as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS runs (
+                       run_id INTEGER PRIMARY KEY,
+                       metadata TEXT NOT NULL,
+                       results TEXT NOT NULL,
+                       written_at REAL)""")
+        connection.close()
+
+
+    def write_run(self, run_id : int, metadata : Dict,
+                  results : pd.DataFrame):
+        results_json = json.dumps(
+            to_json_compatible(results.to_dict(orient='split')))
+
+        #One transaction per run
+        with sqlite3.connect(self.file_name) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)",
+                (int(run_id), json.dumps(to_json_compatible(metadata)),
+                 results_json, time.time()))
+        connection.close()
+
+
+    def read_run(self, run_id : int) -> Tuple[Dict, pd.DataFrame]:
+        with sqlite3.connect(self.file_name) as connection:
+            row = connection.execute(
+                "SELECT metadata, results FROM runs WHERE run_id = ?",
+                (int(run_id),)).fetchone()
+        connection.close()
+
+        if row is None:
+            raise KeyError(f"Run {run_id} is not in {self.file_name}")
+
+        results = json.loads(row[1])
+        return json.loads(row[0]), pd.DataFrame(results['data'],
+                                                columns=results['columns'])
+
+
+    def get_run_ids(self) -> List[int]:
+        with sqlite3.connect(self.file_name) as connection:
+            run_ids = [row[0] for row in connection.execute(
+                "SELECT run_id FROM runs ORDER BY written_at")]
+        connection.close()
+        return run_ids
+
+
+
+class ParquetResultsSink(ResultsSink):
+    """
+    Stores every run in its own folder with the results as a parquet file and
+    the metadata as a json file
+    """
+
+    #File names inside the folder of every run
+    RESULTS_FILE_NAME = "results.parquet"
+    METADATA_FILE_NAME = "metadata.json"
+
+    def __init__(self, location : str):
+        self.location = location
+        os.makedirs(location, exist_ok=True)
+
+
+    def _get_run_location(self, run_id : int) -> str:
+        return os.path.join(self.location, f"run_id={int(run_id)}")
+
+
+    def write_run(self, run_id : int, metadata : Dict,
+                  results : pd.DataFrame):
+        run_location = self._get_run_location(run_id)
+        os.makedirs(run_location, exist_ok=True)
+
+        results.to_parquet(os.path.join(run_location,
+                                        self.RESULTS_FILE_NAME))
+
+        #The metadata is written last so that a run without metadata is
+        # known to be incomplete
+        with open(os.path.join(run_location, self.METADATA_FILE_NAME),
+                  'w') as metadata_file:
+            json.dump(to_json_compatible(metadata), metadata_file, indent=2)
+
+
+    def read_run(self, run_id : int) -> Tuple[Dict, pd.DataFrame]:
+        run_location = self._get_run_location(run_id)
+
+        with open(os.path.join(run_location, self.METADATA_FILE_NAME)) \
+                as metadata_file:
+            metadata = json.load(metadata_file)
+
+        return metadata, pd.read_parquet(os.path.join(run_location,
+                                                      self.RESULTS_FILE_NAME))
+
+
+    def get_run_ids(self) -> List[int]:
+        run_ids = []
+        for folder in os.listdir(self.location):
+            metadata_file_name = os.path.join(self.location, folder,
+                                              self.METADATA_FILE_NAME)
+            if folder.startswith("run_id=") \
+                    and os.path.exists(metadata_file_name):
+                run_ids.append((os.path.getmtime(metadata_file_name),
+                                int(folder[len("run_id="):])))
+
+        return [run_id for _, run_id in sorted(run_ids)]
+
+
+
+def create_results_sink(location : str) -> ResultsSink:
+    """
+    Create the sink based on the location. Files that end in .db or .sqlite
+    use sqlite and everything else is a folder of parquet files
+    """
+    if location.endswith(('.db', '.sqlite')):
+        return SQLiteResultsSink(location)
+    return ParquetResultsSink(location)
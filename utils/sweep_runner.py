@@ -0,0 +1,267 @@
+"""
+This file implements a runner for experiment sweeps, e.g. every task
+constraint x subject x measurement model of the ekf simulations
+
+A sweep is defined as a grid of parameter values. The grid is expanded into
+one job per combination and every job is identified by the hash of its
+parameters. The jobs run in a process pool and every result is committed to
+an append only sqlite store as soon as it arrives, so a crash only loses the
+jobs that are running and a restart skips the jobs that are already in the
+store
+
+E.g.
+    def run_job(job):
+        rmse = simulate(job['subject'], job['model_type'])
+        return {'phase': rmse[0], 'ramp': rmse[3]}
+
+    #The job function has to be importable by the worker processes, so the
+    # sweep is started inside the main guard
+    if __name__ == '__main__':
+        jobs = expand_grid({'subject': ['AB01','AB02'],
+                            'model_type': ['NLS','ISA']})
+        with SweepResultStore('sweep.db') as store:
+            run_sweep(run_job, jobs, store)
+            results = store.to_dataframe()
+"""
+
+#Common imports
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import traceback
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#For docstring
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+
+def expand_grid(grid : Dict[str, Sequence]) -> List[Dict]:
+    """
+    Create one job for every combination of the grid values
+
+    Keyword Arguments:
+    grid -- dictionary with the parameter name and the list of values of
+        every parameter. The last parameter changes the fastest
+
+    Returns:
+    jobs -- list of dictionaries with one value of every parameter
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*grid.values())]
+
+
+def to_json_compatible(value : Any) -> Any:
+    """
+    Convert tuples and numpy types to the json types so that jobs that are
+    equal have the same json string
+    """
+    if isinstance(value, dict):
+        return {str(key): to_json_compatible(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_json_compatible(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _to_json(value : Any) -> str:
+    return json.dumps(to_json_compatible(value), sort_keys=True)
+
+
+def job_hash(job : Dict) -> str:
+    """
+    Returns the hash that identifies a job. It only depends on the parameter
+    names and values, not on their order
+    """
+    return hashlib.sha1(_to_json(job).encode()).hexdigest()
+
+
+class SweepResultStore():
+    """
+    This class stores the results of a sweep in an sqlite file with one row
+    per job. Rows are only added, never modified, and every row is committed
+    when it is added
+    """
+
+    def __init__(self, file_name : str):
+        """
+        Open the store, the file is created if it does not exist
+
+        Keyword Arguments:
+        file_name -- sqlite file of the store
+        """
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS results (
+                   job_hash TEXT PRIMARY KEY,
+                   job TEXT NOT NULL,
+                   result TEXT,
+                   error TEXT,
+                   elapsed_time REAL,
+                   finished_at REAL)""")
+        self.connection.commit()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+
+    def get_finished_hashes(self, include_failed : bool = True) -> set:
+        """
+        Returns the hashes of the jobs that are in the store
+
+        Keyword Arguments:
+        include_failed -- if false, the jobs that raised an exception are
+            not included so that they run again
+        """
+        query = "SELECT job_hash FROM results"
+        if not include_failed:
+            query += " WHERE error IS NULL"
+        return {row[0] for row in self.connection.execute(query)}
+
+
+    def add_result(self, job : Dict, result : Dict = None, error : str = None,
+                   elapsed_time : float = None):
+        """
+        Add the result of a job. A job that is already in the store is
+        replaced, e.g. when a failed job runs again
+
+        Keyword Arguments:
+        job -- parameters of the job
+        result -- dictionary with the outputs of the job
+        error -- traceback of the job if it raised an exception
+        elapsed_time -- run time of the job in seconds
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (job_hash(job), _to_json(job),
+             None if result is None else _to_json(result),
+             error, elapsed_time, time.time()))
+        self.connection.commit()
+
+
+    def to_dataframe(self, include_failed : bool = False) -> pd.DataFrame:
+        """
+        Returns a dataframe with one row per job and one column per job
+        parameter and per result, plus the job hash, error and elapsed time
+
+        Keyword Arguments:
+        include_failed -- if true, the jobs that raised an exception are
+            included with empty results
+        """
+        query = "SELECT job_hash, job, result, error, elapsed_time " \
+                "FROM results"
+        if not include_failed:
+            query += " WHERE error IS NULL"
+        query += " ORDER BY finished_at"
+
+        rows = []
+        for hash_value, job, result, error, elapsed_time \
+                in self.connection.execute(query):
+            row = json.loads(job)
+            if result is not None:
+                row.update(json.loads(result))
+            row.update({'job_hash': hash_value, 'error': error,
+                        'elapsed_time': elapsed_time})
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+
+
+def _run_job(job_function : Callable, job : Dict) \
+        -> Tuple[Dict, str, float]:
+    """
+    Run a job and catch its exception so that one failed job does not stop
+    the sweep
+    """
+    start = time.perf_counter()
+    try:
+        result, error = job_function(job), None
+    except Exception:
+        result, error = None, traceback.format_exc()
+    return result, error, time.perf_counter() - start
+
+
+def run_sweep(job_function : Callable, jobs : List[Dict],
+              store : SweepResultStore, num_processes : int = None,
+              retry_failed : bool = False, initializer : Callable = None,
+              initargs : tuple = ()) -> int:
+    """
+    Run every job that is not in the store with a process pool and add the
+    results to the store as they finish
+
+    Keyword Arguments:
+    job_function -- function that receives a job and returns a dictionary
+        with its results. It has to be defined at the module level so that
+        the worker processes can import it
+    jobs -- list of jobs, e.g. from expand_grid
+    store -- store with the finished jobs
+    num_processes -- amount of worker processes. Defaults to the number of
+        cores. With one process the jobs run in this process
+    retry_failed -- if true, the jobs that raised an exception run again
+    initializer -- optional function that runs once in every worker
+        process, e.g. to load data that is shared by many jobs
+    initargs -- arguments of the initializer
+
+    Returns:
+    num_jobs -- amount of jobs that were run
+    """
+    finished_hashes = store.get_finished_hashes(include_failed=not retry_failed)
+
+    #Remove the finished jobs and the duplicated jobs
+    pending_jobs = {}
+    for job in jobs:
+        hash_value = job_hash(job)
+        if hash_value not in finished_hashes:
+            pending_jobs.setdefault(hash_value, job)
+    pending_jobs = list(pending_jobs.values())
+
+    num_jobs = len(pending_jobs)
+    print(f"Running {num_jobs} jobs, skipping "
+          f"{len(jobs) - num_jobs} finished jobs")
+
+    if num_processes is None:
+        num_processes = os.cpu_count()
+
+    def add_result(job_index, job, result, error, elapsed_time):
+        store.add_result(job, result, error, elapsed_time)
+        status = "failed" if error is not None else "done"
+        print(f"Job {job_index + 1}/{num_jobs} {status} in "
+              f"{elapsed_time:.1f}s -- {job}")
+        if error is not None:
+            print(error)
+
+    #Don't pay for the pool if there is nothing to parallelize
+    if num_processes == 1 or num_jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job_index, job in enumerate(pending_jobs):
+            add_result(job_index, job, *_run_job(job_function, job))
+        return num_jobs
+
+    with ProcessPoolExecutor(min(num_processes, num_jobs),
+                             initializer=initializer,
+                             initargs=initargs) as executor:
+        futures = {executor.submit(_run_job, job_function, job): job
+                   for job in pending_jobs}
+
+        #Only the main process writes to the store
+        for job_index, future in enumerate(as_completed(futures)):
+            add_result(job_index, futures[future], *future.result())
+
+    return num_jobs